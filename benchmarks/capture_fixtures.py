@@ -0,0 +1,31 @@
+# Captures live coinmarketcap listing / coin pages into tests/fixtures (used instead of the synthetic_*.html pages, which were built to match the current json paths and selectors without network access) and checks every backend parses them
+# python benchmarks/capture_fixtures.py [--page 1] [--coin bitcoin]
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository root, like tests/conftest.py
+from speterlin_crypto import module1 as crypto
+from parse_benchmark import fixtures_path, coins_markets_page_file, coin_data_page_file, check_backends_agree
+
+headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10 7 4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.98 Safari/537.36'} # same as get_coins_markets_coinmarketcap
+
+def capture_pages(page=1, coin='bitcoin'): # returns [listing html, coin html], raises if a page can't be fetched or a backend finds nothing
+    coins_markets_html = crypto._http_request('https://www.coinmarketcap.com/?page=' + str(page), headers=headers).text
+    coin_data_html = crypto._http_request('https://www.coinmarketcap.com/currencies/' + coin, headers=headers).text
+    for backend in crypto.html_parse_backends:
+        if not crypto.parse_coins_markets_coinmarketcap_page(coins_markets_html, backends=[backend]):
+            raise ValueError("No coins markets rows parsed with backend: " + backend)
+    return [coins_markets_html, coin_data_html]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--coin', default='bitcoin')
+    args = parser.parse_args()
+    coins_markets_html, coin_data_html = capture_pages(page=args.page, coin=args.coin)
+    coins_markets, coin_data = check_backends_agree(coins_markets_html, coin_data_html, crypto.html_parse_backends)
+    for file_name, html in [[coins_markets_page_file, coins_markets_html], [coin_data_page_file, coin_data_html]]:
+        with open(os.path.join(fixtures_path, file_name), 'w') as f:
+            f.write(html)
+    print("Captured " + str(len(coins_markets[crypto.html_parse_backends[0]])) + " coins and " + str(len(coin_data[crypto.html_parse_backends[0]])) + " coin data fields into " + fixtures_path)
@@ -0,0 +1,48 @@
+# Import time of speterlin_crypto.module1 in fresh interpreters (python -X importtime, cumulative us of the module) and which heavy optional stacks the import pulls in (should be none, they're imported on first use)
+# python benchmarks/import_benchmark.py [--repeat 5] [--top 15]
+import argparse
+import os
+import subprocess
+import sys
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+heavy_modules = ['binance', 'kucoin', 'twilio', 'pycoingecko', 'pytrends', 'bs4', 'lxml', 'aiohttp', 'asyncio', 'websockets']
+
+def _importtime(module): # [{'module', 'self', 'cumulative', 'depth'}, ...] (seconds) from one fresh interpreter, and the heavy modules loaded
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([package_path] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import sys, ' + module + '; print(",".join(name for name in ' + repr(heavy_modules) + ' if name in sys.modules))'], env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append({'module': name.strip(), 'self': int(self_us)/1e6, 'cumulative': int(cumulative_us)/1e6, 'depth': (len(name) - len(name.lstrip()) - 1)//2})
+    return [rows, [name for name in proc.stdout.strip().split(',') if name]]
+
+def _direct_imports(rows, module): # imports made by module itself (importtime lists children before their parent, one level deeper)
+    idx = next(idx for idx, row in enumerate(rows) if row['module'] == module)
+    children, depth = [], rows[idx]['depth']
+    for row in reversed(rows[:idx]):
+        if row['depth'] <= depth:
+            break
+        if row['depth'] == depth + 1:
+            children.append(row)
+    return children
+
+def measure_import_time(module='speterlin_crypto.module1', repeat=5): # returns [times (cumulative s per run), heavy modules loaded, module's direct imports of the last run sorted by cumulative s]
+    times, heavy_loaded, rows = [], [], []
+    for _ in range(repeat):
+        rows, heavy_loaded = _importtime(module)
+        times.append(next(row['cumulative'] for row in rows if row['module'] == module))
+    return [times, heavy_loaded, sorted(_direct_imports(rows, module), key=lambda row: -row['cumulative'])]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='speterlin_crypto.module1')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+    times, heavy_loaded, top_imports = measure_import_time(args.module, args.repeat)
+    print("import " + args.module + ": min " + str(round(min(times)*1000, 1)) + " ms, first " + str(round(times[0]*1000, 1)) + " ms (" + str(len(times)) + " runs), heavy modules loaded: " + (", ".join(heavy_loaded) if heavy_loaded else "none"))
+    for row in top_imports[:args.top]:
+        print(row['module'].ljust(40) + str(round(row['cumulative']*1000, 1)).rjust(8) + " ms")
@@ -0,0 +1,57 @@
+# Parse throughput of coinmarketcap listing / coin pages per backend (pages/s), checks backends agree before timing
+# python benchmarks/parse_benchmark.py [--repeat 20]
+# pages captured from coinmarketcap with benchmarks/capture_fixtures.py if there are any, else the synthetic pages (built to match the current json paths / selectors, not real coinmarketcap markup)
+import argparse
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository root, like tests/conftest.py (no pip install -e . needed)
+from speterlin_crypto import module1 as crypto
+
+fixtures_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'fixtures') # shared with tests/test_coinmarketcap_parse.py
+coins_markets_page_file, coin_data_page_file = 'coinmarketcap_listing_page.html', 'coinmarketcap_coin_page.html' # captured pages, synthetic ones are prefixed 'synthetic_'
+
+def page_path(file_name): # captured page if there is one else the synthetic one
+    return os.path.join(fixtures_path, file_name) if os.path.exists(os.path.join(fixtures_path, file_name)) else os.path.join(fixtures_path, 'synthetic_' + file_name)
+
+def _close(a, b, rel_tol=0.01): # selectors read display values (e.g. '1.79%', '19.8M') so allow rounding vs embedded json
+    return (math.isnan(a) and math.isnan(b)) or math.isclose(a, b, rel_tol=rel_tol)
+
+def check_backends_agree(coins_markets_html, coin_data_html, backends):
+    coins_markets = {backend: {coin_id: market_data for coin_id, market_data in crypto.parse_coins_markets_coinmarketcap_page(coins_markets_html, backends=[backend]) if coin_id != 'coinmarketcap-20-index'} for backend in backends} # index row only in html table
+    coin_data = {backend: crypto.parse_coin_data_coinmarketcap_page(coin_data_html, coin='bitcoin', backends=[backend]) for backend in backends}
+    base = backends[0]
+    for backend in backends[1:]:
+        if list(coins_markets[backend]) != list(coins_markets[base]):
+            raise AssertionError("Coins markets order / coins differ: " + base + " vs " + backend)
+        for coin_id, market_data in coins_markets[base].items():
+            if market_data['symbol'] != coins_markets[backend][coin_id]['symbol'] or not all(_close(market_data[key], coins_markets[backend][coin_id][key]) for key in ['price', 'market_cap', 'volume_24h', 'circulating_supply']):
+                raise AssertionError("Coins markets differ for coin: " + coin_id + " " + base + " vs " + backend)
+        if set(coin_data[backend]) != set(coin_data[base]) or not all(_close(value, coin_data[backend][key]) for key, value in coin_data[base].items()):
+            raise AssertionError("Coin data differ: " + base + " vs " + backend)
+    return [coins_markets, coin_data]
+
+def time_backend(parse, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse()
+    return repeat / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    with open(page_path(coins_markets_page_file)) as f:
+        coins_markets_html = f.read()
+    with open(page_path(coin_data_page_file)) as f:
+        coin_data_html = f.read()
+    print("Pages: " + page_path(coins_markets_page_file) + ", " + page_path(coin_data_page_file))
+    backends = crypto.html_parse_backends
+    coins_markets, coin_data = check_backends_agree(coins_markets_html, coin_data_html, backends)
+    print("Backends agree: " + ", ".join(backends) + " (" + str(len(coins_markets[backends[0]])) + " coins, " + str(len(coin_data[backends[0]])) + " coin data fields)")
+    for backend in backends:
+        coins_markets_rate = time_backend(lambda: crypto.parse_coins_markets_coinmarketcap_page(coins_markets_html, backends=[backend]), args.repeat)
+        coin_data_rate = time_backend(lambda: crypto.parse_coin_data_coinmarketcap_page(coin_data_html, coin='bitcoin', backends=[backend]), args.repeat)
+        print(backend.ljust(12) + "listing: " + str(round(coins_markets_rate, 1)).rjust(8) + " pages/s, coin: " + str(round(coin_data_rate, 1)).rjust(8) + " pages/s")
@@ -0,0 +1,151 @@
+# Import time (benchmarks/import_benchmark.py) and backtest and live hot path timings on synthetic markets (tests/synthetic_market.py) at several scales, results saved as JSON (benchmarks/results/<commit>.json) to compare between commits
+# python benchmarks/run_benchmarks.py [--scales small,medium] [--repeat 3] [--output results.json] [--compare benchmarks/results/<base commit>.json]
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository root, like tests/conftest.py (no pip install -e . needed)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from speterlin_crypto import module1 as crypto
+from import_benchmark import measure_import_time
+from parse_benchmark import page_path, coins_markets_page_file, coin_data_page_file
+from tests.synthetic_market import generate_market, new_portfolio
+
+benchmarks_path = os.path.dirname(os.path.abspath(__file__))
+scales = { # coins x days of synthetic market, open positions (balance / usdt_invest) and CMC pages parsed
+    'small': {'coins': 100, 'days': 60, 'positions': 10, 'listing_pages': 1, 'coin_pages': 10},
+    'medium': {'coins': 300, 'days': 180, 'positions': 30, 'listing_pages': 10, 'coin_pages': 100},
+    'large': {'coins': 1000, 'days': 365, 'positions': 100, 'listing_pages': 10, 'coin_pages': 1000},
+}
+
+def reset_module_caches(): # cold start per scale (coins are named the same in every scale)
+    crypto._coin_granular_store.clear()
+    crypto._coins_history_cache.clear()
+    crypto.coin_history_cache['memory'].clear()
+    crypto.portfolio_journal['state'].clear()
+    if crypto.coin_history_cache['db'] is not None:
+        crypto.coin_history_cache['db'].close()
+        crypto.coin_history_cache['db'] = None
+
+def time_call(func, setup=None, repeat=3): # func(setup()) repeat times, setup not timed, returns [times, last result]
+    times, result = [], None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        with contextlib.redirect_stdout(io.StringIO()): # module prints every trade / error
+            start = time.perf_counter()
+            result = func(*args)
+            times.append(time.perf_counter() - start)
+    return [times, result]
+
+def result_row(benchmark, scale, times, **params):
+    return {'benchmark': benchmark, 'scale': scale, 'params': params, 'times': times, 'first': times[0], 'min': min(times), 'median': statistics.median(times)}
+
+def run_scale(scale, repeat):
+    config, results = scales[scale], []
+    market = generate_market(config['coins'], config['days'])
+    start_day, end_day, kucoin_pairs = market['start_day'], market['end_day'], market['kucoin_pairs']
+    mid_day = start_day + timedelta(days=config['days'] // 2)
+    portfolio = new_portfolio(start_day, balance=1000*config['positions'])
+    reset_module_caches() # first run_portfolio_rr reads everything from disk
+    for benchmark, func in [('run_portfolio_rr', lambda: crypto.run_portfolio_rr(copy.deepcopy(portfolio), start_day=start_day, end_day=end_day, paper_trading=True, back_testing=True, kucoin_pairs_with_price_and_vol_current=kucoin_pairs)), ('run_portfolio_rr_backtest', lambda: crypto.run_portfolio_rr_backtest(copy.deepcopy(portfolio), start_day=start_day, end_day=end_day, kucoin_pairs_with_price_and_vol_current=kucoin_pairs))]:
+        times, portfolio_end = time_call(func, repeat=repeat)
+        results.append(result_row(benchmark, scale, times, coins=config['coins'], days=config['days'], sold=len(portfolio_end['sold']), open=len(portfolio_end['open'])))
+    with contextlib.redirect_stdout(io.StringIO()):
+        portfolio_mid = crypto.run_portfolio_rr(copy.deepcopy(portfolio), start_day=start_day, end_day=mid_day, paper_trading=True, back_testing=True, kucoin_pairs_with_price_and_vol_current=kucoin_pairs)
+    stop_day = mid_day + timedelta(days=1)
+    times, _ = time_call(lambda portfolio_copy: crypto.update_portfolio_postions_back_testing(portfolio_copy, stop_day=stop_day, end_day=end_day, kucoin_pairs_with_price_and_vol_current=kucoin_pairs), setup=lambda: (copy.deepcopy(portfolio_mid),), repeat=repeat)
+    results.append(result_row('update_portfolio_postions_back_testing', scale, times, open=len(portfolio_mid['open'])))
+    df_coins = crypto.get_saved_coins_data(stop_day.strftime('%Y-%m-%d'))
+    coins_to_buy, coins_to_sell = [[coin, 10.0] for coin in df_coins.index if coin not in portfolio_mid['open'].index][:config['positions']], [[coin, -10.0] for coin in portfolio_mid['open'].index]
+    times, _ = time_call(lambda portfolio_copy: crypto.update_portfolio_buy_and_sell_coins(portfolio_copy, coins_to_buy=coins_to_buy, coins_to_sell=coins_to_sell, stop_day=stop_day, end_day=end_day, paper_trading=True, back_testing=True, kucoin_pairs_with_price_and_vol_current=kucoin_pairs), setup=lambda: (dict(copy.deepcopy(portfolio_mid), balance={'usdt': 1000.0*len(coins_to_buy)}),), repeat=repeat)
+    results.append(result_row('update_portfolio_buy_and_sell_coins', scale, times, buy=len(coins_to_buy), sell=len(coins_to_sell)))
+    portfolio_large = copy.deepcopy(portfolio_end) # sold rows repeated so roi / backups have realistic (years of trading) sizes
+    portfolio_large['sold'] = pd.concat([portfolio_end['sold']]*max(1, (100*config['positions']) // max(1, len(portfolio_end['sold']))), ignore_index=True)
+    times, _ = time_call(lambda portfolio_copy: crypto.portfolio_calculate_roi(portfolio_copy, sold_positions=True), setup=lambda: (copy.deepcopy(portfolio_large),), repeat=repeat)
+    results.append(result_row('portfolio_calculate_roi', scale, times, open=len(portfolio_large['open']), sold=len(portfolio_large['sold'])))
+    times, _ = time_call(lambda: crypto.save_portfolio_backup(portfolio_large, snapshot=True), repeat=repeat)
+    results.append(result_row('save_portfolio_backup (snapshot)', scale, times, open=len(portfolio_large['open']), sold=len(portfolio_large['sold'])))
+    def _change_and_save(): # one cycle's worth of changes (current prices) appended to the journal
+        portfolio_large['open']['current_price(btc)'] = portfolio_large['open']['current_price(btc)']*1.001
+        return crypto.save_portfolio_backup(portfolio_large)
+    times, _ = time_call(_change_and_save, repeat=repeat)
+    results.append(result_row('save_portfolio_backup (journal)', scale, times, open=len(portfolio_large['open']), sold=len(portfolio_large['sold'])))
+    portfolio_name = max(file_name for file_name in os.listdir('data/crypto/saved_portfolio_backups/') if file_name.endswith('.pckl'))[:-len('.pckl')]
+    times, _ = time_call(lambda: crypto.get_saved_portfolio_backup(portfolio_name), repeat=repeat)
+    results.append(result_row('get_saved_portfolio_backup', scale, times, open=len(portfolio_large['open']), sold=len(portfolio_large['sold'])))
+    with open(page_path(coins_markets_page_file)) as f:
+        coins_markets_html = f.read()
+    with open(page_path(coin_data_page_file)) as f:
+        coin_data_html = f.read()
+    times, _ = time_call(lambda: [crypto.parse_coins_markets_coinmarketcap_page(coins_markets_html) for _ in range(config['listing_pages'])], repeat=repeat)
+    results.append(result_row('parse_coins_markets_coinmarketcap_page', scale, times, pages=config['listing_pages']))
+    times, _ = time_call(lambda: [crypto.parse_coin_data_coinmarketcap_page(coin_data_html, coin='bitcoin') for _ in range(config['coin_pages'])], repeat=repeat)
+    results.append(result_row('parse_coin_data_coinmarketcap_page', scale, times, pages=config['coin_pages']))
+    return results
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchmarks_path, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=benchmarks_path, capture_output=True, text=True, check=True).stdout.strip())
+        return [commit, dirty]
+    except Exception:
+        return [None, None]
+
+def compare_results(base, new, threshold=0.1): # min time ratio new / base per (benchmark, scale), flags changes beyond threshold
+    base_times = {(row['benchmark'], row['scale']): row['min'] for row in base['results']}
+    rows = []
+    for row in new['results']:
+        key = (row['benchmark'], row['scale'])
+        if key in base_times:
+            ratio = row['min'] / base_times[key] if base_times[key] else float("NaN")
+            rows.append({'benchmark': row['benchmark'], 'scale': row['scale'], 'base': base_times[key], 'new': row['min'], 'ratio': ratio, 'change': 'slower' if ratio > 1 + threshold else 'faster' if ratio < 1 - threshold else ''})
+    return pd.DataFrame(rows)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', default='small,medium')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None) # default benchmarks/results/<commit>.json
+    parser.add_argument('--compare', default=None) # results json of a previous commit
+    parser.add_argument('--threshold', type=float, default=0.2) # small (ms) timings vary ~10-20% between runs
+    args = parser.parse_args()
+    commit, dirty = git_commit()
+    output = os.path.abspath(args.output if args.output else os.path.join(benchmarks_path, 'results', (commit if commit else 'results') + ('-dirty' if dirty else '') + '.json'))
+    compare = os.path.abspath(args.compare) if args.compare else None
+    results = {'meta': {'commit': commit, 'dirty': dirty, 'time': pd.Timestamp.now().isoformat(), 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__, 'platform': platform.platform(), 'repeat': args.repeat}, 'results': []}
+    times, heavy_loaded, _ = measure_import_time(repeat=args.repeat) # fresh interpreters, so before anything below warms caches
+    results['results'].append(result_row('import speterlin_crypto.module1', 'import', times, heavy_modules_loaded=heavy_loaded))
+    cwd = os.getcwd()
+    crypto.instrumentation['enabled'] = False # not measuring the measurement
+    for scale in args.scales.split(','):
+        with tempfile.TemporaryDirectory() as path:
+            os.chdir(path) # module reads / writes data/crypto/... relative to the current directory
+            crypto.set_offline_mode('replay', path=os.path.join(path, 'offline.sqlite')) # nothing recorded, so any fetch the benchmarks would make fails fast instead of going to the network
+            try:
+                start = time.perf_counter()
+                results['results'].extend(run_scale(scale, args.repeat))
+                print(scale + " done in " + str(round(time.perf_counter() - start, 1)) + "s")
+            finally:
+                crypto.set_offline_mode(None)
+                reset_module_caches()
+                os.chdir(cwd)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(pd.DataFrame(results['results'])[['benchmark', 'scale', 'first', 'min', 'median']].to_string(index=False) + "\nSaved: " + output)
+    if compare:
+        with open(compare) as f:
+            print(compare_results(json.load(f), results, threshold=args.threshold).to_string(index=False))
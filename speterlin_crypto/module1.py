@@ -4,75 +4,534 @@ import json
 import re # from collections import Counter
 import math
 import os # os.getcwd() # os.chdir()
-from collections import Counter
+import threading
+import sqlite3
+import copy
+import itertools
+import sys
+import importlib
+import importlib.util
+import pickle
+import hashlib
+import io
+import heapq
+import random
+import bisect
+import contextlib
+import weakref
+import cProfile
+import tracemalloc
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Third Party imports (in order of appearance then import/from)
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING # 'gzip,deflate' plus 'br' / 'zstd' if brotli / zstandard installed
 import numpy as np
-import bs4 as bs
 import pandas as pd
-from binance.exceptions import BinanceAPIException, BinanceRequestException #, BinanceWithdrawException, maybe refactor and add for executing binance_trade_coin_btc exceptions (also need logic for these) for BinanceOrderException, BinanceOrderMinAmountException, BinanceOrderMinPriceException, BinanceOrderMinTotalException, BinanceOrderUnknownSymbolException, BinanceOrderInactiveSymbolException
-from kucoin.exceptions import KucoinAPIException, KucoinRequestException
-from pycoingecko import CoinGeckoAPI
 from datetime import datetime, timedelta
-from pytrends.request import TrendReq
+# imported where used so importing the module stays light (analysis / backtests don't need the trading, notification or scraping stacks): bs4 (html parsing fallback), pytrends (_google_trends_query), pycoingecko / python-kucoin / python-binance / twilio (clients built on first use, see clients below), asyncio / websockets (streaming), pstats (profiling), process pool / shared memory (run_portfolio_rr_sweep)
+html_parse_backends = ['lxml', 'html.parser', 'json'] if importlib.util.find_spec('lxml') else ['html.parser', 'json'] # order parse_coin_data_coinmarketcap_page / parse_coins_markets_coinmarketcap_page try until one succeeds, lxml is an optional faster BeautifulSoup parser (pip install speterlin-crypto[parsing]), 'json' is last until it's checked against captured live pages (benchmarks/capture_fixtures.py), put it first for the faster parse
 
 # Local Imports
 
 __all__ = [
     "_fetch_data",
+    "get_http_stats",
+    "get_instrumentation_stats",
+    "get_metrics_prometheus",
+    "get_metrics_json_lines",
+    "profile_next_trading_cycle",
+    "set_offline_mode",
+    "get_offline_stats",
+    "RecordReplayClient",
     "trendline",
     "get_coin_data_coinmarketcap",
+    "parse_coin_data_coinmarketcap_page",
     # "get_coin_data_coingecko",
     "get_coin_data",
+    "get_coin_history_cached",
+    "get_coin_history_cache_stats",
     # "get_coin_data_granular_cg",
+    "get_coin_data_granular",
+    "update_kucoin_candles",
+    "get_kucoin_candles",
+    "get_kucoin_candle_prices_in_btc",
+    "get_kucoin_candle_price",
     # "get_coins_markets_cg",
     "get_coins_markets_coinmarketcap",
+    "parse_coins_markets_coinmarketcap_page",
     # "get_coins_markets_coingecko",
     "save_coins_data",
     "get_saved_coins_data",
+    "save_coins_history",
+    "get_saved_coins_history",
+    "migrate_saved_coins_data_to_history",
     "get_google_trends_pt",
+    "prefetch_google_trends",
+    "get_google_trends_cache_stats",
     "get_kucoin_pairs",
+    "get_kucoin_pairs_snapshot",
     "get_binance_pairs",
+    "get_instrument_registry",
+    "refresh_instrument_registry",
+    "get_instrument",
+    "get_instrument_symbol",
     "kucoin_trade_coin_usdt",
+    "kucoin_trade_coins_usdt",
     "binance_trade_coin_btc", # still being used in #retry_exchange_open_orders_in_portfolio and #retry_exchange_trade_error_or_paper_orders_in_portfolio for precautionary
     "kucoin_check_24h_vol_and_price_in_usdt",
     # "binance_check_24h_vol_and_price_in_btc",
     "exchange_check_arbitrage",
     # "kucoin_usdt_check_arbitrages",
     # "binance_btc_check_arbitrages",
+    "scan_arbitrages",
+    "start_arbitrage_scanner",
+    "get_sl_tsl_exit",
+    "PositionBook",
+    "TradeLedger",
     "update_portfolio_postions_back_testing",
     "update_portfolio_buy_and_sell_coins",
+    "get_market_cap_rank_matrix",
+    "get_market_cap_rank_change_matrix",
     "run_portfolio_rr",
+    "run_portfolio_rr_backtest",
+    "run_portfolio_rr_sweep",
     "get_kucoin_assets",
     # "get_binance_assets",
     "portfolio_align_balance_with_exchange",
     "portfolio_calculate_roi",
+    "get_portfolio_metrics",
+    "get_portfolio_equity_curve",
+    "get_portfolio_trade_stats",
     "portfolio_panic_sell",
     "retry_exchange_open_orders_in_portfolio",
     "retry_exchange_trade_error_or_paper_orders_in_portfolio",
+    "get_kucoin_ws_url",
+    "kucoin_stream_tickers",
+    "record_kucoin_ticks",
+    "start_kucoin_ticker_replay_server",
+    "portfolio_check_sl_tsl",
+    "portfolio_stream_sl_tsl",
     "portfolio_trading",
     "save_portfolio_backup",
     "get_saved_portfolio_backup",
 ]
-cg = CoinGeckoAPI()
+# record / replay of external calls so the module can run without network (reproducible performance work): _http_request (coinmarketcap, coingecko site, Kucoin REST), cg (pycoingecko), Google Trends payloads and clients wrapped in RecordReplayClient (i.e. kucoin_client), set_offline_mode('record') then set_offline_mode('replay')
+# each call is keyed by (provider, endpoint, params) and pickled into sqlite, repeated calls with the same key replay in recorded order (last one repeats), errors raised while recording replay as errors, replay can add latency (s, a number or [min, max]) and error_rate (ConnectionError) per provider ({provider: value}) from a seeded random
+offline = {'mode': None, 'path': 'data/crypto/offline_recordings/recordings.sqlite', 'latency': 0, 'error_rate': 0, 'seed': 0, 'retry_sleep': 0, 'random': random.Random(0), 'db': None, 'cursors': Counter(), 'stats': {}, 'lock': threading.Lock()} # retry_sleep replaces _fetch_data's 60s retry sleep when replaying
+
+def _offline_db():
+    if offline['db'] is None:
+        os.makedirs(os.path.dirname(offline['path']), exist_ok=True)
+        offline['db'] = sqlite3.connect(offline['path'], check_same_thread=False) # access serialized by offline['lock']
+        offline['db'].execute("CREATE TABLE IF NOT EXISTS recordings (key TEXT NOT NULL, seq INTEGER NOT NULL, provider TEXT NOT NULL, endpoint TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (key, seq))")
+    return offline['db']
+
+def set_offline_mode(mode=None, path=None, latency=0, error_rate=0, seed=0, clear=False): # mode None (live), 'record' (live calls saved to path) or 'replay' (served from path, no network), clear=True deletes previous recordings when recording, recording into a path with recordings raises ValueError (a new session's seqs would overwrite / mix with the old session's)
+    if mode not in [None, 'record', 'replay']:
+        raise ValueError("mode must be None, 'record' or 'replay'")
+    with offline['lock']:
+        previous_path = offline['path']
+        if path and (path != offline['path']):
+            if offline['db'] is not None:
+                offline['db'].close()
+                offline['db'] = None
+            offline['path'] = path
+        if (mode == 'record') and clear:
+            _offline_db().execute("DELETE FROM recordings")
+            _offline_db().commit()
+        elif (mode == 'record') and _offline_db().execute("SELECT 1 FROM recordings LIMIT 1").fetchone():
+            if offline['path'] != previous_path: # keep the current mode's recordings
+                offline['db'].close()
+                offline['db'], offline['path'] = None, previous_path
+            raise ValueError("offline recordings already in " + (path if path else previous_path) + ", record with clear=True or to a new path")
+        offline.update({'mode': mode, 'latency': latency, 'error_rate': error_rate, 'seed': seed, 'random': random.Random(seed), 'cursors': Counter(), 'stats': {}})
+    return {key: offline[key] for key in ['mode', 'path', 'latency', 'error_rate', 'seed']}
+
+def _offline_setting(name, provider):
+    return offline[name].get(provider, 0) if isinstance(offline[name], dict) else offline[name]
+
+def _offline_record(key, seq, provider, endpoint, record):
+    try:
+        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        if 'error' not in record:
+            print(str(e) + " - Not recording (can't pickle) offline response for: " + provider + " " + endpoint)
+            return
+        data = pickle.dumps({'error': RuntimeError(str(record['error']))}, protocol=pickle.HIGHEST_PROTOCOL)
+    with offline['lock']:
+        _offline_db().execute("INSERT OR REPLACE INTO recordings (key, seq, provider, endpoint, data) VALUES (?, ?, ?, ?, ?)", (key, seq, provider, endpoint, data))
+        _offline_db().commit()
+        offline['stats'].setdefault(provider, Counter())['recorded_errors' if 'error' in record else 'recorded'] += 1
+
+def _offline_call(provider, endpoint, params, func): # func() is the live call
+    mode = offline['mode']
+    if mode is None:
+        return func()
+    key = hashlib.sha1(json.dumps([provider, endpoint, params], sort_keys=True, default=str).encode()).hexdigest()
+    with offline['lock']:
+        stats = offline['stats'].setdefault(provider, Counter())
+        latency, error = (_offline_setting('latency', provider), offline['random'].random() < _offline_setting('error_rate', provider)) if mode == 'replay' else (0, False)
+        latency = offline['random'].uniform(*latency) if isinstance(latency, (list, tuple)) else latency
+        if error:
+            stats['injected_errors'] += 1
+        else: # injected errors don't use up a recording so the retry gets it
+            seq = offline['cursors'][key]
+            offline['cursors'][key] += 1
+    if mode == 'record':
+        try:
+            data = func()
+        except Exception as e:
+            _offline_record(key, seq, provider, endpoint, {'error': e})
+            raise
+        _offline_record(key, seq, provider, endpoint, {'data': data})
+        return data
+    if latency:
+        time.sleep(latency)
+    if error:
+        raise requests.exceptions.ConnectionError("Injected offline replay error for: " + provider + " " + endpoint)
+    with offline['lock']:
+        row = _offline_db().execute("SELECT data FROM recordings WHERE key = ? AND seq <= ? ORDER BY seq DESC LIMIT 1", (key, seq)).fetchone()
+        stats['replayed' if row else 'missing'] += 1
+    if row is None:
+        raise KeyError("No offline recording for: " + provider + " " + endpoint + " " + json.dumps(params, default=str)[:200])
+    record = pickle.loads(row[0])
+    if 'error' in record:
+        raise record['error']
+    return record['data']
+
+def get_offline_stats(): # per provider calls recorded / replayed / missing (no recording) / injected errors
+    with offline['lock']:
+        return pd.DataFrame([{'provider': provider, 'recorded': stats['recorded'], 'recorded_errors': stats['recorded_errors'], 'replayed': stats['replayed'], 'missing': stats['missing'], 'injected_errors': stats['injected_errors']} for provider, stats in offline['stats'].items()], columns=['provider', 'recorded', 'recorded_errors', 'replayed', 'missing', 'injected_errors'])
+
+class RecordReplayClient: # method calls (also nested, i.e. twilio_client.messages.create) go through set_offline_mode record / replay, client=None only replays (data attributes like SIDE_BUY from attributes)
+    provider_attributes = {'kucoin': {'SIDE_BUY': 'buy', 'SIDE_SELL': 'sell'}, 'binance': {'SIDE_BUY': 'BUY', 'SIDE_SELL': 'SELL'}}
+
+    def __init__(self, client, provider, attributes=None, path=()):
+        self._client, self._provider, self._path = client, provider, tuple(path)
+        self._attributes = attributes if attributes is not None else self.provider_attributes.get(provider, {})
+
+    def _resolve(self):
+        if self._client is None:
+            raise RuntimeError("No live client for: " + repr(self) + " (offline mode: " + str(offline['mode']) + ")")
+        value = self._client
+        for name in self._path:
+            value = getattr(value, name)
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._client is None:
+            if not self._path and (name in self._attributes):
+                return self._attributes[name]
+        else:
+            value = getattr(self._resolve(), name)
+            if isinstance(value, (str, bytes, int, float, bool, type(None), tuple)):
+                return value
+        return RecordReplayClient(self._client, self._provider, attributes=self._attributes, path=self._path + (name,))
+
+    def __call__(self, *args, **kwargs):
+        return _offline_call(self._provider, ".".join(self._path), {'args': list(args), 'kwargs': kwargs}, lambda: self._resolve()(*args, **kwargs))
+
+    def __repr__(self):
+        return ".".join((self._provider,) + self._path) # i.e. 'kucoin.get_orders', also _fetch_data instrumentation endpoint
+
+# API clients are built on first use (first attribute access, i.e. kucoin_client.get_orders) instead of at import, so the module imports without python-kucoin / python-binance (pip install speterlin-crypto[trading]) or twilio (pip install speterlin-crypto[notifications]) and without the network (binance's Client pings on construction)
+# constructor kwargs from clients[provider]['kwargs'] (set before first use, i.e. crypto.clients['kucoin']['kwargs'] = {'api_key': ..., 'api_secret': ..., 'passphrase': ...}) else from the environment variables in 'env', assigning a client (crypto.kucoin_client = Client(...)) works like before
+clients = {
+    'coingecko': {'module': 'pycoingecko', 'class': 'CoinGeckoAPI', 'extra': None, 'env': {}, 'kwargs': None},
+    'kucoin': {'module': 'kucoin.client', 'class': 'Client', 'extra': 'trading', 'env': {'api_key': 'KUCOIN_API_KEY', 'api_secret': 'KUCOIN_API_SECRET', 'passphrase': 'KUCOIN_API_PASSPHRASE'}, 'kwargs': None},
+    'binance': {'module': 'binance.client', 'class': 'Client', 'extra': 'trading', 'env': {'api_key': 'BINANCE_API_KEY', 'api_secret': 'BINANCE_API_SECRET'}, 'kwargs': None},
+    'twilio': {'module': 'twilio.rest', 'class': 'Client', 'extra': 'notifications', 'env': {'username': 'TWILIO_ACCOUNT_SID', 'password': 'TWILIO_AUTH_TOKEN'}, 'kwargs': None},
+    'lock': threading.Lock(),
+}
+twilio_phone_to, twilio_phone_from = os.environ.get('TWILIO_PHONE_TO', ''), os.environ.get('TWILIO_PHONE_FROM', '') # crypto.twilio_phone_to = '+1...' like before
+
+def _build_client(provider):
+    config = clients[provider]
+    try:
+        client_class = getattr(importlib.import_module(config['module']), config['class'])
+    except ImportError as e:
+        raise ImportError(str(e) + " - " + provider + " client needs: pip install speterlin-crypto" + ("[" + config['extra'] + "]" if config['extra'] else "")) from e
+    kwargs = config['kwargs'] if config['kwargs'] is not None else {key: os.environ[env_var] for key, env_var in config['env'].items() if os.environ.get(env_var)}
+    return client_class(**kwargs)
+
+class _LazyClient: # stands in for an API client until first attribute access, then builds it (once, thread safe) and delegates
+    def __init__(self, provider):
+        self._provider, self._client = provider, None
+
+    def _get_client(self):
+        if self._client is None:
+            with clients['lock']:
+                if self._client is None:
+                    self._client = _build_client(self._provider)
+        return self._client
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._get_client(), name)
+
+    def __repr__(self):
+        return "<lazy " + self._provider + " client" + (" (built)" if self._client is not None else "") + ">"
+
+cg = RecordReplayClient(_LazyClient('coingecko'), 'coingecko')
+kucoin_client, binance_client, twilio_client = _LazyClient('kucoin'), _LazyClient('binance'), _LazyClient('twilio')
 
 # same as in eventregistry/quant-trading/crypto.py
 # need to have ndg-httpsclient, pyopenssl, and pyasn1 (latter 2 are normally already installed) installed to deal with Caused by SSLError(SSLError("bad handshake: SysCallError(60, 'ETIMEDOUT')",),) according to https://stackoverflow.com/questions/33410577 (should also check tls_version and maybe unset https_proxy from commandline), but doesn't seem to work
+# per stage / endpoint timers (histograms of seconds) and counters: 'fetch' (_fetch_data by function), 'http' (_http_request by host), 'rate_limit' (token bucket waits by provider), 'cycle' (portfolio_trading stages), exported with get_metrics_prometheus() / get_metrics_json_lines(), crypto.instrumentation['enabled'] = False turns off
+instrumentation = {'enabled': True, 'buckets': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 240.0), 'timers': {}, 'counters': Counter(), 'json_lines_file': None, 'profile': None, 'profile_trigger_file': 'data/crypto/profile_next_cycle', 'lock': threading.Lock()} # json_lines_file: portfolio_trading appends get_metrics_json_lines() there every cycle if set
+
+def _instrument_observe(stage, endpoint, seconds):
+    if not instrumentation['enabled']:
+        return
+    with instrumentation['lock']:
+        timer = instrumentation['timers'].get((stage, endpoint))
+        if timer is None:
+            timer = instrumentation['timers'][(stage, endpoint)] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0]*(len(instrumentation['buckets']) + 1)} # last bucket is +Inf
+        timer['count'], timer['sum'], timer['max'] = timer['count'] + 1, timer['sum'] + seconds, max(timer['max'], seconds)
+        timer['buckets'][bisect.bisect_left(instrumentation['buckets'], seconds)] += 1
+
+def _instrument_count(stage, endpoint, event, value=1):
+    if instrumentation['enabled']:
+        with instrumentation['lock']:
+            instrumentation['counters'][(stage, endpoint, event)] += value
+
+@contextlib.contextmanager
+def _instrument_stage(stage, endpoint): # times the block even if it raises (counted as an 'errors' event)
+    start_time = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        _instrument_count(stage, endpoint, 'errors')
+        raise
+    finally:
+        _instrument_observe(stage, endpoint, time.perf_counter() - start_time)
+
+def _instrument_quantile(timer, q): # upper bound of the bucket holding quantile q (max for the +Inf bucket)
+    rank, cumulative = q*timer['count'], 0
+    for bound, count in zip(list(instrumentation['buckets']) + [timer['max']], timer['buckets']):
+        cumulative += count
+        if cumulative >= rank:
+            return min(bound, timer['max'])
+    return timer['max']
+
+def get_instrumentation_stats(): # per stage / endpoint count, errors, total / avg / p50 / p95 / max seconds (p50 / p95 are histogram bucket upper bounds)
+    with instrumentation['lock']:
+        timers, counters = copy.deepcopy(instrumentation['timers']), instrumentation['counters'].copy()
+    keys = list(timers) + [key for key in dict.fromkeys((stage, endpoint) for stage, endpoint, event in counters) if key not in timers]
+    empty_timer = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0]*(len(instrumentation['buckets']) + 1)}
+    return pd.DataFrame([dict({'stage': stage, 'endpoint': endpoint, 'count': timer['count'], 'errors': counters[(stage, endpoint, 'errors')], 'total': timer['sum'], 'avg': timer['sum'] / timer['count'] if timer['count'] else float("NaN"), 'p50': _instrument_quantile(timer, 0.5) if timer['count'] else float("NaN"), 'p95': _instrument_quantile(timer, 0.95) if timer['count'] else float("NaN"), 'max': timer['max']}, \
+        **{event: value for (counter_stage, counter_endpoint, event), value in counters.items() if (counter_stage, counter_endpoint) == (stage, endpoint) and event != 'errors'}) for stage, endpoint in keys for timer in [timers.get((stage, endpoint), empty_timer)]], columns=None if keys else ['stage', 'endpoint', 'count', 'errors', 'total', 'avg', 'p50', 'p95', 'max'])
+
+def _prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def get_metrics_prometheus(): # Prometheus text exposition format (i.e. serve it from a /metrics endpoint or write it for node_exporter's textfile collector)
+    with instrumentation['lock']:
+        timers, counters = copy.deepcopy(instrumentation['timers']), instrumentation['counters'].copy()
+    lines = ["# HELP speterlin_crypto_stage_seconds Time spent per stage and endpoint.", "# TYPE speterlin_crypto_stage_seconds histogram"]
+    for (stage, endpoint), timer in timers.items():
+        labels, cumulative = 'stage="' + _prometheus_label(stage) + '",endpoint="' + _prometheus_label(endpoint) + '"', 0
+        for bound, count in zip([repr(float(bound)) for bound in instrumentation['buckets']] + ["+Inf"], timer['buckets']):
+            cumulative += count
+            lines.append('speterlin_crypto_stage_seconds_bucket{' + labels + ',le="' + bound + '"} ' + str(cumulative))
+        lines.extend(['speterlin_crypto_stage_seconds_sum{' + labels + '} ' + repr(timer['sum']), 'speterlin_crypto_stage_seconds_count{' + labels + '} ' + str(timer['count'])])
+    lines.extend(["# HELP speterlin_crypto_events_total Events (errors, retries, calls, ...) per stage and endpoint.", "# TYPE speterlin_crypto_events_total counter"])
+    lines.extend('speterlin_crypto_events_total{stage="' + _prometheus_label(stage) + '",endpoint="' + _prometheus_label(endpoint) + '",event="' + _prometheus_label(event) + '"} ' + str(value) for (stage, endpoint, event), value in counters.items())
+    return "\n".join(lines) + "\n"
+
+def get_metrics_json_lines(path=None): # one JSON object per timer / counter (with time), appended to path if path
+    with instrumentation['lock']:
+        timers, counters = copy.deepcopy(instrumentation['timers']), instrumentation['counters'].copy()
+    current_time = datetime.now().isoformat()
+    lines = [json.dumps({'time': current_time, 'type': 'timer', 'stage': stage, 'endpoint': endpoint, 'count': timer['count'], 'sum': timer['sum'], 'max': timer['max'], 'buckets': dict(zip([str(bound) for bound in instrumentation['buckets']] + ["+Inf"], timer['buckets']))}) for (stage, endpoint), timer in timers.items()]
+    lines.extend(json.dumps({'time': current_time, 'type': 'counter', 'stage': stage, 'endpoint': endpoint, 'event': event, 'value': value}) for (stage, endpoint, event), value in counters.items())
+    text = "".join(line + "\n" for line in lines)
+    if path:
+        with open(path, 'a') as f:
+            f.write(text)
+    return text
+
+# opt-in profile of the next portfolio_trading cycle (cProfile of the trading thread and / or tracemalloc top allocations), also triggered from outside the process by creating instrumentation['profile_trigger_file'] (i.e. touch data/crypto/profile_next_cycle)
+def profile_next_trading_cycle(cprofile=True, tracemalloc_frames=0, path='data/crypto/profiles', top=30): # tracemalloc_frames > 0 also traces allocations (slows the cycle), writes path/cycle_<time>.prof (for pstats / snakeviz) and .txt summary
+    instrumentation['profile'] = {'cprofile': cprofile, 'tracemalloc_frames': tracemalloc_frames, 'path': path, 'top': top}
+    return instrumentation['profile']
+
+def _cycle_profile_start():
+    profile = instrumentation['profile']
+    if profile is None and instrumentation['profile_trigger_file'] and os.path.exists(instrumentation['profile_trigger_file']):
+        try:
+            with open(instrumentation['profile_trigger_file']) as f:
+                options = f.read().strip()
+            os.remove(instrumentation['profile_trigger_file'])
+            profile = profile_next_trading_cycle(**(json.loads(options) if options else {})) # file can hold options i.e. {"tracemalloc_frames": 10}
+        except Exception as e:
+            print(str(e) + " - Profile trigger file error: " + instrumentation['profile_trigger_file'])
+            return None
+    if profile is None:
+        return None
+    instrumentation['profile'] = None
+    state = dict(profile, profiler=None, tracemalloc_started=False)
+    if profile['tracemalloc_frames'] and not tracemalloc.is_tracing():
+        tracemalloc.start(profile['tracemalloc_frames'])
+        state['tracemalloc_started'] = True
+    if profile['cprofile']:
+        state['profiler'] = cProfile.Profile()
+        state['profiler'].enable()
+    return state
+
+def _cycle_profile_stop(state):
+    if state is None:
+        return None
+    if state['profiler']:
+        state['profiler'].disable()
+    os.makedirs(state['path'], exist_ok=True)
+    file_name = os.path.join(state['path'], 'cycle_' + datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
+    summary = io.StringIO()
+    if state['profiler']:
+        state['profiler'].dump_stats(file_name + '.prof')
+        import pstats
+        pstats.Stats(state['profiler'], stream=summary).sort_stats('cumulative').print_stats(state['top'])
+    if tracemalloc.is_tracing() and state['tracemalloc_frames']:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        summary.write("tracemalloc current: " + str(current) + " bytes, peak: " + str(peak) + " bytes\n" + "\n".join(str(stat) for stat in snapshot.statistics('lineno')[:state['top']]) + "\n")
+        if state['tracemalloc_started']:
+            tracemalloc.stop()
+    with open(file_name + '.txt', 'w') as f:
+        f.write(summary.getvalue())
+    print("Cycle profile saved: " + file_name + ('.prof / ' if state['profiler'] else '') + '.txt')
+    return file_name
+
+_exchange_retry_exceptions = {('binance.exceptions', 'BinanceAPIException'), ('binance.exceptions', 'BinanceRequestException'), ('kucoin.exceptions', 'KucoinAPIException'), ('kucoin.exceptions', 'KucoinRequestException')} # by (module, name) so the exchange clients aren't imported for the check, BinanceWithdrawException, maybe refactor and add for executing binance_trade_coin_btc exceptions (also need logic for these) for BinanceOrderException, BinanceOrderMinAmountException, BinanceOrderMinPriceException, BinanceOrderMinTotalException, BinanceOrderUnknownSymbolException, BinanceOrderInactiveSymbolException
+
 def _fetch_data(func, params, error_str, empty_data, retry=True):
+    endpoint, start_time = getattr(func, '__qualname__', None) or repr(func), time.perf_counter() # i.e. 'get_coin_data', 'Client.get_orders'
     try:
         data = func(**params)
     except (ValueError, TypeError) as e:
+        _instrument_observe('fetch', endpoint, time.perf_counter() - start_time)
+        _instrument_count('fetch', endpoint, 'errors')
         print(str(e) + error_str)
         data = empty_data
     except Exception as e:
+        _instrument_observe('fetch', endpoint, time.perf_counter() - start_time)
+        _instrument_count('fetch', endpoint, 'errors')
         print(str(e) + error_str)
         data = empty_data
-        if retry and ((type(e) in [UnboundLocalError, TimeoutError, RuntimeError, requests.exceptions.ConnectionError, requests.exceptions.TooManyRedirects, BinanceAPIException, BinanceRequestException, KucoinAPIException, KucoinRequestException]) or (type(e) is requests.exceptions.HTTPError and e.response.status_code == 429)): # UnboundLocalError because of response error (local variable 'response' referenced before assignment), if use urllib for request TimeoutError is urllib.error.URLError: <urlopen error [Errno 60] Operation timed out>, requests.exceptions.ConnectionError is for (even when not using urllib): NewConnectionError('<urllib3.connection.VerifiedHTTPSConnection object at 0x119429240>: Failed to establish a new connection: [Errno 60] Operation timed out and: requests.exceptions.ConnectionError: ('Connection aborted.', OSError("(54, 'ECONNRESET')",)), currently unresolved - (even when not using urllib): Max retries exceeded with url: /?t=PD (Caused by SSLError(SSLError("bad handshake: SysCallError(50/54/60, 'ENETDOWN'/'ETIMEDOUT'/'ECONNRESET')",)
-            time.sleep(60) # CoinGecko has limit of 100 requests/minute therefore sleep for a minute, unsure of request limit for Google Trends
+        if retry and ((type(e) in [UnboundLocalError, TimeoutError, RuntimeError, requests.exceptions.ConnectionError, requests.exceptions.TooManyRedirects, requests.exceptions.ReadTimeout, requests.exceptions.ConnectTimeout, ]) or ((type(e).__module__, type(e).__name__) in _exchange_retry_exceptions) or (type(e) is requests.exceptions.HTTPError and e.response.status_code == 429)): # UnboundLocalError because of response error (local variable 'response' referenced before assignment), if use urllib for request TimeoutError is urllib.error.URLError: <urlopen error [Errno 60] Operation timed out>, requests.exceptions.ConnectionError is for (even when not using urllib): NewConnectionError('<urllib3.connection.VerifiedHTTPSConnection object at 0x119429240>: Failed to establish a new connection: [Errno 60] Operation timed out and: requests.exceptions.ConnectionError: ('Connection aborted.', OSError("(54, 'ECONNRESET')",)), currently unresolved - (even when not using urllib): Max retries exceeded with url: /?t=PD (Caused by SSLError(SSLError("bad handshake: SysCallError(50/54/60, 'ENETDOWN'/'ETIMEDOUT'/'ECONNRESET')",)
+            _instrument_count('fetch', endpoint, 'retries')
+            time.sleep(offline['retry_sleep'] if offline['mode'] == 'replay' else 60) # CoinGecko has limit of 100 requests/minute therefore sleep for a minute, unsure of request limit for Google Trends
             data = _fetch_data(func, params, error_str, empty_data, retry=False)
+    else:
+        _instrument_observe('fetch', endpoint, time.perf_counter() - start_time)
     return data
 
+# token bucket per provider shared across threads (concurrent save_coins_data), rate is requests per second and capacity is the max burst, can change before running i.e. crypto.rate_limits['coinmarketcap']['rate'] = 2.0
+rate_limits = {
+    'coinmarketcap': {'rate': 5.0, 'capacity': 10}, # ~1000 coins in ~3.5min, lower if coinmarketcap starts returning 403/429 (detected automation before)
+    'coingecko': {'rate': 30/60, 'capacity': 5}, # CoinGecko public API is ~30 requests/minute
+    'kucoin': {'rate': 30/3, 'capacity': 15}, # Kucoin API request rate limit is 45 times/3s, capacity + 3s of rate so no 3s window has more than 45 requests (kucoin_trade_coins_usdt)
+    'google_trends': {'rate': 1/5, 'capacity': 1}, # unsure of request limit for Google Trends, conservative
+}
+_rate_limiters, _rate_limiters_lock = {}, threading.Lock()
+
+def _rate_limiter_acquire(provider): # blocks until a token is available for provider
+    if offline['mode'] == 'replay': # replay latency stands in for provider pacing
+        return
+    with _rate_limiters_lock:
+        if provider not in _rate_limiters:
+            _rate_limiters[provider] = {'tokens': float(rate_limits[provider]['capacity']), 'last': time.monotonic(), 'lock': threading.Lock()}
+        limiter = _rate_limiters[provider]
+    start_time = time.monotonic()
+    while True:
+        with limiter['lock']:
+            now = time.monotonic()
+            limiter['tokens'], limiter['last'] = min(rate_limits[provider]['capacity'], limiter['tokens'] + (now - limiter['last'])*rate_limits[provider]['rate']), now
+            if limiter['tokens'] >= 1:
+                limiter['tokens'] -= 1
+                _instrument_observe('rate_limit', provider, now - start_time) # time waited for a token
+                return
+            wait = (1 - limiter['tokens']) / rate_limits[provider]['rate']
+        time.sleep(wait)
+
+# fetch_page(page) for each page with a bounded worker pool (each page paced by rate_limits[provider] token bucket if provider), results returned in page order so merged data (and market_cap_rank) is the same as fetching pages one after another, first failed page (in page order) raises and cancels pages not started
+def _fetch_pages(fetch_page, pages, max_workers=4, provider=None):
+    pages = list(pages)
+    if max_workers <= 1 or len(pages) <= 1:
+        return [fetch_page(page) for page in pages]
+    def _fetch_page(page):
+        if provider:
+            _rate_limiter_acquire(provider)
+        return fetch_page(page)
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(pages)))
+    futures = [executor.submit(_fetch_page, page) for page in pages]
+    try:
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+# shared pooled requests session for module fetchers (keep-alive instead of a new TLS connection per requests.get), compressed responses (gzip/deflate, brotli/zstd if installed), conditional requests (If-None-Match / If-Modified-Since) for urls that returned ETag / Last-Modified, per host stats
+http_session = {'session': None, 'pool_maxsize': 16, 'timeout': 30, 'conditional_cache': OrderedDict(), 'conditional_cache_size': 256, 'stats': {}, 'lock': threading.Lock()}
+
+def _http_session():
+    with http_session['lock']:
+        if http_session['session'] is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=http_session['pool_maxsize'], pool_maxsize=http_session['pool_maxsize']) # pool_maxsize connections per host for concurrent fetchers
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+            http_session['session'] = session
+        return http_session['session']
+
+def _http_request(url, method='GET', headers=None, **kwargs): # drop in for requests.get / requests.post, returns requests.Response (previous response if 304 Not Modified)
+    if offline['mode']: # recorded / replayed per host (set_offline_mode)
+        return _offline_call(url.split("/")[2], method + " " + url, {key: value for key, value in kwargs.items() if key != 'timeout'}, lambda: _http_request_live(url, method=method, headers=headers, **kwargs))
+    return _http_request_live(url, method=method, headers=headers, **kwargs)
+
+def _http_request_live(url, method='GET', headers=None, **kwargs):
+    headers, host = dict(headers) if headers else {}, url.split("/")[2]
+    cached = http_session['conditional_cache'].get(url) if method == 'GET' else None
+    if cached:
+        headers.update({key: value for key, value in [('If-None-Match', cached.headers.get('ETag')), ('If-Modified-Since', cached.headers.get('Last-Modified'))] if value})
+    start_time = time.time()
+    try:
+        resp = _http_session().request(method, url, headers=headers, timeout=kwargs.pop('timeout', http_session['timeout']), **kwargs)
+    except Exception:
+        with http_session['lock']:
+            http_session['stats'].setdefault(host, Counter())['errors'] += 1
+        _instrument_observe('http', host, time.time() - start_time)
+        _instrument_count('http', host, 'errors')
+        raise
+    latency = time.time() - start_time
+    _instrument_observe('http', host, latency)
+    if resp.status_code >= 400:
+        _instrument_count('http', host, 'status_' + str(resp.status_code))
+    with http_session['lock']:
+        stats = http_session['stats'].setdefault(host, Counter())
+        stats['requests'], stats['latency'], stats['max_latency'], stats['bytes'] = stats['requests'] + 1, stats['latency'] + latency, max(stats['max_latency'], latency), stats['bytes'] + len(resp.content)
+        stats['wire_bytes'] += int(resp.headers.get('Content-Length', len(resp.content))) # compressed size if server sent Content-Length
+        if cached and resp.status_code == 304:
+            stats['not_modified'] += 1
+            http_session['conditional_cache'].move_to_end(url)
+            return cached
+        if method == 'GET' and resp.ok and (resp.headers.get('ETag') or resp.headers.get('Last-Modified')):
+            http_session['conditional_cache'][url] = resp
+            http_session['conditional_cache'].move_to_end(url)
+            while len(http_session['conditional_cache']) > http_session['conditional_cache_size']:
+                http_session['conditional_cache'].popitem(last=False)
+    return resp
+
+def get_http_stats(): # per host requests, errors, 304s, average / max latency (s), bytes (decoded) and wire_bytes
+    with http_session['lock']:
+        return pd.DataFrame([{'host': host, 'requests': stats['requests'], 'errors': stats['errors'], 'not_modified': stats['not_modified'], 'avg_latency': stats['latency'] / stats['requests'] if stats['requests'] else float("NaN"), 'max_latency': stats['max_latency'], 'bytes': stats['bytes'], 'wire_bytes': stats['wire_bytes']} for host, stats in http_session['stats'].items()], columns=['host', 'requests', 'errors', 'not_modified', 'avg_latency', 'max_latency', 'bytes', 'wire_bytes']).set_index('host')
+
 # data is dataframe column series
 def trendline(data, order=1, reverse_to_ascending=False):
     data_index_values = data.index.values[::-1] if reverse_to_ascending else data.index.values
@@ -80,19 +539,94 @@ def trendline(data, order=1, reverse_to_ascending=False):
     slope = coeffs[-2]
     return float(slope)
 
+_next_data_re = re.compile(r'<script id="__NEXT_DATA__" type="application/json"[^>]*>(.*?)</script>', re.S)
+
+def _get_embedded_json(html): # Next.js page state embedded in coinmarketcap pages, None if not found
+    match = _next_data_re.search(html)
+    try:
+        return json.loads(match.group(1)) if match else None
+    except ValueError:
+        return None
+
+def _find_in_json(data, is_match): # depth first search of dicts / lists (and JSON encoded strings like coinmarketcap's initialState) for first value where is_match(value)
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, str) and (value[:1] in ['{', '[']):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                continue
+        if is_match(value):
+            return value
+        if isinstance(value, dict):
+            stack.extend(reversed(list(value.values())))
+        elif isinstance(value, list):
+            stack.extend(reversed(value))
+    return None
+
+def _get_json_path(data, path): # value at path of keys in dicts / lists (and JSON encoded strings like coinmarketcap's initialState), '*' matches the first list element with a value at the rest of the path, None if not found
+    if isinstance(data, str) and (data[:1] in ['{', '[']):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return None
+    if not path:
+        return data
+    if path[0] == '*':
+        return next((value for value in (_get_json_path(item, path[1:]) for item in data) if value is not None), None) if isinstance(data, list) else None
+    return _get_json_path(data[path[0]], path[1:]) if isinstance(data, dict) and (path[0] in data) else None
+
+def _cmc_json_float(value):
+    try:
+        return float(value) if value is not None else float("NaN")
+    except (TypeError, ValueError):
+        return float("NaN")
+
+def _cmc_json_quote(coin, key): # USD quote value from 'quotes' list, 'quote' dict or flattened 'quote.USD.<key>' (compressed format)
+    if isinstance(coin.get('quotes'), list) and coin['quotes']:
+        quote = next((quote for quote in coin['quotes'] if quote.get('name') == 'USD'), coin['quotes'][0])
+    elif isinstance(coin.get('quote'), dict):
+        quote = coin['quote'].get('USD', {})
+    else:
+        quote = {key: coin.get('quote.USD.' + key, coin.get('quotes.0.' + key))}
+    return _cmc_json_float(quote.get(key))
+
 # coinmarktcap detected automation 403 forbidden after 1 day
 def get_coin_data_coinmarketcap(coin):
-    market_data = {}
     headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.98 Safari/537.36'}
     site_url = 'https://www.coinmarketcap.com/currencies/' + coin
-    resp = requests.get(site_url, headers=headers)
-    soup = bs.BeautifulSoup(resp.text, 'html.parser')
+    resp = _http_request(site_url, headers=headers)
+    return parse_coin_data_coinmarketcap_page(resp.text, coin=coin)
+
+# parses a coinmarketcap coin page with html_parse_backends in order until one finds the statistics: 'lxml' / 'html.parser' (BeautifulSoup selectors), 'json' (page's embedded __NEXT_DATA__ state, no html parsing)
+def parse_coin_data_coinmarketcap_page(html, coin, backends=None):
+    market_data = {}
+    for backend in (backends if backends else html_parse_backends):
+        market_data = _coin_data_coinmarketcap_from_json(html) if backend == 'json' else _coin_data_coinmarketcap_from_soup(html, coin=coin, parser=backend)
+        if len(market_data) > 1: # more than price
+            return market_data
+    print("Error scraping coinmarketcap data for coin: " + coin)
+    return market_data
+
+def _coin_data_coinmarketcap_from_json(html):
+    detail = _find_in_json(_get_embedded_json(html), lambda value: isinstance(value, dict) and isinstance(value.get('statistics'), dict) and ('price' in value['statistics']) and ('marketCap' in value['statistics']))
+    if not detail:
+        return {}
+    statistics, volume_24h = detail['statistics'], _cmc_json_float(detail['statistics'].get('volume24h', detail.get('volume')))
+    market_cap = _cmc_json_float(statistics['marketCap'])
+    market_data = {'price': _cmc_json_float(statistics['price']), 'market_cap': market_cap, 'volume_(24h)': volume_24h, 'vol/mkt_cap_(24h)': volume_24h / market_cap if market_cap else float("NaN"), 'fdv': _cmc_json_float(statistics.get('fullyDilutedMarketCap')), 'total_supply': _cmc_json_float(statistics.get('totalSupply')), 'max_supply': _cmc_json_float(statistics.get('maxSupply')), 'circulating_supply': _cmc_json_float(statistics.get('circulatingSupply'))} # same ids as selectors
+    return market_data
+
+def _coin_data_coinmarketcap_from_soup(html, coin, parser='html.parser'):
+    import bs4 as bs # only needed when pages are parsed as html
+    market_data = {}
+    soup = bs.BeautifulSoup(html, parser, parse_only=bs.SoupStrainer(['span', 'dl'])) # only parse price span and statistics
     span_price = soup.find("span", {"class": "sc-c1554bc0-0 RbQXx base-text"}) if soup.find("span", {"class": "sc-c1554bc0-0 RbQXx base-text"}) else soup.find("span", {"class": "abbreviation-price"}) # stopped working 2026-01-22 "sc-65e7f566-0 WXGwg base-text" # 2025-07-01 some reason bitcoin "sc-65e7f566-0 esyGGG base-text" # 2024-11-29 "sc-d1ede7e3-0 fsQm base-text" # changed 2024-05-24 "sc-f70bb44c-0 jxpCgO base-text" "sc-16891c57-0 dxubiK base-text" # "sc-16891c57-0 imoWES coin-stats-header"
     price = span_price.text.strip().replace('$',"").replace(',',"") if span_price and span_price.text else float("NaN")
     market_data['price'] = float(price)
     dl_statistics = soup.find("dl", {"class": "sc-c1554bc0-0 clNNVq"}) # stopped working 2026-02-26 "sc-c1554bc0-0 ekvTUh CoinMetrics_xflex-container__O27KR" # stopped working 2026-01-22 "sc-65e7f566-0 cqLPHw CoinMetrics_xflex-container__O27KR" # changed 2024-11-29 "sc-65e7f566-0 eQBACe coin-metrics-table" # changed 2024-07-19 "sc-d1ede7e3-0 bwRagp coin-metrics-table" # changed 2024-05-24 "sc-f70bb44c-0 iQEJet coin-metrics-table" # "sc-16891c57-0 gPFIPZ coin-metrics-table" # "sc-8755d3ba-0 ddgngg" # "sc-8755d3ba-0 iausdo" # "sc-16891c57-0 hpRXnp"
     if not dl_statistics:
-        print("Error scraping coinmarketcap data for coin: " + coin)
         return market_data
     times_table = {'P': 1e15, 'T': 1e12, 'B': 1e9, 'M': 1e6, 'K': 1e3}
     divs, div_count = dl_statistics.find_all("div", {"data-role": "group-item"}), 0 # {"class": "sc-c1554bc0-0 iSUEMj"} # "sc-aef7b723-0 RdAHw" # count = 0
@@ -118,9 +652,10 @@ def get_coin_data_coinmarketcap(coin):
 
 # coingecko detected automation 403 forbidden on 2023-05-02 04:27:25.340357 ~several days after implementation, also on 2025-12-08
 def get_coin_data_coingecko(coin):
+    import bs4 as bs # only needed when pages are parsed as html
     data = {}
     site_url = 'https://www.coingecko.com/en/coins/' + coin
-    resp = requests.get(site_url) # 403 error persists even with: , headers=headers # headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10 7 4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.98 Safari/537.36'}
+    resp = _http_request(site_url) # 403 error persists even with: , headers=headers # headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10 7 4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.98 Safari/537.36'}
     soup = bs.BeautifulSoup(resp.text, 'html.parser')
     # table = soup.find("table", {"class": "tw-w-full"})
     divs = soup.find_all("div", {"class": "tw-flex tw-justify-between tw-w-full tw-h-10 tw-py-2.5 tw-border-b tw-border-gray-200 dark:tw-border-opacity-10 tw-pl-0"})
@@ -143,80 +678,344 @@ def get_coin_data(coin, date=None, historical=False, retry_current_if_no_histori
         # data = cg.get_coin_by_id(id=coin)
         data = get_coin_data_coinmarketcap(coin)
     else:
-        data = cg.get_coin_history_by_id(coin, date=date)
+        data = get_coin_history_cached(coin, date=date)
         if ('market_data' not in data or not data['market_data']['market_cap']['usd']) and retry_current_if_no_historical_market_data and (date == datetime.utcnow().strftime('%d-%m-%Y')):
             print("Retrying current since no historical market data and day is current day for coin: " + coin + " on (utc time): " + str(datetime.utcnow()))
             data = get_coin_data(coin) # no need for retries / recursive break out loop since historical passed as False
     # maybe refactor and add if 'market_data' not in data or not data['market_data']['market_cap']['usd']: print('Error') and make data['market_data']['current_price']['usd'] = None
     return data
 
+# two tier cache for cg.get_coin_history_by_id keyed by (coin, date): in-memory LRU backed by sqlite on disk, so repeat backtests over the same window don't re-download (and hit CoinGecko rate limits), negative results (no market_data) cached too once date is in the past (utc) since won't change
+coin_history_cache = {'path': 'data/crypto/saved_coin_history_cache/coin_history.sqlite', 'max_size': 10000, 'enabled': True, 'memory': OrderedDict(), 'stats': Counter(), 'lock': threading.Lock(), 'db': None}
+
+def _coin_history_cache_db():
+    if coin_history_cache['db'] is None:
+        os.makedirs(os.path.dirname(coin_history_cache['path']), exist_ok=True)
+        coin_history_cache['db'] = sqlite3.connect(coin_history_cache['path'], check_same_thread=False) # access serialized by coin_history_cache['lock']
+        coin_history_cache['db'].execute("CREATE TABLE IF NOT EXISTS coin_history (coin TEXT NOT NULL, date TEXT NOT NULL, data TEXT NOT NULL, PRIMARY KEY (coin, date))")
+    return coin_history_cache['db']
+
+def _coin_history_cache_memory_put(key, data):
+    coin_history_cache['memory'][key] = data
+    coin_history_cache['memory'].move_to_end(key)
+    if len(coin_history_cache['memory']) > coin_history_cache['max_size']:
+        coin_history_cache['memory'].popitem(last=False)
+
+def get_coin_history_cached(coin, date): # date is a string in format '%d-%m-%Y' like cg.get_coin_history_by_id, don't modify returned data (shared with cache)
+    if not coin_history_cache['enabled']:
+        return cg.get_coin_history_by_id(coin, date=date)
+    key = (coin, date)
+    with coin_history_cache['lock']:
+        if key in coin_history_cache['memory']:
+            coin_history_cache['stats']['memory_hits'] += 1
+            coin_history_cache['memory'].move_to_end(key)
+            return coin_history_cache['memory'][key]
+        row = _coin_history_cache_db().execute("SELECT data FROM coin_history WHERE coin = ? AND date = ?", key).fetchone()
+        if row:
+            coin_history_cache['stats']['disk_hits'] += 1
+            _coin_history_cache_memory_put(key, json.loads(row[0]))
+            return coin_history_cache['memory'][key]
+        coin_history_cache['stats']['misses'] += 1
+    data = cg.get_coin_history_by_id(coin, date=date) # outside lock, errors raised to _fetch_data (not cached)
+    if datetime.strptime(date, '%d-%m-%Y').date() < datetime.utcnow().date(): # past (utc) days are final (negative results too, i.e. delisted / not yet listed coins), current day data changes during the day
+        with coin_history_cache['lock']:
+            _coin_history_cache_db().execute("INSERT OR REPLACE INTO coin_history (coin, date, data) VALUES (?, ?, ?)", (coin, date, json.dumps(data)))
+            _coin_history_cache_db().commit()
+            _coin_history_cache_memory_put(key, data)
+    return data
+
+def get_coin_history_cache_stats():
+    stats = coin_history_cache['stats']
+    lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+    return {'memory_hits': stats['memory_hits'], 'disk_hits': stats['disk_hits'], 'misses': stats['misses'], 'hit_rate': (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else float("NaN"), 'memory_size': len(coin_history_cache['memory'])}
+
 # Minutely data will be used for duration within 1 day, Hourly data will be used for duration between 1 day and 90 days, Daily data will be used for duration above 90 days
 def get_coin_data_granular_cg(coin, from_timestamp, to_timestamp, currency='btc'): # time is in local time (PST)
     data = cg.get_coin_market_chart_range_by_id(coin, vs_currency=currency, from_timestamp=from_timestamp, to_timestamp=to_timestamp)
     # maybe refactor and add if 'prices' not in data: print('Error') and make data['prices'] = None
     return data
 
-def get_coins_markets_cg(currency='btc', per_page=250, pages=1): # if decide to use less than max 250 entries per_page need to change error_str of _fetch_data executions
-    same_symbol_coins = {'ftt': 'farmatrust', 'hot': 'hydro-protocol', 'stx': 'stox', 'btt': 'blocktrade', 'edg': 'edgeless', 'ghost': 'ghostprism', 'ult': 'shardus', 'box': 'box-token', 'mtc': 'mtc-mesh-network', 'spc': 'spacechain', 'ong': 'ong-social', 'comp': 'compound-coin'} # 'tac': 'traceability-chain' # same_symbol is just covering the top 1000 by market cap from coingecko on
+# local store of granular prices per (coin, currency): sorted timestamp (ms) / price arrays and covered [from, to] intervals (s) in data/crypto/saved_coin_granular/, missing intervals are fetched from CoinGecko in chunks of up to 90 days (hourly data), read ahead to prefetch_to_timestamp so backtests fetch each coin's range once (or in a few chunks) instead of one day per open coin per simulated day
+coin_granular_path = 'data/crypto/saved_coin_granular/'
+coin_granular_chunk_days = 90 # Hourly data will be used for duration between 1 day and 90 days
+_coin_granular_store = {}
+
+def _coin_granular_load(coin, currency):
+    key = (coin, currency)
+    if key not in _coin_granular_store:
+        file_name = coin_granular_path + coin + '_' + currency + '.npz'
+        if os.path.exists(file_name):
+            with np.load(file_name) as npz:
+                _coin_granular_store[key] = {'timestamps': npz['timestamps'], 'prices': npz['prices'], 'covered': [list(interval) for interval in npz['covered']]}
+        else:
+            _coin_granular_store[key] = {'timestamps': np.empty(0, dtype=np.int64), 'prices': np.empty(0, dtype=np.float64), 'covered': []}
+    return _coin_granular_store[key]
+
+def _coin_granular_missing_intervals(covered, from_timestamp, to_timestamp): # covered is sorted and merged
+    missing, current = [], from_timestamp
+    for covered_from, covered_to in covered:
+        if covered_to < current:
+            continue
+        if covered_from > to_timestamp:
+            break
+        if covered_from > current:
+            missing.append([current, covered_from])
+        current = max(current, covered_to)
+    if current < to_timestamp:
+        missing.append([current, to_timestamp])
+    return missing
+
+def get_coin_data_granular(coin, from_timestamp, to_timestamp, currency='btc', prefetch_to_timestamp=None): # same input/output as get_coin_data_granular_cg ({'prices': [[timestamp ms, price], ...]}), empty 'prices' if CoinGecko has no data (MDI)
+    store = _coin_granular_load(coin, currency)
+    missing = _coin_granular_missing_intervals(store['covered'], from_timestamp, to_timestamp)
+    if missing:
+        fetch_from, fetch_to = missing[0][0], min(max(missing[-1][1], prefetch_to_timestamp if prefetch_to_timestamp else to_timestamp), datetime.timestamp(datetime.now()))
+        fetch_to = max(fetch_to, to_timestamp) # precautionary if to_timestamp is in the future
+        timestamps, prices, covered = [store['timestamps']], [store['prices']], [] # covered intervals committed with the merged arrays so a chunk raising doesn't leave coverage without data
+        try:
+            for chunk_from, chunk_to in _coin_granular_missing_intervals(store['covered'], fetch_from, fetch_to):
+                while chunk_from < chunk_to:
+                    chunk_stop = min(chunk_from + coin_granular_chunk_days*24*60*60, chunk_to)
+                    data = get_coin_data_granular_cg(coin, from_timestamp=chunk_from, to_timestamp=chunk_stop, currency=currency) # errors raised to _fetch_data, chunks fetched before the error are kept
+                    if 'prices' in data and data['prices']:
+                        chunk_prices = np.array(data['prices'], dtype=np.float64)
+                        timestamps.append(chunk_prices[:, 0].astype(np.int64))
+                        prices.append(chunk_prices[:, 1])
+                    if chunk_stop <= datetime.timestamp(datetime.now()): # don't mark future as covered (no data yet)
+                        covered.append([chunk_from, chunk_stop])
+                    chunk_from = chunk_stop
+        finally:
+            if covered:
+                store['timestamps'], unique_idxs = np.unique(np.concatenate(timestamps), return_index=True)
+                store['prices'] = np.concatenate(prices)[unique_idxs]
+                merged = []
+                for interval in sorted(store['covered'] + covered):
+                    if merged and interval[0] <= merged[-1][1]:
+                        merged[-1][1] = max(merged[-1][1], interval[1])
+                    else:
+                        merged.append(list(interval))
+                store['covered'] = merged
+                os.makedirs(coin_granular_path, exist_ok=True)
+                with open(coin_granular_path + coin + '_' + currency + '.npz.' + str(os.getpid()) + '.tmp', 'wb') as f: # atomic replace since run_portfolio_rr_sweep workers can write the same coin
+                    np.savez(f, timestamps=store['timestamps'], prices=store['prices'], covered=np.array(store['covered'], dtype=np.float64).reshape(-1, 2))
+                os.replace(coin_granular_path + coin + '_' + currency + '.npz.' + str(os.getpid()) + '.tmp', coin_granular_path + coin + '_' + currency + '.npz')
+    idx_start, idx_stop = np.searchsorted(store['timestamps'], from_timestamp*1000, side='left'), np.searchsorted(store['timestamps'], to_timestamp*1000, side='right')
+    return {'prices': np.column_stack([store['timestamps'][idx_start:idx_stop], store['prices'][idx_start:idx_stop]]).tolist()}
+
+# local OHLCV candle store per Kucoin pair (i.e. 'HYPE-USDT') and interval: columnar arrays (time = candle start in s, open, close, high, low, volume, turnover) and covered [from, to] intervals (s) in data/crypto/saved_kucoin_candles/<pair>_<interval>.npz, only missing intervals are fetched (max_candles per Kucoin klines request), candles not closed yet aren't stored
+# backtest_pricing=True prices update_portfolio_postions_back_testing / run_portfolio_rr_backtest paths and backtest buys / sells from Kucoin closes (price in btc = close / BTC-USDT close) instead of CoinGecko granular / history, falling back to CoinGecko for pairs Kucoin has no candles for (not listed), max_gap (s) is how old the last candle can be for a price at a time
+kucoin_candles = {'path': 'data/crypto/saved_kucoin_candles/', 'interval': '1hour', 'max_candles': 1500, 'max_gap': 24*60*60, 'backtest_pricing': False, 'stats': Counter()}
+kucoin_candle_intervals = {'1min': 60, '3min': 3*60, '5min': 5*60, '15min': 15*60, '30min': 30*60, '1hour': 60*60, '2hour': 2*60*60, '4hour': 4*60*60, '6hour': 6*60*60, '8hour': 8*60*60, '12hour': 12*60*60, '1day': 24*60*60, '1week': 7*24*60*60}
+kucoin_candle_columns = ['open', 'close', 'high', 'low', 'volume', 'turnover'] # Kucoin kline field order after time
+_kucoin_candles_store = {}
+
+def get_kucoin_candles_kucoin(symbol_pair, from_timestamp, to_timestamp, interval='1hour'): # up to 1500 candles [[time, open, close, high, low, volume, turnover], ...] (strings, newest first) starting in [from_timestamp, to_timestamp) (s)
+    _rate_limiter_acquire('kucoin')
+    resp = _http_request('https://api.kucoin.com/api/v1/market/candles?type=' + interval + '&symbol=' + symbol_pair + '&startAt=' + str(int(from_timestamp)) + '&endAt=' + str(int(to_timestamp)))
+    data = json.loads(resp.text)
+    if data.get('code') != '200000':
+        raise (RuntimeError if data.get('code') == '429000' else ValueError)("Kucoin candles error " + str(data.get('code')) + ": " + str(data.get('msg'))) # too many requests retried by _fetch_data
+    return data['data']
+
+def _kucoin_candles_file(symbol_pair, interval):
+    return kucoin_candles['path'] + symbol_pair + '_' + interval + '.npz'
+
+def _kucoin_candles_load(symbol_pair, interval):
+    key = (symbol_pair, interval)
+    if key not in _kucoin_candles_store:
+        if os.path.exists(_kucoin_candles_file(symbol_pair, interval)):
+            with np.load(_kucoin_candles_file(symbol_pair, interval)) as npz:
+                _kucoin_candles_store[key] = {column: npz[column] for column in ['time'] + kucoin_candle_columns}
+                _kucoin_candles_store[key]['covered'] = [list(interval_covered) for interval_covered in npz['covered']]
+        else:
+            _kucoin_candles_store[key] = {'time': np.empty(0, dtype=np.int64), **{column: np.empty(0, dtype=np.float64) for column in kucoin_candle_columns}, 'covered': []}
+    return _kucoin_candles_store[key]
+
+def update_kucoin_candles(symbol_pair, from_timestamp, to_timestamp, interval=None): # fetches only the missing intervals of [from_timestamp, to_timestamp] (s), returns number of candles added, errors raised to _fetch_data (candles fetched before the error are kept)
+    interval = interval if interval else kucoin_candles['interval']
+    store, interval_seconds = _kucoin_candles_load(symbol_pair, interval), kucoin_candle_intervals[interval]
+    closed_to = (int(datetime.timestamp(datetime.now())) // interval_seconds)*interval_seconds - interval_seconds # start of the last closed candle
+    missing = _coin_granular_missing_intervals(store['covered'], from_timestamp, min(to_timestamp, closed_to))
+    if not missing:
+        kucoin_candles['stats']['hits'] += 1
+        return 0
+    rows, chunks, candles_before = [], 0, len(store['time'])
+    try:
+        for chunk_from, chunk_to in missing:
+            while chunk_from < chunk_to:
+                chunk_stop = min(chunk_from + (kucoin_candles['max_candles'] - 1)*interval_seconds, chunk_to) # endAt is inclusive
+                rows.extend(row for row in get_kucoin_candles_kucoin(symbol_pair, chunk_from, chunk_stop, interval=interval) if int(row[0]) <= closed_to)
+                kucoin_candles['stats']['requests'] += 1
+                store['covered'].append([chunk_from, chunk_stop])
+                chunk_from, chunks = chunk_stop, chunks + 1
+    finally:
+        if chunks:
+            candles = np.array(rows, dtype=np.float64).reshape(-1, 1 + len(kucoin_candle_columns))
+            times, unique_idxs = np.unique(np.concatenate([candles[:, 0].astype(np.int64), store['time']]), return_index=True) # fetched candles first so they replace stored ones
+            store.update({column: np.concatenate([candles[:, column_idx + 1], store[column]])[unique_idxs] for column_idx, column in enumerate(kucoin_candle_columns)})
+            store['time'], merged = times, []
+            for interval_covered in sorted(store['covered']):
+                if merged and interval_covered[0] <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], interval_covered[1])
+                else:
+                    merged.append(list(interval_covered))
+            store['covered'] = merged
+            os.makedirs(kucoin_candles['path'], exist_ok=True)
+            with open(_kucoin_candles_file(symbol_pair, interval) + '.' + str(os.getpid()) + '.tmp', 'wb') as f: # atomic replace since run_portfolio_rr_sweep workers can write the same pair
+                np.savez(f, covered=np.array(store['covered'], dtype=np.float64).reshape(-1, 2), **{column: store[column] for column in ['time'] + kucoin_candle_columns})
+            os.replace(_kucoin_candles_file(symbol_pair, interval) + '.' + str(os.getpid()) + '.tmp', _kucoin_candles_file(symbol_pair, interval))
+    kucoin_candles['stats']['candles'] += len(store['time']) - candles_before
+    return len(store['time']) - candles_before
+
+def get_kucoin_candles(symbol_pair, from_timestamp, to_timestamp, interval=None, update=True, prefetch_to_timestamp=None): # {'time', 'open', 'close', 'high', 'low', 'volume', 'turnover'} arrays (views into the store, don't modify) of candles starting in [from_timestamp, to_timestamp) (s), missing intervals up to prefetch_to_timestamp fetched first if update
+    interval = interval if interval else kucoin_candles['interval']
+    if update:
+        update_kucoin_candles(symbol_pair, from_timestamp, max(to_timestamp, prefetch_to_timestamp if prefetch_to_timestamp else to_timestamp), interval=interval)
+    store = _kucoin_candles_load(symbol_pair, interval)
+    idx_start, idx_stop = np.searchsorted(store['time'], from_timestamp, side='left'), np.searchsorted(store['time'], to_timestamp, side='left')
+    return {column: store[column][idx_start:idx_stop] for column in ['time'] + kucoin_candle_columns}
+
+def _kucoin_candles_btc(symbol_pair, from_timestamp, to_timestamp, interval=None): # {'timestamps' (candle close time in ms), 'prices' (close / BTC-USDT close of the same candle)} for the whole store, rebuilt only when either store changed
+    interval = interval if interval else kucoin_candles['interval']
+    for pair in [symbol_pair, 'BTC-USDT']:
+        update_kucoin_candles(pair, from_timestamp, to_timestamp, interval=interval)
+    store, btc_store = _kucoin_candles_load(symbol_pair, interval), _kucoin_candles_load('BTC-USDT', interval)
+    if (store.get('btc') is None) or (store['btc']['sources'][0] is not store['time']) or (store['btc']['sources'][1] is not btc_store['time']):
+        btc_idxs = np.minimum(np.searchsorted(btc_store['time'], store['time']), max(len(btc_store['time']) - 1, 0))
+        matched = (btc_idxs < len(btc_store['time'])) & (btc_store['time'][btc_idxs] == store['time']) if len(btc_store['time']) else np.zeros(len(store['time']), dtype=bool)
+        store['btc'] = {'timestamps': (store['time'][matched] + kucoin_candle_intervals[interval])*1000, 'prices': store['close'][matched] / btc_store['close'][btc_idxs[matched]], 'sources': [store['time'], btc_store['time']]}
+    return store['btc']
+
+def get_kucoin_candle_prices_in_btc(symbol_pair, from_timestamp, to_timestamp, prefetch_to_timestamp=None): # same output as get_coin_data_granular ({'prices': [[timestamp ms, price in btc], ...]}) from Kucoin candles closing in [from_timestamp, to_timestamp], {} (no 'prices') if Kucoin has no candles for symbol_pair
+    candles_in_btc = _kucoin_candles_btc(symbol_pair, from_timestamp - kucoin_candle_intervals[kucoin_candles['interval']], max(to_timestamp, prefetch_to_timestamp if prefetch_to_timestamp else to_timestamp))
+    if not len(candles_in_btc['timestamps']):
+        return {}
+    idx_start, idx_stop = np.searchsorted(candles_in_btc['timestamps'], from_timestamp*1000, side='left'), np.searchsorted(candles_in_btc['timestamps'], to_timestamp*1000, side='right')
+    return {'prices': np.column_stack([candles_in_btc['timestamps'][idx_start:idx_stop], candles_in_btc['prices'][idx_start:idx_stop]]).tolist()}
+
+def get_kucoin_candle_price(symbol_pair, timestamp, prefetch_to_timestamp=None): # [price (usdt), price_in_btc] close of the last candle closed by timestamp (s) and at most max_gap old, NaNs if none
+    interval_seconds = kucoin_candle_intervals[kucoin_candles['interval']]
+    candles_in_btc = _kucoin_candles_btc(symbol_pair, timestamp - kucoin_candles['max_gap'] - interval_seconds, max(timestamp, prefetch_to_timestamp if prefetch_to_timestamp else timestamp))
+    store = _kucoin_candles_load(symbol_pair, kucoin_candles['interval'])
+    idx = np.searchsorted(store['time'], timestamp - interval_seconds, side='right') - 1
+    if (idx < 0) or (store['time'][idx] + interval_seconds < timestamp - kucoin_candles['max_gap']):
+        return [float("NaN"), float("NaN")]
+    btc_idx = np.searchsorted(candles_in_btc['timestamps'], (store['time'][idx] + interval_seconds)*1000, side='left')
+    price_in_btc = float(candles_in_btc['prices'][btc_idx]) if (btc_idx < len(candles_in_btc['timestamps'])) and (candles_in_btc['timestamps'][btc_idx] == (store['time'][idx] + interval_seconds)*1000) else float("NaN")
+    return [float(store['close'][idx]), price_in_btc]
+
+def _kucoin_backtest_pair(coin, symbol): # Kucoin pair of coin from the instrument registry if kucoin_candles['backtest_pricing'] and coin owns symbol (collision rule) otherwise None (callers fall back to CoinGecko), so candles of another coin with the same symbol aren't used
+    if not (kucoin_candles['backtest_pricing'] and isinstance(symbol, str) and symbol):
+        return None
+    instrument = get_instrument(coin, by='id')
+    return instrument['kucoin_pair'] if instrument and instrument['symbol_owner'] and (instrument['symbol'] == symbol.lower()) else None
+
+def _kucoin_candle_backtest_price(coin, symbol, date, end_day): # [price (usdt), price_in_btc] at date from the candle store if coin has a Kucoin pair (see _kucoin_backtest_pair) else NaNs (callers fall back to CoinGecko)
+    symbol_pair = _kucoin_backtest_pair(coin, symbol)
+    if not symbol_pair:
+        return [float("NaN"), float("NaN")]
+    return _fetch_data(get_kucoin_candle_price, params={'symbol_pair': symbol_pair, 'timestamp': datetime.timestamp(date), 'prefetch_to_timestamp': datetime.timestamp(end_day)}, error_str=" - No Kucoin candle price for: " + symbol_pair + " on: " + str(date), empty_data=[float("NaN"), float("NaN")])
+
+cg_same_symbol_coins = {'ftt': 'farmatrust', 'hot': 'hydro-protocol', 'stx': 'stox', 'btt': 'blocktrade', 'edg': 'edgeless', 'ghost': 'ghostprism', 'ult': 'shardus', 'box': 'box-token', 'mtc': 'mtc-mesh-network', 'spc': 'spacechain', 'ong': 'ong-social', 'comp': 'compound-coin'} # 'tac': 'traceability-chain' # same_symbol is just covering the top 1000 by market cap from coingecko on
+
+def get_coins_markets_cg(currency='btc', per_page=250, pages=1, max_workers=4): # if decide to use less than max 250 entries per_page need to change error_str of _fetch_data executions
     data = []
-    for page in range(pages):
-        data.extend(cg.get_coins_markets(vs_currency=currency, per_page=per_page, page=page + 1)) # no fetch_data on this call since get_coins_markets always called with _fetch_data
+    for page_data in _fetch_pages(lambda page: cg.get_coins_markets(vs_currency=currency, per_page=per_page, page=page), range(1, pages+1), max_workers=max_workers, provider='coingecko'): # no fetch_data on this call since get_coins_markets always called with _fetch_data
+        data.extend(page_data)
     for coin in data:
-        if (coin['symbol'] in same_symbol_coins) and (same_symbol_coins[coin['symbol']] == coin['id']): # (list(same_symbol_coins.keys()) + list(binance_btc_api_error_coins.keys())) and coin['id'] in (list(same_symbol_coins.values()) + list(binance_btc_api_error_coins.values())): # refactor, some coins have the same symbol, find a way to select first occurence of symbol, issues with FTT and HOT
+        if (coin['symbol'] in cg_same_symbol_coins) and (cg_same_symbol_coins[coin['symbol']] == coin['id']): # (list(cg_same_symbol_coins.keys()) + list(binance_btc_api_error_coins.keys())) and coin['id'] in (list(cg_same_symbol_coins.values()) + list(binance_btc_api_error_coins.values())): # refactor, some coins have the same symbol, find a way to select first occurence of symbol, issues with FTT and HOT
             data.remove(coin)
     return data
 
-def get_coins_markets_coinmarketcap(pages=10): # refactor add market cap
+def get_coins_markets_coinmarketcap(pages=10, max_workers=4): # refactor add market cap
     data = {}
     market_cap_rank = 0
     headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10 7 4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/71.0.3578.98 Safari/537.36'} #
-    times_table = {'P': 1e15, 'T': 1e12, 'B': 1e9, 'M': 1e6, 'K': 1e3}
-    for page in range(1, pages+1):
+    def _fetch_page(page):
         site_url = 'https://www.coinmarketcap.com/?page=' + str(page)
-        resp = requests.get(site_url, headers=headers)
+        resp = _http_request(site_url, headers=headers)
         # resp = requests.get(site_url)
-        soup = bs.BeautifulSoup(resp.text, 'html.parser')
-        table = soup.find("table", class_=lambda x: x and "cmc-table" in x) # chatgpt recommendation 2025-07-08 since changed again 2025-07-03 # changed ~2025-06-23 "sc-db1da501-3 ccGPRR cmc-table" # changed ~2025-04-15 "sc-db1da501-3 kTEDDd cmc-table" # changed 2025-03-01 (noticed on 2025-03-24) "sc-e66afe2c-3 gDwpBm cmc-table" # changed 2025-02-28 "sc-936354b2-3 tLXcG cmc-table" changed 2024-11-29 "sc-7b3ac367-3 etbcea cmc-table" changed 2024-07-30 "sc-963bde9f-3 fGUAUU cmc-table"# changed 2024-07-19 "sc-963bde9f-3 dzympI cmc-table"# changed 2024-05-24 "sc-ae0cff98-3 ipWPGi cmc-table" "sc-14cb040a-3 dsflYb cmc-table" "sc-feda9013-3 ePzlNg cmc-table" # "class": "sc-66133f36-3 etbEmy cmc-table" "sc-b6abf4b4-3 gTnkjE cmc-table"}) # idx,  0, # "sc-996d6db8-3 cOXNvh cmc-table" # "sc-beb003d5-3 ieTeVa cmc-table" # need to change this up every once in a while
-        for row in table.find_all('tr')[1:]: # page 'coinmarketcap-20-index-dtf' is populating 1st position
-            # print(row)
-            tds = row.find_all("td")
-            a_link = row.find("a", {"class": "cmc-link"})
-            coin_id = a_link['href'].split('/currencies/')[-1].replace('/','')
-            if a_link.find_all("p"):
-                links = a_link.find_all("p") # links = a_link.find_all("p") if a_link.find_all("p") else a_link.find_all("span")
-                coin_symbol = links[1].text.strip().lower() # coin_symbol = links[1].text.strip().lower()
-            else:
-                links = a_link.find_all("span")
-                coin_symbol = links[2].text.strip().lower()
-                # price =
-            # print(coin_id + ": " + coin_symbol + ", " + str(tds[3].text.strip()))
+        coins_rows = parse_coins_markets_coinmarketcap_page(resp.text)
+        if not coins_rows: # precautionary, ranks would shift if a page was skipped
+            raise ValueError("No coins markets table on coinmarketcap page: " + str(page))
+        return coins_rows
+    for coins_rows in _fetch_pages(_fetch_page, range(1, pages+1), max_workers=max_workers, provider='coinmarketcap'): # market_cap_rank assigned in page order after fetching
+        for coin_id, symbol_and_market_data in coins_rows:
             market_cap_rank = (market_cap_rank + 1) if coin_id != 'coinmarketcap-20-index' else market_cap_rank # 'coinmarketcap-20-index-dtf' # market_cap_rank = float(tds[1].text.strip()) if tds[1].text.strip() else float("NaN") #
-            try:
-                price = float(tds[3].text.strip().replace('$',"").replace(',',"")) # if tds[3].text.strip() else float("NaN")
-            except Exception as e:
-                price = float("NaN")
-                print(str(e) + " - Price issue(s) for coin: " + coin_id + " with market cap rank: " + str(market_cap_rank))
-            try:
-                market_cap = float(tds[7].text.split('$')[-1].replace('$',"").replace(',',"")) if tds[7].text.split('$')[-1] else float("NaN")
-                volume_24h = float(tds[8].find("a").text.strip().replace('$',"").replace(',',"")) if tds[8].find("a").text.strip() else float("NaN") # find("a") since there is also volume listed in coin
-                circulating_supply = float(tds[9].text.split(" ")[0].strip().replace(',',"")[:-1]) * times_table[tds[9].text.split(" ")[0].strip().replace(',',"")[-1]] if tds[9].text.split(" ")[0].strip() else float("NaN") # if re.findall(r"["+"".join(times_table.keys())+"]", circulating_supply_value)
-            except Exception as e:
-                print(str(e) + " - Market Cap / Volume (24h) / Circulating Supply issue(s) for coin: " + coin_id + " with market cap rank: " + str(market_cap_rank))
-                market_cap, volume_24h, circulating_supply = [float("NaN")]*3
-            data[coin_id] = {"symbol": coin_symbol, "market_cap_rank": market_cap_rank, "price": price, "market_cap": market_cap, "volume_24h": volume_24h, "circulating_supply": circulating_supply}
+            data[coin_id] = {"symbol": symbol_and_market_data['symbol'], "market_cap_rank": market_cap_rank, "price": symbol_and_market_data['price'], "market_cap": symbol_and_market_data['market_cap'], "volume_24h": symbol_and_market_data['volume_24h'], "circulating_supply": symbol_and_market_data['circulating_supply']}
             # if market_cap_rank == 11:
             #     print("Market cap rank: " + str(market_cap_rank)) # + ", Sleeping 10s")
             #     break
                 # time.sleep(10)
     return data
 
+# parses a coinmarketcap listing page into [[coin_id, {symbol, price, market_cap, volume_24h, circulating_supply}], ...] in page order (market_cap_rank assigned by caller) with html_parse_backends in order until one finds coins: 'lxml' / 'html.parser' (BeautifulSoup selectors), 'json' (embedded __NEXT_DATA__ state)
+def parse_coins_markets_coinmarketcap_page(html, backends=None):
+    for backend in (backends if backends else html_parse_backends):
+        coins_rows = _coins_markets_coinmarketcap_from_json(html) if backend == 'json' else _coins_markets_coinmarketcap_from_soup(html, parser=backend)
+        if coins_rows:
+            return coins_rows
+    return []
+
+# explicit __NEXT_DATA__ paths of the listing on coinmarketcap listing pages (initialState compressed keysArr rows, dehydratedState react-query rows), other coin lists on the page (trending, gainers / losers, recently added) are never read as the listing
+coinmarketcap_listing_json_paths = [['props', 'pageProps', 'initialState', 'cryptocurrency', 'listingLatest', 'data'], ['props', 'initialState', 'cryptocurrency', 'listingLatest', 'data'], ['props', 'pageProps', 'dehydratedState', 'queries', '*', 'state', 'data', 'data', 'listing', 'cryptoCurrencyList'], ['props', 'dehydratedState', 'queries', '*', 'state', 'data', 'data', 'listing', 'cryptoCurrencyList']]
+coinmarketcap_listing_min_coins = 50 # listing pages have 100 coins, json listing rejected (html selectors used) if shorter or cmcRank isn't continuous
+
+def _coins_markets_coinmarketcap_from_json(html):
+    embedded = _get_embedded_json(html)
+    coins_list = next((coins_list for coins_list in (_get_json_path(embedded, path) for path in coinmarketcap_listing_json_paths) if isinstance(coins_list, list) and coins_list and isinstance(coins_list[0], dict)), None)
+    if not coins_list:
+        return []
+    coins_list = [dict(zip(coins_list[0]['keysArr'], values)) for values in coins_list[1:]] if 'keysArr' in coins_list[0] else coins_list # compressed format: keys row then value rows
+    ranks = sorted(coin['cmcRank'] for coin in coins_list if isinstance(coin.get('cmcRank'), (int, float)))
+    if (len(coins_list) < coinmarketcap_listing_min_coins) or (len(ranks) != len(coins_list)) or (ranks != list(range(int(ranks[0]), int(ranks[0]) + len(ranks)))) or not all(('slug' in coin) and ('symbol' in coin) for coin in coins_list):
+        print("Coinmarketcap listing json rejected: " + str(len(coins_list)) + " coins, ranks " + (str(ranks[0]) + "-" + str(ranks[-1]) if ranks else "missing"))
+        return []
+    coins_list = sorted(coins_list, key=lambda coin: coin['cmcRank'])
+    return [[coin['slug'], {'symbol': str(coin['symbol']).lower(), 'price': _cmc_json_quote(coin, 'price'), 'market_cap': _cmc_json_quote(coin, 'marketCap'), 'volume_24h': _cmc_json_quote(coin, 'volume24h'), 'circulating_supply': _cmc_json_float(coin.get('circulatingSupply'))}] for coin in coins_list]
+
+def _coins_markets_coinmarketcap_from_soup(html, parser='html.parser'):
+    import bs4 as bs # only needed when pages are parsed as html
+    coins_rows = []
+    times_table = {'P': 1e15, 'T': 1e12, 'B': 1e9, 'M': 1e6, 'K': 1e3}
+    soup = bs.BeautifulSoup(html, parser, parse_only=bs.SoupStrainer('table')) # only parse tables
+    table = soup.find("table", class_=lambda x: x and "cmc-table" in x) # chatgpt recommendation 2025-07-08 since changed again 2025-07-03 # changed ~2025-06-23 "sc-db1da501-3 ccGPRR cmc-table" # changed ~2025-04-15 "sc-db1da501-3 kTEDDd cmc-table" # changed 2025-03-01 (noticed on 2025-03-24) "sc-e66afe2c-3 gDwpBm cmc-table" # changed 2025-02-28 "sc-936354b2-3 tLXcG cmc-table" changed 2024-11-29 "sc-7b3ac367-3 etbcea cmc-table" changed 2024-07-30 "sc-963bde9f-3 fGUAUU cmc-table"# changed 2024-07-19 "sc-963bde9f-3 dzympI cmc-table"# changed 2024-05-24 "sc-ae0cff98-3 ipWPGi cmc-table" "sc-14cb040a-3 dsflYb cmc-table" "sc-feda9013-3 ePzlNg cmc-table" # "class": "sc-66133f36-3 etbEmy cmc-table" "sc-b6abf4b4-3 gTnkjE cmc-table"}) # idx,  0, # "sc-996d6db8-3 cOXNvh cmc-table" # "sc-beb003d5-3 ieTeVa cmc-table" # need to change this up every once in a while
+    if not table:
+        return coins_rows
+    for row in table.find_all('tr')[1:]: # page 'coinmarketcap-20-index-dtf' is populating 1st position
+        # print(row)
+        tds = row.find_all("td")
+        a_link = row.find("a", {"class": "cmc-link"})
+        coin_id = a_link['href'].split('/currencies/')[-1].replace('/','')
+        if a_link.find_all("p"):
+            links = a_link.find_all("p") # links = a_link.find_all("p") if a_link.find_all("p") else a_link.find_all("span")
+            coin_symbol = links[1].text.strip().lower() # coin_symbol = links[1].text.strip().lower()
+        else:
+            links = a_link.find_all("span")
+            coin_symbol = links[2].text.strip().lower()
+            # price =
+        # print(coin_id + ": " + coin_symbol + ", " + str(tds[3].text.strip()))
+        try:
+            price = float(tds[3].text.strip().replace('$',"").replace(',',"")) # if tds[3].text.strip() else float("NaN")
+        except Exception as e:
+            price = float("NaN")
+            print(str(e) + " - Price issue(s) for coin: " + coin_id)
+        try:
+            market_cap = float(tds[7].text.split('$')[-1].replace('$',"").replace(',',"")) if tds[7].text.split('$')[-1] else float("NaN")
+            volume_24h = float(tds[8].find("a").text.strip().replace('$',"").replace(',',"")) if tds[8].find("a").text.strip() else float("NaN") # find("a") since there is also volume listed in coin
+            circulating_supply = float(tds[9].text.split(" ")[0].strip().replace(',',"")[:-1]) * times_table[tds[9].text.split(" ")[0].strip().replace(',',"")[-1]] if tds[9].text.split(" ")[0].strip() else float("NaN") # if re.findall(r"["+"".join(times_table.keys())+"]", circulating_supply_value)
+        except Exception as e:
+            print(str(e) + " - Market Cap / Volume (24h) / Circulating Supply issue(s) for coin: " + coin_id)
+            market_cap, volume_24h, circulating_supply = [float("NaN")]*3
+        coins_rows.append([coin_id, {"symbol": coin_symbol, "price": price, "market_cap": market_cap, "volume_24h": volume_24h, "circulating_supply": circulating_supply}])
+    return coins_rows
+
 # coingecko detected automation 403 forbidden on 2023-05-05 ~several days after implementation, works on 2025-12-08
-def get_coins_markets_coingecko(pages=10):
+def get_coins_markets_coingecko(pages=10, max_workers=4):
+    import bs4 as bs # only needed when pages are parsed as html
     data = {}
-    for page in range(1, pages+1):
-        site_url = 'https://www.coingecko.com/?page=' + str(page)
-        resp = requests.get(site_url)
-        soup = bs.BeautifulSoup(resp.text, 'html.parser')
+    for resp_text in _fetch_pages(lambda page: _http_request('https://www.coingecko.com/?page=' + str(page)).text, range(1, pages+1), max_workers=max_workers, provider='coingecko'): # merged in page order
+        soup = bs.BeautifulSoup(resp_text, 'html.parser')
         table = soup.find("table", {"class": "gecko-homepage-coin-table gecko-sticky-table sortable"}) # "sort table mb-0 text-sm text-lg-normal table-scrollable"
         for row in table.find_all('tr')[1:]:
             market_cap_rank = float(row.find("td", {"class": "tw-sticky tw-left-[34px] gecko-sticky"}).text.strip()) # "table-number tw-text-left text-xs cg-sticky-col cg-sticky-second-col tw-max-w-14 lg:tw-w-14"
@@ -231,47 +1030,70 @@ def get_coins_markets_coingecko(pages=10):
             data[coin_id] = {"symbol": coin_symbol, "market_cap_rank": market_cap_rank, "price": current_price, "24h_volume": current_24h_volume, "market_cap": current_market_cap}
     return data
 
-def save_coins_data(date, pages=10): # date is in format '%Y-%m-%d' # maybe refactor and add date if code block runs at a datetime.now() which is close to the next day, if runs longer no need to add date since market runs 24/7 # number of pages should be constant
+def _add_coin_data_to_df_coins(df_coins, coin_id, symbol_and_market_data, coin_data): # shared by serial and concurrent save_coins_data so both produce the same df_coins
+    if not coin_data:
+        print("Error retrieving initial coin data for: " + coin_id)
+        df_coins.loc[coin_id, ["Market Cap Rank", "Price", "Market Cap", "24h Volume", "Supply: Circulating"]] = [symbol_and_market_data['market_cap_rank'], symbol_and_market_data['price'], symbol_and_market_data['market_cap'], symbol_and_market_data['volume_24h'], symbol_and_market_data['circulating_supply']]
+    else:
+        # generally incomplete historical community data: facebook likes, twitter followers; developer data
+        df_coins.loc[coin_id] = [
+            symbol_and_market_data['market_cap_rank'],
+            float("NaN"), # coin_data['community_data']['facebook_likes'] if coin_data['community_data']['facebook_likes'] else float("NaN"),
+            float("NaN"), # coin_data['community_data']['twitter_followers'] if coin_data['community_data']['twitter_followers'] else float("NaN"),
+            float("NaN"), # coin_data['community_data']['reddit_subscribers'] if coin_data['community_data']['reddit_subscribers'] else float("NaN"),
+            float("NaN"), # coin_data['community_data']['reddit_average_posts_48h'] + coin_data['community_data']['reddit_average_comments_48h'] if (coin_data['community_data']['reddit_average_posts_48h'] and coin_data['community_data']['reddit_average_comments_48h']) else float("NaN"),
+            float("NaN"), # coin_data['developer_data']['stars'] if coin_data['developer_data']['stars'] else float("NaN"),
+            float("NaN"), # coin_data['developer_data']['total_issues'] if coin_data['developer_data']['total_issues'] else float("NaN"),
+            float("NaN"), # coin_data['public_interest_stats']['alexa_rank'] if coin_data['public_interest_stats']['alexa_rank'] else float("NaN"),
+            coin_data["price"] if "market_cap" in coin_data else symbol_and_market_data['price'], # float("NaN")
+            float("NaN"), # coin_data['market_data']['current_price']['btc'] if coin_data['market_data']['current_price']['btc'] else float("NaN"),
+            coin_data["market_cap"] if "market_cap" in coin_data else symbol_and_market_data['market_cap'], # coin_data['market_data']['market_cap']['usd'] if coin_data['market_data']['market_cap']['usd'] else float("NaN"),
+            coin_data["volume_(24h)"] if "volume_(24h)" in coin_data else symbol_and_market_data['volume_24h'], # coin_data['market_data']['24_hour_trading_vol'] if coin_data['market_data']['24_hour_trading_vol'] else float("NaN"),
+            coin_data["vol/mkt_cap_(24h)"] if "vol/mkt_cap_(24h)" in coin_data else float("NaN"),
+            coin_data["fdv"] if "fdv" in coin_data else float("NaN"), # coin_data['market_data']['fully_diluted_valuation'] if ('fully_diluted_valuation' in coin_data['market_data'] and coin_data['market_data']['fully_diluted_valuation']) else float("NaN"),
+            coin_data["circulating_supply"] if "circulating_supply" in coin_data else symbol_and_market_data['circulating_supply'],
+            coin_data["max_supply"] if "max_supply" in coin_data else float("NaN"),
+            coin_data["total_supply"] if "total_supply" in coin_data else float("NaN")
+        ]
+    return df_coins
+
+def save_coins_data(date, pages=10, concurrent=False, max_workers=8): # date is in format '%Y-%m-%d' # maybe refactor and add date if code block runs at a datetime.now() which is close to the next day, if runs longer no need to add date since market runs 24/7 # number of pages should be constant
     coins = _fetch_data(get_coins_markets_coinmarketcap, params={'pages': pages}, error_str=" - No " + "" + " coins markets data with pages: " + str(pages) + " on: " + str(datetime.now()), empty_data={}) # refactor all - ensure error_str have date: # 'currency': 'btc',
     df_coins = pd.DataFrame(columns = ["Market Cap Rank", "Facebook Likes", "Twitter Followers", "Reddit Subscribers", "Reddit Posts & Comments 48h", "Developer Stars", "Developer Issues", "Alexa Rank", "Price", "Price (BTC)", "Market Cap", "24h Volume", "24h Volume / Market Cap", "Fully Diluted Valuation", "Supply: Circulating", "Supply: Max", "Supply: Total"]) # maybe refactor and add columns which measure other KPIs (look to stocks.py for motivation)
-    count = 0
-    for coin_id, symbol_and_market_data in coins.items(): # here and throughout where iterating over get_coins_markets_cg assuming that all necessary keys are there (not checking for example if 'market_cap_rank', 'current_price', 'symbol' in coin) (has been the case in all cases observed)
-        count += 1
-        if count % 134 == 0:
-            print("Sleeping 1min every 134 requests on: " + str(datetime.now()))
-            time.sleep(1*60)
-        coin_data = _fetch_data(get_coin_data, params={'coin': coin_id}, error_str=" - No " + "" + " coin data for: " + coin_id + " on: " + str(datetime.now()), empty_data={})
-        if not coin_data:
-            print("Error retrieving initial coin data for: " + coin_id)
-            df_coins.loc[coin_id, ["Market Cap Rank", "Price", "Market Cap", "24h Volume", "Supply: Circulating"]] = [symbol_and_market_data['market_cap_rank'], symbol_and_market_data['price'], symbol_and_market_data['market_cap'], symbol_and_market_data['volume_24h'], symbol_and_market_data['circulating_supply']]
-        else:
-            # generally incomplete historical community data: facebook likes, twitter followers; developer data
-            df_coins.loc[coin_id] = [
-                symbol_and_market_data['market_cap_rank'],
-                float("NaN"), # coin_data['community_data']['facebook_likes'] if coin_data['community_data']['facebook_likes'] else float("NaN"),
-                float("NaN"), # coin_data['community_data']['twitter_followers'] if coin_data['community_data']['twitter_followers'] else float("NaN"),
-                float("NaN"), # coin_data['community_data']['reddit_subscribers'] if coin_data['community_data']['reddit_subscribers'] else float("NaN"),
-                float("NaN"), # coin_data['community_data']['reddit_average_posts_48h'] + coin_data['community_data']['reddit_average_comments_48h'] if (coin_data['community_data']['reddit_average_posts_48h'] and coin_data['community_data']['reddit_average_comments_48h']) else float("NaN"),
-                float("NaN"), # coin_data['developer_data']['stars'] if coin_data['developer_data']['stars'] else float("NaN"),
-                float("NaN"), # coin_data['developer_data']['total_issues'] if coin_data['developer_data']['total_issues'] else float("NaN"),
-                float("NaN"), # coin_data['public_interest_stats']['alexa_rank'] if coin_data['public_interest_stats']['alexa_rank'] else float("NaN"),
-                coin_data["price"] if "market_cap" in coin_data else symbol_and_market_data['price'], # float("NaN")
-                float("NaN"), # coin_data['market_data']['current_price']['btc'] if coin_data['market_data']['current_price']['btc'] else float("NaN"),
-                coin_data["market_cap"] if "market_cap" in coin_data else symbol_and_market_data['market_cap'], # coin_data['market_data']['market_cap']['usd'] if coin_data['market_data']['market_cap']['usd'] else float("NaN"),
-                coin_data["volume_(24h)"] if "volume_(24h)" in coin_data else symbol_and_market_data['volume_24h'], # coin_data['market_data']['24_hour_trading_vol'] if coin_data['market_data']['24_hour_trading_vol'] else float("NaN"),
-                coin_data["vol/mkt_cap_(24h)"] if "vol/mkt_cap_(24h)" in coin_data else float("NaN"),
-                coin_data["fdv"] if "fdv" in coin_data else float("NaN"), # coin_data['market_data']['fully_diluted_valuation'] if ('fully_diluted_valuation' in coin_data['market_data'] and coin_data['market_data']['fully_diluted_valuation']) else float("NaN"),
-                coin_data["circulating_supply"] if "circulating_supply" in coin_data else symbol_and_market_data['circulating_supply'],
-                coin_data["max_supply"] if "max_supply" in coin_data else float("NaN"),
-                coin_data["total_supply"] if "total_supply" in coin_data else float("NaN")
-            ]
+    if concurrent: # bounded worker pool, coinmarketcap requests paced by rate_limits['coinmarketcap'] token bucket instead of sleeping 1min every 134 requests
+        coins_data, errors, start_time = {}, 0, time.time()
+        def _fetch_coin_data(coin_id):
+            _rate_limiter_acquire('coinmarketcap')
+            return _fetch_data(get_coin_data, params={'coin': coin_id}, error_str=" - No " + "" + " coin data for: " + coin_id + " on: " + str(datetime.now()), empty_data={})
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(_fetch_coin_data, coin_id): coin_id for coin_id in coins}
+            for future in as_completed(futures):
+                coins_data[futures[future]] = future.result()
+                errors += 0 if coins_data[futures[future]] else 1
+                if len(coins_data) % 100 == 0 or len(coins_data) == len(coins):
+                    print("save_coins_data progress: " + str(len(coins_data)) + "/" + str(len(coins)) + " coins, " + str(errors) + " errors, elapsed: " + str(round(time.time() - start_time, 1)) + "s on: " + str(datetime.now()))
+        for coin_id, symbol_and_market_data in coins.items(): # iterate in coins (market cap rank) order so df_coins index order matches serial mode
+            df_coins = _add_coin_data_to_df_coins(df_coins, coin_id, symbol_and_market_data, coins_data[coin_id])
+    else:
+        count = 0
+        for coin_id, symbol_and_market_data in coins.items(): # here and throughout where iterating over get_coins_markets_cg assuming that all necessary keys are there (not checking for example if 'market_cap_rank', 'current_price', 'symbol' in coin) (has been the case in all cases observed)
+            count += 1
+            if (count % 134 == 0) and (offline['mode'] != 'replay'):
+                print("Sleeping 1min every 134 requests on: " + str(datetime.now()))
+                time.sleep(1*60)
+            coin_data = _fetch_data(get_coin_data, params={'coin': coin_id}, error_str=" - No " + "" + " coin data for: " + coin_id + " on: " + str(datetime.now()), empty_data={})
+            df_coins = _add_coin_data_to_df_coins(df_coins, coin_id, symbol_and_market_data, coin_data)
     f = open('data/crypto/saved_coins_data/' + 'coins_' + date + '.pckl', 'wb') # 2020_06_02, format is '%Y-%m-%d' # datetime.now().strftime('%Y-%m-%d')
     pd.to_pickle(df_coins, f)
     f.close()
+    save_coins_history(date, df_coins) # also append to columnar store which get_saved_coins_data reads first
     return df_coins
 
 # 02/24/2020 is first day with 100 coins, 02/27/2020 is first day with 200 coins, 03/09/2020 is first day with 250 coins, 07/04/2020 is first day with 1000 coins, 2022-04-25->26 frozen, 2024-07-28->29 frozen, 2025-02-02->11 Jackson Hole some error, 2025-02-20->24 KCS retrieval error
 def get_saved_coins_data(date): # date is a string in format '%Y-%m-%d'
+    df_coins_historical = get_saved_coins_history(date) # columnar store first (memory-mapped, only reads the rows for date), falls back to coins_<date>.pckl if date not migrated / saved there
+    if not df_coins_historical.empty:
+        return df_coins_historical
     try:
         f = open('data/crypto/saved_coins_data/' + 'coins_' + date + '.pckl', 'rb')
         df_coins_historical = pd.read_pickle(f)
@@ -281,32 +1103,222 @@ def get_saved_coins_data(date): # date is a string in format '%Y-%m-%d'
         df_coins_historical = pd.DataFrame()
     return df_coins_historical
 
+# append-only columnar store of saved coins data (date x coin): index.json (dates, row offsets, coin ids, columns) + one raw binary file per column (float64) and coin_idx.bin (int32), rows for a date are contiguous and in saved (market cap rank) order, so loading a date or date range only reads (memory-maps) those rows
+# saving a date again appends its new rows and marks the old ones superseded (None in dates), each date's saved dtypes are restored on read so frames match coins_<date>.pckl
+# columns are only created once they have a non-NaN value (i.e. 'Facebook Likes', 'Alexa Rank' are always NaN since moving to coinmarketcap) and rows before a column's 'start' row are NaN
+coins_history_path = 'data/crypto/saved_coins_history/'
+_coins_history_cache = {}
+
+def _coins_history_index(path=coins_history_path):
+    index_file = path + 'index.json'
+    if not os.path.exists(index_file):
+        return None
+    mtime = (os.stat(index_file).st_mtime_ns, os.stat(index_file).st_size)
+    if path in _coins_history_cache and _coins_history_cache[path]['mtime'] == mtime:
+        return _coins_history_cache[path]
+    with open(index_file, 'r') as f:
+        index = json.load(f)
+    index['date_to_pos'] = {date: pos for pos, date in enumerate(index['dates']) if date is not None} # None is a superseded (saved again) date
+    index['coins_array'] = np.array(index['coins'], dtype=object)
+    index['mtime'], index['memmaps'] = mtime, {}
+    _coins_history_cache[path] = index
+    return index
+
+def _coins_history_memmap(index, file_name, dtype, path=coins_history_path):
+    n_rows = index['offsets'][-1] if index['offsets'] else 0
+    if file_name not in index['memmaps']:
+        n_items = os.path.getsize(path + file_name) // np.dtype(dtype).itemsize if os.path.exists(path + file_name) else 0
+        index['memmaps'][file_name] = np.memmap(path + file_name, dtype=dtype, mode='r', shape=(min(n_items, n_rows),)) if min(n_items, n_rows) else np.empty(0, dtype=dtype) # np.memmap errors on empty files
+    return index['memmaps'][file_name]
+
+def save_coins_history(date, df_coins, path=coins_history_path): # date is a string in format '%Y-%m-%d', append only - a date saved again replaces the date's rows
+    os.makedirs(path, exist_ok=True)
+    index = {'dates': [], 'offsets': [0], 'coins': [], 'columns': {}, 'schemas': [], 'schema_dtypes': [], 'date_schema': []}
+    if os.path.exists(path + 'index.json'): # read from disk rather than _coins_history_cache since index is modified below
+        with open(path + 'index.json', 'r') as f:
+            index = json.load(f)
+        index.setdefault('schema_dtypes', [None]*len(index['schemas'])) # stores saved before dtypes were kept read as float64
+    coin_to_idx, n_rows = {coin: idx for idx, coin in enumerate(index['coins'])}, index['offsets'][-1]
+    for coin in df_coins.index:
+        if coin not in coin_to_idx:
+            coin_to_idx[coin] = len(index['coins'])
+            index['coins'].append(coin)
+    values = df_coins.astype('float64')
+    for column in values.columns:
+        if column not in index['columns'] and values[column].notna().any():
+            index['columns'][column] = {'file': re.sub(r'[^0-9a-z]+', '_', column.lower()).strip('_') + '.bin', 'start': n_rows}
+    for file_name, start, array in [('coin_idx.bin', 0, np.array([coin_to_idx[coin] for coin in df_coins.index], dtype=np.int32))] + [(column_info['file'], column_info['start'], values[column].to_numpy(dtype=np.float64) if column in values.columns else np.full(len(values), np.nan)) for column, column_info in index['columns'].items()]:
+        with open(path + file_name, 'ab') as f:
+            f.truncate((n_rows - start)*array.itemsize) # drops rows of a crashed (not indexed) append
+            f.write(array.tobytes())
+    dtypes = {column: str(dtype) for column, dtype in df_coins.dtypes.items()}
+    schema = next((schema for schema, (schema_columns, schema_dtypes) in enumerate(zip(index['schemas'], index['schema_dtypes'])) if schema_columns == list(values.columns) and schema_dtypes == dtypes), None)
+    if schema is None:
+        schema = len(index['schemas'])
+        index['schemas'].append(list(values.columns))
+        index['schema_dtypes'].append(dtypes)
+    if date in index['dates']: # saved again (i.e. save_coins_data re-run), reads use the new rows
+        index['dates'][index['dates'].index(date)] = None
+    index['dates'].append(date)
+    index['offsets'].append(n_rows + len(values))
+    index['date_schema'].append(schema)
+    with open(path + 'index.json.tmp', 'w') as f: # index written last (and atomically) so a crash mid-append leaves the previous index valid
+        json.dump(index, f)
+    os.replace(path + 'index.json.tmp', path + 'index.json')
+    return _coins_history_index(path)
+
+def get_saved_coins_history(start_date, end_date=None, columns=None, path=coins_history_path): # dates are strings in format '%Y-%m-%d', single date returns same DataFrame as get_saved_coins_data, date range returns DataFrame with (date, coin) MultiIndex
+    index = _coins_history_index(path)
+    dates = [start_date] if not end_date else [(datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days=day)).strftime('%Y-%m-%d') for day in range((datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')).days + 1)]
+    dfs = {}
+    for date in dates:
+        if not index or date not in index['date_to_pos']:
+            continue
+        pos = index['date_to_pos'][date]
+        row_start, row_stop = index['offsets'][pos], index['offsets'][pos + 1]
+        coins = index['coins_array'][_coins_history_memmap(index, 'coin_idx.bin', np.int32, path)[row_start:row_stop]]
+        date_columns = columns if columns else index['schemas'][index['date_schema'][pos]]
+        data = np.full((row_stop - row_start, len(date_columns)), np.nan) # single float64 block, faster DataFrame construction than dict of columns
+        for col_idx, column in enumerate(date_columns):
+            column_info = index['columns'].get(column)
+            if column_info and row_stop > column_info['start']:
+                row_first = max(row_start, column_info['start'])
+                data[row_first - row_start:, col_idx] = _coins_history_memmap(index, column_info['file'], np.float64, path)[row_first - column_info['start']:row_stop - column_info['start']]
+        dfs[date] = pd.DataFrame(data, index=pd.Index(list(coins)), columns=date_columns)
+        dtypes = index['schema_dtypes'][index['date_schema'][pos]] if index.get('schema_dtypes') else None
+        if dtypes and any(dtypes.get(column, 'float64') != 'float64' for column in date_columns):
+            dfs[date] = dfs[date].astype({column: dtypes[column] for column in date_columns if dtypes.get(column, 'float64') != 'float64'})
+    if not end_date:
+        return dfs[start_date] if start_date in dfs else pd.DataFrame()
+    return pd.concat(dfs, names=['date', 'coin']) if dfs else pd.DataFrame()
+
+def migrate_saved_coins_data_to_history(path=coins_history_path): # one shot, appends every data/crypto/saved_coins_data/coins_<date>.pckl (in date order) not already in the columnar store
+    dates = sorted(file_name[len('coins_'):-len('.pckl')] for file_name in os.listdir('data/crypto/saved_coins_data/') if re.match(r'coins_\d{4}-\d{2}-\d{2}\.pckl$', file_name))
+    for date in dates:
+        index = _coins_history_index(path)
+        if index and date in index['date_to_pos']:
+            continue
+        f = open('data/crypto/saved_coins_data/' + 'coins_' + date + '.pckl', 'rb')
+        df_coins = pd.read_pickle(f)
+        f.close()
+        if not df_coins.empty:
+            save_coins_history(date, df_coins, path=path)
+    print("migrated " + str(len(dates)) + " saved coins data dates to: " + path)
+
+# Google Trends per (term, window) cache: in-memory LRU backed by sqlite on disk like coin_history_cache, only windows that ended before today (utc) without partial data are cached, one TrendReq session reused per (hl, tz), payloads paced by rate_limits['google_trends']
+# uncached terms are queried batch_size (max 5) per payload and each term rescaled to its own max of 100 and rounded to integers (like querying it alone, which is what trendline slopes were computed on), terms with max below min_batch_max in a batch are re-queried alone so rounding doesn't flatten them
+google_trends_cache = {'path': 'data/crypto/saved_google_trends_cache/google_trends.sqlite', 'max_size': 10000, 'enabled': True, 'batch_size': 5, 'min_batch_max': 25, 'memory': OrderedDict(), 'sessions': {}, 'stats': Counter(), 'lock': threading.Lock(), 'session_lock': threading.Lock(), 'db': None}
+
+def _google_trends_cache_db():
+    if google_trends_cache['db'] is None:
+        os.makedirs(os.path.dirname(google_trends_cache['path']), exist_ok=True)
+        google_trends_cache['db'] = sqlite3.connect(google_trends_cache['path'], check_same_thread=False) # access serialized by google_trends_cache['lock']
+        google_trends_cache['db'].execute("CREATE TABLE IF NOT EXISTS google_trends (key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    return google_trends_cache['db']
+
+def _google_trends_cache_get(key):
+    if not google_trends_cache['enabled']:
+        return None
+    with google_trends_cache['lock']:
+        if key in google_trends_cache['memory']:
+            google_trends_cache['stats']['memory_hits'] += 1
+            google_trends_cache['memory'].move_to_end(key)
+            return google_trends_cache['memory'][key]
+        row = _google_trends_cache_db().execute("SELECT data FROM google_trends WHERE key = ?", (key,)).fetchone()
+        if row:
+            google_trends_cache['stats']['disk_hits'] += 1
+            google_trends_cache['memory'][key] = json.loads(row[0])
+            if len(google_trends_cache['memory']) > google_trends_cache['max_size']:
+                google_trends_cache['memory'].popitem(last=False)
+            return google_trends_cache['memory'][key]
+        google_trends_cache['stats']['misses'] += 1
+    return None
+
+def _google_trends_cache_put(key, series, to_date):
+    if (not google_trends_cache['enabled']) or (to_date.date() >= datetime.utcnow().date()) or any(series['isPartial']): # current window can still change
+        return
+    with google_trends_cache['lock']:
+        _google_trends_cache_db().execute("INSERT OR REPLACE INTO google_trends (key, data) VALUES (?, ?)", (key, json.dumps(series)))
+        _google_trends_cache_db().commit()
+        google_trends_cache['memory'][key] = series
+        if len(google_trends_cache['memory']) > google_trends_cache['max_size']:
+            google_trends_cache['memory'].popitem(last=False)
+
+def _google_trends_query(kw_list, timeframe, cat, geo, tz, gprop, hl): # one payload (up to 5 keywords) on the reused session, errors raised to _fetch_data
+    _rate_limiter_acquire('google_trends')
+    def _interest_over_time():
+        with google_trends_cache['session_lock']: # TrendReq keeps payload state, one query at a time
+            if (hl, tz) not in google_trends_cache['sessions']:
+                from pytrends.request import TrendReq
+                google_trends_cache['sessions'][(hl, tz)] = TrendReq(hl=hl, tz=tz)
+            _pytrends = google_trends_cache['sessions'][(hl, tz)]
+            _pytrends.build_payload(kw_list, cat=cat, timeframe=[timeframe], geo=geo, gprop=gprop)
+            return _pytrends.interest_over_time()
+    data = _offline_call('google_trends', 'interest_over_time', [kw_list, timeframe, cat, geo, tz, gprop, hl], _interest_over_time) # recorded / replayed (set_offline_mode)
+    google_trends_cache['stats']['payloads'] += 1
+    return data
+
+def _google_trends_series(data, kw, rescale=False): # {'date', 'value', 'isPartial'} lists for kw, values rescaled to own max of 100 if rescale, empty lists if no data
+    if data.empty or kw not in data.columns:
+        return {'date': [], 'value': [], 'isPartial': []}
+    values, value_max = data[kw].tolist(), data[kw].max()
+    return {'date': [date.isoformat() for date in data.index], 'value': [int(round(value*100.0/value_max)) for value in values] if rescale and value_max and value_max != 100 else values, 'isPartial': [bool(is_partial) for is_partial in data['isPartial']] if 'isPartial' in data.columns else [False]*len(values)}
+
+def _get_google_trends_series(kw_list, from_date, to_date, cat=0, geo='', tz=480, gprop='', hl='en-US'): # {kw: series} from cache, uncached terms batched
+    timeframe = from_date.strftime('%Y-%m-%d') + ' ' + to_date.strftime('%Y-%m-%d')
+    keys = {kw: json.dumps([kw, timeframe, cat, geo, tz, gprop, hl]) for kw in dict.fromkeys(kw_list)}
+    kw_series = {kw: _google_trends_cache_get(key) for kw, key in keys.items()}
+    missing = [kw for kw, series in kw_series.items() if series is None]
+    batch_size = max(1, min(google_trends_cache['batch_size'], 5))
+    for idx in range(0, len(missing), batch_size):
+        batch = missing[idx:idx + batch_size]
+        data = _google_trends_query(batch, timeframe, cat=cat, geo=geo, tz=tz, gprop=gprop, hl=hl)
+        for kw in batch:
+            if (len(batch) > 1) and (data.empty or kw not in data.columns or data[kw].max() < google_trends_cache['min_batch_max']): # too coarse (or no data) relative to other terms, query alone
+                kw_series[kw] = _google_trends_series(_google_trends_query([kw], timeframe, cat=cat, geo=geo, tz=tz, gprop=gprop, hl=hl), kw)
+            else:
+                kw_series[kw] = _google_trends_series(data, kw, rescale=len(batch) > 1)
+            _google_trends_cache_put(keys[kw], kw_series[kw], to_date)
+    return kw_series
+
+def prefetch_google_trends(kw_list, from_date, to_date, cat=0, geo='', tz=480, gprop='', hl='en-US'): # fills cache for all terms (batched) so following get_google_trends_pt calls for the same window are cache hits, returns number of terms with data
+    return sum(1 for series in _get_google_trends_series(kw_list, from_date, to_date, cat=cat, geo=geo, tz=tz, gprop=gprop, hl=hl).values() if series['value'])
+
 def get_google_trends_pt(kw_list, from_date, to_date, trend_days=270, cat=0, geo='', tz=480, gprop='', hl='en-US', isPartial_col=False): # trend_days max is around 270 # category to narrow results # geo e.g 'US', 'UK' # tz = timezone offset default is 360 which is US CST (UTC-6), PST is 480 (assuming UTC-8*60) # hl language default is en-US # gprop : filter results to specific google property like 'images', 'news', 'youtube' or 'froogle' # overlap=100, sleeptime=1, not doing multiple searches # other variables: timeout=(10,25), proxies=['https://34.203.233.13:80',], retries=2, backoff_factor=0.1, requests_args={'verify':False}, from_start=False, scale_cols=True
     data = pd.DataFrame()
-    if len(kw_list) != 1: # not doing multirange_interest_over_time: len(kw_list)==0 or len(kw_list)>5
-        print("Error: The keyword list must be 1, not doing multirange_interest_over_time") # be > 0 and can contain at most 5 words
+    if not (0 < len(kw_list) <= 5): # not doing multirange_interest_over_time
+        print("Error: The keyword list must be > 0 and can contain at most 5 words")
         return data
     # not verifying from_date, to_date types, _fetch_data should handle error
     n_days = (to_date - from_date).days
     if n_days>270 or trend_days>270:
         print("Error: To - From Dates or Trend days must not exceed 270")
         return data
-    _pytrends = TrendReq(hl=hl, tz=tz)
-    # pytrends.build_payload(kw_list, cat=0, timeframe=, geo='', gprop='')
-    try:
-        _pytrends.build_payload(kw_list, cat=cat, timeframe=[from_date.strftime('%Y-%m-%d') + ' ' + to_date.strftime('%Y-%m-%d')], geo=geo, gprop=gprop) # trend_dates[0]
-    except Exception as e:
-        print(str(e) + " - No (or issue with) Pytrends for kw_list: " + str(kw_list) + " with from_date: " + str(from_date) + " and to_date: " + str(to_date))
-    data = _pytrends.interest_over_time().reset_index()
+    return _google_trends_frame(_get_google_trends_series(kw_list, from_date, to_date, cat=cat, geo=geo, tz=tz, gprop=gprop, hl=hl), isPartial_col=isPartial_col) # each kw scaled to its own max of 100 (same as a single keyword query)
+
+def _google_trends_frame(kw_series, isPartial_col=False): # get_google_trends_pt DataFrame ('date' and one column per kw) from _get_google_trends_series {kw: series}
+    data = pd.DataFrame()
+    kw_series = {kw: series for kw, series in kw_series.items() if series['value']}
+    if not kw_series: # no data, like pytrends empty interest_over_time
+        return data
+    data = pd.DataFrame({kw: pd.Series(series['value'], index=pd.to_datetime(series['date'])) for kw, series in kw_series.items()}) # aligned on date (terms can come from different payloads / cache)
+    data['isPartial'] = pd.DataFrame({kw: pd.Series(series['isPartial'], index=pd.to_datetime(series['date'])) for kw, series in kw_series.items()}).fillna(False).any(axis=1)
+    data = data.rename_axis('date').reset_index()
+    data['date'] = data['date'].astype('datetime64[ns]') # same as pytrends interest_over_time
     if not isPartial_col:
         data.drop('isPartial', axis=1, inplace=True)
     return data
 
+def get_google_trends_cache_stats():
+    stats = google_trends_cache['stats']
+    lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+    return {'memory_hits': stats['memory_hits'], 'disk_hits': stats['disk_hits'], 'misses': stats['misses'], 'hit_rate': (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else float("NaN"), 'payloads': stats['payloads'], 'memory_size': len(google_trends_cache['memory'])}
+
 # Currently, the KuCoin operations are not licensed in the USA; hence, it doesn’t have to report to IRS. However, the company states that it may disclose personal data at the request of government authorities. Therefore, you should report any income you generate from KuCoin to tax authorities.
 # Kucoin API is restricted for each account, the request rate limit is 45 times/3s
 def get_kucoin_pairs(): # pair="USDT"
     base_url = "https://api.kucoin.com"
-    resp = requests.get(base_url + '/api/v1/market/allTickers')
+    resp = _http_request(base_url + '/api/v1/market/allTickers')
     data = json.loads(resp.text)
     kucoin_pairs_with_price_and_vol_current = {}
     for pair_price in data['data']['ticker']:
@@ -314,6 +1326,37 @@ def get_kucoin_pairs(): # pair="USDT"
             kucoin_pairs_with_price_and_vol_current[pair_price['symbol']] = {'price': float(pair_price['last']), '24h_volume': float(pair_price['volValue']) if ('volValue' in pair_price) and pair_price['volValue'] else float("NaN")}
     return kucoin_pairs_with_price_and_vol_current
 
+# shared get_kucoin_pairs() snapshot (allTickers is ~1000 symbols) so portfolio_trading, kucoin_trade_coin_usdt and the retry functions make one tickers request per cycle instead of one per coin / order, refetched when older than max_staleness seconds
+kucoin_pairs_snapshot = {'max_staleness': 30, 'data': {}, 'time': None, 'refreshing': False, 'refreshed': threading.Event(), 'stats': Counter(), 'lock': threading.Lock()} # tickers fetched outside lock, at most one fetch at a time (concurrent callers wait for it)
+kucoin_pairs_snapshot['refreshed'].set() # cleared while a fetch runs
+
+def get_kucoin_pairs_snapshot(refresh=False, max_staleness=None): # refresh=True at start of trading cycle, returns {} (like _fetch_data empty_data) and keeps previous snapshot if refetch fails
+    max_staleness = max_staleness if max_staleness is not None else kucoin_pairs_snapshot['max_staleness']
+    with kucoin_pairs_snapshot['lock']:
+        if not refresh and kucoin_pairs_snapshot['data'] and (time.time() - kucoin_pairs_snapshot['time'] <= max_staleness):
+            kucoin_pairs_snapshot['stats']['hits'] += 1
+            return kucoin_pairs_snapshot['data']
+        refreshing, wait_start_time = kucoin_pairs_snapshot['refreshing'], time.time()
+        if not refreshing:
+            kucoin_pairs_snapshot['refreshing'] = True
+            kucoin_pairs_snapshot['refreshed'].clear()
+    if refreshing: # another thread is fetching (_fetch_data can retry for up to a minute), use its result
+        kucoin_pairs_snapshot['refreshed'].wait()
+        with kucoin_pairs_snapshot['lock']:
+            kucoin_pairs_snapshot['stats']['waits'] += 1
+            return kucoin_pairs_snapshot['data'] if kucoin_pairs_snapshot['time'] and (kucoin_pairs_snapshot['time'] >= wait_start_time) else {}
+    kucoin_pairs_with_price_and_vol_current = {}
+    try:
+        kucoin_pairs_with_price_and_vol_current = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={})
+    finally:
+        with kucoin_pairs_snapshot['lock']:
+            kucoin_pairs_snapshot['stats']['refreshes' if kucoin_pairs_with_price_and_vol_current else 'errors'] += 1
+            if kucoin_pairs_with_price_and_vol_current:
+                kucoin_pairs_snapshot['data'], kucoin_pairs_snapshot['time'] = kucoin_pairs_with_price_and_vol_current, time.time()
+            kucoin_pairs_snapshot['refreshing'] = False
+            kucoin_pairs_snapshot['refreshed'].set()
+    return kucoin_pairs_with_price_and_vol_current
+
 def get_binance_pairs():
     binance_pairs_with_price_current = {}
     for pair_price in _fetch_data(binance_client.get_all_tickers, params={}, error_str=" - Binance get all tickers error on: " + str(datetime.now()), empty_data=[]):
@@ -321,43 +1364,208 @@ def get_binance_pairs():
             binance_pairs_with_price_current[pair_price['symbol']] = {'price': float(pair_price['price'])}
     return binance_pairs_with_price_current
 
-def kucoin_trade_coin_usdt(symbol_pair, coin, trade=None, side=None, usdt_invest=None, quantity=None, price_in_btc=None, paper_trading=True, open_time=5, other_notes=None):
+# instrument registry: coinmarketcap id (portfolio coin id) <-> symbol <-> coingecko id <-> Kucoin pair (<SYMBOL>-USDT) <-> Binance pair (<SYMBOL>BTC) with O(1) lookups, built from coinmarketcap listing (+ coingecko markets and exchange tickers), persisted to instrument_registry['path'] and refreshed in the background when older than max_staleness (seconds) so asset checks don't scrape coinmarketcap
+# collision rules: a symbol belongs to the highest market cap coin with it (first in listing) and only that coin gets the symbol's exchange pairs (get_instrument_symbol returns None for the others so they aren't traded under another coin's symbol), instrument_symbol_fallbacks only for symbols not in the listing, coingecko id is the same id if coingecko has it otherwise the coingecko coin with the same symbol (excluding cg_same_symbol_coins)
+# min_buy_refresh_interval: update_portfolio_buy_and_sell_coins refreshes (blocking) before live buys if a coin to buy isn't in a registry older than this (seconds), so coins listed since the last refresh aren't skipped
+instrument_registry = {'path': 'data/crypto/instrument_registry.json', 'max_staleness': 24*60*60, 'min_buy_refresh_interval': 60*60, 'pages': 10, 'cg_pages': 4, 'data': None, 'time': None, 'refreshing': False, 'refreshed': threading.Event(), 'stats': Counter(), 'lock': threading.Lock()}
+instrument_registry['refreshed'].set() # cleared while a refresh runs
+instrument_symbol_fallbacks = {'btc': 'bitcoin', 'bnb': 'binancecoin', 'fet': 'fetch-ai', 'kmd': 'komodo', 'cnd': 'cindicator', 'coti': 'coti', 'tfuel': 'theta-fuel', 'tomo': 'tomochain', 'gto': 'gifto', 'btg': 'bitcoin-gold'} # assets 'FET', 'KMD' leftover from qtrading and cryptohopper trades, 'TFUEL' from THETA, 'GTO' and 'BTG' from arbitrage, see get_binance_assets
+
+def _instrument_registry_index(coins, time_built): # coins in market cap rank order
+    data = {'time': time_built, 'coins': coins, 'id': {}, 'symbol': {}, 'cg_id': {}, 'kucoin_pair': {}, 'binance_pair': {}}
+    for coin in coins:
+        data['id'][coin['id']] = coin
+        data['symbol'].setdefault(coin['symbol'], coin)
+        for by in ['cg_id', 'kucoin_pair', 'binance_pair']:
+            if coin[by]:
+                data[by].setdefault(coin[by], coin)
+    return data
+
+def _build_instrument_registry(pages, cg_pages):
+    coins_data = _fetch_data(get_coins_markets_coinmarketcap, params={'pages': pages}, error_str=" - No " + "" + " coins markets data with pages: " + str(pages) + " on: " + str(datetime.now()), empty_data={})
+    if not coins_data:
+        return None
+    cg_coins = _fetch_data(get_coins_markets_cg, params={'currency': 'usd', 'pages': cg_pages}, error_str=" - No " + "CoinGecko" + " coins markets data with pages: " + str(cg_pages) + " on: " + str(datetime.now()), empty_data=[]) if cg_pages else [] # optional, coingecko ids left None if it fails (403)
+    cg_ids, cg_symbol_to_id = set(coin['id'] for coin in cg_coins), {}
+    for coin in cg_coins:
+        cg_symbol_to_id.setdefault(coin['symbol'], coin['id'])
+    kucoin_pairs = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={})
+    binance_pairs = _fetch_data(get_binance_pairs, params={}, error_str=" - Binance get all tickers error on: " + str(datetime.now()), empty_data={}) # {} if binance_client not set
+    coins, symbols = [], set()
+    for coin_id, symbol_and_market_data in list(coins_data.items()) + [[coin_id, {'symbol': symbol, 'market_cap_rank': float("NaN")}] for symbol, coin_id in instrument_symbol_fallbacks.items() if coin_id not in coins_data]:
+        symbol = symbol_and_market_data['symbol']
+        if (coin_id in instrument_symbol_fallbacks.values()) and (coin_id not in coins_data) and (symbol in symbols): # fallback only if symbol not in listing
+            continue
+        symbol_owner = symbol not in symbols
+        symbols.add(symbol)
+        coins.append({'id': coin_id, 'symbol': symbol, 'market_cap_rank': symbol_and_market_data['market_cap_rank'], 'symbol_owner': symbol_owner, 'cg_id': coin_id if coin_id in cg_ids else cg_symbol_to_id.get(symbol) if symbol_owner else None, 'kucoin_pair': symbol.upper() + '-USDT' if symbol_owner and (symbol.upper() + '-USDT' in kucoin_pairs) else None, 'binance_pair': symbol.upper() + 'BTC' if symbol_owner and (symbol.upper() + 'BTC' in binance_pairs) else None})
+    return coins
+
+def refresh_instrument_registry(pages=None, cg_pages=None, background=False): # background=True returns immediately (at most one refresh at a time), otherwise returns registry data after the refresh (waits for one already running, previous data kept if coinmarketcap fetch fails)
+    pages, cg_pages = pages if pages else instrument_registry['pages'], cg_pages if cg_pages is not None else instrument_registry['cg_pages']
+    with instrument_registry['lock']:
+        refreshing = instrument_registry['refreshing']
+        if not refreshing:
+            instrument_registry['refreshing'] = True
+            instrument_registry['refreshed'].clear()
+    if refreshing:
+        if not background:
+            instrument_registry['refreshed'].wait()
+        return instrument_registry['data']
+    if background:
+        threading.Thread(target=_refresh_instrument_registry, args=(pages, cg_pages), daemon=True).start()
+        return instrument_registry['data']
+    return _refresh_instrument_registry(pages, cg_pages)
+
+def _refresh_instrument_registry(pages, cg_pages):
+    try:
+        coins = _build_instrument_registry(pages, cg_pages)
+        with instrument_registry['lock']:
+            instrument_registry['stats']['refreshes' if coins else 'errors'] += 1
+            if coins:
+                instrument_registry['data'], instrument_registry['time'] = _instrument_registry_index(coins, time.time()), time.time()
+        if coins:
+            os.makedirs(os.path.dirname(instrument_registry['path']), exist_ok=True)
+            with open(instrument_registry['path'] + '.tmp', 'w') as f:
+                json.dump({'time': instrument_registry['time'], 'coins': coins}, f)
+            os.replace(instrument_registry['path'] + '.tmp', instrument_registry['path'])
+    except Exception as e:
+        print(str(e) + " - Instrument registry refresh error on: " + str(datetime.now()))
+    finally:
+        with instrument_registry['lock']:
+            instrument_registry['refreshing'] = False
+            instrument_registry['refreshed'].set()
+    return instrument_registry['data']
+
+def get_instrument_registry(refresh=False, pages=None): # loads from disk on first call, builds (blocking) if there is none, refreshes in the background if older than max_staleness
+    with instrument_registry['lock']:
+        if (instrument_registry['data'] is None) and os.path.exists(instrument_registry['path']):
+            try:
+                with open(instrument_registry['path']) as f:
+                    saved_registry = json.load(f)
+                instrument_registry['data'], instrument_registry['time'] = _instrument_registry_index(saved_registry['coins'], saved_registry['time']), saved_registry['time']
+            except Exception as e:
+                print(str(e) + " - Instrument registry load error: " + instrument_registry['path'])
+        data, registry_time = instrument_registry['data'], instrument_registry['time']
+    if refresh or data is None:
+        return refresh_instrument_registry(pages=pages) or {'time': None, 'coins': [], 'id': {}, 'symbol': {}, 'cg_id': {}, 'kucoin_pair': {}, 'binance_pair': {}}
+    if time.time() - registry_time > instrument_registry['max_staleness']:
+        refresh_instrument_registry(pages=pages, background=True)
+    instrument_registry['stats']['hits'] += 1
+    return data
+
+def get_instrument(value, by='symbol'): # by is 'id' (coinmarketcap), 'symbol', 'cg_id', 'kucoin_pair' or 'binance_pair', returns {'id', 'symbol', 'market_cap_rank', 'symbol_owner', 'cg_id', 'kucoin_pair', 'binance_pair'} or None
+    return get_instrument_registry()[by].get(value)
+
+def get_instrument_symbol(coin): # symbol for coin id if coin owns the symbol (collision rule) otherwise None
+    instrument = get_instrument(coin, by='id')
+    return instrument['symbol'] if instrument and instrument['symbol_owner'] else None
+
+def _kucoin_order_values(symbol_pair, kucoin_pairs_with_price_and_vol_current, trade=None, side=None, usdt_invest=None, quantity=None, price=None, price_in_btc=None, client=None): # returns [side, quantity, price, price_in_btc] for the limit order
+    client = client if client else kucoin_client
     if not (trade or side):
         raise ValueError('trade or side value is required')
     if not (usdt_invest or quantity): # or (quantity and not (quantity % int(quantity) == 0) # (quantity and not isinstance(quantity, int)) # allow selling of non-integer quantities if quantity specified since retry open orders can be non-integer since executed quantity can be a float, i.e. WNXMBTC retry open order buy on 09/04/2020: quantity (18.394) = original_quantity(24) - executed_quantity(5.606)
         raise ValueError("usdt_invest or quantity required") # and if quantity specified must be an integer
     # symbol = symbol_pair.split("-")[0].lower() # symbol_pair = coin.upper() + '-USDT'
-    side = side if side else kucoin_client.SIDE_SELL if trade == "sell" else kucoin_client.SIDE_BUY if trade == "buy" else None # precautionary, case sensitive and string has to be either 'buy' or 'sell' otherwise error in order # binance_client.SIDE_SELL is "SELL" and binance_client.SIDE_BUY is "BUY" but precautionary in case python-binance api changes # side is terminology used by python-binance api
-    kucoin_pairs_with_price_and_vol_current = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={})
-    price, btc_price = kucoin_pairs_with_price_and_vol_current[symbol_pair]['price'] if symbol_pair in kucoin_pairs_with_price_and_vol_current else float("NaN"), kucoin_pairs_with_price_and_vol_current['BTC-USDT']['price'] # maybe refactor add fail safes
+    side = side if side else client.SIDE_SELL if trade == "sell" else client.SIDE_BUY if trade == "buy" else None # precautionary, case sensitive and string has to be either 'buy' or 'sell' otherwise error in order # binance_client.SIDE_SELL is "SELL" and binance_client.SIDE_BUY is "BUY" but precautionary in case python-binance api changes # side is terminology used by python-binance api
+    price, btc_price = price if price else kucoin_pairs_with_price_and_vol_current[symbol_pair]['price'] if symbol_pair in kucoin_pairs_with_price_and_vol_current else float("NaN"), kucoin_pairs_with_price_and_vol_current['BTC-USDT']['price'] # maybe refactor add fail safes
     price_in_btc = price_in_btc if price_in_btc else price / btc_price
     quantity = quantity if quantity else float("NaN") if np.isnan(price) else math.floor(usdt_invest / price) if usdt_invest > 10 else math.ceil(usdt_invest / price) # not checking if price_in_btc > btc_invest (resulting in fractions of a coin for example 'yearn-finance' on 08/10/2020) since would have to return "BTrade Error" which would lead to more logic downstream, easier to check before calling this function, also if it happens quantity = 0 and "BTrade Error" would occur # for now taken care of in update_portfolio_buy_and_sell_coins() - see comments near non-back_testing buying logic # have to worry about insufficient BTC available if round up and minimum order amounts (usually around $10 or 0.001 BTC as of June 12 2020) if round down - error if less than minimum: about APIError(code=-1013): Filter failure: MIN_NOTIONAL # sammchardy/python-binance/issues/219, got (rounding - I think) error for FETBTC: APIError(code=-1013): Filter failure: LOT_SIZE
-    if paper_trading:
-        message_body = "Q Trading @crypto (Paper Trading): " + symbol_pair + " " + (trade if trade else side) + " at price_in_btc " + str(price_in_btc) + " and price $" + str(price) + " and quantity " + str(quantity) + ", " + str(other_notes) + ", :)" # None if 'BTCUSDT' not in binance_pairs_with_price_current because want message to reflect logic of function
-        print("executed kucoin_trade_coin_usdt()\n" + "\033[94m" + message_body +  "\033[0m") # blue # maybe refactor and add other color to function calls
-        return [quantity, price, price_in_btc, {}, [], None] # here and below not returning position ('long' or 'long-p' based on value of paper_trading) as well, only helps in a one situation (complicates logic a bit in another situation) and can also be derived from value of trade_notes
-    # maybe refactor and add precautionary alert to ensure ok with real trading - as parameter in function (to turn alert on or off, default on when not portfolio_trading, off when portfolio_trading)
-    order = _fetch_data(kucoin_client.create_limit_order, params={
+    return [side, quantity, price, price_in_btc]
+
+def _kucoin_paper_order(symbol_pair, trade, side, quantity, price, price_in_btc, other_notes):
+    message_body = "Q Trading @crypto (Paper Trading): " + symbol_pair + " " + (trade if trade else side) + " at price_in_btc " + str(price_in_btc) + " and price $" + str(price) + " and quantity " + str(quantity) + ", " + str(other_notes) + ", :)" # None if 'BTCUSDT' not in binance_pairs_with_price_current because want message to reflect logic of function
+    print("executed kucoin_trade_coin_usdt()\n" + "\033[94m" + message_body +  "\033[0m") # blue # maybe refactor and add other color to function calls
+    return [quantity, price, price_in_btc, {}, [], None] # here and below not returning position ('long' or 'long-p' based on value of paper_trading) as well, only helps in a one situation (complicates logic a bit in another situation) and can also be derived from value of trade_notes
+
+def _kucoin_create_limit_order(symbol_pair, side, quantity, price, trade=None, client=None):
+    client = client if client else kucoin_client
+    return _fetch_data(client.create_limit_order, params={
         'symbol': symbol_pair, #'LINK-USDT',
         'side': side, # kucoin_client.SIDE_BUY,
         'price': price, # 7.29,
         'size': round(quantity, 8)
         # 'timeInForce': 'GTC' # default
     }, error_str=" - Kucoin trade execution error for symbol pair " + str(symbol_pair) + ", " + str(trade if trade else side) + ", price " + str(price) + ", quantity " + str(quantity) + ", " + " on: " + str(datetime.now()), empty_data={})
-    if not order: # maybe refactor and raise error, possibly a precautionary alert like above which is default on when not portfolio_trading, off when portfolio_trading
-        return [quantity, price, price_in_btc, {}, [], "KTrade Error"]
-    # check open_orders immediately and use open_time if no order['fills'] and no open_orders to avoid ~Filled situation and to prevent assigning '~Filled' to a position which should have 'Not filled' (happened with STORJBTC buy on 2020-08-27 17:20:45)
-    open_orders = _fetch_data(kucoin_client.get_orders, params={'symbol': symbol_pair, 'status': 'active'}, error_str=" - Kucoin open orders error for symbol pair: " + symbol_pair + " on: " + str(datetime.now()), empty_data={'items':[]})['items'] # probably need to refactor since this doesn't always work, orders['items'][0]['cancelExist'] is more reliable however the orders['items'][0]['id'] doesn't always work (when cancelling etc) # also need to refactor since might need information besides ['items']
-    if not order['orderId'] and not open_orders: # if not open_orders['items'][0]['cancelExist']: # maybe refactor 'cancelExist' main way of telling if order is open or closed atm # if both of these conditions fail after order went through most likely means that more processing time (on Binance servers) is needed to process open_order (unlikely but possible that open_order was created and executed in the span of ~4 lines of code) # maybe refactor might be able to use 'executedQty'
-        time.sleep(open_time)
-        open_orders = _fetch_data(kucoin_client.get_orders, params={'symbol': symbol_pair, 'status': 'active'}, error_str=" - Kucoin open orders error for symbol pair: " + symbol_pair + " on: " + str(datetime.now()), empty_data={'items':[]})['items'] # ,
+
+def _kucoin_open_orders(symbol_pair, client=None):
+    client = client if client else kucoin_client
+    return _fetch_data(client.get_orders, params={'symbol': symbol_pair, 'status': 'active'}, error_str=" - Kucoin open orders error for symbol pair: " + symbol_pair + " on: " + str(datetime.now()), empty_data={'items':[]})['items'] # probably need to refactor since this doesn't always work, orders['items'][0]['cancelExist'] is more reliable however the orders['items'][0]['id'] doesn't always work (when cancelling etc) # also need to refactor since might need information besides ['items']
+
+def _kucoin_order_trade_notes(symbol_pair, trade, side, quantity, price, price_in_btc, order, open_orders, other_notes): # prints and sms messages the order result, returns trade_notes
     trade_notes = "Filled" if not open_orders else "Not filled" if (open_orders and float(open_orders[0]['size']) == quantity) else "Partially filled" if (open_orders and float(open_orders[0]['size']) != quantity) else "~Filled" # if have open_time > 0 can most likely (high probability) assume that if no order['fills'] and no open_orders that order has been Filled, but keep as precautionary (might be a failure on Binance servers in creating open_order or an API documentation change), should always check balances / assets
     message_body = "Q Trading @crypto: " + symbol_pair + " " + (trade if trade else side) + " at price_in_btc " + str(price_in_btc) + " and price $" + str(price) + " and quantity " + str(quantity) + ", " + str(other_notes) + ", " + trade_notes + (" :)" if trade_notes == "Filled" else " :/" if trade_notes == "Partially filled" else " :(")
     color_start, color_end = ["\033[92m", "\033[0m"] if trade_notes in ["Filled", "~Filled"] else ["\033[33m", "\033[0m"] if trade_notes == "Partially filled" else ["\033[91m", "\033[0m"] # green yellow red # last condition is if "Not filled" or "BTrade Error"
     print("executed kucoin_trade_coin_usdt()\n" + color_start + message_body + color_end + "\n\033[1mOrder:\033[0m " + str(order) + "\n\033[1mOpen orders:\033[0m" + str(open_orders))
     twilio_message = _fetch_data(twilio_client.messages.create, params={'to': twilio_phone_to, 'from_': twilio_phone_from, 'body': message_body}, error_str=" - Twilio msg error to: " + twilio_phone_to + " on: " + str(datetime.now()), empty_data=None) # No need to add message_body here and other cases to error_str since already printed in line before # maybe add logic here and other locations to deal with error - possibly e-mailing through another client
+    return trade_notes
+
+def kucoin_trade_coin_usdt(symbol_pair, coin, trade=None, side=None, usdt_invest=None, quantity=None, price=None, price_in_btc=None, paper_trading=True, open_time=5, other_notes=None): # price (i.e. from websocket ticker) used instead of tickers snapshot price if given
+    kucoin_pairs_with_price_and_vol_current = get_kucoin_pairs_snapshot() # snapshot no older than kucoin_pairs_snapshot['max_staleness'] before placing order
+    side, quantity, price, price_in_btc = _kucoin_order_values(symbol_pair, kucoin_pairs_with_price_and_vol_current, trade=trade, side=side, usdt_invest=usdt_invest, quantity=quantity, price=price, price_in_btc=price_in_btc)
+    if paper_trading:
+        return _kucoin_paper_order(symbol_pair, trade, side, quantity, price, price_in_btc, other_notes)
+    # maybe refactor and add precautionary alert to ensure ok with real trading - as parameter in function (to turn alert on or off, default on when not portfolio_trading, off when portfolio_trading)
+    order = _kucoin_create_limit_order(symbol_pair, side, quantity, price, trade=trade)
+    if not order: # maybe refactor and raise error, possibly a precautionary alert like above which is default on when not portfolio_trading, off when portfolio_trading
+        return [quantity, price, price_in_btc, {}, [], "KTrade Error"]
+    # check open_orders immediately and use open_time if no order['fills'] and no open_orders to avoid ~Filled situation and to prevent assigning '~Filled' to a position which should have 'Not filled' (happened with STORJBTC buy on 2020-08-27 17:20:45)
+    open_orders = _kucoin_open_orders(symbol_pair)
+    if not order['orderId'] and not open_orders: # if not open_orders['items'][0]['cancelExist']: # maybe refactor 'cancelExist' main way of telling if order is open or closed atm # if both of these conditions fail after order went through most likely means that more processing time (on Binance servers) is needed to process open_order (unlikely but possible that open_order was created and executed in the span of ~4 lines of code) # maybe refactor might be able to use 'executedQty'
+        time.sleep(open_time)
+        open_orders = _kucoin_open_orders(symbol_pair) # ,
+    trade_notes = _kucoin_order_trade_notes(symbol_pair, trade, side, quantity, price, price_in_btc, order, open_orders, other_notes)
     return [quantity, price, price_in_btc, order, open_orders, trade_notes] #
 
+# batched kucoin_trade_coin_usdt for orders [{'symbol_pair', 'coin', 'trade' / 'side', 'usdt_invest' / 'quantity', 'price', 'price_in_btc', 'paper_trading', 'other_notes', 'check_price'}, ...] (same keywords, paper_trading defaults to True), returns the same [quantity, price, price_in_btc, order, open_orders, trade_notes] per order in orders order
+# check_price is the price an order was decided at (i.e. update_portfolio_buy_and_sell_coins buys), the order is then priced and sized from the tickers snapshot and skipped (None returned for it) if the snapshot price is missing or above usdt_invest or kucoin_check_24h_vol_and_price_in_usdt fails (24h vol too low or price moved kucoin_price_mismatch_limit from check_price)
+# one tickers snapshot (no older than kucoin_pairs_snapshot['max_staleness']) for all orders, limit orders submitted concurrently and then open orders of the submitted symbol pairs polled together (one open_time wait shared by all orders without orderId and open orders), every Kucoin request paced by rate_limits['kucoin'] (45 requests/3s)
+# client is kucoin_client by default (i.e. tests/kucoin_mock_client.py's KucoinMockClient() to test without Kucoin)
+def kucoin_trade_coins_usdt(orders, open_time=5, max_workers=8, client=None):
+    if not orders:
+        return []
+    client = client if client else kucoin_client
+    kucoin_pairs_with_price_and_vol_current = get_kucoin_pairs_snapshot()
+    results, order_values, real_order_idxs = [None]*len(orders), [], []
+    for order_idx, order_params in enumerate(orders):
+        order_values.append(_kucoin_order_values(order_params['symbol_pair'], kucoin_pairs_with_price_and_vol_current, trade=order_params.get('trade'), side=order_params.get('side'), usdt_invest=order_params.get('usdt_invest'), quantity=order_params.get('quantity'), price=order_params.get('price'), price_in_btc=order_params.get('price_in_btc'), client=client))
+        if order_params.get('check_price'):
+            price, kucoin_usdt_24h_vol = order_values[order_idx][2], kucoin_pairs_with_price_and_vol_current[order_params['symbol_pair']]['24h_volume'] if order_params['symbol_pair'] in kucoin_pairs_with_price_and_vol_current else float("NaN")
+            if np.isnan(price) or (order_params.get('usdt_invest') and price > order_params['usdt_invest']) or not (kucoin_usdt_24h_vol > 0) or any(kucoin_check_24h_vol_and_price_in_usdt(symbol_pair=order_params['symbol_pair'], kucoin_usdt_24h_vol=kucoin_usdt_24h_vol, price=order_params['check_price'], kucoin_price=price)):
+                continue # results[order_idx] stays None
+        if order_params.get('paper_trading', True):
+            results[order_idx] = _kucoin_paper_order(order_params['symbol_pair'], order_params.get('trade'), *order_values[order_idx], order_params.get('other_notes'))
+        else:
+            real_order_idxs.append(order_idx)
+    if not real_order_idxs:
+        return results
+    def create_order(order_idx):
+        _rate_limiter_acquire('kucoin')
+        side, quantity, price, price_in_btc = order_values[order_idx]
+        return _kucoin_create_limit_order(orders[order_idx]['symbol_pair'], side, quantity, price, trade=orders[order_idx].get('trade'), client=client)
+    def get_open_orders(symbol_pair):
+        _rate_limiter_acquire('kucoin')
+        return _kucoin_open_orders(symbol_pair, client=client)
+    def report(order_idx):
+        side, quantity, price, price_in_btc = order_values[order_idx]
+        return _kucoin_order_trade_notes(orders[order_idx]['symbol_pair'], orders[order_idx].get('trade'), side, quantity, price, price_in_btc, submitted[order_idx], open_orders[orders[order_idx]['symbol_pair']], orders[order_idx].get('other_notes'))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        submitted = dict(zip(real_order_idxs, executor.map(create_order, real_order_idxs)))
+        for order_idx in real_order_idxs:
+            if not submitted[order_idx]:
+                results[order_idx] = [*order_values[order_idx][1:], {}, [], "KTrade Error"]
+        symbol_pairs = list(dict.fromkeys(orders[order_idx]['symbol_pair'] for order_idx in real_order_idxs if submitted[order_idx]))
+        open_orders = dict(zip(symbol_pairs, executor.map(get_open_orders, symbol_pairs)))
+        symbol_pairs_to_recheck = list(dict.fromkeys(orders[order_idx]['symbol_pair'] for order_idx in real_order_idxs if submitted[order_idx] and not submitted[order_idx]['orderId'] and not open_orders[orders[order_idx]['symbol_pair']])) # same ~Filled precaution as kucoin_trade_coin_usdt
+        if symbol_pairs_to_recheck:
+            time.sleep(open_time)
+            open_orders.update(zip(symbol_pairs_to_recheck, executor.map(get_open_orders, symbol_pairs_to_recheck)))
+        submitted_order_idxs = [order_idx for order_idx in real_order_idxs if submitted[order_idx]]
+        for order_idx, trade_notes in zip(submitted_order_idxs, executor.map(report, submitted_order_idxs)):
+            results[order_idx] = [*order_values[order_idx][1:], submitted[order_idx], open_orders[orders[order_idx]['symbol_pair']], trade_notes]
+    return results
+
 # can add option for market or limit, but for now only limit orders, can also add options for different kind of timeInForce options, also add option to trade on another exchange if necessary or another base currency, maybe add option for checking 24h_vol, price, pump and dump so can have logic here and return value block_trade for logic at location of trade, returning price_in_btc since a bit more accurate than coingecko price
 def binance_trade_coin_btc(symbol_pair, trade=None, side=None, btc_invest=None, quantity=None, paper_trading=True, open_time=1, other_notes=None): # don't like non-boolean value for trade value but having two bool values would complicate matters (i.e if both set True etc.) # assuming binance processes open_order (if order not immediately filled) almost immediately (1s) (and that this open_order sometimes filled immediately since often getting ~Filled) # can use recvWindow with api
     if not (trade or side):
@@ -462,6 +1670,244 @@ def binance_btc_check_arbitrages(pages=1):
                 arbitrage_pairs[symbol_pair] = arbitrage_opportunity
     return arbitrage_pairs
 
+# continuous cross-exchange arbitrage scanner: Kucoin (USDT pairs), Binance (USDT pairs, BTC pairs * BTCUSDT) and coinmarketcap reference (usd) prices fetched concurrently, aligned by symbol as one price array (coins x venues) and every venue pair's spread computed in one step
+# the coinmarketcap listing is rescraped when older than reference_max_staleness (s, once per scan at the default interval), spreads against a reference older than reference_max_age (i.e. its refresh failed) are dropped (counted in stats 'stale_reference') since exchange prices are fresh every scan, a symbol belongs to the highest market cap coin with it (like the instrument registry), change_min is the roi change a still open arbitrage needs to be reported again
+arbitrage_scanner = {'exchanges': ['kucoin', 'binance'], 'arbitrage_roi_min': 0.05, 'change_min': 0.01, 'interval': 60, 'pages': 10, 'reference_max_staleness': 60, 'reference_max_age': 60, 'reference': {'symbols': None, 'coins': None, 'prices': None, 'time': None}, 'arbitrages': {}, 'stats': Counter(), 'lock': threading.Lock()}
+arbitrage_columns = ['symbol', 'coin', 'buy_exchange', 'sell_exchange', 'buy_price', 'sell_price', 'roi']
+
+def _arbitrage_reference(coins_data): # coinmarketcap {coin_id: {'symbol', 'price', ...}} (rank order) -> [symbols, coins, prices] arrays, first coin per symbol
+    symbols, coins, prices, seen = [], [], [], set()
+    for coin_id, symbol_and_market_data in coins_data.items():
+        symbol = str(symbol_and_market_data['symbol']).upper()
+        if symbol not in seen:
+            seen.add(symbol)
+            symbols.append(symbol)
+            coins.append(coin_id)
+            prices.append(symbol_and_market_data['price'])
+    return [np.array(symbols, dtype=object), np.array(coins, dtype=object), np.array(prices, dtype=np.float64)]
+
+def _arbitrage_align(symbols, pairs, quote): # prices (NaN where missing) of <symbol><quote> pairs ({pair: {'price'}}) aligned to symbols
+    quote_pairs = [pair for pair in pairs if pair.endswith(quote) and len(pair) > len(quote)]
+    pair_prices = np.array([pairs[pair]['price'] for pair in quote_pairs], dtype=np.float64)
+    idxs = pd.Index([pair[:-len(quote)] for pair in quote_pairs]).get_indexer(symbols) if quote_pairs else np.full(len(symbols), -1)
+    return np.where(idxs >= 0, pair_prices[np.maximum(idxs, 0)] if len(pair_prices) else np.nan, np.nan)
+
+def _arbitrage_prices(symbols, reference_prices, exchange_pairs): # [venues, prices (len(symbols) x len(venues)) in usd(t)]
+    venues, columns = ['reference'], [reference_prices]
+    for exchange, pairs in exchange_pairs.items():
+        if exchange == 'kucoin':
+            columns.append(_arbitrage_align(symbols, pairs, '-USDT'))
+        elif exchange == 'binance':
+            btc_usdt = pairs['BTCUSDT']['price'] if 'BTCUSDT' in pairs else np.nan
+            usdt_prices = _arbitrage_align(symbols, pairs, 'USDT')
+            columns.append(np.where(np.isnan(usdt_prices), _arbitrage_align(symbols, pairs, 'BTC')*btc_usdt, usdt_prices))
+        venues.append(exchange)
+    return [venues, np.column_stack(columns) if len(symbols) else np.empty((0, len(venues)))]
+
+def _arbitrage_spreads(symbols, coins, venues, prices, arbitrage_roi_min): # all venue pairs at once (long logic, no shorting: buy on the cheaper venue), same roi as exchange_check_arbitrage
+    venue_pairs = list(itertools.combinations(range(len(venues)), 2))
+    if not venue_pairs or not len(symbols):
+        return pd.DataFrame(columns=arbitrage_columns)
+    first, second = prices[:, [pair[0] for pair in venue_pairs]], prices[:, [pair[1] for pair in venue_pairs]]
+    buy_prices, sell_prices = np.minimum(first, second), np.maximum(first, second) # NaN if either venue has no price
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rois = (sell_prices - buy_prices) / buy_prices
+    coin_idxs, pair_idxs = np.nonzero((rois >= arbitrage_roi_min) & (buy_prices > 0))
+    venue_names, buy_first = np.array(venues, dtype=object), first[coin_idxs, pair_idxs] <= second[coin_idxs, pair_idxs]
+    first_venues, second_venues = venue_names[[pair[0] for pair in venue_pairs]][pair_idxs], venue_names[[pair[1] for pair in venue_pairs]][pair_idxs]
+    df_arbitrages = pd.DataFrame({'symbol': symbols[coin_idxs], 'coin': coins[coin_idxs], 'buy_exchange': np.where(buy_first, first_venues, second_venues), 'sell_exchange': np.where(buy_first, second_venues, first_venues), 'buy_price': buy_prices[coin_idxs, pair_idxs], 'sell_price': sell_prices[coin_idxs, pair_idxs], 'roi': rois[coin_idxs, pair_idxs]}, columns=arbitrage_columns)
+    return df_arbitrages.sort_values('roi', ascending=False, kind='stable').reset_index(drop=True)
+
+def _arbitrage_changes(df_arbitrages, arbitrages_previous, change_min, unavailable=()): # [df_changes with status 'new' / 'changed' / 'closed', {(symbol, buy_exchange, sell_exchange): roi}], arbitrages on unavailable (fetch failed) venues are kept as they were
+    arbitrages = dict(zip(zip(df_arbitrages['symbol'], df_arbitrages['buy_exchange'], df_arbitrages['sell_exchange']), df_arbitrages['roi']))
+    status = ['new' if key not in arbitrages_previous else 'changed' if abs(roi - arbitrages_previous[key]) >= change_min else None for key, roi in arbitrages.items()]
+    df_changes = df_arbitrages.assign(status=status)[[value is not None for value in status]]
+    arbitrages.update({key: roi for key, roi in arbitrages_previous.items() if (key[1] in unavailable) or (key[2] in unavailable)})
+    closed = [key for key in arbitrages_previous if key not in arbitrages]
+    if closed:
+        df_closed = pd.DataFrame([[symbol, None, buy_exchange, sell_exchange, float("NaN"), float("NaN"), float("NaN"), 'closed'] for symbol, buy_exchange, sell_exchange in closed], columns=arbitrage_columns + ['status'])
+        df_changes = pd.concat([df_changes, df_closed], ignore_index=True) if len(df_changes) else df_closed
+    arbitrages.update({key: arbitrages_previous[key] for key in arbitrages if (key in arbitrages_previous) and abs(arbitrages[key] - arbitrages_previous[key]) < change_min}) # unreported changes accumulate against the last reported roi
+    return [df_changes.reset_index(drop=True), arbitrages]
+
+def scan_arbitrages(arbitrage_roi_min=None, exchanges=None, pages=None, refresh_reference=False): # returns [df_arbitrages (every spread >= arbitrage_roi_min now), df_changes (only new / changed / closed since the previous scan)], an exchange whose fetch fails is left out of the scan
+    arbitrage_roi_min = arbitrage_roi_min if arbitrage_roi_min is not None else arbitrage_scanner['arbitrage_roi_min']
+    exchanges, pages = exchanges if exchanges else arbitrage_scanner['exchanges'], pages if pages else arbitrage_scanner['pages']
+    reference = arbitrage_scanner['reference']
+    refresh_reference = refresh_reference or (reference['time'] is None) or (time.time() - reference['time'] > arbitrage_scanner['reference_max_staleness'])
+    fetchers = {'kucoin': lambda: get_kucoin_pairs_snapshot(refresh=True), 'binance': lambda: _fetch_data(get_binance_pairs, params={}, error_str=" - Binance get all tickers error on: " + str(datetime.now()), empty_data={})}
+    with _instrument_stage('arbitrage', 'fetch'):
+        with ThreadPoolExecutor(max_workers=len(exchanges) + 1) as executor:
+            futures = {exchange: executor.submit(fetchers[exchange]) for exchange in exchanges}
+            if refresh_reference:
+                futures['reference'] = executor.submit(_fetch_data, get_coins_markets_coinmarketcap, params={'pages': pages}, error_str=" - No " + "" + " coins markets data with pages: " + str(pages) + " on: " + str(datetime.now()), empty_data={})
+            data = {name: future.result() for name, future in futures.items()}
+    with arbitrage_scanner['lock']:
+        if data.get('reference'):
+            reference['symbols'], reference['coins'], reference['prices'] = _arbitrage_reference(data['reference'])
+            reference['time'] = time.time()
+        arbitrage_scanner['stats']['fetch_errors'] += sum(1 for name in data if not data[name])
+        if reference['symbols'] is None:
+            print("No coinmarketcap reference prices for arbitrage scan on: " + str(datetime.now()))
+            return [pd.DataFrame(columns=arbitrage_columns), pd.DataFrame(columns=arbitrage_columns + ['status'])]
+        reference_prices, unavailable = reference['prices'], [exchange for exchange in exchanges if not data[exchange]]
+        if time.time() - reference['time'] > arbitrage_scanner['reference_max_age']: # exchange vs exchange spreads only, reference arbitrages kept (not closed) like an unavailable exchange's
+            arbitrage_scanner['stats']['stale_reference'] += 1
+            reference_prices, unavailable = np.full(len(reference['symbols']), np.nan), unavailable + ['reference']
+        with _instrument_stage('arbitrage', 'scan'):
+            venues, prices = _arbitrage_prices(reference['symbols'], reference_prices, {exchange: data[exchange] for exchange in exchanges if data[exchange]})
+            df_arbitrages = _arbitrage_spreads(reference['symbols'], reference['coins'], venues, prices, arbitrage_roi_min)
+            df_changes, arbitrage_scanner['arbitrages'] = _arbitrage_changes(df_arbitrages, arbitrage_scanner['arbitrages'], arbitrage_scanner['change_min'], unavailable=unavailable)
+        arbitrage_scanner['stats']['scans'] += 1
+    return [df_arbitrages, df_changes]
+
+def start_arbitrage_scanner(on_change=None, interval=None, stop_time=None, **params): # scans every interval seconds in a background thread until stop_time (time.time() seconds) or stop(), calls on_change(df_changes) only when something changed (default prints), params go to scan_arbitrages, returns stop
+    interval, stop_event = interval if interval else arbitrage_scanner['interval'], threading.Event()
+    on_change = on_change if on_change else lambda df_changes: print("Arbitrage changes on: " + str(datetime.now()) + "\n" + df_changes.to_string(index=False))
+    def run():
+        while not stop_event.is_set() and ((stop_time is None) or (time.time() < stop_time)):
+            start_time = time.time()
+            try:
+                _, df_changes = scan_arbitrages(**params)
+                if len(df_changes):
+                    on_change(df_changes)
+            except Exception as e:
+                print(str(e) + " - Arbitrage scan error on: " + str(datetime.now()))
+            stop_event.wait(max(interval - (time.time() - start_time), 0))
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    def stop():
+        stop_event.set()
+        thread.join()
+    return stop
+
+# vectorized sell by TSL/SL check over a price path (same logic as stepping tick by tick in update_portfolio_postions_back_testing / portfolio_trading): arms TSL at first price_in_btc_change >= tsl_a, running max price from arming, sells at first tsl change from max <= tsl_p, SL only checked before TSL is armed
+# returns [exit_idx (None if no sell), exit_reason ('Sell by TSL', 'Sell by SL' or None), tsl_armed, tsl_max_price_in_btc] with TSL state at exit_idx (or at last price if no sell)
+def get_sl_tsl_exit(prices_in_btc, buy_price_in_btc, sl, tsl_a, tsl_p, tsl_armed=False, tsl_max_price_in_btc=float("NaN")):
+    prices_in_btc = np.asarray(prices_in_btc, dtype=np.float64)
+    if not len(prices_in_btc):
+        return [None, None, tsl_armed, tsl_max_price_in_btc]
+    with np.errstate(invalid='ignore'): # NaN comparisons are False like in scalar logic
+        price_in_btc_change = (prices_in_btc - buy_price_in_btc) / buy_price_in_btc
+        arm_idxs = np.flatnonzero(price_in_btc_change >= tsl_a)
+        arm_idx = 0 if tsl_armed else arm_idxs[0] if len(arm_idxs) else len(prices_in_btc)
+        sl_idxs = np.flatnonzero(price_in_btc_change[:arm_idx] <= sl)
+        if len(sl_idxs):
+            return [int(sl_idxs[0]), 'Sell by SL', tsl_armed, tsl_max_price_in_btc]
+        if arm_idx == len(prices_in_btc):
+            return [None, None, tsl_armed, tsl_max_price_in_btc]
+        armed_prices_in_btc = prices_in_btc[arm_idx:]
+        tsl_max_prices_in_btc = np.maximum.accumulate(np.concatenate([[tsl_max_price_in_btc if tsl_armed else armed_prices_in_btc[0]], np.where(np.isnan(armed_prices_in_btc), -np.inf, armed_prices_in_btc)]))[1:] # NaN price never raises max, NaN max stays NaN
+        tsl_idxs = np.flatnonzero((armed_prices_in_btc - tsl_max_prices_in_btc) / tsl_max_prices_in_btc <= tsl_p)
+    if len(tsl_idxs):
+        return [arm_idx + int(tsl_idxs[0]), 'Sell by TSL', True, float(tsl_max_prices_in_btc[tsl_idxs[0]])]
+    return [None, None, True, float(tsl_max_prices_in_btc[-1])]
+
+def _frame_from_rows(rows, index, columns, dtypes): # bool columns with missing values stay object (like .loc enlargement) instead of astype turning NaN into True
+    df = pd.DataFrame(rows, index=index, columns=columns)
+    return df.astype({column: dtype for column, dtype in dtypes.items() if column in df.columns and not (dtype == bool and df[column].isna().any())})
+
+# portfolio['open'] as coin -> row list with O(1) field access by column name (instead of scalar .loc[coin, [...]] and .drop(coin) which copy / reindex the whole DataFrame), coins kept in DataFrame row order
+class PositionBook:
+    __slots__ = ('columns', 'dtypes', 'index_name', '_column_idxs', '_rows')
+
+    def __init__(self, columns, dtypes, index_name=None):
+        self.columns, self.dtypes, self.index_name = list(columns), dict(dtypes), index_name
+        self._column_idxs = {column: idx for idx, column in enumerate(self.columns)}
+        self._rows = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        book = cls(columns=df.columns, dtypes=df.dtypes, index_name=df.index.name)
+        book._rows = {coin: list(values) for coin, values in zip(df.index, df.itertuples(index=False, name=None))}
+        return book
+
+    def to_frame(self):
+        return _frame_from_rows(list(self._rows.values()), index=pd.Index(list(self._rows), name=self.index_name), columns=self.columns, dtypes=self.dtypes)
+
+    def get(self, coin, columns): # like portfolio['open'].loc[coin, columns], columns can be a column or list of columns
+        row = self._rows[coin]
+        return row[self._column_idxs[columns]] if isinstance(columns, str) else [row[self._column_idxs[column]] for column in columns]
+
+    def set(self, coin, columns, values): # like portfolio['open'].loc[coin, columns] = values, adds coin (other columns NaN) / new columns like .loc enlargement
+        columns, values = ([columns], [values]) if isinstance(columns, str) else (columns, values)
+        for column in columns:
+            if column not in self._column_idxs:
+                self._column_idxs[column] = len(self.columns)
+                self.columns.append(column)
+                for row in self._rows.values():
+                    row.append(float("NaN"))
+        row = self._rows.setdefault(coin, [float("NaN")]*len(self.columns))
+        for column, value in zip(columns, values):
+            row[self._column_idxs[column]] = value
+
+    def column(self, column):
+        return [row[self._column_idxs[column]] for row in self._rows.values()]
+
+    def pop(self, coin): # returns the removed position as {column: value}
+        return dict(zip(self.columns, self._rows.pop(coin)))
+
+    def __contains__(self, coin):
+        return coin in self._rows
+
+    def __iter__(self): # iterates over a copy of coins so positions can be popped while iterating
+        return iter(list(self._rows))
+
+    def __len__(self):
+        return len(self._rows)
+
+# append-only portfolio['sold'] rows (closed trades), appended to the sold DataFrame once when converted back (instead of .loc[len(portfolio['sold'])] = [...] which grows the whole DataFrame on every sell)
+class TradeLedger:
+    __slots__ = ('columns', 'dtypes', '_rows')
+
+    def __init__(self, columns, dtypes):
+        self.columns, self.dtypes, self._rows = list(columns), dict(dtypes), []
+
+    def append(self, values): # values in self.columns order, like portfolio['sold'].loc[len(portfolio['sold'])] = values
+        self._rows.append(list(values))
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def to_frame(self, start_idx=0):
+        return _frame_from_rows(self._rows, index=range(start_idx, start_idx + len(self._rows)), columns=self.columns, dtypes=self.dtypes)
+
+    def __len__(self):
+        return len(self._rows)
+
+# swaps portfolio['open'] for a PositionBook and adds portfolio['sold_ledger'] for closed trades, returns [portfolio, swapped] (swapped is False if portfolio is already in book form i.e. inside run_portfolio_rr)
+def _portfolio_to_book(portfolio):
+    if isinstance(portfolio['open'], PositionBook):
+        return [portfolio, False]
+    portfolio['open'], portfolio['sold_ledger'] = PositionBook.from_frame(portfolio['open']), TradeLedger(columns=portfolio['sold'].columns, dtypes=portfolio['sold'].dtypes)
+    return [portfolio, True]
+
+sold_ledger_concat_min = 16 # ledgers with fewer rows (live paths sell a few coins per conversion) are written into portfolio['sold'] in place, longer ones (backtests) with one pd.concat
+
+# swaps portfolio['open'] / portfolio['sold'] back to DataFrames (saved portfolios, portfolio_calculate_roi and README calls always see DataFrames)
+def _portfolio_from_book(portfolio, swapped=True):
+    if not swapped:
+        return portfolio
+    portfolio['open'], sold_ledger = portfolio['open'].to_frame(), portfolio.pop('sold_ledger')
+    df_sold_previous, n_previous = portfolio['sold'], len(portfolio['sold'])
+    if len(sold_ledger) and (portfolio['sold'].empty or len(sold_ledger) >= sold_ledger_concat_min):
+        df_sold_new = sold_ledger.to_frame(start_idx=len(portfolio['sold']))
+        portfolio['sold'] = df_sold_new if portfolio['sold'].empty else pd.concat([portfolio['sold'], df_sold_new])
+    elif len(sold_ledger):
+        for row in sold_ledger:
+            portfolio['sold'].loc[len(portfolio['sold'])] = row
+    if len(sold_ledger): # running ROI aggregates continued with the new closed trades
+        _portfolio_sold_aggregates_append(df_sold_previous, n_previous, portfolio['sold'], sold_ledger)
+    return portfolio
+
+@contextlib.contextmanager
+def _portfolio_book(portfolio): # portfolio in book form inside the block (portfolio dict modified in place), converted back to DataFrames when the block exits even if it raises so a failed order / fetch never leaves a PositionBook in a saved or reused portfolio
+    portfolio, swapped = _portfolio_to_book(portfolio)
+    try:
+        yield portfolio
+    finally:
+        _portfolio_from_book(portfolio, swapped)
+
 def update_portfolio_postions_back_testing(portfolio, stop_day, end_day, **params):
     STOP_LOSS = portfolio['constants']['sl']
     BASE_PAIR = portfolio['constants']['base_pair'] # 'btc' # portfolio['constants']['base_pair'] # maybe refactor and add to other functions so that can avoid +'BTC' or +'-USDT' and coin_data['market_data']['current_price']['btc'/'usdt']
@@ -470,53 +1916,43 @@ def update_portfolio_postions_back_testing(portfolio, stop_day, end_day, **param
     END_DAY_OPEN_POSITIONS_GTRENDS_15D, END_DAY_OPEN_POSITIONS_KUCOIN_USDT_24H_VOL = portfolio['constants']['end_day_open_positions_gtrends_15d'], portfolio['constants']['end_day_open_positions_kucoin_usdt_24h_vol']
     # binance_pairs_with_price_current = params['binance_pairs_with_price_current'] # maybe refactor here and other params[] and add logic for dealing with error ('binance_pairs_with_price_current' not in params)
     kucoin_pairs_with_price_and_vol_current = params['kucoin_pairs_with_price_and_vol_current']
-    # sell if TSL or SL, update current positions (assume symbol doesn't change), update current google trends and/or binance btc 24h vol if conditions met, update current positions
-    # print("Sleeping 2min every time we update portfolio positions back testing on: " + str(stop_day))
-    # time.sleep(2*60)
-    for coin in portfolio['open'].index: # print(str(stop_day) + "\n" + str(portfolio['open'].drop(['binance_btc_24h_vol(btc)', 'rank_rise_d', 'gtrends_15d'], axis=1))) # print("updating: " + coin, end=", ") # print("buying: " + coin, end=", ") # print(str(stop_day) + "\n" + str(portfolio['open'].drop(['position', 'buy_date', 'buy_price(btc)', 'balance'], axis=1)))
-        # time is local time (PST) not utc time, price and time are in hourly intervals even within 24 hours
-        # coin_data_granular = _fetch_data(get_coin_data_granular_cg, params={'coin': coin, 'currency': 'usd', 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)), 'to_timestamp': datetime.timestamp(stop_day)}, error_str=" - No granular coin data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(stop_day), empty_data={}) # if think in terms of ultimately accumulating btc can make currency 'btc' and have tsl/sl be in relation to btc rather than usd
-        coin_data_granular_in_btc = _fetch_data(get_coin_data_granular, params={'coin': coin, 'currency': 'btc', 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)), 'to_timestamp': datetime.timestamp(stop_day)}, error_str=" - No granular coin data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(stop_day), empty_data={})
-        if not ('prices' in coin_data_granular_in_btc and coin_data_granular_in_btc['prices']): # 'market_data' not in coin_data or not coin_data['market_data']['market_cap']['usd']: # remove granular from error_str
-            print("Error retreiving granular market data for coin: " + coin + " on date: " + stop_day.strftime('%Y-%m-%d')) # error message should be covered in method
-            portfolio['open'].loc[coin, 'other_notes'] = "MDI " +  stop_day.strftime('%Y-%m-%d') # MDI stands for Market Data Issue
-        else:
-            buy_price_in_btc, tsl_armed, tsl_max_price_in_btc, quantity = portfolio['open'].loc[coin, ['buy_price(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'balance']]
-            symbol_pair = portfolio['open'].loc[coin, 'symbol'].upper() + '-USDT' # 'BTC'
-            # can add price_trend or google_trend analysis
-            for idx,timestamp_price_in_btc in enumerate(coin_data_granular_in_btc['prices']):
-                price_in_btc, interval_time = timestamp_price_in_btc[1], datetime.fromtimestamp(timestamp_price_in_btc[0]/1000) # CoinGecko timestamp is off by factor of 1000
+    with _portfolio_book(portfolio):
+        if END_DAY_OPEN_POSITIONS_GTRENDS_15D and (stop_day == end_day) and len(portfolio['open']): # one batched query (5 terms per payload) for all open positions, per coin calls below are cache hits
+            _fetch_data(prefetch_google_trends, params={'kw_list': [coin if not re.search('-', coin) else coin.split("-")[0] for coin in portfolio['open']], 'from_date': stop_day - timedelta(days=15), 'to_date': stop_day}, error_str=" - No " + "google trends" + " prefetch data for open positions from: " + str(stop_day - timedelta(days=15)) + " to: " + str(stop_day), empty_data=0)
+        # sell if TSL or SL, update current positions (assume symbol doesn't change), update current google trends and/or binance btc 24h vol if conditions met, update current positions
+        # print("Sleeping 2min every time we update portfolio positions back testing on: " + str(stop_day))
+        # time.sleep(2*60)
+        for coin in portfolio['open']: # print(str(stop_day) + "\n" + str(portfolio['open'].drop(['binance_btc_24h_vol(btc)', 'rank_rise_d', 'gtrends_15d'], axis=1))) # print("updating: " + coin, end=", ") # print("buying: " + coin, end=", ") # print(str(stop_day) + "\n" + str(portfolio['open'].drop(['position', 'buy_date', 'buy_price(btc)', 'balance'], axis=1)))
+            # time is local time (PST) not utc time, price and time are in hourly intervals even within 24 hours
+            # coin_data_granular = _fetch_data(get_coin_data_granular_cg, params={'coin': coin, 'currency': 'usd', 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)), 'to_timestamp': datetime.timestamp(stop_day)}, error_str=" - No granular coin data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(stop_day), empty_data={}) # if think in terms of ultimately accumulating btc can make currency 'btc' and have tsl/sl be in relation to btc rather than usd
+            kucoin_backtest_pair = _kucoin_backtest_pair(coin, portfolio['open'].get(coin, 'symbol'))
+            coin_data_granular_in_btc = _fetch_data(get_kucoin_candle_prices_in_btc, params={'symbol_pair': kucoin_backtest_pair, 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)), 'to_timestamp': datetime.timestamp(stop_day), 'prefetch_to_timestamp': datetime.timestamp(end_day)}, error_str=" - No Kucoin candle data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(stop_day), empty_data={}) if kucoin_backtest_pair else {} # no 'prices' if Kucoin has no candles for the pair
+            if 'prices' not in coin_data_granular_in_btc:
+                coin_data_granular_in_btc = _fetch_data(get_coin_data_granular, params={'coin': coin, 'currency': 'btc', 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)), 'to_timestamp': datetime.timestamp(stop_day), 'prefetch_to_timestamp': datetime.timestamp(end_day)}, error_str=" - No granular coin data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(stop_day), empty_data={})
+            if not ('prices' in coin_data_granular_in_btc and coin_data_granular_in_btc['prices']): # 'market_data' not in coin_data or not coin_data['market_data']['market_cap']['usd']: # remove granular from error_str
+                print("Error retreiving granular market data for coin: " + coin + " on date: " + stop_day.strftime('%Y-%m-%d')) # error message should be covered in method
+                portfolio['open'].set(coin, 'other_notes', "MDI " +  stop_day.strftime('%Y-%m-%d')) # MDI stands for Market Data Issue
+            else:
+                buy_price_in_btc, tsl_armed, tsl_max_price_in_btc, quantity = portfolio['open'].get(coin, ['buy_price(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'balance'])
+                symbol_pair = portfolio['open'].get(coin, 'symbol').upper() + '-USDT' # 'BTC'
+                # can add price_trend or google_trend analysis
+                exit_idx, exit_reason, tsl_armed, tsl_max_price_in_btc = get_sl_tsl_exit(prices_in_btc=np.array([timestamp_price_in_btc[1] for timestamp_price_in_btc in coin_data_granular_in_btc['prices']], dtype=np.float64), buy_price_in_btc=buy_price_in_btc, sl=STOP_LOSS, tsl_a=TRAILING_STOP_LOSS_ARM, tsl_p=TRAILING_STOP_LOSS_PERCENTAGE, tsl_armed=tsl_armed, tsl_max_price_in_btc=tsl_max_price_in_btc)
+                idx = exit_idx if exit_idx is not None else len(coin_data_granular_in_btc['prices']) - 1
+                price_in_btc, interval_time = coin_data_granular_in_btc['prices'][idx][1], datetime.fromtimestamp(coin_data_granular_in_btc['prices'][idx][0]/1000) # CoinGecko timestamp is off by factor of 1000
                 price_in_btc_change = (price_in_btc - buy_price_in_btc) / buy_price_in_btc
-                # if price_in_btc_change >= TAKE_PROFIT_PERCENTAGE:
-                if not tsl_armed and price_in_btc_change >= TRAILING_STOP_LOSS_ARM:
-                    tsl_armed, tsl_max_price_in_btc = True, price_in_btc
-                if tsl_armed:
-                    if price_in_btc > tsl_max_price_in_btc:
-                        tsl_max_price_in_btc = price_in_btc
-                    tsl_price_in_btc_change = (price_in_btc - tsl_max_price_in_btc) / tsl_max_price_in_btc
-                    if tsl_price_in_btc_change <= TRAILING_STOP_LOSS_PERCENTAGE:
-                        # coin_data_granular_in_btc = _fetch_data(get_coin_data_granular, params={'coin': coin, 'currency': 'btc', 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)), 'to_timestamp': datetime.timestamp(stop_day)}, error_str=" - No granular coin data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(stop_day), empty_data={}) # more time consuming (0.03 vs. 0.003) but more accurate than doing btc_data on stop_day and obtaining btc_price - would be the price for that stop_day (i.e. if sold 2020-06-01 20:00:00 PST btc_price will be (stop_day) btc_price: 2020-06-02 17:00:00 PST) # maybe refactor and check if 'prices' not in coin_data_granular for now let it fail during back_testing don't want to add logic for adding/replacing more important other_notes
-                        sell_price_in_btc = price_in_btc # tsl_max_price * (1 + TRAILING_STOP_LOSS_PERCENTAGE) # use price even though Minutely data will be used for duration within 1 day, Hourly data will be used for duration between 1 day and 90 days, Daily data will be used for duration above 90 days, since tsl_max_price might also be a bit inaccurate # * (1 - PRICE_UNCERTAINTY_PERCENTAGE) # maybe refactor here and other change sell_price_in_btc to price_in_btc
+                if exit_idx is not None: # Sell by TSL or SL
+                    sell_price_in_btc = price_in_btc # tsl_max_price * (1 + TRAILING_STOP_LOSS_PERCENTAGE) # use price even though Minutely data will be used for duration within 1 day, Hourly data will be used for duration between 1 day and 90 days, Daily data will be used for duration above 90 days, since tsl_max_price might also be a bit inaccurate # * (1 - PRICE_UNCERTAINTY_PERCENTAGE) # maybe refactor here and other change sell_price_in_btc to price_in_btc
+                    sell_price = _kucoin_candle_backtest_price(coin, portfolio['open'].get(coin, 'symbol'), interval_time, end_day)[0]
+                    if math.isnan(sell_price): # CoinGecko if not pricing from Kucoin candles or no candle
                         coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (interval_time + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': False}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(interval_time + timedelta(hours=7)), empty_data={}) # assuming here and other references that CoinGecko price not too much different from Kucoin
                         sell_price = coin_data['market_data']['current_price']['usd'] if ('market_data' in coin_data) and ('current_price' in coin_data['market_data']) and ('usd' in coin_data['market_data']['current_price']) else float("NaN")
-                        monetary_return = sell_price*quantity if BASE_PAIR == 'usdt' else sell_price_in_btc*quantity
-                        other_notes, trade_notes = 'Sell by TSL', None # maybe refactor not likely that market_data wont be in btc_data - other_notes[:2] + other_notes[7:9] gives you sUBP allows to see both notes # precautionary trade_notes while back_testing should always be None
-                        portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + monetary_return # maybe refactor and add here and in all calls to adjusting portfolio['balance']['btc'] throughout a precautionary check for price_in_btc (since it's possible but rare that price_in_btc might be float("NaN")) and don't want one bad order to affect other orders
-                        symbol, position, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d = portfolio['open'].loc[coin, ['symbol', 'position', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d']]
-                        portfolio['sold'].loc[len(portfolio['sold'])], portfolio['open'] = [coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, interval_time, sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes], portfolio['open'].drop(coin) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).append(pd.Series([coin, interval_time, sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, tsl_max_price_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'tsl_max_price(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin) # 'binance_btc_24h_vol(btc)', portfolio['open'].loc[coin, 'binance_btc_24h_vol(btc)'], 'binance_btc_24h_vol(btc)',
-                        break # continue not break since want to check last conditional - (idx == len(coin_data_granular_in_btc['prices']) - 1)
-                elif price_in_btc_change <= STOP_LOSS:
-                    # coin_data_granular_in_btc = _fetch_data(get_coin_data_granular, params={'coin': coin, 'currency': 'btc', 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)), 'to_timestamp': datetime.timestamp(stop_day)}, error_str=" - No granular coin data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(stop_day), empty_data={})
-                    sell_price_in_btc = price_in_btc # sell_price, sell_price_in_btc = price, coin_data_granular_in_btc['prices'][idx][1] # buy_price * (1 + STOP_LOSS) # use price even though Minutely data will be used for duration within 1 day, Hourly data will be used for duration between 1 day and 90 days, Daily data will be used for duration above 90 days, since buy_price might also be a bit inaccurate and unrealistic to sell at exact STOP_LOSS loss # * (1 - PRICE_UNCERTAINTY_PERCENTAGE)
-                    coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (interval_time + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': False}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(interval_time + timedelta(hours=7)), empty_data={}) # assuming here and other references that CoinGecko price not too much different from Kucoin
-                    sell_price = coin_data['market_data']['current_price']['usd'] if ('market_data' in coin_data) and ('current_price' in coin_data['market_data']) and ('usd' in coin_data['market_data']['current_price']) else float("NaN")
                     monetary_return = sell_price*quantity if BASE_PAIR == 'usdt' else sell_price_in_btc*quantity
-                    other_notes, trade_notes = 'Sell by SL', None # maybe refactor not likely that market_data wont be in btc_data - other_notes[:2] + other_notes[7:9] gives you sUBP allows to see both notes # precautionary trade_notes while back_testing should always be None
-                    portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + monetary_return
-                    symbol, position, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d = portfolio['open'].loc[coin, ['symbol', 'position', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d']]
-                    portfolio['sold'].loc[len(portfolio['sold'])], portfolio['open'] = [coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, interval_time, sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes], portfolio['open'].drop(coin) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).append(pd.Series([coin, interval_time, sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, tsl_max_price_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'tsl_max_price(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin) # 'binance_btc_24h_vol(btc)', portfolio['open'].loc[coin, 'binance_btc_24h_vol(btc)'], 'binance_btc_24h_vol(btc)',
-                    break
-                if (idx == len(coin_data_granular_in_btc['prices']) - 1): # some days ends earlier than 16:59 like 2020-06-08 ends 15:59 (fet), 16:12 (edo), 16:29 (stmx, bnt) issue with coingecko data (but also when when run on different occasions returns different results for same day i.e. with end_day 6/14/2020 and different start days (6/17/2020 and same start days) return different end times)
+                    other_notes, trade_notes = exit_reason, None # maybe refactor not likely that market_data wont be in btc_data - other_notes[:2] + other_notes[7:9] gives you sUBP allows to see both notes # precautionary trade_notes while back_testing should always be None
+                    portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + monetary_return # maybe refactor and add here and in all calls to adjusting portfolio['balance']['btc'] throughout a precautionary check for price_in_btc (since it's possible but rare that price_in_btc might be float("NaN")) and don't want one bad order to affect other orders
+                    symbol, position, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d = portfolio['open'].get(coin, ['symbol', 'position', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d'])
+                    portfolio['sold_ledger'].append([coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, interval_time, sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes]) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).append(pd.Series([coin, interval_time, sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, tsl_max_price_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'tsl_max_price(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin) # 'binance_btc_24h_vol(btc)', portfolio['open'].loc[coin, 'binance_btc_24h_vol(btc)'], 'binance_btc_24h_vol(btc)',
+                    portfolio['open'].pop(coin)
+                else: # last price, some days ends earlier than 16:59 like 2020-06-08 ends 15:59 (fet), 16:12 (edo), 16:29 (stmx, bnt) issue with coingecko data (but also when when run on different occasions returns different results for same day i.e. with end_day 6/14/2020 and different start days (6/17/2020 and same start days) return different end times)
                     if stop_day == end_day:
                         # if END_DAY_OPEN_POSITIONS_KUCOIN_USDT_24H_VOL and (symbol_pair in kucoin_pairs_with_price_and_vol_current) and (stop_day.date() == datetime.now().date()): # maybe refactor - stop_day.date() == datetime.now().date() is a bit inaccurate (can make accurate to the hour or minute) # uses old/incomplete information - not np.isnan(portfolio['open'].loc[coin, 'binance_btc_24h_vol(btc)'])
                             # portfolio['open'].loc[coin, 'binance_btc_24h_vol(btc)'] = float(_fetch_data(binance_client.get_ticker, params={'symbol': symbol_pair}, error_str=" - Binance get ticker error for symbol pair: " + symbol_pair + " on: " + str(datetime.now().date()), empty_data={'quoteVolume': "NaN"})['quoteVolume']) # *binance_pairs_with_price_current['BTCUSDT'] # here, buying have to account for error if coin is no longer listed on binance # binance_client.get_ticker other useful keys 'bidPrice', 'bidQty', 'askPrice', 'askQty' OHLV
@@ -525,10 +1961,10 @@ def update_portfolio_postions_back_testing(portfolio, stop_day, end_day, **param
                             # using Pytrends (Cryptory is deprecated doesn't work after Python 3.6-3.8) since good data and can retrieve other metrics like reddit subscribers, exchange rates, metal prices
                             google_trends = _fetch_data(get_google_trends_pt, params={'kw_list': [coin_search_term], 'from_date': stop_day - timedelta(days=15), 'to_date': stop_day}, error_str=" - No " + "google trends" + " data for coin search term: " + coin_search_term + " from: " + str(stop_day - timedelta(days=15)) + " to: " + str(stop_day), empty_data=pd.DataFrame())
                             google_trends_slope = trendline(google_trends.sort_values('date', inplace=False, ascending=True)[coin_search_term]) if not google_trends.empty else float("NaN") # sort_values is precautionary, should already be ascending:  # , reverse_to_ascending=True
-                            portfolio['open'].loc[coin, 'gtrends_15d'] = google_trends_slope
-                    portfolio['open'].loc[coin, ['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)']] = [interval_time, price_in_btc, price_in_btc_change, tsl_armed, tsl_max_price_in_btc]
-    # print("Sleeping 1min every time after updating portfolio positions back testing on: " + str(stop_day))
-    # time.sleep(1*60)
+                            portfolio['open'].set(coin, 'gtrends_15d', google_trends_slope)
+                    portfolio['open'].set(coin, ['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)'], [interval_time, price_in_btc, price_in_btc_change, tsl_armed, tsl_max_price_in_btc])
+        # print("Sleeping 1min every time after updating portfolio positions back testing on: " + str(stop_day))
+        # time.sleep(1*60)
     return portfolio
 
 def update_portfolio_buy_and_sell_coins(portfolio, coins_to_buy, coins_to_sell, stop_day, end_day, paper_trading, back_testing, **params): # refactor and add back_testing
@@ -537,131 +1973,347 @@ def update_portfolio_buy_and_sell_coins(portfolio, coins_to_buy, coins_to_sell,
     BUY_DATE_GTRENDS_15D = portfolio['constants']['buy_date_gtrends_15d']
     coins_to_avoid = {'jupiter': 'CoinGecko issues ie price is $0.001469126328981041 on 2024-03-21 17:00:00 when it should be $1.24 (confuses with Jupiter Dex token jupiter-ag / jupiter-project)', 'flux': 'CoinGecko issues ie price is $0.08684909049706278 on 2024-03-21 17:00:00 when it should be $1.38 (correct id is flux-zelcash, flux is incorrect id)'}
     # binance_pairs_with_price_current = params['binance_pairs_with_price_current']
-    if not back_testing:
-        coins_data = _fetch_data(get_coins_markets_coinmarketcap, params={'pages': 10}, error_str=" - No " + "" + " coins markets data with pages: " + str(10) + " on: " + str(datetime.now()), empty_data={})
-        coins_symbol_to_id = {**{'btc': 'bitcoin', 'bnb': 'binancecoin', 'fet': 'fetch-ai', 'kmd': 'komodo', 'cnd': 'cindicator', 'coti': 'coti', 'tfuel': 'theta-fuel', 'tomo': 'tomochain', 'gto': 'gifto', 'btg': 'bitcoin-gold'}, **{symbol_and_market_data['symbol']: coin_id for coin_id, symbol_and_market_data in coins_data.items()}}
-        coins_id_to_symbol = {value: key for key,value in coins_symbol_to_id.items()}
+    if not back_testing: # coin id -> symbol from instrument registry (refreshes in the background) instead of scraping coinmarketcap pages
+        instrument_registry_data = get_instrument_registry()
+        if any(coin not in instrument_registry_data['id'] for coin, market_cap_rank_change in coins_to_buy) and (not instrument_registry_data['time'] or (time.time() - instrument_registry_data['time'] > instrument_registry['min_buy_refresh_interval'])): # coins listed since the registry was built would be skipped
+            refresh_instrument_registry()
     kucoin_pairs_with_price_and_vol_current = params['kucoin_pairs_with_price_and_vol_current']
     retry_end_day_if_no_historical_market_data = True if datetime.utcnow() >= (end_day + timedelta(hours=7)) and datetime.utcnow() <= (end_day + timedelta(hours=7+1)) else False # if run between closing and 1 hour after closing time and historical market_data for stop day (next day in utc time) day not available allow retry on current day, useful if want to make trades within that hour
-    for coin, market_cap_rank_change in coins_to_sell:
-        symbol_pair = portfolio['open'].loc[coin, 'symbol'].upper() + '-USDT' # maybe refactor, -USDT here and below to make kucoin_trade_coin_usdt() logic easier # maybe refactor all and change balance variable name to order_quantity
-        position, buy_price_in_btc, quantity = portfolio['open'].loc[coin, ['position', 'buy_price(btc)', 'balance']] # maybe refactor, buy_price_in_btc here so only one call for both 'buy_price(btc)', 'balance' to portfolio.loc[]
-        if back_testing:
-            sell_date, sell_price_in_btc, roi_in_btc, other_notes = portfolio['open'].loc[coin, ['current_date', 'current_price(btc)', 'current_roi(btc)', 'other_notes']] # binance_btc_24h_vol_in_btc, 'binance_btc_24h_vol(btc)', # not using slightly more accurate price with coin_data['market_data']['current_price']['usd'] and date using stop_day (16:.. vs. 17 PST) since then have to retrieve coin_data and recalculate roi
-            # coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (stop_day + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': retry_end_day_if_no_historical_market_data}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(stop_day + timedelta(hours=7)), empty_data={})
-            # sell_price_in_btc, other_notes_extra = [coin_data['market_data']['current_price']['btc'], None] if ('market_data' in coin_data and 'btc' in coin_data['market_data']['current_price']) else [sell_price/binance_pairs_with_price_current['BTCUSDT'], "sUsing BPrice"]
-            coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (stop_day + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': retry_end_day_if_no_historical_market_data}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(stop_day + timedelta(hours=7)), empty_data={'market_data':{'current_price':{'usd':float("NaN")}}}) # maybe refactor empty_data here and in get_kucoin_assets()
-            sell_price, trade_notes = coin_data['market_data']['current_price']['usd'] if ('market_data' in coin_data) and ('current_price' in coin_data['market_data']) and ('usd' in coin_data['market_data']['current_price']) else float("NaN"), None # other_notes if not other_notes_extra else other_notes_extra[:2] + other_notes_extra[7:9] + str(other_notes), None # only concatenate other_notes strings while back_testing since MDI issue notes only occur during back_testing, should be taken care of if back_testing and then real time trading, other_notes_extra[:2] + other_notes_extra[7:9] gives you sUBP allows to see both notes # precautionary trade_notes while back_testing should always be None
-        else: # no need to worry about back running (if back running and algorithm has gotten to the current day) - stop_day.date() == datetime.now().date()
-            #  binance_btc_24h_vol_in_btc , float(_fetch_data(binance_client.get_ticker, params={'symbol': symbol_pair}, error_str=" - Binance get ticker error for symbol pair: " + symbol_pair + " on date: " + str(datetime.now().date()), empty_data={})['quoteVolume']) # *binance_pairs_with_price_current['BTCUSDT'] # maybe refactor - add back binance_btc_24h_vol_in_btc if want to check for pump and dump but complicates matters when checking for buying and selling
-            # coin_data = _fetch_data(get_coin_data, params={'coin': coin}, error_str=" - No " + "" + " coin data for: " + coin + " on: " + str(datetime.now()), empty_data={})
-            # sell_price_in_btc, other_notes = [coin_data['market_data']['current_price']['btc'], None] if ('market_data' in coin_data and 'btc' in coin_data['market_data']['current_price']) else [binance_pairs_with_price_current[symbol_pair], "sUsing BPrice"] # sell_price, coin_data['market_data']['current_price']['usd'], ('usd' and , binance_pairs_with_price_current[symbol_pair]*binance_pairs_with_price_current['BTCUSDT'], # maybe refactor and add MDI Issue note to other_notes (but only if other_notes not occupied) # assuming selling at 17 PST and that order is filled near coingecko price (maybe refactor)
-            quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = kucoin_trade_coin_usdt(symbol_pair=symbol_pair, coin=coin, trade="sell", quantity=quantity, paper_trading=(True if position == 'long-p' else False)) # binance_coin_btc_order, binance_coin_btc_open_orders,  # paper_trading
-            sell_price, sell_price_in_btc, sell_date, other_notes = price, price_in_btc, datetime.now(), None
-            roi_in_btc = (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc
-        portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + sell_price*quantity # keep variable balance here so don't have to add more code for when not back_testing, in general balance used for when retrieving value from portfolio, quantity used when calculating value or value returned after submitting an order # (sell_price / btc_price)
-        # coin_data already retrieved in current_date, current_price, current_roi # can use np.append(coin, portfolio['open'].loc[coin, [...]].to_numpy())
-        symbol, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc = portfolio['open'].loc[coin, ['symbol', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d', 'tsl_max_price(btc)']]
-        portfolio['sold'].loc[len(portfolio['sold'])], portfolio['open'] = [coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, sell_date, sell_price, sell_price_in_btc, roi_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes], portfolio['open'].drop(coin) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'trade_notes', 'other_notes']).append(pd.Series([coin, sell_date, sell_price, sell_price_in_btc, roi_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin) # 'binance_btc_24h_vol(btc)', binance_btc_24h_vol_in_btc, 'binance_btc_24h_vol(btc)',
-    for coin, market_cap_rank_change in coins_to_buy: # coins_market_cap_rank_change_by_factor.items()
-        if portfolio['balance'][BASE_PAIR] >= INVEST_MIN and (coin not in coins_to_avoid): # can add max open positions and a waiting list to reflect real trading: # assuming always enforcing BTC_INVEST_MIN # maybe refactor, logic here and not in run_portfolio_algorithm to keep logic simple (even though makes tickers_to_buy/sell lists longer) # maybe refactor if insufficient balance and signals are indicating a buy can add positions as a long-p then buy when balance opens up
-            invest = INVEST if (portfolio['balance'][BASE_PAIR] >= INVEST) else portfolio['balance'][BASE_PAIR]
+    with _portfolio_book(portfolio):
+        sell_orders = kucoin_trade_coins_usdt([{'symbol_pair': portfolio['open'].get(coin, 'symbol').upper() + '-USDT', 'coin': coin, 'trade': "sell", 'quantity': portfolio['open'].get(coin, 'balance'), 'paper_trading': (True if portfolio['open'].get(coin, 'position') == 'long-p' else False)} for coin, market_cap_rank_change in coins_to_sell]) if not back_testing else [] # all sell orders submitted together (see kucoin_trade_coins_usdt) # paper_trading
+        for sell_idx, (coin, market_cap_rank_change) in enumerate(coins_to_sell):
+            symbol_pair = portfolio['open'].get(coin, 'symbol').upper() + '-USDT' # maybe refactor, -USDT here and below to make kucoin_trade_coin_usdt() logic easier # maybe refactor all and change balance variable name to order_quantity
+            position, buy_price_in_btc, quantity = portfolio['open'].get(coin, ['position', 'buy_price(btc)', 'balance']) # maybe refactor, buy_price_in_btc here so only one call for both 'buy_price(btc)', 'balance' to portfolio.loc[]
             if back_testing:
-                coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (stop_day + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': retry_end_day_if_no_historical_market_data}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(stop_day + timedelta(hours=7)), empty_data={})
+                sell_date, sell_price_in_btc, roi_in_btc, other_notes = portfolio['open'].get(coin, ['current_date', 'current_price(btc)', 'current_roi(btc)', 'other_notes']) # binance_btc_24h_vol_in_btc, 'binance_btc_24h_vol(btc)', # not using slightly more accurate price with coin_data['market_data']['current_price']['usd'] and date using stop_day (16:.. vs. 17 PST) since then have to retrieve coin_data and recalculate roi
+                # coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (stop_day + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': retry_end_day_if_no_historical_market_data}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(stop_day + timedelta(hours=7)), empty_data={})
+                # sell_price_in_btc, other_notes_extra = [coin_data['market_data']['current_price']['btc'], None] if ('market_data' in coin_data and 'btc' in coin_data['market_data']['current_price']) else [sell_price/binance_pairs_with_price_current['BTCUSDT'], "sUsing BPrice"]
+                sell_price, trade_notes = _kucoin_candle_backtest_price(coin, portfolio['open'].get(coin, 'symbol'), stop_day, end_day)[0], None
+                if math.isnan(sell_price): # CoinGecko if not pricing from Kucoin candles or no candle
+                    coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (stop_day + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': retry_end_day_if_no_historical_market_data}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(stop_day + timedelta(hours=7)), empty_data={'market_data':{'current_price':{'usd':float("NaN")}}}) # maybe refactor empty_data here and in get_kucoin_assets()
+                    sell_price, trade_notes = coin_data['market_data']['current_price']['usd'] if ('market_data' in coin_data) and ('current_price' in coin_data['market_data']) and ('usd' in coin_data['market_data']['current_price']) else float("NaN"), None # other_notes if not other_notes_extra else other_notes_extra[:2] + other_notes_extra[7:9] + str(other_notes), None # only concatenate other_notes strings while back_testing since MDI issue notes only occur during back_testing, should be taken care of if back_testing and then real time trading, other_notes_extra[:2] + other_notes_extra[7:9] gives you sUBP allows to see both notes # precautionary trade_notes while back_testing should always be None
+            else: # no need to worry about back running (if back running and algorithm has gotten to the current day) - stop_day.date() == datetime.now().date()
+                #  binance_btc_24h_vol_in_btc , float(_fetch_data(binance_client.get_ticker, params={'symbol': symbol_pair}, error_str=" - Binance get ticker error for symbol pair: " + symbol_pair + " on date: " + str(datetime.now().date()), empty_data={})['quoteVolume']) # *binance_pairs_with_price_current['BTCUSDT'] # maybe refactor - add back binance_btc_24h_vol_in_btc if want to check for pump and dump but complicates matters when checking for buying and selling
+                # coin_data = _fetch_data(get_coin_data, params={'coin': coin}, error_str=" - No " + "" + " coin data for: " + coin + " on: " + str(datetime.now()), empty_data={})
+                # sell_price_in_btc, other_notes = [coin_data['market_data']['current_price']['btc'], None] if ('market_data' in coin_data and 'btc' in coin_data['market_data']['current_price']) else [binance_pairs_with_price_current[symbol_pair], "sUsing BPrice"] # sell_price, coin_data['market_data']['current_price']['usd'], ('usd' and , binance_pairs_with_price_current[symbol_pair]*binance_pairs_with_price_current['BTCUSDT'], # maybe refactor and add MDI Issue note to other_notes (but only if other_notes not occupied) # assuming selling at 17 PST and that order is filled near coingecko price (maybe refactor)
+                quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = sell_orders[sell_idx] # binance_coin_btc_order, binance_coin_btc_open_orders,
+                sell_price, sell_price_in_btc, sell_date, other_notes = price, price_in_btc, datetime.now(), None
+                roi_in_btc = (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc
+            portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + sell_price*quantity # keep variable balance here so don't have to add more code for when not back_testing, in general balance used for when retrieving value from portfolio, quantity used when calculating value or value returned after submitting an order # (sell_price / btc_price)
+            # coin_data already retrieved in current_date, current_price, current_roi # can use np.append(coin, portfolio['open'].loc[coin, [...]].to_numpy())
+            symbol, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc = portfolio['open'].get(coin, ['symbol', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d', 'tsl_max_price(btc)'])
+            portfolio['sold_ledger'].append([coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, sell_date, sell_price, sell_price_in_btc, roi_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes]) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'trade_notes', 'other_notes']).append(pd.Series([coin, sell_date, sell_price, sell_price_in_btc, roi_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin) # 'binance_btc_24h_vol(btc)', binance_btc_24h_vol_in_btc, 'binance_btc_24h_vol(btc)',
+            portfolio['open'].pop(coin)
+        def open_position(coin, market_cap_rank_change, symbol, price, price_in_btc, quantity, buy_date, kucoin_usdt_24h_vol, trade_notes):
+            if BUY_DATE_GTRENDS_15D:
+                coin_search_term = coin if not re.search('-', coin) else coin.split("-")[0]  # precautionary returns coin or coin symbol, assuming coins are unique to tickers / other similar search terms
+                google_trends = _google_trends_frame({coin_search_term: buy_google_trends[coin_search_term]}) if coin_search_term in buy_google_trends else _fetch_data(get_google_trends_pt, params={'kw_list': [coin_search_term], 'from_date': stop_day - timedelta(days=15), 'to_date': stop_day}, error_str=" - No " + "google trends" + " data for coin search term: " + coin_search_term + " from: " + str(stop_day - timedelta(days=15)) + " to: " + str(stop_day), empty_data=pd.DataFrame()) # single keyword query only if the batched prefetch failed
+                google_trends_slope = trendline(google_trends.sort_values('date', inplace=False, ascending=True)[coin_search_term]) if not google_trends.empty else float("NaN") # sort_values is precautionary, should already be ascending:  # , reverse_to_ascending=True
             else:
-                coin_data = _fetch_data(get_coin_data, params={'coin': coin}, error_str=" - No " + "" + " coin data for: " + coin + " on: " + str(datetime.now()), empty_data={}) # retrieving coin_data even when not back_testing as a double check for market cap rank and to retreive symbol, input price_in_btc for function binance_check_24h_vol_and_price_in_btc
-            # error with some coins (bitbay), if these 2 conditions aren't meant usually indicate larger issues with the coin, further if error retreiving market cap rank whole basis for algorithm falls apart (market cap rank is meaningless)
-            if back_testing and not (('market_data' in coin_data) and coin_data['market_data']['market_cap']['usd'] and coin_data['market_data']['current_price']['btc']): # refactor can probably get rid of coin_data['market_data']['market_cap']['usd'] / 'usd'/'btc' in coin_data['market_data']['market_cap']/['current_price']
-                print("Error retreiving initial market data for coin: " + coin + " on date: " + stop_day.strftime('%Y-%m-%d'))
-            else: # don't add coin if issue retreiving market_data
-                # can add other exchanges
+                google_trends_slope = 0
+            portfolio['open'].set(coin, ['symbol', 'position', 'balance', 'buy_price', 'buy_date', 'buy_price(btc)', 'current_date', 'current_price(btc)', 'current_roi(btc)', 'rank_rise_d', 'gtrends_15d', 'kucoin_usdt_24h_vol', 'tsl_armed', 'trade_notes'], [symbol, ('long' if not paper_trading else 'long-p'), quantity] + [price] + [buy_date, price_in_btc]*2 + [0, market_cap_rank_change, google_trends_slope, kucoin_usdt_24h_vol, False, trade_notes]) # 'binance_btc_24h_vol(btc)'
+        buy_google_trends = _fetch_data(_get_google_trends_series, params={'kw_list': [coin if not re.search('-', coin) else coin.split("-")[0] for coin, market_cap_rank_change in coins_to_buy if coin not in coins_to_avoid], 'from_date': stop_day - timedelta(days=15), 'to_date': stop_day}, error_str=" - No " + "google trends" + " prefetch data for coins to buy from: " + str(stop_day - timedelta(days=15)) + " to: " + str(stop_day), empty_data={}) if BUY_DATE_GTRENDS_15D and coins_to_buy else {} # search term -> series for all candidates in batched payloads (instead of one payload per bought coin), also when the current window isn't cached
+        buy_orders = [] # not back_testing: [coin, market_cap_rank_change, symbol, kucoin_usdt_24h_vol, order] submitted together after all buys are decided
+        for coin, market_cap_rank_change in coins_to_buy: # coins_market_cap_rank_change_by_factor.items()
+            if portfolio['balance'][BASE_PAIR] >= INVEST_MIN and (coin not in coins_to_avoid): # can add max open positions and a waiting list to reflect real trading: # assuming always enforcing BTC_INVEST_MIN # maybe refactor, logic here and not in run_portfolio_algorithm to keep logic simple (even though makes tickers_to_buy/sell lists longer) # maybe refactor if insufficient balance and signals are indicating a buy can add positions as a long-p then buy when balance opens up
+                invest = INVEST if (portfolio['balance'][BASE_PAIR] >= INVEST) else portfolio['balance'][BASE_PAIR]
                 if back_testing:
-                    symbol, symbol_pair = coin_data['symbol'], coin_data['symbol'].upper() + '-USDT' # maybe refactor name to btc_symbol_pair or just symbol_pair like other instances
+                    coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (stop_day + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': retry_end_day_if_no_historical_market_data}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(stop_day + timedelta(hours=7)), empty_data={})
                 else:
-                    if coin not in coins_id_to_symbol:
-                        continue
-                    symbol, symbol_pair = coins_id_to_symbol[coin], coins_id_to_symbol[coin].upper() + '-USDT'
-                if symbol_pair in kucoin_pairs_with_price_and_vol_current: # binance_pairs_with_price_current # not retrieving new prices since whole function should execute (if done over one DAYS period) quickly
+                    coin_data = _fetch_data(get_coin_data, params={'coin': coin}, error_str=" - No " + "" + " coin data for: " + coin + " on: " + str(datetime.now()), empty_data={}) # retrieving coin_data even when not back_testing as a double check for market cap rank and to retreive symbol, input price_in_btc for function binance_check_24h_vol_and_price_in_btc
+                # error with some coins (bitbay), if these 2 conditions aren't meant usually indicate larger issues with the coin, further if error retreiving market cap rank whole basis for algorithm falls apart (market cap rank is meaningless)
+                if back_testing and not (('market_data' in coin_data) and coin_data['market_data']['market_cap']['usd'] and coin_data['market_data']['current_price']['btc']): # refactor can probably get rid of coin_data['market_data']['market_cap']['usd'] / 'usd'/'btc' in coin_data['market_data']['market_cap']/['current_price']
+                    print("Error retreiving initial market data for coin: " + coin + " on date: " + stop_day.strftime('%Y-%m-%d'))
+                else: # don't add coin if issue retreiving market_data
+                    # can add other exchanges
                     if back_testing:
-                        price_in_btc, price = coin_data['market_data']['current_price']['btc'], coin_data['market_data']['current_price']['usd'] # maybe refactor -  assuming that if 'market_data' in coin_data and coin_data['market_data']['market_cap']['usd'] ('usd' and 'btc') in coin_data['market_data']['current_price'] also in there
+                        symbol, symbol_pair = coin_data['symbol'], coin_data['symbol'].upper() + '-USDT' # maybe refactor name to btc_symbol_pair or just symbol_pair like other instances
                     else:
-                        price, btc_price = kucoin_pairs_with_price_and_vol_current[symbol_pair]['price'], kucoin_pairs_with_price_and_vol_current['BTC-USDT']['price']
-                        price_in_btc = price / btc_price
-                    if (price > invest): # simpler to put this logic here rather than in binance_trade_coin_btc() (and make it continue here if trade_notes == "BTrade Error" or something similar) # maybe refactor - don't want to buy fractions of a coin for now
-                        continue
-                    if back_testing: # maybe refactor and put this logic into function binance_trade_coin_btc, maybe also include binance_check_24h_vol_and_price_in_btc in back_testing purchases
-                        buy_date, kucoin_usdt_24h_vol, quantity, trade_notes = stop_day, float("NaN"), math.floor(invest / price) if invest > 10 else math.ceil(invest / price), None # btc_price / price # assuming buying at 17 PST and that order is filled near coingecko price (maybe refactor) # precautionary keep > 0.001 in case BTC_INVEST_MIN is set below this amount # can get historical total_volume (exchange-weighted 24h_vol) with coin_data['market_data']['total_volume']['usd'] but can't get historical binance_btc_24h_vol (Binance symbol_pair 24h_vol) therefore doesn't match / reflect stocks.py
-                    else:
-                        kucoin_usdt_24h_vol = kucoin_pairs_with_price_and_vol_current[symbol_pair]['24h_volume'] # float("NaN") # binance_btc_24h_vol_in_btc = float("NaN") # float(_fetch_data(binance_client.get_ticker, params={'symbol': symbol_pair}, error_str=" - Binance get ticker error for symbol pair: " + symbol_pair + " on date: " + str(datetime.now().date()), empty_data={'quoteVolume': "NaN"})['quoteVolume']) # *binance_pairs_with_price_current['BTCUSDT'] # don't check for - if stop_day.date() == datetime.now().date() else None since no back running # a bit inaccurate (can make accurate to hour or minute)
-                        kucoin_usdt_24h_vol_too_low, kucoin_price_mismatch = kucoin_check_24h_vol_and_price_in_usdt(symbol_pair=symbol_pair, kucoin_usdt_24h_vol=kucoin_usdt_24h_vol, price=price, kucoin_price=price) if (kucoin_usdt_24h_vol > 0) else [True, True] # refactor not checking CoinGecko price since issue with API as of 2023 so kucoin_price_mismatch is 0
-                        # binance_btc_24h_vol_in_btc_too_low, binance_price_in_btc_mismatch = binance_check_24h_vol_and_price_in_btc(symbol_pair=symbol_pair, binance_btc_24h_vol_in_btc=binance_btc_24h_vol_in_btc, price_in_btc=price_in_btc, binance_price_in_btc=binance_pairs_with_price_current[symbol_pair]) if (binance_btc_24h_vol_in_btc > 0) else [True, True] # *binance_pairs_with_price_current['BTCUSDT']
-                        if kucoin_usdt_24h_vol_too_low or kucoin_price_mismatch: # binance_btc_24h_vol_in_btc_too_low, binance_price_in_btc_mismatch
+                        symbol = get_instrument_symbol(coin)
+                        if not symbol: # not in registry or another coin has the symbol
                             continue
-                        quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = kucoin_trade_coin_usdt(symbol_pair=symbol_pair, coin=coin, trade="buy", usdt_invest=invest, price_in_btc=price_in_btc, paper_trading=paper_trading) # binance_coin_btc_order, binance_coin_btc_open_orders # maybe refactor and change binance_coin_btc... to binance_btc_..., binance_coin_btc may be good to reflect importance (exchange order)
-                        buy_date = datetime.now() # if not back_testing buying when run the algorithm, also if back running need to use datetime.now() and if real time running datetime.now() is closer to time order is processed due to api request limits, processing, etc.
-                    if BUY_DATE_GTRENDS_15D:
-                        coin_search_term = coin if not re.search('-', coin) else coin.split("-")[0]  # precautionary returns coin or coin symbol, assuming coins are unique to tickers / other similar search terms
-                        google_trends = _fetch_data(get_google_trends_pt, params={'kw_list': [coin_search_term], 'from_date': stop_day - timedelta(days=15), 'to_date': stop_day}, error_str=" - No " + "google trends" + " data for coin search term: " + coin_search_term + " from: " + str(stop_day - timedelta(days=15)) + " to: " + str(stop_day), empty_data=pd.DataFrame())
-                        google_trends_slope = trendline(google_trends.sort_values('date', inplace=False, ascending=True)[coin_search_term]) if not google_trends.empty else float("NaN") # sort_values is precautionary, should already be ascending:  # , reverse_to_ascending=True
-                    else:
-                        google_trends_slope = 0
-                    portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] - price*quantity # btc value not entirely accurate in real time and doesn't take into account distribution tokens but close enough to prevent trades from executing if underbudget, also don't check assets since want to allocate full btc value to coin # (price / btc_price) # a bit more accurate than using just btc_invest since rounding for quantity: quantity = math.floor(btc_invest*btc_price / price)
-                    portfolio['open'].loc[coin, ['symbol', 'position', 'balance', 'buy_price', 'buy_date', 'buy_price(btc)', 'current_date', 'current_price(btc)', 'current_roi(btc)', 'rank_rise_d', 'gtrends_15d', 'kucoin_usdt_24h_vol', 'tsl_armed', 'trade_notes']] = [symbol, ('long' if not paper_trading else 'long-p'), quantity] + [price] + [buy_date, price_in_btc]*2 + [0, market_cap_rank_change, google_trends_slope, kucoin_usdt_24h_vol, False, trade_notes] # 'binance_btc_24h_vol(btc)'
+                        symbol_pair = symbol.upper() + '-USDT'
+                    if symbol_pair in kucoin_pairs_with_price_and_vol_current: # binance_pairs_with_price_current # not retrieving new prices since whole function should execute (if done over one DAYS period) quickly
+                        if back_testing:
+                            price_in_btc, price = coin_data['market_data']['current_price']['btc'], coin_data['market_data']['current_price']['usd'] # maybe refactor -  assuming that if 'market_data' in coin_data and coin_data['market_data']['market_cap']['usd'] ('usd' and 'btc') in coin_data['market_data']['current_price'] also in there
+                            candle_price, candle_price_in_btc = _kucoin_candle_backtest_price(coin, symbol, stop_day, end_day) # Kucoin close if pricing from Kucoin candles
+                            if not (math.isnan(candle_price) or math.isnan(candle_price_in_btc)):
+                                price, price_in_btc = candle_price, candle_price_in_btc
+                        else:
+                            price, btc_price = kucoin_pairs_with_price_and_vol_current[symbol_pair]['price'], kucoin_pairs_with_price_and_vol_current['BTC-USDT']['price']
+                            price_in_btc = price / btc_price
+                        if (price > invest): # simpler to put this logic here rather than in binance_trade_coin_btc() (and make it continue here if trade_notes == "BTrade Error" or something similar) # maybe refactor - don't want to buy fractions of a coin for now
+                            continue
+                        if back_testing: # maybe refactor and put this logic into function binance_trade_coin_btc, maybe also include binance_check_24h_vol_and_price_in_btc in back_testing purchases
+                            buy_date, kucoin_usdt_24h_vol, quantity, trade_notes = stop_day, float("NaN"), math.floor(invest / price) if invest > 10 else math.ceil(invest / price), None # btc_price / price # assuming buying at 17 PST and that order is filled near coingecko price (maybe refactor) # precautionary keep > 0.001 in case BTC_INVEST_MIN is set below this amount # can get historical total_volume (exchange-weighted 24h_vol) with coin_data['market_data']['total_volume']['usd'] but can't get historical binance_btc_24h_vol (Binance symbol_pair 24h_vol) therefore doesn't match / reflect stocks.py
+                        else:
+                            kucoin_usdt_24h_vol = kucoin_pairs_with_price_and_vol_current[symbol_pair]['24h_volume'] # float("NaN") # binance_btc_24h_vol_in_btc = float("NaN") # float(_fetch_data(binance_client.get_ticker, params={'symbol': symbol_pair}, error_str=" - Binance get ticker error for symbol pair: " + symbol_pair + " on date: " + str(datetime.now().date()), empty_data={'quoteVolume': "NaN"})['quoteVolume']) # *binance_pairs_with_price_current['BTCUSDT'] # don't check for - if stop_day.date() == datetime.now().date() else None since no back running # a bit inaccurate (can make accurate to hour or minute)
+                            kucoin_usdt_24h_vol_too_low, kucoin_price_mismatch = kucoin_check_24h_vol_and_price_in_usdt(symbol_pair=symbol_pair, kucoin_usdt_24h_vol=kucoin_usdt_24h_vol, price=price, kucoin_price=price) if (kucoin_usdt_24h_vol > 0) else [True, True] # refactor not checking CoinGecko price since issue with API as of 2023 so kucoin_price_mismatch is 0
+                            # binance_btc_24h_vol_in_btc_too_low, binance_price_in_btc_mismatch = binance_check_24h_vol_and_price_in_btc(symbol_pair=symbol_pair, binance_btc_24h_vol_in_btc=binance_btc_24h_vol_in_btc, price_in_btc=price_in_btc, binance_price_in_btc=binance_pairs_with_price_current[symbol_pair]) if (binance_btc_24h_vol_in_btc > 0) else [True, True] # *binance_pairs_with_price_current['BTCUSDT']
+                            if kucoin_usdt_24h_vol_too_low or kucoin_price_mismatch: # binance_btc_24h_vol_in_btc_too_low, binance_price_in_btc_mismatch
+                                continue
+                            quantity = math.floor(invest / price) if invest > 10 else math.ceil(invest / price) # same quantity kucoin_trade_coin(s)_usdt computes for usdt_invest, so balance below can be reserved before the order is placed
+                            buy_orders.append([coin, market_cap_rank_change, symbol, kucoin_usdt_24h_vol, price*quantity, {'symbol_pair': symbol_pair, 'coin': coin, 'trade': "buy", 'usdt_invest': invest, 'check_price': price, 'paper_trading': paper_trading}]) # priced, sized and price / 24h vol rechecked by kucoin_trade_coins_usdt from a fresh tickers snapshot since params['kucoin_pairs_with_price_and_vol_current'] is from the start of the cycle
+                        portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] - price*quantity # btc value not entirely accurate in real time and doesn't take into account distribution tokens but close enough to prevent trades from executing if underbudget, also don't check assets since want to allocate full btc value to coin # (price / btc_price) # a bit more accurate than using just btc_invest since rounding for quantity: quantity = math.floor(btc_invest*btc_price / price)
+                        if back_testing:
+                            open_position(coin, market_cap_rank_change, symbol, price, price_in_btc, quantity, buy_date, kucoin_usdt_24h_vol, trade_notes)
+        buy_orders_executed = kucoin_trade_coins_usdt([order for coin, market_cap_rank_change, symbol, kucoin_usdt_24h_vol, reserved, order in buy_orders])
+        for (coin, market_cap_rank_change, symbol, kucoin_usdt_24h_vol, reserved, order), order_executed in zip(buy_orders, buy_orders_executed): # binance_coin_btc_order, binance_coin_btc_open_orders # maybe refactor and change binance_coin_btc... to binance_btc_..., binance_coin_btc may be good to reflect importance (exchange order)
+            portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + reserved # replaced by the executed order's value below
+            if order_executed is None: # fresh price / 24h vol failed the checks, not bought
+                continue
+            quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = order_executed
+            portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] - (price*quantity if not np.isnan(price*quantity) else reserved)
+            open_position(coin, market_cap_rank_change, symbol, price, price_in_btc, quantity, datetime.now(), kucoin_usdt_24h_vol, trade_notes) # if not back_testing buying when run the algorithm, also if back running need to use datetime.now() and if real time running datetime.now() is closer to time order is processed due to api request limits, processing, etc.
     return portfolio
 
-def run_portfolio_rr(portfolio, start_day=None, end_day=None, rr_sell=True, paper_trading=True, back_testing=False): # start_day and end_day are datetime objects # can get rid of back_testing parameter and add logic like start_day.date() < (end_day - timedelta(days=DAYS)).date(), # maybe refactor rr_buy/sell to algo_buy/sell if add more algorithms
+# date x coin matrices of saved coins data limited to coins_to_analyze, 'ranks' is 'Market Cap Rank' and 'positions' is row position in saved data (NaN if coin not in that date's top coins_to_analyze), 'lengths' is len(df_coins) for each date
+def get_market_cap_rank_matrix(dates, coins_to_analyze): # dates are strings in format '%Y-%m-%d'
+    dfs_coins = [get_saved_coins_data(date=date).iloc[:coins_to_analyze] for date in dates]
+    coins = pd.Index(pd.unique(np.concatenate([df_coins.index.to_numpy(dtype=object) for df_coins in dfs_coins] + [np.empty(0, dtype=object)])))
+    ranks, positions = np.full((len(dates), len(coins)), np.nan), np.full((len(dates), len(coins)), np.nan)
+    for date_pos, df_coins in enumerate(dfs_coins):
+        if not df_coins.empty:
+            col_idxs = coins.get_indexer(df_coins.index)
+            ranks[date_pos, col_idxs], positions[date_pos, col_idxs] = df_coins['Market Cap Rank'].to_numpy(dtype=np.float64), np.arange(len(df_coins))
+    return {'dates': list(dates), 'date_to_pos': {date: date_pos for date_pos, date in enumerate(dates)}, 'coins': coins, 'ranks': ranks, 'positions': positions, 'lengths': np.array([len(df_coins) for df_coins in dfs_coins], dtype=np.float64)}
+
+# market_cap_rank_change for every (stop date, coin) in rank_matrix with the start date days before (NaN rows if start date not in rank_matrix), vectorized version of run_portfolio_rr's scalar logic:
+# coin in start and stop - start rank - stop rank, coin only in stop - min(len start, len stop) - stop rank if len stop and len start are close (within up_move/2) else NaN, coin only in start (dropped out) - start rank - (min(len start, len stop) - down_move)
+def get_market_cap_rank_change_matrix(rank_matrix, days, up_move, down_move):
+    change = np.full(rank_matrix['ranks'].shape, np.nan)
+    for stop_pos, date in enumerate(rank_matrix['dates']):
+        start_date = (datetime.strptime(date, '%Y-%m-%d') - timedelta(days=days)).strftime('%Y-%m-%d')
+        if start_date not in rank_matrix['date_to_pos']:
+            continue
+        start_pos = rank_matrix['date_to_pos'][start_date]
+        len_start, len_stop = rank_matrix['lengths'][start_pos], rank_matrix['lengths'][stop_pos]
+        if not (len_start and len_stop):
+            continue
+        in_start, in_stop = ~np.isnan(rank_matrix['positions'][start_pos]), ~np.isnan(rank_matrix['positions'][stop_pos])
+        rel_tol = (up_move/2)/max(len_start, len_stop) # same as math.isclose(len_stop, len_start, rel_tol=rel_tol)
+        lengths_close = (abs(len_stop - len_start) <= abs(rel_tol*len_start)) or (abs(len_stop - len_start) <= abs(rel_tol*len_stop))
+        change[stop_pos] = np.where(in_start & in_stop, rank_matrix['ranks'][start_pos] - rank_matrix['ranks'][stop_pos], np.where(in_stop, (min(len_start, len_stop) - rank_matrix['ranks'][stop_pos]) if lengths_close else np.nan, np.where(in_start, rank_matrix['ranks'][start_pos] - (min(len_start, len_stop) - down_move), np.nan)))
+    return change
+
+# rr buy / sell signals on stop_day from rank_matrix / rank_change_matrix (portfolio['open'] is a PositionBook), returns [coins_to_buy, coins_to_sell] as [[coin, market_cap_rank_change], ...] in df_coins_interval_stop order (dropped out coins last in df_coins_interval_start order)
+def _rr_coins_to_buy_and_sell(portfolio, rank_matrix, rank_change_matrix, stop_day, rr_sell=True):
+    UP_MOVE, DOWN_MOVE = portfolio['constants']['up_down_move'], -portfolio['constants']['up_down_move']
+    DAYS, RANK_RISE_D_BUY_LIMIT = portfolio['constants']['days'], portfolio['constants']['rank_rise_d_buy_limit']
+    stop_pos, start_pos = rank_matrix['date_to_pos'][stop_day.strftime('%Y-%m-%d')], rank_matrix['date_to_pos'][(stop_day - timedelta(days=DAYS)).strftime('%Y-%m-%d')]
+    coins_to_buy, coins_to_sell = [], [] # multi-dimensional array [coin, market_cap_rank_change] # coins_market_cap_rank_change_by_factor = Counter()
+    # buy if coin increases in market cap rank by UP_MOVE over DAYS, sell if coin decreases by DOWN_MOVE over DAYS
+    if rank_matrix['lengths'][start_pos] and rank_matrix['lengths'][stop_pos]: # not (df_coins_interval_start.empty or df_coins_interval_stop.empty)
+        # can also add google trends, reddit possibly chart first coordinate with price timestamp
+        market_cap_rank_change, in_stop, in_start = rank_change_matrix[stop_pos], ~np.isnan(rank_matrix['positions'][stop_pos]), ~np.isnan(rank_matrix['positions'][start_pos])
+        in_open = rank_matrix['coins'].isin(list(portfolio['open']))
+        with np.errstate(invalid='ignore'): # NaN market_cap_rank_change comparisons are False like in scalar logic
+            coins_to_buy_mask, coins_to_sell_mask = in_stop & ~in_open & (market_cap_rank_change >= UP_MOVE) & (market_cap_rank_change <= RANK_RISE_D_BUY_LIMIT), (in_stop & in_open & (market_cap_rank_change <= DOWN_MOVE)) if rr_sell else np.zeros(len(in_open), dtype=bool) # rr_buy and
+        for col_idx in np.flatnonzero(coins_to_buy_mask)[np.argsort(rank_matrix['positions'][stop_pos][coins_to_buy_mask], kind='stable')]: # in df_coins_interval_stop order
+            coins_to_buy.append([rank_matrix['coins'][col_idx], market_cap_rank_change[col_idx]])
+        for col_idx in np.flatnonzero(coins_to_sell_mask)[np.argsort(rank_matrix['positions'][stop_pos][coins_to_sell_mask], kind='stable')]:
+            if portfolio['open'].get(rank_matrix['coins'][col_idx], 'trade_notes') in ["Filled", "~Filled", None]: # can add short logic # not accounting for if there is a market data issue (MDI when backtesting) - if sell price and roi doesn't reflect actual, can try to postpone selling by a day
+                coins_to_sell.append([rank_matrix['coins'][col_idx], market_cap_rank_change[col_idx]])
+        coins_dropped_out_mask = in_start & ~in_stop & in_open if rr_sell else np.zeros(len(in_open), dtype=bool) # important to keep this logic for coins which are delisted or name / id changes, market_cap_rank_change for these is start rank - (min(len(df_coins_interval_start), len(df_coins_interval_stop)) - DOWN_MOVE) (to be safe, and DOWN_MOVE assumed to be negative value), unused and inaccurate but still saving
+        for col_idx in np.flatnonzero(coins_dropped_out_mask)[np.argsort(rank_matrix['positions'][start_pos][coins_dropped_out_mask], kind='stable')]:
+            coins_to_sell.append([rank_matrix['coins'][col_idx], market_cap_rank_change[col_idx]])
+    return [coins_to_buy, coins_to_sell]
+
+def run_portfolio_rr(portfolio, start_day=None, end_day=None, rr_sell=True, paper_trading=True, back_testing=False, rank_matrix=None, kucoin_pairs_with_price_and_vol_current=None): # rank_matrix and kucoin_pairs_with_price_and_vol_current can be preloaded (i.e. shared across runs in run_portfolio_rr_sweep) # start_day and end_day are datetime objects # can get rid of back_testing parameter and add logic like start_day.date() < (end_day - timedelta(days=DAYS)).date(), # maybe refactor rr_buy/sell to algo_buy/sell if add more algorithms
     print("running run_portfolio_rr()")
     UP_MOVE, DOWN_MOVE = portfolio['constants']['up_down_move'], -portfolio['constants']['up_down_move']
     DAYS = portfolio['constants']['days']
     COINS_TO_ANALYZE, RANK_RISE_D_BUY_LIMIT = portfolio['constants']['coins_to_analyze'], portfolio['constants']['rank_rise_d_buy_limit'] # limit here is capitalized since it is a portfolio constant
     # binance_pairs_with_price_current = {pair_price['symbol']: float(pair_price['price'] if ('price' in pair_price) and pair_price['price'] else "NaN") for pair_price in _fetch_data(binance_client.get_all_tickers, params={}, error_str=" - Binance get all tickers error on: " + str(datetime.now()), empty_data=[])} # maybe refactor and change to a different api source to figure out which symbol_pairs are listed on Binance, for now this is ok, a bit buggy / outdated
-    kucoin_pairs_with_price_and_vol_current = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={})
+    kucoin_pairs_with_price_and_vol_current = kucoin_pairs_with_price_and_vol_current if kucoin_pairs_with_price_and_vol_current is not None else get_kucoin_pairs_snapshot()
     end_day = end_day if end_day else datetime.now().replace(hour=17, minute=0, second=0, microsecond=0) # better to be on utc time, PST 17h is 24h UTC time, CoinGecko historical saves in UTC time # maybe refactor and make start/stop/end_datetime instead of start/stop/end_day
     start_day = start_day if start_day else end_day - timedelta(days=DAYS) # not this - datetime.strptime('2020_02_24 17:00:00', '%Y_%m_%d %H:%M:%S') - since back_testing=False (default)
     stop_day = start_day + timedelta(days=DAYS) # if running in real time stop_day should be almost equivalent (minus processing times) to datetime.now() # maybe refactor and make it stop_day = start_day - timedelta(days=DAYS) so easier to restart from last date, but then have to worry about data before start_day, have to worry about other logic in this function, other algorithms
     if (back_testing and not paper_trading) or (not back_testing and (stop_day.date() != datetime.now().date())): # ((start_day.date() < (end_day - timedelta(days=DAYS)).date()) or (end_day.date() < datetime.now().date())) #  precautionary - if back_testing, doesn't matter if paper_trading is set to True or False, just, don't allow back running
         print("Error (backtesting and not paper trading) or back running")
         return portfolio
-    while stop_day.date() <= end_day.date():
-        if not (portfolio['open']['current_date'] >= stop_day).any(): # in case re-run existing portfolio over same days to avoid back running (and conserve time): avoid selling existing coins incorrectly to TSL (too early) due to tsl_max_price set on future day or selling/buying existing/new coins incorrectly with algorithm logic # assuming datetime is always in 17:00:00
-            if back_testing:
-                portfolio = update_portfolio_postions_back_testing(portfolio=portfolio, stop_day=stop_day, end_day=end_day, kucoin_pairs_with_price_and_vol_current=kucoin_pairs_with_price_and_vol_current)
-            if rr_sell or (portfolio['balance']['usd'] >= portfolio['constants']['usd_invest_min']):
-                df_coins_interval_start, df_coins_interval_stop = get_saved_coins_data(date=(stop_day - timedelta(days=DAYS)).strftime('%Y-%m-%d')).iloc[:COINS_TO_ANALYZE], get_saved_coins_data(date=stop_day.strftime('%Y-%m-%d')).iloc[:COINS_TO_ANALYZE] # maybe refactor and make option to limit amount of coins to analyze
-                # buy if coin increases in market cap rank by UP_MOVE over DAYS, sell if coin decreases by DOWN_MOVE over DAYS
-                if not (df_coins_interval_start.empty or df_coins_interval_stop.empty):
-                    # can also add google trends, reddit possibly chart first coordinate with price timestamp
-                    coins_to_buy, coins_to_sell = [], [] # multi-dimensional array [coin, market_cap_rank_change] # coins_market_cap_rank_change_by_factor = Counter()
-                    for coin in df_coins_interval_stop.index:
-                        new_market_cap_rank = df_coins_interval_stop.loc[coin, 'Market Cap Rank']
-                        try: # if else statement same number of lines
-                            market_cap_rank_change = df_coins_interval_start.loc[coin, 'Market Cap Rank'] - new_market_cap_rank
-                        except Exception as e: # print(str(e) + " - Could not get historical saved market cap rank for: " + coin)
-                            market_cap_rank_change = min(len(df_coins_interval_start), len(df_coins_interval_stop)) - new_market_cap_rank if math.isclose(len(df_coins_interval_stop), len(df_coins_interval_start), rel_tol=((UP_MOVE/2)/max(len(df_coins_interval_start), len(df_coins_interval_stop)))) else float("NaN") # min() and max() to be conservative - leads to lower rank_rise and lower rel_tol, assuming same_symbol_coins are up to date # len(df_coins_interval_start) - new_market_cap_rank because # don't add UP_MOVE/DOWN_MOVE to be safe # rel_tol is relative to the larger absolute value of len(df_coins_interval_stop) or len(df_coins_interval_start) # len(df_coins_interval_stop) == len(df_coins_interval_start)
-                        if (coin not in portfolio['open'].index) and (market_cap_rank_change >= UP_MOVE) and (market_cap_rank_change <= RANK_RISE_D_BUY_LIMIT): # rr_buy and
-                            coins_to_buy.append([coin, market_cap_rank_change])
-                        elif rr_sell and (coin in portfolio['open'].index) and (portfolio['open'].loc[coin, 'trade_notes'] in ["Filled", "~Filled", None]) and (market_cap_rank_change <= DOWN_MOVE): # can add short logic # not accounting for if there is a market data issue (MDI when backtesting) - if sell price and roi doesn't reflect actual, can try to postpone selling by a day # (market_cap_rank_change <= DOWN_MOVE) and
-                            coins_to_sell.append([coin, market_cap_rank_change]) # coins_market_cap_rank_change_by_factor[coin] = market_cap_rank_change
-                    for coin in list(set(df_coins_interval_start.index.values) - set(df_coins_interval_stop.index.values)): # important to keep this logic for coins which are delisted or name / id changes
-                        if rr_sell and (coin in portfolio['open'].index):
-                            # if coin not in new dataframe assume it has fallen out of top coins: min(len(df_coins_interval_start), len(df_coins_interval_stop)) - DOWN_MOVE (to be safe, and DOWN_MOVE assumed to be negative value)
-                            coins_to_sell.append([coin, df_coins_interval_start.loc[coin, 'Market Cap Rank'] - (min(len(df_coins_interval_start), len(df_coins_interval_stop)) - DOWN_MOVE)]) # if rr_sell else None # market_cap_rank_change unused and inaccurate but still saving # coins_market_cap_rank_change_by_factor[coin] = df_coins_interval_start.loc[coin, 'Market Cap Rank'] - (len(df_coins_interval_start) - DOWN_MOVE)
+    rank_matrix = rank_matrix if rank_matrix else get_market_cap_rank_matrix(dates=sorted({(stop_day + timedelta(days=day)).strftime('%Y-%m-%d') for day in range((end_day.date() - stop_day.date()).days + 1)} | {(stop_day + timedelta(days=day - DAYS)).strftime('%Y-%m-%d') for day in range((end_day.date() - stop_day.date()).days + 1)}), coins_to_analyze=COINS_TO_ANALYZE) # each saved coins data date loaded once (instead of twice per stop_day)
+    rank_change_matrix = get_market_cap_rank_change_matrix(rank_matrix, days=DAYS, up_move=UP_MOVE, down_move=DOWN_MOVE)
+    with _portfolio_book(portfolio): # positions stay in book form for the whole run, converted back to DataFrames even if run is interrupted
+        while stop_day.date() <= end_day.date():
+            if not any(pd.notna(current_date) and current_date >= stop_day for current_date in portfolio['open'].column('current_date')): # in case re-run existing portfolio over same days to avoid back running (and conserve time): avoid selling existing coins incorrectly to TSL (too early) due to tsl_max_price set on future day or selling/buying existing/new coins incorrectly with algorithm logic # assuming datetime is always in 17:00:00
+                if back_testing:
+                    portfolio = update_portfolio_postions_back_testing(portfolio=portfolio, stop_day=stop_day, end_day=end_day, kucoin_pairs_with_price_and_vol_current=kucoin_pairs_with_price_and_vol_current)
+                if rr_sell or (portfolio['balance']['usd'] >= portfolio['constants']['usd_invest_min']):
+                    coins_to_buy, coins_to_sell = _rr_coins_to_buy_and_sell(portfolio, rank_matrix=rank_matrix, rank_change_matrix=rank_change_matrix, stop_day=stop_day, rr_sell=rr_sell)
                     if (coins_to_buy or coins_to_sell):
                         portfolio = update_portfolio_buy_and_sell_coins(portfolio=portfolio, coins_to_buy=coins_to_buy, coins_to_sell=coins_to_sell, stop_day=stop_day, end_day=end_day, paper_trading=paper_trading, back_testing=back_testing, kucoin_pairs_with_price_and_vol_current=kucoin_pairs_with_price_and_vol_current)
-        else:
-            print("skipping " +  str(stop_day) + " since portfolio has already run on this date")
-        stop_day = stop_day + timedelta(days=1)
+            else:
+                print("skipping " +  str(stop_day) + " since portfolio has already run on this date")
+            stop_day = stop_day + timedelta(days=1)
     return portfolio
 
+# event-driven run_portfolio_rr(back_testing=True) in one pass from start_day to end_day, same portfolio['open'] / portfolio['sold'] / balance as the day by day backtest:
+# a position's granular prices (btc) are loaded once when it is opened and its SL/TSL exit found with one get_sl_tsl_exit over its whole remaining price path (days overlap only at the stop_day boundary price which can't change the SL/TSL outcome twice), exits are scheduled as (day, position order) events and merged with the daily rank signal events so each day runs its exits in portfolio['open'] order and then rr sells / buys
+# current price / roi / TSL state and MDI notes of open positions are worked out (from the same preloaded arrays) only when a position is rr sold and at end_day instead of every day, fills are the back_testing fill model (exit tick price in btc with the CoinGecko daily usd price of that day, rr sells at current price, buys at stop_day's CoinGecko price)
+def run_portfolio_rr_backtest(portfolio, start_day, end_day, rr_sell=True, rank_matrix=None, kucoin_pairs_with_price_and_vol_current=None): # rank_matrix and kucoin_pairs_with_price_and_vol_current like run_portfolio_rr
+    print("running run_portfolio_rr_backtest()")
+    STOP_LOSS, TRAILING_STOP_LOSS_ARM, TRAILING_STOP_LOSS_PERCENTAGE = portfolio['constants']['sl'], portfolio['constants']['tsl_a'], portfolio['constants']['tsl_p']
+    BASE_PAIR, DAYS, END_DAY_OPEN_POSITIONS_GTRENDS_15D = portfolio['constants']['base_pair'], portfolio['constants']['days'], portfolio['constants']['end_day_open_positions_gtrends_15d']
+    kucoin_pairs_with_price_and_vol_current = kucoin_pairs_with_price_and_vol_current if kucoin_pairs_with_price_and_vol_current is not None else get_kucoin_pairs_snapshot()
+    days = [start_day + timedelta(days=DAYS + day) for day in range((end_day.date() - (start_day + timedelta(days=DAYS)).date()).days + 1)] # stop_day of each run_portfolio_rr iteration
+    rank_matrix = rank_matrix if rank_matrix else get_market_cap_rank_matrix(dates=sorted({stop_day.strftime('%Y-%m-%d') for stop_day in days} | {(stop_day - timedelta(days=DAYS)).strftime('%Y-%m-%d') for stop_day in days}), coins_to_analyze=portfolio['constants']['coins_to_analyze'])
+    rank_change_matrix = get_market_cap_rank_change_matrix(rank_matrix, days=DAYS, up_move=portfolio['constants']['up_down_move'], down_move=-portfolio['constants']['up_down_move'])
+    days_from_ms, days_to_ms = np.array([datetime.timestamp(stop_day - timedelta(days=1)) for stop_day in days], dtype=np.float64)*1000, np.array([datetime.timestamp(stop_day) for stop_day in days], dtype=np.float64)*1000 # granular price window of each stop_day like update_portfolio_postions_back_testing
+    with _portfolio_book(portfolio):
+        positions, exits, position_count, coins_windows = {}, [], itertools.count(), {} # positions: coin -> preloaded prices, day windows, state when tracking started, exit # exits: heap of (day_idx, position order, coin) # coins_windows: coin -> [timestamps, prices, window starts, window stops] for all days (coins are bought again and again)
+        def track(coin, day_idx): # start tracking coin from days[day_idx] (first day update_portfolio_postions_back_testing would see it)
+            if day_idx >= len(days):
+                return
+            stop_day, store, kucoin_backtest_pair = days[day_idx], None, _kucoin_backtest_pair(coin, portfolio['open'].get(coin, 'symbol'))
+            if kucoin_backtest_pair: # like update_portfolio_postions_back_testing, CoinGecko if Kucoin has no candles for the pair
+                store = _fetch_data(_kucoin_candles_btc, params={'symbol_pair': kucoin_backtest_pair, 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)) - kucoin_candle_intervals[kucoin_candles['interval']], 'to_timestamp': datetime.timestamp(end_day)}, error_str=" - No Kucoin candle data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(end_day), empty_data=None)
+            if (store is None) or not len(store['timestamps']):
+                store = _coin_granular_load(coin, 'btc')
+                if _coin_granular_missing_intervals(store['covered'], datetime.timestamp(stop_day - timedelta(days=1)), min(datetime.timestamp(end_day), datetime.timestamp(datetime.now()))):
+                    _fetch_data(get_coin_data_granular, params={'coin': coin, 'currency': 'btc', 'from_timestamp': datetime.timestamp(stop_day - timedelta(days=1)), 'to_timestamp': datetime.timestamp(stop_day), 'prefetch_to_timestamp': datetime.timestamp(end_day)}, error_str=" - No granular coin data for: " + coin + " from: " + str(stop_day - timedelta(days=1)) + " to: " + str(end_day), empty_data={}) # fetches (once) everything up to end_day into the local granular store
+                    store = _coin_granular_load(coin, 'btc')
+            if (coin not in coins_windows) or (coins_windows[coin][0] is not store['timestamps']):
+                coins_windows[coin] = [store['timestamps'], store['prices'], np.searchsorted(store['timestamps'], days_from_ms, side='left'), np.searchsorted(store['timestamps'], days_to_ms, side='right')]
+            timestamps, prices, window_starts, window_stops = coins_windows[coin]
+            position = {'order': next(position_count), 'day_idx': day_idx, 'timestamps': timestamps, 'prices': prices, 'state': portfolio['open'].get(coin, ['buy_price(btc)', 'tsl_armed', 'tsl_max_price(btc)']), 'window_starts': window_starts[day_idx:], 'window_stops': window_stops[day_idx:]}
+            buy_price_in_btc, tsl_armed, tsl_max_price_in_btc = position['state']
+            chunk_start, path_stop, chunk_size = position['window_starts'][0], position['window_stops'][-1], 256
+            while chunk_start < path_stop: # most positions exit within days, so check the path in doubling chunks (TSL state carried over like from day to day)
+                chunk_stop = min(chunk_start + chunk_size, path_stop)
+                exit_idx, exit_reason, tsl_armed, tsl_max_price_in_btc = get_sl_tsl_exit(prices_in_btc=prices[chunk_start:chunk_stop], buy_price_in_btc=buy_price_in_btc, sl=STOP_LOSS, tsl_a=TRAILING_STOP_LOSS_ARM, tsl_p=TRAILING_STOP_LOSS_PERCENTAGE, tsl_armed=tsl_armed, tsl_max_price_in_btc=tsl_max_price_in_btc)
+                if exit_idx is not None:
+                    position['exit'] = [chunk_start + exit_idx, exit_reason, tsl_max_price_in_btc]
+                    heapq.heappush(exits, (day_idx + int(np.searchsorted(position['window_stops'], position['exit'][0], side='right')), position['order'], coin)) # first day whose window has the exit price
+                    break
+                chunk_start, chunk_size = chunk_stop, chunk_size*2
+            positions[coin] = position
+        def update_position(coin, day_idx): # portfolio['open'] values of coin after update_portfolio_postions_back_testing on days[day_idx] (coin not sold by SL/TSL by then)
+            position = positions[coin]
+            window_starts, window_stops = position['window_starts'][:day_idx - position['day_idx'] + 1], position['window_stops'][:day_idx - position['day_idx'] + 1]
+            days_with_prices, days_without_prices = np.flatnonzero(window_stops > window_starts), np.flatnonzero(window_stops == window_starts)
+            if len(days_without_prices): # MDI stands for Market Data Issue
+                portfolio['open'].set(coin, 'other_notes', "MDI " + days[position['day_idx'] + days_without_prices[-1]].strftime('%Y-%m-%d'))
+            if len(days_with_prices):
+                price_idx = window_stops[days_with_prices[-1]] - 1
+                buy_price_in_btc, tsl_armed, tsl_max_price_in_btc = position['state']
+                exit_idx, exit_reason, tsl_armed, tsl_max_price_in_btc = get_sl_tsl_exit(prices_in_btc=position['prices'][window_starts[0]:price_idx + 1], buy_price_in_btc=buy_price_in_btc, sl=STOP_LOSS, tsl_a=TRAILING_STOP_LOSS_ARM, tsl_p=TRAILING_STOP_LOSS_PERCENTAGE, tsl_armed=tsl_armed, tsl_max_price_in_btc=tsl_max_price_in_btc)
+                price_in_btc = float(position['prices'][price_idx])
+                portfolio['open'].set(coin, ['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)'], [datetime.fromtimestamp(float(position['timestamps'][price_idx])/1000), price_in_btc, (price_in_btc - buy_price_in_btc) / buy_price_in_btc, tsl_armed, tsl_max_price_in_btc])
+            return len(days_with_prices) and days_with_prices[-1] == day_idx - position['day_idx'] # prices on days[day_idx]
+        current_dates = [current_date for current_date in portfolio['open'].column('current_date') if pd.notna(current_date)]
+        first_day_idx = next((day_idx for day_idx, stop_day in enumerate(days) if not any(current_date >= stop_day for current_date in current_dates)), len(days)) # in case re-run existing portfolio over same days (like run_portfolio_rr)
+        for day_idx in range(first_day_idx):
+            print("skipping " +  str(days[day_idx]) + " since portfolio has already run on this date")
+        for coin in portfolio['open']:
+            track(coin, first_day_idx)
+        for day_idx in range(first_day_idx, len(days)):
+            stop_day = days[day_idx]
+            if END_DAY_OPEN_POSITIONS_GTRENDS_15D and (stop_day == end_day) and len(portfolio['open']):
+                _fetch_data(prefetch_google_trends, params={'kw_list': [coin if not re.search('-', coin) else coin.split("-")[0] for coin in portfolio['open']], 'from_date': stop_day - timedelta(days=15), 'to_date': stop_day}, error_str=" - No " + "google trends" + " prefetch data for open positions from: " + str(stop_day - timedelta(days=15)) + " to: " + str(stop_day), empty_data=0)
+            while exits and exits[0][0] == day_idx: # sell by TSL or SL
+                exit_day_idx, order, coin = heapq.heappop(exits)
+                if (coin not in positions) or (positions[coin]['order'] != order): # sold by rr before exit
+                    continue
+                position = positions.pop(coin)
+                price_idx, other_notes, tsl_max_price_in_btc = position['exit']
+                sell_price_in_btc, interval_time = float(position['prices'][price_idx]), datetime.fromtimestamp(float(position['timestamps'][price_idx])/1000)
+                sell_price = _kucoin_candle_backtest_price(coin, portfolio['open'].get(coin, 'symbol'), interval_time, end_day)[0]
+                if math.isnan(sell_price): # CoinGecko if not pricing from Kucoin candles or no candle
+                    coin_data = _fetch_data(get_coin_data, params={'coin': coin, 'date': (interval_time + timedelta(hours=7)).strftime('%d-%m-%Y'), 'historical': True, 'retry_current_if_no_historical_market_data': False}, error_str=" - No " + "historical" + " coin data for: " + coin + " on date: " + str(interval_time + timedelta(hours=7)), empty_data={})
+                    sell_price = coin_data['market_data']['current_price']['usd'] if ('market_data' in coin_data) and ('current_price' in coin_data['market_data']) and ('usd' in coin_data['market_data']['current_price']) else float("NaN")
+                symbol, position_type, buy_date, buy_price, buy_price_in_btc, quantity, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d = portfolio['open'].get(coin, ['symbol', 'position', 'buy_date', 'buy_price', 'buy_price(btc)', 'balance', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d'])
+                portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + (sell_price*quantity if BASE_PAIR == 'usdt' else sell_price_in_btc*quantity)
+                portfolio['sold_ledger'].append([coin, symbol, position_type, buy_date, buy_price, buy_price_in_btc, quantity, interval_time, sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, None, other_notes])
+                portfolio['open'].pop(coin)
+            if END_DAY_OPEN_POSITIONS_GTRENDS_15D and (stop_day == end_day):
+                for coin in portfolio['open']:
+                    if (coin in positions) and update_position(coin, day_idx):
+                        coin_search_term = coin if not re.search('-', coin) else coin.split("-")[0]
+                        google_trends = _fetch_data(get_google_trends_pt, params={'kw_list': [coin_search_term], 'from_date': stop_day - timedelta(days=15), 'to_date': stop_day}, error_str=" - No " + "google trends" + " data for coin search term: " + coin_search_term + " from: " + str(stop_day - timedelta(days=15)) + " to: " + str(stop_day), empty_data=pd.DataFrame())
+                        portfolio['open'].set(coin, 'gtrends_15d', trendline(google_trends.sort_values('date', inplace=False, ascending=True)[coin_search_term]) if not google_trends.empty else float("NaN"))
+            if rr_sell or (portfolio['balance']['usd'] >= portfolio['constants']['usd_invest_min']):
+                coins_to_buy, coins_to_sell = _rr_coins_to_buy_and_sell(portfolio, rank_matrix=rank_matrix, rank_change_matrix=rank_change_matrix, stop_day=stop_day, rr_sell=rr_sell)
+                if (coins_to_buy or coins_to_sell):
+                    for coin, market_cap_rank_change in coins_to_sell:
+                        update_position(coin, day_idx) if coin in positions else None
+                    portfolio = update_portfolio_buy_and_sell_coins(portfolio=portfolio, coins_to_buy=coins_to_buy, coins_to_sell=coins_to_sell, stop_day=stop_day, end_day=end_day, paper_trading=True, back_testing=True, kucoin_pairs_with_price_and_vol_current=kucoin_pairs_with_price_and_vol_current)
+                    for coin, market_cap_rank_change in coins_to_sell:
+                        positions.pop(coin, None)
+                    for coin, market_cap_rank_change in coins_to_buy:
+                        if (coin in portfolio['open']) and (coin not in positions):
+                            track(coin, day_idx + 1)
+        for coin in portfolio['open']:
+            if coin in positions:
+                update_position(coin, len(days) - 1)
+    return portfolio
+
+# rank_matrix arrays shared read-only with run_portfolio_rr_sweep workers through shared memory (not copied per worker / combination)
+_sweep_rank_matrix = None
+
+def _attach_shared_array(name, shape, dtype): # parent owns (and unlinks) the shared memory, pool workers share the parent's resource tracker
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name, track=False) if sys.version_info >= (3, 13) else shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def _run_portfolio_rr_sweep_init(shared_arrays, dates, coins, lengths):
+    global _sweep_rank_matrix
+    _sweep_rank_matrix = {'dates': dates, 'date_to_pos': {date: date_pos for date_pos, date in enumerate(dates)}, 'coins': pd.Index(coins), 'lengths': lengths, 'shms': []}
+    for key, (name, shape, dtype) in shared_arrays.items():
+        shm, _sweep_rank_matrix[key] = _attach_shared_array(name, shape, dtype)
+        _sweep_rank_matrix['shms'].append(shm) # keep reference so buffer stays mapped
+
+def _run_portfolio_rr_sweep_worker(portfolio, start_day, end_day, kucoin_pairs_with_price_and_vol_current):
+    start_time = time.time()
+    portfolio = run_portfolio_rr_backtest(portfolio=portfolio, start_day=start_day, end_day=end_day, rank_matrix=_sweep_rank_matrix, kucoin_pairs_with_price_and_vol_current=kucoin_pairs_with_price_and_vol_current)
+    metrics, trade_stats = get_portfolio_metrics(portfolio), get_portfolio_trade_stats(portfolio)
+    return {'roi(btc)': metrics['roi(btc)'], 'open_roi(btc)': metrics['open_roi(btc)'], 'sold_roi(btc)': metrics['sold_roi(btc)'],
+        'open_trades': metrics['open_trades'], 'sold_trades': metrics['sold_trades'], 'sold_by_sl': trade_stats['sold_by_sl'], 'sold_by_tsl': trade_stats['sold_by_tsl'], 'win_rate': trade_stats['win_rate'], 'max_drawdown': trade_stats['max_drawdown'],
+        'balance': portfolio['balance'][portfolio['constants']['base_pair']], 'execution_time': time.time() - start_time}
+
+# backtest every combination of param_grid (portfolio['constants'] keys to lists of values, i.e. {'up_down_move': [10, 50], 'days': [10, 15], 'sl': [-0.3], 'tsl_a': [0.5], 'tsl_p': [-0.2], 'rank_rise_d_buy_limit': [1000]}) across a process pool, returns one DataFrame row per combination with ROI and trade counts
+# saved coins data for start_day to end_day is loaded once and shared with workers through shared memory, Kucoin tickers fetched once, CoinGecko history / granular prices shared through their disk caches
+def run_portfolio_rr_sweep(portfolio, param_grid, start_day, end_day, processes=None):
+    from concurrent.futures import ProcessPoolExecutor # process pool / shared memory only needed for sweeps
+    from multiprocessing import shared_memory
+    if 'coins_to_analyze' in param_grid:
+        raise ValueError("coins_to_analyze can't be swept since shared rank matrix is limited to portfolio['constants']['coins_to_analyze']")
+    rank_matrix = get_market_cap_rank_matrix(dates=[(start_day + timedelta(days=day)).strftime('%Y-%m-%d') for day in range((end_day.date() - start_day.date()).days + 1)], coins_to_analyze=portfolio['constants']['coins_to_analyze'])
+    kucoin_pairs_with_price_and_vol_current = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={})
+    combinations = [dict(zip(param_grid.keys(), values)) for values in itertools.product(*param_grid.values())]
+    shms, shared_arrays = [], {}
+    try:
+        for key in ['ranks', 'positions']:
+            shm = shared_memory.SharedMemory(create=True, size=max(rank_matrix[key].nbytes, 1))
+            shms.append(shm)
+            np.ndarray(rank_matrix[key].shape, dtype=rank_matrix[key].dtype, buffer=shm.buf)[:] = rank_matrix[key]
+            shared_arrays[key] = (shm.name, rank_matrix[key].shape, rank_matrix[key].dtype)
+        with ProcessPoolExecutor(max_workers=processes, initializer=_run_portfolio_rr_sweep_init, initargs=(shared_arrays, rank_matrix['dates'], list(rank_matrix['coins']), rank_matrix['lengths'])) as executor:
+            futures = {}
+            for combination in combinations:
+                portfolio_combination = copy.deepcopy(portfolio)
+                portfolio_combination['constants'] = {**portfolio_combination['constants'], **combination}
+                futures[executor.submit(_run_portfolio_rr_sweep_worker, portfolio_combination, start_day, end_day, kucoin_pairs_with_price_and_vol_current)] = len(futures)
+            results = [None]*len(combinations)
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e:
+                    print(str(e) + " - Sweep error for combination: " + str(combinations[futures[future]]))
+                    results[futures[future]] = {}
+                print("run_portfolio_rr_sweep progress: " + str(sum(result is not None for result in results)) + "/" + str(len(combinations)) + " on: " + str(datetime.now()))
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return pd.DataFrame([{**combination, **result} for combination, result in zip(combinations, results)])
+
 def get_kucoin_assets(account_type="trade", other_coins_symbol_to_id=None, pages=10):
     # main_account, trade_account = {}, {}
     trade_assets = pd.DataFrame(columns=['symbol','balance','balance_locked','current_date','current_price','current_value','current_price(btc)','current_value(btc)','other_notes']).astype({'symbol':'object','balance':'float64','balance_locked':'float64','current_date':'datetime64[ns]','current_price':'float64','current_value':'float64','current_price(btc)':'float64','current_value(btc)':'float64','other_notes':'object'})
     accounts = _fetch_data(kucoin_client.get_accounts, params={}, error_str=" - Kucoin get account error on: " + str(datetime.now()), empty_data={}) # account gets updated after each trade # maybe refactor and include binance_client here and in other functions as a parameter
-    coins_data = _fetch_data(get_coins_markets_coinmarketcap, params={'pages': pages}, error_str=" - No " + "" + " coins markets data with pages: " + str(pages) + " on: " + str(datetime.now()), empty_data={})
-    coins_symbol_to_id = {**{'btc': 'bitcoin', 'bnb': 'binancecoin', 'fet': 'fetch-ai', 'kmd': 'komodo', 'cnd': 'cindicator', 'coti': 'coti', 'tfuel': 'theta-fuel', 'tomo': 'tomochain', 'gto': 'gifto', 'btg': 'bitcoin-gold'}, **{symbol_and_market_data['symbol']: coin_id for coin_id, symbol_and_market_data in coins_data.items()}}
-    if other_coins_symbol_to_id:
-        coins_symbol_to_id = {**coins_symbol_to_id, **other_coins_symbol_to_id} # maybe refactor and always add assets symbols & ids to coins_symbol_to_id, not sure about processing time: dict(zip(list(assets['symbol']), list(assets.index.values)))
-    kucoin_pairs_with_price_and_vol_current = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={})
+    instruments_by_symbol, other_coins_symbol_to_id = get_instrument_registry(pages=pages)['symbol'], other_coins_symbol_to_id if other_coins_symbol_to_id else {} # pages only used if there is no saved registry yet
+    kucoin_pairs_with_price_and_vol_current = get_kucoin_pairs_snapshot()
     for account in accounts:
         # if account['type'] == 'main' and float(account['balance']) > 0.0:
             # main_account[account['currency']] = {'balance': float(account['balance']), 'available': float(account['available']), 'holds': float(account['holds'])}
@@ -670,7 +2322,7 @@ def get_kucoin_assets(account_type="trade", other_coins_symbol_to_id=None, pages
             balance_free, balance_locked = float(account['available']), float(account['holds'])
             price, btc_price = 1.0 if account['currency'] == "USDT" else kucoin_pairs_with_price_and_vol_current[account['currency'] + '-USDT']['price'], kucoin_pairs_with_price_and_vol_current['BTC-USDT']['price'] # maybe refactor add fail safes
             price_in_btc = price / btc_price
-            coin = coins_symbol_to_id[symbol] if symbol in coins_symbol_to_id else symbol
+            coin = other_coins_symbol_to_id[symbol] if symbol in other_coins_symbol_to_id else instruments_by_symbol[symbol]['id'] if symbol in instruments_by_symbol else symbol
             trade_assets.loc[coin, ['symbol','balance','balance_locked','current_date','current_price','current_value','current_price(btc)','current_value(btc)']] = [symbol, balance_free, balance_locked, datetime.now(), price, price*(balance_free+balance_locked), price_in_btc, price_in_btc*(balance_free+balance_locked)] # trade_account = {'balance': float(account['balance']), 'available': float(account['available']), 'holds': float(account['holds'])}
     return trade_assets
 
@@ -683,9 +2335,7 @@ def get_binance_assets(other_coins_symbol_to_id=None, pages=10): # maybe refacto
         print("Error retrieving account from Binance")
         return assets
     binance_pairs_with_price_current = get_binance_pairs()
-    coins_symbol_to_id = {**{'btc': 'bitcoin', 'bnb': 'binancecoin', 'fet': 'fetch-ai', 'kmd': 'komodo', 'cnd': 'cindicator', 'coti': 'coti', 'tfuel': 'theta-fuel', 'tomo': 'tomochain', 'gto': 'gifto', 'btg': 'bitcoin-gold'}, **{symbol_and_market_data['symbol']: coin_id for coin_id, symbol_and_market_data in _fetch_data(get_coins_markets_coinmarketcap, params={'pages': pages}, error_str=" - No " + "" + " coins markets data with pages: " + str(pages) + " on: " + str(datetime.now()), empty_data={}).items()}}
-    if other_coins_symbol_to_id:
-        coins_symbol_to_id = {**coins_symbol_to_id, **other_coins_symbol_to_id} # maybe refactor and always add assets symbols & ids to coins_symbol_to_id, not sure about processing time: dict(zip(list(assets['symbol']), list(assets.index.values)))
+    instruments_by_symbol, other_coins_symbol_to_id = get_instrument_registry(pages=pages)['symbol'], other_coins_symbol_to_id if other_coins_symbol_to_id else {} # pages only used if there is no saved registry yet
     for asset in account['balances']:
         balance_free, balance_locked = float(asset['free'] if ('free' in asset) and asset['free'] else "NaN"), float(asset['locked'] if ('locked' in asset) and asset['locked'] else "NaN") # locked balance means it's an order pending # precautionay checking for ('free'/'locked' in asset) and asset['free'/'locked'] # "NaN" here and below so that doesn't throw error when adding to to assets DataFrame
         if balance_free > 0:
@@ -693,7 +2343,7 @@ def get_binance_assets(other_coins_symbol_to_id=None, pages=10): # maybe refacto
             # btc/coin prices are quoted in the price of the given exchange not coingecko, and converted to usd with exchange usdt/btc (not the way coingecko does it)
             price_in_btc = 1.0 if symbol == 'btc' else binance_pairs_with_price_current[symbol_pair] if symbol_pair in binance_pairs_with_price_current else float("NaN")
             price = price_in_btc*binance_pairs_with_price_current['BTCUSDT'] if 'BTCUSDT' in binance_pairs_with_price_current else float("NaN")
-            coin = coins_symbol_to_id[symbol] if symbol in coins_symbol_to_id else symbol # maybe refactor - cheap fix for now
+            coin = other_coins_symbol_to_id[symbol] if symbol in other_coins_symbol_to_id else instruments_by_symbol[symbol]['id'] if symbol in instruments_by_symbol else symbol # maybe refactor - cheap fix for now
             assets.loc[coin, ['symbol','balance','balance_locked','current_date','current_price','current_value','current_price(btc)','current_value(btc)']] = [symbol, balance_free, balance_locked, datetime.now(), price, price*(balance_free+balance_locked), price_in_btc, price_in_btc*(balance_free+balance_locked)]
             if balance_locked > 0:
                 print(asset['asset'] + " has locked balance of: " + str(balance_locked))
@@ -712,45 +2362,128 @@ def portfolio_align_balance_with_exchange(portfolio, exchange_assets, exchange):
     return portfolio
 
 # can also use rate of return (takes into account time), a little bit deceiving if add new investment which has 0% return intuition says it shouldn't draw ROI down but it does since cost of investment increases but net value of investments - cost of investment stays the same
+# running ROI aggregates of sold positions (closed trades are appended, so each row is folded in once) per sold DataFrame, real (avoid_paper_positions) and all: value / cost sums continued row by row in sold order like portfolio_calculate_roi's row loop so ROIs are the same to the last bit
+# _portfolio_from_book folds the sold ledger rows in as it appends them, a sold DataFrame without aggregates (loaded, built elsewhere or rows added outside the ledger) is folded once, in place price / balance edits (retry functions) drop its aggregates
+# cached by id with a weak reference to the DataFrame, so a new DataFrame reusing a freed one's id never gets its aggregates
+portfolio_metrics = {'cache': OrderedDict(), 'max_size': 64, 'stats': Counter(), 'lock': threading.Lock()}
+
+def _fold(start, values): # start + values[0] + values[1] + ... left to right (np.cumsum is sequential unlike np.sum which is pairwise)
+    return np.cumsum(np.concatenate([[start], values]))[-1] if len(values) else start
+
+def _sold_aggregates_new():
+    return {'n': 0, 'value': {False: 0.0, True: 0.0}, 'cost': {False: 0.0, True: 0.0}, 'costs': {False: np.empty(0), True: np.empty(0)}} # keyed by avoid_paper_positions
+
+def _sold_aggregates_fold(aggregates, buy_prices_in_btc, sell_prices_in_btc, balances, paper): # folds sold rows (in sold order) into aggregates
+    values, costs, real = sell_prices_in_btc*balances, buy_prices_in_btc*balances, ~paper
+    for avoid_paper_positions, mask in [(False, np.ones(len(values), dtype=bool)), (True, real)]:
+        aggregates['value'][avoid_paper_positions] = _fold(aggregates['value'][avoid_paper_positions], values[mask])
+        aggregates['cost'][avoid_paper_positions] = _fold(aggregates['cost'][avoid_paper_positions], costs[mask])
+        aggregates['costs'][avoid_paper_positions] = np.concatenate([aggregates['costs'][avoid_paper_positions], costs[mask]])
+    aggregates['n'] += len(values)
+    portfolio_metrics['stats']['rows_folded'] += len(values)
+    return aggregates
+
+def _sold_aggregates_cached(df_sold, n=None): # aggregates of df_sold (with n rows folded, default all rows) or None, call with portfolio_metrics['lock']
+    entry = portfolio_metrics['cache'].get(id(df_sold))
+    return entry[1] if entry and (entry[0]() is df_sold) and (entry[1]['n'] == (len(df_sold) if n is None else n)) else None
+
+def _sold_aggregates_cache(df_sold, aggregates): # call with portfolio_metrics['lock']
+    portfolio_metrics['cache'][id(df_sold)] = [weakref.ref(df_sold), aggregates]
+    portfolio_metrics['cache'].move_to_end(id(df_sold))
+    if len(portfolio_metrics['cache']) > portfolio_metrics['max_size']:
+        portfolio_metrics['cache'].popitem(last=False)
+
+def _portfolio_sold_aggregates(df_sold):
+    with portfolio_metrics['lock']:
+        aggregates = _sold_aggregates_cached(df_sold)
+        if aggregates is None:
+            portfolio_metrics['stats']['rebuilds'] += 1
+            aggregates = _sold_aggregates_fold(_sold_aggregates_new(), *[df_sold[column].to_numpy(dtype=np.float64) for column in ['buy_price(btc)', 'sell_price(btc)', 'balance']], (df_sold['position'] == 'long-p').to_numpy(dtype=bool))
+        _sold_aggregates_cache(df_sold, aggregates)
+        return aggregates
+
+def _portfolio_sold_aggregates_append(df_sold_previous, n_previous, df_sold, sold_ledger): # sold_ledger rows were appended to df_sold_previous (n_previous rows before) giving df_sold (the same DataFrame if appended in place), continues df_sold_previous's aggregates with the ledger rows
+    with portfolio_metrics['lock']:
+        aggregates = _sold_aggregates_cached(df_sold_previous, n=n_previous) if n_previous else _sold_aggregates_new()
+        portfolio_metrics['cache'].pop(id(df_sold_previous), None)
+        if aggregates is None: # never computed, folded on first use
+            return
+        idxs = [sold_ledger.columns.index(column) for column in ['buy_price(btc)', 'sell_price(btc)', 'balance', 'position']]
+        buy_prices_in_btc, sell_prices_in_btc, balances = [np.array([row[idx] for row in sold_ledger], dtype=np.float64) for idx in idxs[:3]]
+        _sold_aggregates_cache(df_sold, _sold_aggregates_fold(aggregates, buy_prices_in_btc, sell_prices_in_btc, balances, np.array([row[idxs[3]] == 'long-p' for row in sold_ledger], dtype=bool)))
+
+def _portfolio_sold_aggregates_invalidate(df_sold): # after editing sold rows' prices / balances in place
+    with portfolio_metrics['lock']:
+        entry = portfolio_metrics['cache'].get(id(df_sold))
+        if entry and entry[0]() is df_sold:
+            del portfolio_metrics['cache'][id(df_sold)]
+
 def portfolio_calculate_roi(portfolio, open_positions=True, sold_positions=False, avoid_paper_positions=False):
     value_of_current_investments, value_of_sold_investments, cost_of_investments = 0, 0, 0 # maybe refactor here and below to avoid divide by zero errors
-    if open_positions:
-        for coin in portfolio['open'].index:
-            if avoid_paper_positions and (portfolio['open'].loc[coin, 'position'] == 'long-p'):
-                continue
-            current_price_in_btc, buy_price_in_btc, balance = portfolio['open'].loc[coin, ['current_price(btc)', 'buy_price(btc)', 'balance']] # maybe refactor and multiply columns and sum
-            value_of_current_investments += current_price_in_btc*balance
-            cost_of_investments += buy_price_in_btc*balance
+    if open_positions: # few positions, prices change every cycle so summed on demand
+        df_open = portfolio['open'][portfolio['open']['position'] != 'long-p'] if avoid_paper_positions else portfolio['open']
+        balances = df_open['balance'].to_numpy(dtype=np.float64)
+        value_of_current_investments, cost_of_investments = _fold(0, df_open['current_price(btc)'].to_numpy(dtype=np.float64)*balances), _fold(0, df_open['buy_price(btc)'].to_numpy(dtype=np.float64)*balances)
     if sold_positions: # maybe refactor and use portfolio['balance']['btc']
-        for idx in portfolio['sold'].index:
-            if avoid_paper_positions and (portfolio['sold'].loc[idx, 'position'] == 'long-p'):
-                continue
-            sell_price_in_btc, buy_price_in_btc, balance = portfolio['sold'].loc[idx, ['sell_price(btc)', 'buy_price(btc)', 'balance']] # maybe refactor and multiply columns and sum
-            value_of_sold_investments += sell_price_in_btc*balance
-            cost_of_investments += buy_price_in_btc*balance
+        aggregates = _portfolio_sold_aggregates(portfolio['sold'])
+        value_of_sold_investments = aggregates['value'][avoid_paper_positions]
+        cost_of_investments = _fold(cost_of_investments, aggregates['costs'][avoid_paper_positions]) if cost_of_investments else aggregates['cost'][avoid_paper_positions] # sold costs continue from open costs
     if cost_of_investments: # maybe refactor here and below, to deal with if only paper_trades issue (divide by zero)
         return (value_of_current_investments + value_of_sold_investments - cost_of_investments) / cost_of_investments
     else:
         return float("NaN")
 
+def get_portfolio_metrics(portfolio): # the six ROIs portfolio_trading prints (open / sold / both, real and all) plus trade counts
+    metrics = {}
+    for name, open_positions, sold_positions in [('open_roi(btc)', True, False), ('sold_roi(btc)', False, True), ('roi(btc)', True, True)]:
+        metrics[name], metrics[name + '_real'] = portfolio_calculate_roi(portfolio, open_positions=open_positions, sold_positions=sold_positions), portfolio_calculate_roi(portfolio, open_positions=open_positions, sold_positions=sold_positions, avoid_paper_positions=True)
+    metrics.update({'open_trades': len(portfolio['open']), 'sold_trades': len(portfolio['sold'])})
+    return metrics
+
+# realized equity curve over closed trades in sold order: cumulative value / cost (btc) and roi(btc) (last row is portfolio_calculate_roi(open_positions=False, sold_positions=True)), drawdown of (1 + roi(btc)) from its running max
+def get_portfolio_equity_curve(portfolio, avoid_paper_positions=False):
+    df_sold = portfolio['sold'][portfolio['sold']['position'] != 'long-p'] if avoid_paper_positions else portfolio['sold']
+    balances = df_sold['balance'].to_numpy(dtype=np.float64)
+    values, costs = np.cumsum(df_sold['sell_price(btc)'].to_numpy(dtype=np.float64)*balances), np.cumsum(df_sold['buy_price(btc)'].to_numpy(dtype=np.float64)*balances)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        roi = (values - costs) / costs
+        equity = 1 + roi
+        drawdown = equity / np.fmax.accumulate(equity) - 1 if len(equity) else equity
+    return pd.DataFrame({'sell_date': df_sold['sell_date'].to_numpy(), 'pnl(btc)': np.diff(values - costs, prepend=0.0), 'value(btc)': values, 'cost(btc)': costs, 'roi(btc)': roi, 'drawdown': drawdown}, index=df_sold.index)
+
+def get_portfolio_trade_stats(portfolio, avoid_paper_positions=False): # per closed trade stats vectorized over sold
+    df_sold = portfolio['sold'][portfolio['sold']['position'] != 'long-p'] if avoid_paper_positions else portfolio['sold']
+    rois, pnls = df_sold['roi(btc)'].to_numpy(dtype=np.float64), (df_sold['sell_price(btc)'].to_numpy(dtype=np.float64) - df_sold['buy_price(btc)'].to_numpy(dtype=np.float64))*df_sold['balance'].to_numpy(dtype=np.float64)
+    wins, losses = rois[rois > 0], rois[rois <= 0]
+    holding_days = (pd.to_datetime(df_sold['sell_date']) - pd.to_datetime(df_sold['buy_date'])).dt.total_seconds().to_numpy() / (24*60*60) if len(df_sold) else np.empty(0)
+    equity_curve = get_portfolio_equity_curve(portfolio, avoid_paper_positions=avoid_paper_positions)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'trades': len(df_sold), 'wins': len(wins), 'losses': len(losses), 'win_rate': len(wins) / len(rois) if len(rois) else float("NaN"),
+            'avg_roi(btc)': float(np.nanmean(rois)) if len(rois) else float("NaN"), 'median_roi(btc)': float(np.nanmedian(rois)) if len(rois) else float("NaN"), 'best_roi(btc)': float(np.nanmax(rois)) if len(rois) else float("NaN"), 'worst_roi(btc)': float(np.nanmin(rois)) if len(rois) else float("NaN"),
+            'avg_win_roi(btc)': float(wins.mean()) if len(wins) else float("NaN"), 'avg_loss_roi(btc)': float(losses.mean()) if len(losses) else float("NaN"), 'profit_factor': float(np.nansum(pnls[pnls > 0]) / -np.nansum(pnls[pnls < 0])) if (pnls < 0).any() else float("NaN"),
+            'avg_holding_days': float(np.nanmean(holding_days)) if len(holding_days) else float("NaN"), 'sold_by_sl': int((df_sold['other_notes'] == 'Sell by SL').sum()), 'sold_by_tsl': int((df_sold['other_notes'] == 'Sell by TSL').sum()),
+            'roi(btc)': float(equity_curve['roi(btc)'].iloc[-1]) if len(equity_curve) else float("NaN"), 'max_drawdown': float(np.nanmin(equity_curve['drawdown'])) if len(equity_curve) and equity_curve['drawdown'].notna().any() else float("NaN")}
 
 # maybe refactor, pause buying / terminate program
 def portfolio_panic_sell(portfolio, df_matching_open_positions): # , paper_trading - paper_trading would be precautionary since function shouldn't be called if paper trading # , , idx_start, idx_end):
     BASE_PAIR = portfolio['constants']['base_pair']
-    for coin,row in df_matching_open_positions.iterrows(): # if don't use iterrows(): coin = df_matching_open_positions.index[0]
-        symbol_pair, other_notes = row['symbol'].upper() + '-USDT', 'Panic Sell' # 'BTC'
-        position, buy_price_in_btc, quantity = row[['position', 'buy_price(btc)', 'balance']] # portfolio['open'].loc[coin, ['buy_price(btc)', 'balance']]
-        quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = kucoin_trade_coin_usdt(symbol_pair=symbol_pair, coin=coin, trade="sell", quantity=quantity, paper_trading=(True if position == 'long-p' else False), other_notes=other_notes) # binance_coin_btc_order, binance_coin_btc_open_orders,  # paper_trading
-        sell_price_in_btc, sell_price = price_in_btc, price # maybe refactor and remove sell_date, place datetime.now() in portfolio['sold'], portfolio['open'] = ... line, good here for now since panic sells seem to have a longer delay (1.5-2.5 seconds) than other sells (1-1.5 seconds)
-        roi_in_btc = (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc
-        portfolio['balance'][BASE_PAIR] = (portfolio['balance'][BASE_PAIR] + sell_price*quantity) if BASE_PAIR == 'usdt' else (portfolio['balance'][BASE_PAIR] + sell_price_in_btc*quantity) # here and other locations where making calculations after alpaca_trade_ticker(): quantity should always == balance when quantity specified in binance_trade_coin_btc() since if quantity given then that quantity is used no matter what # (sell_price / btc_price)
-        symbol, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc = row[['symbol', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d', 'tsl_max_price(btc)']]
-        portfolio['sold'].loc[len(portfolio['sold'])], portfolio['open'] = [coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, datetime.now(), sell_price, sell_price_in_btc, roi_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes], portfolio['open'].drop(coin) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'trade_notes', 'other_notes']).append(pd.Series([coin, datetime.now(), sell_price, sell_price_in_btc, roi_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin)
+    with _portfolio_book(portfolio):
+        other_notes = 'Panic Sell'
+        sell_orders = kucoin_trade_coins_usdt([{'symbol_pair': row['symbol'].upper() + '-USDT', 'coin': coin, 'trade': "sell", 'quantity': row['balance'], 'paper_trading': (True if row['position'] == 'long-p' else False), 'other_notes': other_notes} for coin,row in df_matching_open_positions.iterrows()]) # all sell orders submitted together instead of one after another (prices move during a panic sell) # paper_trading
+        for (coin,row), sell_order in zip(df_matching_open_positions.iterrows(), sell_orders): # if don't use iterrows(): coin = df_matching_open_positions.index[0]
+            position, buy_price_in_btc = row[['position', 'buy_price(btc)']] # portfolio['open'].loc[coin, ['buy_price(btc)', 'balance']]
+            quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = sell_order # binance_coin_btc_order, binance_coin_btc_open_orders,
+            sell_price_in_btc, sell_price = price_in_btc, price # maybe refactor and remove sell_date, place datetime.now() in portfolio['sold'], portfolio['open'] = ... line, good here for now since panic sells seem to have a longer delay (1.5-2.5 seconds) than other sells (1-1.5 seconds)
+            roi_in_btc = (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc
+            portfolio['balance'][BASE_PAIR] = (portfolio['balance'][BASE_PAIR] + sell_price*quantity) if BASE_PAIR == 'usdt' else (portfolio['balance'][BASE_PAIR] + sell_price_in_btc*quantity) # here and other locations where making calculations after alpaca_trade_ticker(): quantity should always == balance when quantity specified in binance_trade_coin_btc() since if quantity given then that quantity is used no matter what # (sell_price / btc_price)
+            symbol, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc = row[['symbol', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d', 'tsl_max_price(btc)']]
+            portfolio['sold_ledger'].append([coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, datetime.now(), sell_price, sell_price_in_btc, roi_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes]) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'trade_notes', 'other_notes']).append(pd.Series([coin, datetime.now(), sell_price, sell_price_in_btc, roi_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin)
+            portfolio['open'].pop(coin)
     return portfolio
     # don't add retry logic for now, this would mean that I would have to keep the program running after panic_sell() finishes running, which would not be normal, can add retry_binance_open_orders_in_portfolio() if change my mind
 
 def retry_exchange_open_orders_in_portfolio(portfolio, exchange_open_orders, exchange_client, exchange, open_order_price_difference_limit=0.15):
-    exchange_pairs_with_price_current = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={}) if exchange == "kucoin" else get_binance_pairs()
+    exchange_pairs_with_price_current = get_kucoin_pairs_snapshot() if exchange == "kucoin" else get_binance_pairs()
     BASE_PAIR = portfolio['constants']['base_pair']
     for open_order in exchange_open_orders:
         symbol, side = open_order['symbol'].split("-")[0].lower(), open_order['side']
@@ -801,13 +2534,14 @@ def retry_exchange_open_orders_in_portfolio(portfolio, exchange_open_orders, exc
                     new_roi_in_btc = (new_price_in_btc - buy_price_in_btc) / buy_price_in_btc # maybe refactor to (be consistent with other sell_price_in_btc's) new_sell_price_in_btc = new_price_in_btc and (new_sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc
                     decreased_return = (sell_price - price)*quantity if BASE_PAIR == 'usdt' else (sell_price_in_btc - price_in_btc)*quantity # maybe refactor and add abs(), should always be positive if still open order and using limit order and even if negative (if the price suddenly drops in between checking for open orders and price) logic should still work
                     portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] - decreased_return
+                    _portfolio_sold_aggregates_invalidate(portfolio['sold'])
                     portfolio['sold'].loc[idx, ['sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'trade_notes', 'other_notes']] = [datetime.now(), new_price, new_price_in_btc, new_roi_in_btc, trade_notes, "Retried order"] # maybe refactor and move "Retried Order" notes into trade_notes somehow # update sell_date in case new order is incomplete even if new executed quantity is less than original executed quantity
     return portfolio
 
 def retry_exchange_trade_error_or_paper_orders_in_portfolio(portfolio, exchange, df_matching_open_positions, df_matching_sold_positions, paper_trading, exchange_trade_error_or_paper_order_price_difference_limit=0.15):
     BASE_PAIR = portfolio['constants']['base_pair']
     INVEST_MIN = portfolio['constants'][BASE_PAIR.lower() + '_invest_min'] # BTC_INVEST, portfolio['constants']['btc_invest'],
-    exchange_pairs_with_price_current = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={}) if exchange == "kucoin" else get_binance_pairs()
+    exchange_pairs_with_price_current = get_kucoin_pairs_snapshot() if exchange == "kucoin" else get_binance_pairs()
     error_message = "KTrade Error" if exchange == "kucoin" else "BTrade Error"
     for coin,row in df_matching_open_positions.iterrows(): # if not df_matching_open_positions.empty:
         symbol_pair = row['symbol'].upper() + ("-" if exchange == "kucoin" else "") + BASE_PAIR.upper()
@@ -837,17 +2571,175 @@ def retry_exchange_trade_error_or_paper_orders_in_portfolio(portfolio, exchange,
             quantity, price, price_in_btc, exchange_coin_pair_order, exchange_coin_pair_open_orders, trade_notes = kucoin_trade_coin_usdt(symbol_pair=symbol_pair, coin=coin, trade="sell", quantity=balance, paper_trading=False, other_notes="Retrying " + error_message + " order for coin " + coin + " sold on " + str(sell_date)) if exchange == "kucoin" else binance_trade_coin_btc(symbol_pair=symbol_pair, trade="sell", quantity=balance, paper_trading=False, other_notes="Retrying " + error_message + " order for coin " + coin + " sold on " + str(sell_date))
             roi_in_btc = (price_in_btc - buy_price_in_btc) / buy_price_in_btc
             portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + (price*quantity if exchange == "kucoin" else price_in_btc*quantity)
+            _portfolio_sold_aggregates_invalidate(portfolio['sold'])
             portfolio['sold'].loc[idx, ['sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'trade_notes', 'other_notes']] = [datetime.now(), price, price_in_btc, roi_in_btc, trade_notes, "Retried order-e"]
     return portfolio
 
-def portfolio_trading(portfolio, exchange, paper_trading=True, portfolio_usdt_value_negative_change_from_max_limit=-0.3, portfolio_current_roi_restart={'engaged': False, 'limit': 0.15}, download_and_save_coins_data=False): # refactor to mimick run_portfolio_rr # maybe add short logic # maybe refactor buying_disabled/paper_trading to be None/False as default and then change within function (or if specified) based on certain conditions # maybe refactor name of this variable and similar here and below to portfolio_current_roi_in_btc_restart
+# SL/TSL check for one open coin (portfolio in book form) at price_in_btc, sells coin if TSL/SL hit else updates current price / roi / TSL state, used by portfolio_trading polling and portfolio_stream_sl_tsl streaming
+def portfolio_check_sl_tsl(portfolio, coin, price_in_btc, current_datetime=None, price=None): # price (usdt) used for sell order if given, else from get_kucoin_pairs_snapshot() in kucoin_trade_coin_usdt
+    STOP_LOSS = portfolio['constants']['sl']
+    TRAILING_STOP_LOSS_ARM, TRAILING_STOP_LOSS_PERCENTAGE = portfolio['constants']['tsl_a'], portfolio['constants']['tsl_p']
+    BASE_PAIR = portfolio['constants']['base_pair']
+    if portfolio['open'].get(coin, 'trade_notes') in ["Not filled", "Partially filled", "KTrade Error"]: # maybe refactor quick fix for now since if using small TSL/SL sometimes price hits selling point before the ticker is bought, maybe refactor and only check for not in ['Filled', '~Filled'] - think computationally the same, maybe refactor and move up to right below for coin in portfolio['open'].index:
+        return portfolio
+    position, buy_price_in_btc, tsl_armed, tsl_max_price_in_btc, balance = portfolio['open'].get(coin, ['position', 'buy_price(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'balance'])
+    price_in_btc_change = (price_in_btc - buy_price_in_btc) / buy_price_in_btc
+    symbol_pair = portfolio['open'].get(coin, 'symbol').upper() + '-USDT'
+    if not tsl_armed and price_in_btc_change >= TRAILING_STOP_LOSS_ARM:
+        tsl_armed, tsl_max_price_in_btc = True, price_in_btc
+    if tsl_armed:
+        if price_in_btc > tsl_max_price_in_btc:
+            tsl_max_price_in_btc = price_in_btc
+        tsl_price_in_btc_change = (price_in_btc - tsl_max_price_in_btc) / tsl_max_price_in_btc
+        if tsl_price_in_btc_change <= TRAILING_STOP_LOSS_PERCENTAGE: # should check if price on coingecko is equal/close to price in binance
+            print("<<<< COIN SOLD due to TSL >>>>")
+            other_notes = 'Sell by TSL'
+            quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = kucoin_trade_coin_usdt(symbol_pair=symbol_pair, coin=coin, trade="sell", quantity=balance, price=price, price_in_btc=price_in_btc, paper_trading=(True if position == 'long-p' else False), other_notes=other_notes + " at ~roi " + str(price_in_btc_change)) # ~ roi since roi calculated with CoinGecko price but real roi is with Binance price # paper_trading
+            sell_price, sell_price_in_btc = price, price_in_btc # sell_price, = price, coin_data['market_data']['current_price']['btc'],  # tsl_max_price * (1 + TRAILING_STOP_LOSS_PERCENTAGE) # maybe refactor - check if 'btc' in coin_data['market_data']['current_price'], should be if 'usd' in it, logic to check for it a bit cumbersome, also not sure if need to relabel price_in_btc as sell_price_in_btc (but looks good to be consistent with logic throughout)
+            portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + sell_price*quantity
+            symbol, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d = portfolio['open'].get(coin, ['symbol', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d'])
+            portfolio['sold_ledger'].append([coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, datetime.now(), sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes]) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).append(pd.Series([coin, datetime.now(), sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, tsl_max_price_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'tsl_max_price(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin)
+            portfolio['open'].pop(coin)
+            return portfolio
+    elif price_in_btc_change <= STOP_LOSS: # should check if price on coingecko is equal/close to price in binance
+        print("<<<< COIN SOLD due to SL >>>>")
+        other_notes = 'Sell by SL'
+        quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = kucoin_trade_coin_usdt(symbol_pair=symbol_pair, coin=coin, trade="sell", quantity=balance, price=price, price_in_btc=price_in_btc, paper_trading=(True if position == 'long-p' else False), other_notes=other_notes + " at ~roi " + str(price_in_btc_change)) # paper_trading
+        sell_price, sell_price_in_btc = price, price_in_btc # sell_price, = price, coin_data['market_data']['current_price']['btc'], # buy_price * (1 + STOP_LOSS)
+        portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + sell_price*quantity
+        symbol, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d = portfolio['open'].get(coin, ['symbol', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d'])
+        portfolio['sold_ledger'].append([coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, datetime.now(), sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes]) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).append(pd.Series([coin, datetime.now(), sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, tsl_max_price_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'tsl_max_price(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin)
+        portfolio['open'].pop(coin)
+        return portfolio
+    current_datetime = current_datetime if current_datetime else datetime.now()
+    portfolio['open'].set(coin, ['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)'], [current_datetime, price_in_btc, price_in_btc_change, tsl_armed, tsl_max_price_in_btc])
+    return portfolio
+
+# Kucoin public websocket endpoint from bullet-public token, returns [ws_url, ping_interval in seconds]
+def get_kucoin_ws_url():
+    base_url = "https://api.kucoin.com"
+    resp = _http_request(base_url + '/api/v1/bullet-public', method='POST')
+    data = json.loads(resp.text)['data']
+    instance_server = data['instanceServers'][0]
+    return [instance_server['endpoint'] + "?token=" + data['token'] + "&connectId=" + str(int(time.time()*1000)), instance_server['pingInterval']/1000]
+
+async def _kucoin_stream_tickers(connect, ws_url, symbol_pairs, on_ticker, stop_time, ping_interval):
+    import asyncio
+    async with connect(ws_url) as ws:
+        for idx in range(0, len(symbol_pairs), 100): # Kucoin allows up to 100 symbols per topic subscription
+            await ws.send(json.dumps({'id': str(int(time.time()*1000)) + "-" + str(idx), 'type': 'subscribe', 'topic': '/market/ticker:' + ",".join(symbol_pairs[idx:idx+100]), 'privateChannel': False, 'response': True}))
+        last_ping = time.time()
+        while time.time() < stop_time:
+            if time.time() - last_ping >= ping_interval: # Kucoin closes connection if no ping within pingInterval
+                await ws.send(json.dumps({'id': str(int(time.time()*1000)), 'type': 'ping'}))
+                last_ping = time.time()
+            try:
+                message = json.loads(await asyncio.wait_for(ws.recv(), timeout=max(min(stop_time, last_ping + ping_interval) - time.time(), 0.01)))
+            except asyncio.TimeoutError:
+                continue
+            if (message.get('type') == 'message') and (message.get('subject') == 'trade.ticker'):
+                keep_streaming = on_ticker(message['topic'].split(":")[1], float(message['data']['price']))
+                if asyncio.iscoroutine(keep_streaming): # async on_ticker (i.e. blocking work in loop.run_in_executor)
+                    keep_streaming = await keep_streaming
+                if keep_streaming is False:
+                    return
+
+# calls on_ticker(symbol_pair, price) on every Kucoin ticker update for symbol_pairs until stop_time (time.time() seconds) or until on_ticker returns False, on_ticker runs on the stream's event loop so blocking work (orders) should be in an async on_ticker awaiting loop.run_in_executor
+# returns True if streamed without error, False if websockets isn't installed or connection / stream error (caller falls back to polling), ws_url can point to a local replay server (start_kucoin_ticker_replay_server)
+def kucoin_stream_tickers(symbol_pairs, on_ticker, stop_time, ws_url=None, ping_interval=18):
+    try:
+        from websockets.asyncio.client import connect # optional dependency (pip install speterlin-crypto[streaming])
+    except ImportError as e:
+        print(str(e) + " - websockets>=13 required for Kucoin ticker streaming")
+        return False
+    import asyncio
+    try:
+        ws_url, ping_interval = [ws_url, ping_interval] if ws_url else get_kucoin_ws_url()
+        with ThreadPoolExecutor(max_workers=1) as executor: # own thread and event loop so also works where an event loop is already running (i.e. Jupyter)
+            executor.submit(asyncio.run, _kucoin_stream_tickers(connect, ws_url, list(symbol_pairs), on_ticker, stop_time, ping_interval)).result()
+        return True
+    except Exception as e:
+        print(str(e) + " - Kucoin websocket stream error for symbol pairs: " + str(list(symbol_pairs)) + " on: " + str(datetime.now()))
+        return False
+
+# records Kucoin ticker updates for symbol_pairs over seconds as [[timestamp (ms), symbol_pair, price], ...] (i.e. to json.dump and replay with start_kucoin_ticker_replay_server)
+def record_kucoin_ticks(symbol_pairs, seconds, ws_url=None):
+    ticks = []
+    kucoin_stream_tickers(symbol_pairs, on_ticker=lambda symbol_pair, price: ticks.append([int(time.time()*1000), symbol_pair, price]), stop_time=time.time() + seconds, ws_url=ws_url)
+    return ticks
+
+# local stand-in for Kucoin's public websocket (welcome, subscribe ack, pong, /market/ticker messages) replaying recorded ticks to subscribed symbol pairs at speed times the recorded pace, starts replay on first subscribe
+# runs in a background thread, returns [ws_url, stop] where stop() shuts the server down
+def start_kucoin_ticker_replay_server(ticks, host='127.0.0.1', port=0, speed=1.0):
+    from websockets.asyncio.server import serve # optional dependency
+    import asyncio
+    ticks, ready, server_state = sorted(ticks, key=lambda tick: tick[0]), threading.Event(), {}
+    async def replay(ws, subscribed):
+        for tick_timestamp, symbol_pair, price in ticks:
+            await asyncio.sleep(max((tick_timestamp - ticks[0][0])/1000/speed - (time.time() - replay_start_time), 0)) if speed else None
+            if symbol_pair in subscribed:
+                await ws.send(json.dumps({'type': 'message', 'topic': '/market/ticker:' + symbol_pair, 'subject': 'trade.ticker', 'data': {'price': str(price), 'time': tick_timestamp}}))
+    async def handler(ws):
+        nonlocal replay_start_time
+        subscribed, replay_task = set(), None
+        await ws.send(json.dumps({'id': str(int(time.time()*1000)), 'type': 'welcome'}))
+        async for raw_message in ws:
+            message = json.loads(raw_message)
+            if message.get('type') == 'subscribe':
+                subscribed.update(message['topic'].split(":")[1].split(","))
+                await ws.send(json.dumps({'id': message['id'], 'type': 'ack'}))
+                if replay_task is None:
+                    replay_start_time, replay_task = time.time(), asyncio.create_task(replay(ws, subscribed))
+            elif message.get('type') == 'ping':
+                await ws.send(json.dumps({'id': message['id'], 'type': 'pong'}))
+        if replay_task:
+            replay_task.cancel()
+    replay_start_time = time.time()
+    async def run_server():
+        async with serve(handler, host, port) as server:
+            server_state['loop'], server_state['stop'] = asyncio.get_running_loop(), asyncio.Event()
+            server_state['ws_url'] = "ws://" + host + ":" + str(list(server.sockets)[0].getsockname()[1])
+            ready.set()
+            await server_state['stop'].wait()
+    thread = threading.Thread(target=asyncio.run, args=(run_server(),), daemon=True)
+    thread.start()
+    ready.wait()
+    def stop():
+        server_state['loop'].call_soon_threadsafe(server_state['stop'].set)
+        thread.join()
+    return [server_state['ws_url'], stop]
+
+# streaming SL/TSL: evaluates portfolio_check_sl_tsl on every Kucoin ticker update of open coins (and BTC-USDT for price_in_btc) until stop_time instead of once per portfolio_trading cycle, stops early once all streamed coins are sold
+# returns [portfolio, streamed] where streamed is False if stream failed (portfolio_trading then keeps polling)
+def portfolio_stream_sl_tsl(portfolio, stop_time, ws_url=None):
+    import asyncio # on_ticker runs on kucoin_stream_tickers' event loop
+    with _portfolio_book(portfolio):
+        symbol_pairs_to_coin = {portfolio['open'].get(coin, 'symbol').upper() + '-USDT': coin for coin in portfolio['open'] if portfolio['open'].get(coin, 'trade_notes') not in ["Not filled", "Partially filled", "KTrade Error"]}
+        btc_price = get_kucoin_pairs_snapshot().get('BTC-USDT', {}).get('price') if symbol_pairs_to_coin else None # until first BTC-USDT ticker
+        async def on_ticker(symbol_pair, price):
+            nonlocal btc_price
+            btc_price = price if symbol_pair == 'BTC-USDT' else btc_price
+            if (symbol_pair in symbol_pairs_to_coin) and btc_price:
+                coin = symbol_pairs_to_coin[symbol_pair]
+                await asyncio.get_running_loop().run_in_executor(None, lambda: portfolio_check_sl_tsl(portfolio, coin=coin, price_in_btc=price / btc_price, price=price)) # sell orders (kucoin_trade_coin_usdt) block, ticks are still checked one at a time in order
+                if coin not in portfolio['open']: # sold by SL/TSL
+                    del symbol_pairs_to_coin[symbol_pair]
+            return bool(symbol_pairs_to_coin)
+        streamed = kucoin_stream_tickers(sorted(set(symbol_pairs_to_coin) | {'BTC-USDT'}), on_ticker=on_ticker, stop_time=stop_time, ws_url=ws_url) if symbol_pairs_to_coin else True
+    return [portfolio, streamed]
+
+def _portfolio_coins_symbol_to_id(portfolio): # portfolio coins (open and sold) override instrument registry when mapping exchange assets to coin ids, sold after open like dict(zip(open + sold))
+    return {**dict(zip(portfolio['open']['symbol'], portfolio['open'].index)), **dict(zip(portfolio['sold']['symbol'], portfolio['sold']['coin']))}
+
+def portfolio_trading(portfolio, exchange, paper_trading=True, portfolio_usdt_value_negative_change_from_max_limit=-0.3, portfolio_current_roi_restart={'engaged': False, 'limit': 0.15}, download_and_save_coins_data=False, streaming=False, streaming_ws_url=None, cycles=None): # cycles stops and returns portfolio after that many cycles (i.e. a simulated cycle with set_offline_mode('replay')) # streaming=True evaluates SL/TSL on Kucoin websocket ticker updates between cycles (polling each cycle stays as fallback) # refactor to mimick run_portfolio_rr # maybe add short logic # maybe refactor buying_disabled/paper_trading to be None/False as default and then change within function (or if specified) based on certain conditions # maybe refactor name of this variable and similar here and below to portfolio_current_roi_in_btc_restart
     DAYS = portfolio['constants']['days']
     STOP_LOSS = portfolio['constants']['sl']
     TRAILING_STOP_LOSS_ARM, TRAILING_STOP_LOSS_PERCENTAGE = portfolio['constants']['tsl_a'], portfolio['constants']['tsl_p']
     BASE_PAIR = portfolio['constants']['base_pair']
+    cycle = 0
     while True:
         print("<< " + str(datetime.now()) + ", paper trading: " + str(paper_trading) + ", portfolio btc value (-)change from max limit: " + str(portfolio_usdt_value_negative_change_from_max_limit) + ", portfolio current roi restart: " + str(portfolio_current_roi_restart) + ", download and save coins data: " + str(download_and_save_coins_data) + " >>") #  + ", buying disabled: " + str(buying_disabled)
-        start_time = time.time()
+        start_time, profile_state = time.time(), _cycle_profile_start() # profile_next_trading_cycle() / profile trigger file
         if (datetime.utcnow().hour == 12) and (datetime.utcnow().minute < 4):
             twilio_message = _fetch_data(twilio_client.messages.create, params={'to': twilio_phone_to, 'from_': twilio_phone_from, 'body': "Q Trading @crypto: running on " + str(datetime.now()) + " :)"}, error_str=" - Twilio msg error to: " + twilio_phone_to + " on: " + str(datetime.now()), empty_data=None)
         if (datetime.utcnow().hour == 0) and (datetime.utcnow().minute < 12): # (datetime.utcnow().hour == 0) and (datetime.utcnow().minute < 4): # since runs every 4 minutes
@@ -866,68 +2758,49 @@ def portfolio_trading(portfolio, exchange, paper_trading=True, portfolio_usdt_va
             print("Sleeping 1min after saving / checking for saved coins data on: " + str(datetime.now())) # maybe refactor to 2min
             time.sleep(1*60)
             if not paper_trading: # only align balance btc when not paper trading since when paper trading balance should be aligned with current (paper) trading not actual balance btc, aligning balance btc after switching over from paper trading to not paper trading helps to deal with delisted coins
-                # assets = get_binance_assets(other_coins_symbol_to_id=dict(zip(list(portfolio['open']['symbol'].values) + list(portfolio['sold']['symbol'].values), list(portfolio['open'].index.values) + list(portfolio['sold']['coin'].values))), pages=4)
-                assets = get_kucoin_assets(other_coins_symbol_to_id=dict(zip(list(portfolio['open']['symbol'].values) + list(portfolio['sold']['symbol'].values), list(portfolio['open'].index.values) + list(portfolio['sold']['coin'].values))))
-                portfolio = portfolio_align_balance_with_exchange(portfolio, exchange_assets=assets, exchange=exchange) if not assets.empty else portfolio
-            portfolio = run_portfolio_rr(portfolio=portfolio, start_day=(todays_date - timedelta(days=DAYS)), end_day=todays_date, paper_trading=paper_trading) # On 08/08/2020: rr algorithm went from analyzing top 250 coins by Market Cap to top 1000 coins by Market Cap # rr_buy=(True if not buying_disabled else False),
-            save_portfolio_backup(portfolio) # very unlikely to fail before next save_portfolio_backup() but still saving because precautionary and updating portfolio
+                # assets = get_binance_assets(other_coins_symbol_to_id=_portfolio_coins_symbol_to_id(portfolio), pages=4)
+                with _instrument_stage('cycle', 'assets'):
+                    assets = get_kucoin_assets(other_coins_symbol_to_id=_portfolio_coins_symbol_to_id(portfolio))
+                with _instrument_stage('cycle', 'align_balance'):
+                    portfolio = portfolio_align_balance_with_exchange(portfolio, exchange_assets=assets, exchange=exchange) if not assets.empty else portfolio
+            with _instrument_stage('cycle', 'run_portfolio_rr'):
+                portfolio = run_portfolio_rr(portfolio=portfolio, start_day=(todays_date - timedelta(days=DAYS)), end_day=todays_date, paper_trading=paper_trading) # On 08/08/2020: rr algorithm went from analyzing top 250 coins by Market Cap to top 1000 coins by Market Cap # rr_buy=(True if not buying_disabled else False),
+            with _instrument_stage('cycle', 'save_portfolio_backup'):
+                save_portfolio_backup(portfolio) # very unlikely to fail before next save_portfolio_backup() but still saving because precautionary and updating portfolio
             twilio_message = _fetch_data(twilio_client.messages.create, params={'to': twilio_phone_to, 'from_': twilio_phone_from, 'body': "Q Trading @crypto: Coin data saved and run_portfolio_rr executed on: " + datetime.now().strftime('%Y-%m-%d') + " :)"}, error_str=" - Twilio msg error to: " + twilio_phone_to + " on: " + str(datetime.now()), empty_data=None) # not sms messaging assets value since would require more (unnecessary) processing/logic since have Binance App on phone
-        for coin in portfolio['open'].index:
-            # better to have price from coingecko (crypto insurance companies use it, and it represents a wider more accurate picture of the price, also if price hits tsl/sl temporarily on one exchange might be due to a demand/supply anomaly), also common to trade to btc then send btc to another exchange and transfer to fiat there, issue: coingecko only updates every 4 minutes
-            # coin_data, price_in_btc = _fetch_data(get_coin_data, params={'coin': coin}, error_str=" - No " + "" + " coin data for: " + coin + " on: " + str(datetime.now()), empty_data={}), None
-            kucoin_pairs_with_price_and_vol_current, price_in_btc = _fetch_data(get_kucoin_pairs, params={}, error_str=" - Kucoin get tickers error on: " + str(datetime.now()), empty_data={}), None
-            if kucoin_pairs_with_price_and_vol_current: # ('market_data' in coin_data) and coin_data['market_data']['market_cap']['usd'] and coin_data['market_data']['current_price']['btc']:
-                btc_price, current_datetime = kucoin_pairs_with_price_and_vol_current['BTC-USDT']['price'], None
-                try:
-                    price = kucoin_pairs_with_price_and_vol_current[portfolio['open'].loc[coin, 'symbol'].upper() + "-USDT"]['price']
-                    price_in_btc = price / btc_price
-                except Exception as e:
-                    price_in_btc = portfolio['open'].loc[coin, 'current_price(btc)'] # price / btc_price
-                    price = price_in_btc * btc_price
-                    current_datetime = portfolio['open'].loc[coin, 'current_date']
-                    print(str(e) + " - Price issue(s) for coin: " + coin + " with symbol pair: " + str(portfolio['open'].loc[coin, 'symbol'].upper() + "-USDT"))
-            #     price_in_btc = coin_data['market_data']['current_price']['btc']
-            #     # print(coin + ": " + str(coin_data['market_data']['current_price']['usd']))
-            else:
-                print("Error retreiving Kucoin prices and volumes on: " + str(datetime.now()))
-            if price_in_btc: # maybe refactor check for if 'position' == 'long'/'long-p' in case implement shorting, price to ensure price was calculated on coingecko
-                if portfolio['open'].loc[coin, 'trade_notes'] in ["Not filled", "Partially filled", "KTrade Error"]: # maybe refactor quick fix for now since if using small TSL/SL sometimes price hits selling point before the ticker is bought, maybe refactor and only check for not in ['Filled', '~Filled'] - think computationally the same, maybe refactor and move up to right below for coin in portfolio['open'].index:
-                    continue
-                position, buy_price_in_btc, tsl_armed, tsl_max_price_in_btc, balance = portfolio['open'].loc[coin, ['position', 'buy_price(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'balance']]
-                price_in_btc_change = (price_in_btc - buy_price_in_btc) / buy_price_in_btc
-                symbol_pair = portfolio['open'].loc[coin, 'symbol'].upper() + '-USDT'
-                if not tsl_armed and price_in_btc_change >= TRAILING_STOP_LOSS_ARM:
-                    tsl_armed, tsl_max_price_in_btc = True, price_in_btc
-                if tsl_armed:
-                    if price_in_btc > tsl_max_price_in_btc:
-                        tsl_max_price_in_btc = price_in_btc
-                    tsl_price_in_btc_change = (price_in_btc - tsl_max_price_in_btc) / tsl_max_price_in_btc
-                    if tsl_price_in_btc_change <= TRAILING_STOP_LOSS_PERCENTAGE: # should check if price on coingecko is equal/close to price in binance
-                        print("<<<< COIN SOLD due to TSL >>>>")
-                        other_notes = 'Sell by TSL'
-                        quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = kucoin_trade_coin_usdt(symbol_pair=symbol_pair, coin=coin, trade="sell", quantity=balance, price_in_btc=price_in_btc, paper_trading=(True if position == 'long-p' else False), other_notes=other_notes + " at ~roi " + str(price_in_btc_change)) # ~ roi since roi calculated with CoinGecko price but real roi is with Binance price # paper_trading
-                        sell_price, sell_price_in_btc = price, price_in_btc # sell_price, = price, coin_data['market_data']['current_price']['btc'],  # tsl_max_price * (1 + TRAILING_STOP_LOSS_PERCENTAGE) # maybe refactor - check if 'btc' in coin_data['market_data']['current_price'], should be if 'usd' in it, logic to check for it a bit cumbersome, also not sure if need to relabel price_in_btc as sell_price_in_btc (but looks good to be consistent with logic throughout)
-                        portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + sell_price*quantity
-                        symbol, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d = portfolio['open'].loc[coin, ['symbol', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d']]
-                        portfolio['sold'].loc[len(portfolio['sold'])], portfolio['open'] = [coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, datetime.now(), sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes], portfolio['open'].drop(coin) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).append(pd.Series([coin, datetime.now(), sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, tsl_max_price_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'tsl_max_price(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin)
-                        continue
-                elif price_in_btc_change <= STOP_LOSS: # should check if price on coingecko is equal/close to price in binance
-                    print("<<<< COIN SOLD due to SL >>>>")
-                    other_notes = 'Sell by SL'
-                    quantity, price, price_in_btc, kucoin_coin_usdt_order, kucoin_coin_usdt_open_orders, trade_notes = kucoin_trade_coin_usdt(symbol_pair=symbol_pair, coin=coin, trade="sell", quantity=balance, price_in_btc=price_in_btc, paper_trading=(True if position == 'long-p' else False), other_notes=other_notes + " at ~roi " + str(price_in_btc_change)) # paper_trading
-                    sell_price, sell_price_in_btc = price, price_in_btc # sell_price, = price, coin_data['market_data']['current_price']['btc'], # buy_price * (1 + STOP_LOSS)
-                    portfolio['balance'][BASE_PAIR] = portfolio['balance'][BASE_PAIR] + sell_price*quantity
-                    symbol, buy_date, buy_price, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d = portfolio['open'].loc[coin, ['symbol', 'buy_date', 'buy_price', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d']]
-                    portfolio['sold'].loc[len(portfolio['sold'])], portfolio['open'] = [coin, symbol, position, buy_date, buy_price, buy_price_in_btc, quantity, datetime.now(), sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, kucoin_usdt_24h_vol, gtrends_15d, rank_rise_d, tsl_max_price_in_btc, trade_notes, other_notes], portfolio['open'].drop(coin) # portfolio['sold'], portfolio['open'] = portfolio['sold'].append(portfolio['open'].loc[coin].drop(['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).append(pd.Series([coin, datetime.now(), sell_price, sell_price_in_btc, (sell_price_in_btc - buy_price_in_btc) / buy_price_in_btc, tsl_max_price_in_btc, trade_notes, other_notes], index=['coin', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'tsl_max_price(btc)', 'trade_notes', 'other_notes'])), ignore_index=True), portfolio['open'].drop(coin)
-                    continue
-                current_datetime = current_datetime if current_datetime else datetime.now()
-                portfolio['open'].loc[coin, ['current_date', 'current_price(btc)', 'current_roi(btc)', 'tsl_armed', 'tsl_max_price(btc)']] = [current_datetime, price_in_btc, price_in_btc_change, tsl_armed, tsl_max_price_in_btc]
-                # print("[ " + coin + ": " + " price change: " + str(price_change) + ", tsl armed: " + str(tsl_armed) + ", tsl max price: " + str(tsl_max_price) + ", execution time: " + str(time.time() - start_time) + " ]")
+        with _portfolio_book(portfolio):
+            with _instrument_stage('cycle', 'tickers'):
+                kucoin_pairs_with_price_and_vol_current = get_kucoin_pairs_snapshot(refresh=True) if len(portfolio['open']) else {} # one tickers request per cycle shared by all open coins and orders
+            stage_start_time = time.perf_counter()
+            for coin in portfolio['open']:
+                # better to have price from coingecko (crypto insurance companies use it, and it represents a wider more accurate picture of the price, also if price hits tsl/sl temporarily on one exchange might be due to a demand/supply anomaly), also common to trade to btc then send btc to another exchange and transfer to fiat there, issue: coingecko only updates every 4 minutes
+                # coin_data, price_in_btc = _fetch_data(get_coin_data, params={'coin': coin}, error_str=" - No " + "" + " coin data for: " + coin + " on: " + str(datetime.now()), empty_data={}), None
+                price_in_btc = None
+                if kucoin_pairs_with_price_and_vol_current: # ('market_data' in coin_data) and coin_data['market_data']['market_cap']['usd'] and coin_data['market_data']['current_price']['btc']:
+                    btc_price, current_datetime = kucoin_pairs_with_price_and_vol_current['BTC-USDT']['price'], None
+                    try:
+                        price = kucoin_pairs_with_price_and_vol_current[portfolio['open'].get(coin, 'symbol').upper() + "-USDT"]['price']
+                        price_in_btc = price / btc_price
+                    except Exception as e:
+                        price_in_btc = portfolio['open'].get(coin, 'current_price(btc)') # price / btc_price
+                        price = price_in_btc * btc_price
+                        current_datetime = portfolio['open'].get(coin, 'current_date')
+                        print(str(e) + " - Price issue(s) for coin: " + coin + " with symbol pair: " + str(portfolio['open'].get(coin, 'symbol').upper() + "-USDT"))
+                #     price_in_btc = coin_data['market_data']['current_price']['btc']
+                #     # print(coin + ": " + str(coin_data['market_data']['current_price']['usd']))
+                else:
+                    print("Error retreiving Kucoin prices and volumes on: " + str(datetime.now()))
+                if price_in_btc: # maybe refactor check for if 'position' == 'long'/'long-p' in case implement shorting, price to ensure price was calculated on coingecko
+                    portfolio = portfolio_check_sl_tsl(portfolio, coin=coin, price_in_btc=price_in_btc, current_datetime=current_datetime)
+                    # print("[ " + coin + ": " + " price change: " + str(price_change) + ", tsl armed: " + str(tsl_armed) + ", tsl max price: " + str(tsl_max_price) + ", execution time: " + str(time.time() - start_time) + " ]")
+            _instrument_observe('cycle', 'sl_tsl', time.perf_counter() - stage_start_time)
         if (datetime.utcnow().minute >= 30) and (datetime.utcnow().minute < 34): # runs once per hour at the end of the hour (since if save data or run algorithm at beginning of hour may have conflict since saving data and running algorithm takes time)
             if not paper_trading:
-                assets = get_kucoin_assets(other_coins_symbol_to_id=dict(zip(list(portfolio['open']['symbol'].values) + list(portfolio['sold']['symbol'].values), list(portfolio['open'].index.values) + list(portfolio['sold']['coin'].values)))) # assets = get_binance_assets(...) # precautionary to have portfolio['sold'] values since coins should be sold completely (unless fractions remain due to distribution or if some remain due to incomplete order) (would show up as balance_locked)
+                with _instrument_stage('cycle', 'assets'):
+                    assets = get_kucoin_assets(other_coins_symbol_to_id=_portfolio_coins_symbol_to_id(portfolio)) # assets = get_binance_assets(...) # precautionary to have portfolio['sold'] values since coins should be sold completely (unless fractions remain due to distribution or if some remain due to incomplete order) (would show up as balance_locked)
                 if not assets.empty:
-                    portfolio, portfolio_usdt_value = portfolio_align_balance_with_exchange(portfolio, exchange_assets=assets, exchange=exchange), assets['current_value'].sum() # portfolio_align_balance_btc_with_binance(portfolio, binance_assets=assets) # and assets.loc['bitcoin', 'balance_locked'] == 0 # simple way to make sure bitcoin balance is correct every hour and to prevent orders
+                    with _instrument_stage('cycle', 'align_balance'):
+                        portfolio, portfolio_usdt_value = portfolio_align_balance_with_exchange(portfolio, exchange_assets=assets, exchange=exchange), assets['current_value'].sum() # portfolio_align_balance_btc_with_binance(portfolio, binance_assets=assets) # and assets.loc['bitcoin', 'balance_locked'] == 0 # simple way to make sure bitcoin balance is correct every hour and to prevent orders
                     print(str(assets.drop(['other_notes'], axis=1)) + "\nTotal Current Value: " + str(assets['current_value'].sum()) + "\nTotal Current Value (BTC): " + str(assets['current_value(btc)'].sum()) + "\nExecution time: " + str(time.time() - start_time) + "\n")
                     print("Sleeping 2min after getting assets on: " + str(datetime.now())) # maybe refactor to 2min * make sure to make sure < 32min (next 30min ie 11:30am - current time ie 10:55am = 35/4 = 8.75 -> 0.75:31. 0.5:32, 0.25:33, 0:34)
                     time.sleep(2*60)
@@ -937,6 +2810,7 @@ def portfolio_trading(portfolio, exchange, paper_trading=True, portfolio_usdt_va
                 portfolio_usdt_value = float("NaN") # portfolio_calculate_btc_value_while_paper_trading(portfolio) # float("NaN") since don't want portfolio_panic_sell() to execute while paper trading (if paper trading ride out the bad conditions) and if issue calculating assets might be a larger issue at hand and don't want to pause
             # arbitrage_pairs = kucoin_usdt_check_arbitrages(pages=4) # 4 pages gets you 190/~203 BTC pairs, anything above 4 is very incremental
             # print("Arbitrage pairs within +/- 50%: " + str(Counter({key: value for key,value in arbitrage_pairs.items() if abs(value) <= 0.5})) + "\n") # unrealistic that any arbitrage opportunities outside of 50% would exist, easy way to deal with coin scams, low volume traded coins, other logic issues
+            stage_start_time = time.perf_counter() # open orders / trade error retries
             kucoin_open_orders = _fetch_data(kucoin_client.get_orders, params={'status': 'active'}, error_str=" - Kucoin open orders error " + " on: " + str(datetime.now()), empty_data={'items':[]})['items'] # binance_open_orders = None # _fetch_data(binance_client.get_open_orders, params={}, error_str=" - Binance open orders error on: " + str(datetime.now()), empty_data=[]) # for coin in assets[assets['balance_locked'] > 0].index: # if assets['balance_locked'].any(): - balance_locked not the way since if btc is locked don't know what you're buying just know that you're using btc to buy it
             if kucoin_open_orders: # maybe refactor and looked at assets balance_locked, see if full balance is gone, if any locked make partial
                 print("Kucoin open orders: " + str(kucoin_open_orders))
@@ -959,6 +2833,8 @@ def portfolio_trading(portfolio, exchange, paper_trading=True, portfolio_usdt_va
             df_matching_ktrade_error_open_positions, df_matching_ktrade_error_sold_positions = portfolio['open'][(portfolio['open']['position'] == 'long') & (portfolio['open']['trade_notes'] == "KTrade Error")], portfolio['sold'][(portfolio['sold']['position'] == 'long') & (portfolio['sold']['trade_notes'] == "KTrade Error")] # maybe refactor - checking outside of function because don't want function to be called unless it needs to be
             if not df_matching_ktrade_error_open_positions.empty or not df_matching_ktrade_error_sold_positions.empty:
                 portfolio = retry_exchange_trade_error_or_paper_orders_in_portfolio(portfolio=portfolio, exchange=exchange, df_matching_open_positions=df_matching_ktrade_error_open_positions, df_matching_sold_positions=df_matching_ktrade_error_sold_positions, paper_trading=paper_trading)
+            _instrument_observe('cycle', 'orders', time.perf_counter() - stage_start_time)
+            stage_start_time = time.perf_counter() # portfolio value from max limit panic sell / paper trading restart checks
             # not used when backtesting but ok since want portfolio that performs best through bad conditions and good conditions
             if not paper_trading and (portfolio_usdt_value > portfolio['max_value'][BASE_PAIR]): # maybe refactor not paper_trading quick fix # portfolio['balance']['max']['btc']
                 portfolio['max_value'][BASE_PAIR] = portfolio_usdt_value
@@ -967,39 +2843,167 @@ def portfolio_trading(portfolio, exchange, paper_trading=True, portfolio_usdt_va
                 portfolio = portfolio_panic_sell(portfolio=portfolio, df_matching_open_positions=df_matching_negative_current_roi_open_positions) # , paper_trading=paper_trading # portfolio=portfolio, paper_trading=True, idx_start=len(portfolio['open']) - 1, idx_end=len(portfolio['open']))
                 paper_trading, portfolio_current_roi_restart['engaged'] = True, True
             if paper_trading and portfolio_current_roi_restart['engaged'] and (portfolio_calculate_roi(portfolio) > portfolio_current_roi_restart['limit']):
-                assets = get_kucoin_assets(other_coins_symbol_to_id=dict(zip(list(portfolio['open']['symbol'].values) + list(portfolio['sold']['symbol'].values), list(portfolio['open'].index.values) + list(portfolio['sold']['coin'].values)))) # assets = get_binance_assets(...) # checking again for assets since possible retry_binance_open_orders_in_portfolio() or retry_exchange_trade_error_or_paper_orders_in_portfolio() executed orders and assets are altered
+                assets = get_kucoin_assets(other_coins_symbol_to_id=_portfolio_coins_symbol_to_id(portfolio)) # assets = get_binance_assets(...) # checking again for assets since possible retry_binance_open_orders_in_portfolio() or retry_exchange_trade_error_or_paper_orders_in_portfolio() executed orders and assets are altered
                 if not assets.empty and (assets['current_value'].sum() >= portfolio['max_value'][BASE_PAIR]*(1+portfolio_usdt_value_negative_change_from_max_limit)): # precautionary, prioritizes portfolio sl over restarting real trading, prevents potential downward spiral but requires reset of portfolio_usdt_value_negative_change_from_max_limit unless there is enough momentum upon first restart (from paper to real trading)
                     print("Going from paper trading to real trading on: " + str(datetime.now()))
                     paper_trading, portfolio_current_roi_restart['engaged'] = False, False
                     df_matching_positive_current_roi_paper_open_positions = portfolio['open'][(portfolio['open']['position'] == 'long-p') & (portfolio['open']['current_roi(btc)'] > 0)].sort_values('current_roi(btc)', inplace=False, ascending=False) # maybe refactor - changed to only buy positive positions since after studying positive positions show best momentum (not most negative / relatively cheapest) (in the order of best momentum) - (to assets closest to 0 current_roi(btc))
                     portfolio = portfolio_align_balance_with_exchange(portfolio, exchange_assets=assets, exchange=exchange) # portfolio_align_balance_btc_with_binance(portfolio, binance_assets=assets)
                     portfolio = retry_exchange_trade_error_or_paper_orders_in_portfolio(portfolio=portfolio, exchange=exchange, df_matching_open_positions=df_matching_positive_current_roi_paper_open_positions, df_matching_sold_positions=pd.DataFrame(), paper_trading=paper_trading, exchange_trade_error_or_paper_order_price_difference_limit=10) # exchange_trade_error_or_paper_order_price_difference_limit=10 so that there is no upper limit
+            _instrument_observe('cycle', 'risk_checks', time.perf_counter() - stage_start_time)
         # 'binance_btc_24h_vol(btc)' inspect below
+        stage_start_time = time.perf_counter()
+        metrics = get_portfolio_metrics(portfolio)
         print(str(portfolio['open'].drop(['position', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes'], axis=1)) + "\n" + str(portfolio['open'].drop(['symbol', 'buy_date', 'buy_price', 'buy_price(btc)', 'balance', 'current_date', 'current_price(btc)', 'current_roi(btc)'], axis=1)) + \
-            "\nCurrent ROI (BTC) (Real): " + str(portfolio_calculate_roi(portfolio, avoid_paper_positions=True)) + "\nCurrent ROI (BTC) (All): " + str(portfolio_calculate_roi(portfolio)) + "\nExecution time: " + str(time.time() - start_time) + "\n" + \
+            "\nCurrent ROI (BTC) (Real): " + str(metrics['open_roi(btc)_real']) + "\nCurrent ROI (BTC) (All): " + str(metrics['open_roi(btc)']) + "\nExecution time: " + str(time.time() - start_time) + "\n" + \
             (str(portfolio['sold'].tail(40).drop(['symbol', 'buy_price(btc)', 'sell_price(btc)', 'kucoin_usdt_24h_vol', 'rank_rise_d', 'tsl_max_price(btc)', 'gtrends_15d', 'other_notes'], axis=1)) + \
-            "\nSold ROI (BTC) (Real): " + str(portfolio_calculate_roi(portfolio, open_positions=False, sold_positions=True, avoid_paper_positions=True)) + "\nSold ROI (BTC) (All): " + str(portfolio_calculate_roi(portfolio, open_positions=False, sold_positions=True)) + \
-            "\nPortfolio ROI (BTC) (Real): " + str(portfolio_calculate_roi(portfolio, open_positions=True, sold_positions=True, avoid_paper_positions=True)) + "\nPortfolio ROI (BTC) (All): " + str(portfolio_calculate_roi(portfolio, open_positions=True, sold_positions=True)) + "\nPortfolio Available " + BASE_PAIR.upper() + " Balance: " + str(portfolio['balance'][BASE_PAIR]) + "\n" if (datetime.utcnow().minute >= 30) and (datetime.utcnow().minute < 34) else ""))
-        save_portfolio_backup(portfolio, remove_old_portfolio=(True if ((datetime.now().hour == 0) and (datetime.now().minute < 4)) else False)) # remove old portfolio always at beginning of next day (since portfolios are saved in local time, issue if local time is utc time then save_coins_data() will take too long for this logic to execute) (which is why not removing after run_portfolio_rr() executed) # save every 4 minutes for now, in case something happens
-        time.sleep(240.0 - ((time.time() - start_time) % 240.0))
+            "\nSold ROI (BTC) (Real): " + str(metrics['sold_roi(btc)_real']) + "\nSold ROI (BTC) (All): " + str(metrics['sold_roi(btc)']) + \
+            "\nPortfolio ROI (BTC) (Real): " + str(metrics['roi(btc)_real']) + "\nPortfolio ROI (BTC) (All): " + str(metrics['roi(btc)']) + "\nPortfolio Available " + BASE_PAIR.upper() + " Balance: " + str(portfolio['balance'][BASE_PAIR]) + "\n" if (datetime.utcnow().minute >= 30) and (datetime.utcnow().minute < 34) else ""))
+        _instrument_observe('cycle', 'report', time.perf_counter() - stage_start_time)
+        with _instrument_stage('cycle', 'save_portfolio_backup'):
+            save_portfolio_backup(portfolio, remove_old_portfolio=(True if ((datetime.now().hour == 0) and (datetime.now().minute < 4)) else False)) # remove old portfolio always at beginning of next day (since portfolios are saved in local time, issue if local time is utc time then save_coins_data() will take too long for this logic to execute) (which is why not removing after run_portfolio_rr() executed) # save every 4 minutes for now, in case something happens
+        _instrument_observe('cycle', 'total', time.time() - start_time)
+        _cycle_profile_stop(profile_state)
+        if instrumentation['json_lines_file']:
+            _fetch_data(get_metrics_json_lines, params={'path': instrumentation['json_lines_file']}, error_str=" - Metrics json lines error on: " + str(datetime.now()), empty_data=None)
+        cycle += 1
+        if cycles and (cycle >= cycles):
+            return portfolio
+        next_cycle_time = time.time() + 240.0 - ((time.time() - start_time) % 240.0)
+        if streaming and len(portfolio['open']): # stream until next cycle instead of only sleeping, if stream fails or all streamed coins sold sleep rest of cycle
+            sold_positions = len(portfolio['sold'])
+            with _instrument_stage('cycle', 'stream_sl_tsl'):
+                portfolio, streamed = portfolio_stream_sl_tsl(portfolio, stop_time=next_cycle_time, ws_url=streaming_ws_url)
+            if len(portfolio['sold']) > sold_positions:
+                save_portfolio_backup(portfolio)
+        time.sleep(max(next_cycle_time - time.time(), 0))
+
+# journaled portfolio backups: portfolio_<constants>_to_<date>.pckl stays a full pickled portfolio (same format as before) written as a snapshot on the first save of the day / process, every portfolio_journal['snapshot_every'] saves or when a change can't be journaled (open columns / order changed, sold rows changed other than appended), in between portfolio_<constants>_to_<date>.journal gets one pickled record per save with only what changed: set (other keys i.e. balance, max_value), open / update (changed fields) / close (open positions), sold (appended rows)
+# journal starts with a header holding the sha1 of its snapshot so a journal is never replayed onto a newer snapshot (i.e. crash between writing snapshot and new journal), get_saved_portfolio_backup replays the journal onto the snapshot and ignores a torn last record
+portfolio_journal = {'snapshot_every': 100, 'state': {}, 'lock': threading.Lock()} # state is last saved portfolio per file, used for diffs
+
+def _journal_values_equal(value, value_old):
+    try:
+        return bool(value == value_old) or bool(pd.isna(value) and pd.isna(value_old))
+    except (TypeError, ValueError):
+        return False
+
+def _sold_row_hashes(df_sold): # one uint64 per sold row (index and values) so edits to saved rows (i.e. retry_exchange_trade_error_or_paper_orders_in_portfolio) are detected
+    return pd.util.hash_pandas_object(df_sold, index=True).to_numpy() if len(df_sold) else np.empty(0, dtype=np.uint64)
+
+def _portfolio_journal_state(portfolio):
+    return {'keys': {key: copy.deepcopy(value) for key, value in portfolio.items() if key not in ['open', 'sold']}, 'open_columns': list(portfolio['open'].columns), 'open_rows': dict(zip(portfolio['open'].index, portfolio['open'].itertuples(index=False, name=None))), 'sold_columns': list(portfolio['sold'].columns), 'sold_hashes': _sold_row_hashes(portfolio['sold']), 'records': 0}
+
+# returns [ops, open_rows, sold_hashes] with what changed since state, None if the change needs a snapshot
+def _portfolio_journal_ops(portfolio, state):
+    df_open, df_sold = portfolio['open'], portfolio['sold']
+    sold_len = len(state['sold_hashes'])
+    if (list(df_open.columns) != state['open_columns']) or (list(df_sold.columns) != state['sold_columns']) or (len(df_sold) < sold_len) or (set(state['keys']) - set(portfolio)):
+        return None
+    sold_hashes = _sold_row_hashes(df_sold)
+    if not np.array_equal(sold_hashes[:sold_len], state['sold_hashes']): # saved sold row edited or reordered
+        return None
+    open_rows = dict(zip(df_open.index, df_open.itertuples(index=False, name=None)))
+    if list(open_rows) != [coin for coin in state['open_rows'] if coin in open_rows] + [coin for coin in open_rows if coin not in state['open_rows']]: # replay keeps remaining positions in order and adds new ones at the end
+        return None
+    ops = [['set', key, value] for key, value in portfolio.items() if key not in ['open', 'sold'] and not ((key in state['keys']) and _journal_values_equal(value, state['keys'][key]))]
+    for coin, row in open_rows.items():
+        if coin not in state['open_rows']:
+            ops.append(['open', coin, dict(zip(df_open.columns, row))])
+        else:
+            changed = {column: value for column, value, value_old in zip(df_open.columns, row, state['open_rows'][coin]) if not _journal_values_equal(value, value_old)}
+            if changed:
+                ops.append(['update', coin, changed])
+    ops.extend(['close', coin] for coin in state['open_rows'] if coin not in open_rows)
+    if len(df_sold) > sold_len:
+        ops.append(['sold', sold_len, list(df_sold.iloc[sold_len:].itertuples(index=False, name=None))]) # sold_len so replay only appends onto the matching sold length
+    return [ops, open_rows, sold_hashes]
+
+def _write_portfolio_snapshot(portfolio, file_name): # atomic snapshot then a new journal for it
+    snapshot = pickle.dumps(portfolio, protocol=pickle.HIGHEST_PROTOCOL)
+    for file_extension, data in [('.pckl', snapshot), ('.journal', pickle.dumps({'snapshot': hashlib.sha1(snapshot).hexdigest(), 'time': datetime.now()}))]:
+        with open(file_name + file_extension + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(file_name + file_extension + '.tmp', file_name + file_extension)
+
+def _replay_portfolio_journal(portfolio, journal_file, snapshot_hash):
+    if not os.path.exists(journal_file):
+        return portfolio
+    header, records = None, []
+    with open(journal_file, 'rb') as f:
+        try:
+            header = pickle.load(f)
+            while True:
+                records.append(pickle.load(f))
+        except EOFError:
+            pass
+        except Exception as e:
+            print(str(e) + " - Ignoring torn record after " + str(len(records)) + " records in journal: " + journal_file)
+    if not header or header.get('snapshot') != snapshot_hash:
+        print("Journal doesn't match snapshot (snapshot is newer), not replaying: " + journal_file)
+        return portfolio
+    with _portfolio_book(portfolio):
+        for record in records:
+            for op in record['ops']:
+                if op[0] == 'set':
+                    portfolio[op[1]] = op[2]
+                elif op[0] in ['open', 'update']:
+                    portfolio['open'].set(op[1], list(op[2].keys()), list(op[2].values()))
+                elif op[0] == 'close' and op[1] in portfolio['open']:
+                    portfolio['open'].pop(op[1])
+                elif op[0] == 'sold' and (len(portfolio['sold']) + len(portfolio['sold_ledger']) == op[1]):
+                    for row in op[2]:
+                        portfolio['sold_ledger'].append(row)
+    return portfolio
 
 # as of 09/28/2020 changed portfolio_constants naming of file from (example) 100_100_15 to 100_-100_15
-def save_portfolio_backup(portfolio, remove_old_portfolio=False): # can add logic for different types of portfolio i.e. rr with different kinds of parameters i.e. different up and down moves
+def save_portfolio_backup(portfolio, remove_old_portfolio=False, journal=True, snapshot=False): # can add logic for different types of portfolio i.e. rr with different kinds of parameters i.e. different up and down moves # journal=False pickles the whole portfolio every time (previous behaviour), snapshot=True forces a journal snapshot
     portfolio_constants = "_".join([str(value) if key != 'up_down_move' else str(value) + "_" + str(-value) for key,value in list(portfolio['constants'].items())]) # maybe refactor if implement different algorithms, for now all algorithms (currently only rr) have equal up_move and down_move and implement both up_move and down_move # if portfolio['constants']['type'] == 'rr' else "_".join([str(value) for key,value in list(portfolio['constants'].items())])
     if remove_old_portfolio: # (datetime.now().hour == 0) and (datetime.now().minute < 4)
-        if os.path.exists('data/crypto/saved_portfolio_backups/' + 'portfolio_' + portfolio_constants + '_to_' + (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d') + '.pckl'):
-            os.remove('data/crypto/saved_portfolio_backups/' + 'portfolio_' + portfolio_constants + '_to_' + (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d') + '.pckl')
-    f = open('data/crypto/saved_portfolio_backups/' + 'portfolio_' + portfolio_constants + '_to_' + datetime.now().strftime('%Y-%m-%d') + '.pckl', 'wb') # 2020_06_02, format is '%Y-%m-%d'
-    pd.to_pickle(portfolio, f)
-    f.close()
-    print("portfolio saved")
+        for file_extension in ['.pckl', '.journal']:
+            if os.path.exists('data/crypto/saved_portfolio_backups/' + 'portfolio_' + portfolio_constants + '_to_' + (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d') + file_extension):
+                os.remove('data/crypto/saved_portfolio_backups/' + 'portfolio_' + portfolio_constants + '_to_' + (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d') + file_extension)
+    file_name = 'data/crypto/saved_portfolio_backups/' + 'portfolio_' + portfolio_constants + '_to_' + datetime.now().strftime('%Y-%m-%d') # 2020_06_02, format is '%Y-%m-%d'
+    if not journal:
+        f = open(file_name + '.pckl', 'wb')
+        pd.to_pickle(portfolio, f)
+        f.close()
+        with portfolio_journal['lock']:
+            portfolio_journal['state'].pop(file_name, None)
+            if os.path.exists(file_name + '.journal'):
+                os.remove(file_name + '.journal')
+        print("portfolio saved")
+        return portfolio
+    with portfolio_journal['lock']:
+        state = portfolio_journal['state'].get(file_name)
+        journal_ops = _portfolio_journal_ops(portfolio, state) if (state and not snapshot and (state['records'] < portfolio_journal['snapshot_every']) and os.path.exists(file_name + '.journal')) else None
+        if journal_ops is None:
+            _write_portfolio_snapshot(portfolio, file_name)
+            portfolio_journal['state'][file_name] = _portfolio_journal_state(portfolio)
+            print("portfolio saved (snapshot)")
+            return portfolio
+        ops, open_rows, sold_hashes = journal_ops
+        if ops:
+            with open(file_name + '.journal', 'ab') as f:
+                pickle.dump({'time': datetime.now(), 'ops': ops}, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            for op in ops:
+                if op[0] == 'set':
+                    state['keys'][op[1]] = copy.deepcopy(op[2])
+            state['open_rows'], state['sold_hashes'], state['records'] = open_rows, sold_hashes, state['records'] + 1
+    print("portfolio saved (journal: " + str(len(ops)) + " changes)")
     return portfolio
 
-def get_saved_portfolio_backup(portfolio_name): # portfolio name is portfolio_ + constants, like: portfolio_50_20_-0.3_0.5_-0.2_0.1_0.01_True_False_False # date is a string in format '%Y-%m-%d'
+def get_saved_portfolio_backup(portfolio_name): # portfolio name is portfolio_ + constants, like: portfolio_50_20_-0.3_0.5_-0.2_0.1_0.01_True_False_False # date is a string in format '%Y-%m-%d' # replays portfolio_name.journal onto portfolio_name.pckl if there is one
     try:
         f = open('data/crypto/saved_portfolio_backups/' + portfolio_name + '.pckl', 'rb')
-        portfolio = pd.read_pickle(f)
+        snapshot = f.read()
         f.close()
+        portfolio = pd.read_pickle(io.BytesIO(snapshot))
+        portfolio = _replay_portfolio_journal(portfolio, journal_file='data/crypto/saved_portfolio_backups/' + portfolio_name + '.journal', snapshot_hash=hashlib.sha1(snapshot).hexdigest())
     except Exception as e:
         print(str(e) + " - No saved portfolio backup with name: " + portfolio_name)
         # refactor better to have 'exchange', 'exchange_24h_vol', 'total_24h_vol', 'binance_btc_24h_vol(btc)' column works for now, maybe add column for 'price/volume_trend' (to eliminate coin pumps/pumps and dumps), social metrics trends (reddit subscribers, alexa rank, ...) # for column dtypes: both didn't work - dtype=[np.datetime64, np.float64, np.datetime64, np.float64]) # dtype=np.dtype([('datetime64','float64','datetime64','float6')])) # no need for portfolio['open_orders'] since tracking assets which has balance_locked (in order) # maybe refactor 'open' index to allow for multiple 'long' positions for the same coin but have to worry about portfolio['open'].loc[idx, ...], maybe refactor and change 'balance' to 'quantity' since portfolio not holding (meant to hold) onto assets for long term and each asset is not being refilled/sold incompletely (at least not intentionally) # if add short positions can change 'sold' to 'closed'
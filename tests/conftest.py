@@ -0,0 +1,30 @@
+# tests run from a temporary working directory since the module reads / writes data/crypto/... relative to the current directory
+# python -m pytest tests
+import os
+import sys
+
+import pytest
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, package_path)
+
+from speterlin_crypto import module1 as crypto
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for data_path in [crypto.coin_granular_path, 'data/crypto/saved_coins_data/', 'data/crypto/saved_portfolio_backups/']:
+        os.makedirs(data_path, exist_ok=True)
+    crypto._coin_granular_store.clear()
+    crypto._coins_history_cache.clear()
+    crypto._kucoin_candles_store.clear()
+    crypto.coin_history_cache['memory'].clear()
+    crypto.portfolio_journal['state'].clear()
+    if crypto.coin_history_cache['db'] is not None:
+        crypto.coin_history_cache['db'].close()
+        crypto.coin_history_cache['db'] = None
+    yield tmp_path
+    crypto.portfolio_journal['state'].clear()
+    if crypto.coin_history_cache['db'] is not None:
+        crypto.coin_history_cache['db'].close()
+        crypto.coin_history_cache['db'] = None
@@ -0,0 +1,31 @@
+import threading
+import time
+
+# local stand-in for the python-kucoin Client order endpoints used by kucoin_trade_coin(s)_usdt (create_limit_order, get_orders with status 'active'), every request takes latency seconds and is recorded in requests as [time.monotonic(), endpoint, symbol_pair]
+# orders are filled fill_delay seconds after being created (never if fill_delay is None), orders for reject_symbol_pairs raise like a rejected order
+class KucoinMockClient:
+    SIDE_BUY, SIDE_SELL = 'buy', 'sell'
+
+    def __init__(self, latency=0.1, fill_delay=0, reject_symbol_pairs=()):
+        self.latency, self.fill_delay, self.reject_symbol_pairs = latency, fill_delay, set(reject_symbol_pairs)
+        self.orders, self.requests, self.lock = {}, [], threading.Lock()
+
+    def _request(self, endpoint, symbol_pair):
+        with self.lock:
+            self.requests.append([time.monotonic(), endpoint, symbol_pair])
+        time.sleep(self.latency)
+
+    def create_limit_order(self, symbol, side, price, size, **params):
+        self._request('create_limit_order', symbol)
+        if symbol in self.reject_symbol_pairs:
+            raise ValueError("Mock order rejected for symbol pair: " + symbol)
+        with self.lock:
+            order_id = format(len(self.orders) + 1, '024x')
+            self.orders[order_id] = {'id': order_id, 'symbol': symbol, 'side': side, 'price': str(price), 'size': str(size), 'createdAt': int(time.time()*1000), 'created': time.monotonic()}
+        return {'orderId': order_id}
+
+    def get_orders(self, symbol=None, status=None, **params):
+        self._request('get_orders', symbol)
+        with self.lock:
+            now = time.monotonic()
+            return {'items': [{key: value for key, value in order.items() if key != 'created'} for order in self.orders.values() if (symbol is None or order['symbol'] == symbol) and (status != 'active' or self.fill_delay is None or (now - order['created'] < self.fill_delay))]}
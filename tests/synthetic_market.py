@@ -0,0 +1,83 @@
+# Synthetic market in the saved-data formats (no network): n_coins x days of market cap rank snapshots (saved coins history, like save_coins_data), hourly BTC price paths per coin (saved coin granular .npz, like get_coin_data_granular) and daily USD / BTC prices (coin history cache sqlite, like get_coin_history_cached)
+# written relative to the current directory like the module (data/crypto/...), so run from (or os.chdir to) an empty directory
+# python tests/synthetic_market.py --coins 300 --days 180 --path /tmp/synthetic_market [--seed 0]
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # repository root, like tests/conftest.py (shared by the tests and benchmarks/run_benchmarks.py)
+from speterlin_crypto import module1 as crypto
+
+coins_data_columns = ["Market Cap Rank", "Facebook Likes", "Twitter Followers", "Reddit Subscribers", "Reddit Posts & Comments 48h", "Developer Stars", "Developer Issues", "Alexa Rank", "Price", "Price (BTC)", "Market Cap", "24h Volume", "24h Volume / Market Cap", "Fully Diluted Valuation", "Supply: Circulating", "Supply: Max", "Supply: Total"] # same as save_coins_data
+lookback_days = 30 # rank snapshots before start_day (run_portfolio_rr compares with days before)
+
+def new_portfolio(start_day, balance=10000, **constants): # same shape as examples/example.py portfolio_rr, Google Trends off so backtests make no Google Trends queries
+    portfolio_constants = {'base_pair': 'usdt', 'type': 'rr', 'up_down_move': 10, 'days': 15, 'sl': -0.3, 'tsl_a': 0.5, 'tsl_p': -0.2, 'usdt_invest': 1000, 'usdt_invest_min': 100, 'coins_to_analyze': 1000, 'rank_rise_d_buy_limit': 1000, 'buy_date_gtrends_15d': False, 'end_day_open_positions_gtrends_15d': False, 'end_day_open_positions_kucoin_usdt_24h_vol': False, 'start_balance': {'usdt': balance}, 'start_day': start_day.strftime('%Y-%m-%d')}
+    portfolio_constants.update(constants)
+    return {
+        'constants': portfolio_constants,
+        'balance': {'usdt': balance},
+        'max_value': {'usdt': float("NaN")},
+        'open': pd.DataFrame(columns=['symbol', 'position', 'buy_date', 'buy_price', 'buy_price(btc)', 'balance', 'current_date', 'current_price(btc)', 'current_roi(btc)', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d', 'tsl_armed', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).astype({'symbol': 'object', 'position': 'object', 'buy_date': 'datetime64[ns]', 'buy_price': 'float64', 'buy_price(btc)': 'float64', 'balance': 'float64', 'current_date': 'datetime64[ns]', 'current_price(btc)': 'float64', 'current_roi(btc)': 'float64', 'kucoin_usdt_24h_vol': 'float64', 'gtrends_15d': 'float64', 'rank_rise_d': 'float64', 'tsl_armed': 'bool', 'tsl_max_price(btc)': 'float64', 'trade_notes': 'object', 'other_notes': 'object'}),
+        'sold': pd.DataFrame(columns=['coin', 'symbol', 'position', 'buy_date', 'buy_price', 'buy_price(btc)', 'balance', 'sell_date', 'sell_price', 'sell_price(btc)', 'roi(btc)', 'kucoin_usdt_24h_vol', 'gtrends_15d', 'rank_rise_d', 'tsl_max_price(btc)', 'trade_notes', 'other_notes']).astype({'coin': 'object', 'symbol': 'object', 'position': 'object', 'buy_date': 'datetime64[ns]', 'buy_price': 'float64', 'buy_price(btc)': 'float64', 'balance': 'float64', 'sell_date': 'datetime64[ns]', 'sell_price': 'float64', 'sell_price(btc)': 'float64', 'roi(btc)': 'float64', 'kucoin_usdt_24h_vol': 'float64', 'gtrends_15d': 'float64', 'rank_rise_d': 'float64', 'tsl_max_price(btc)': 'float64', 'trade_notes': 'object', 'other_notes': 'object'}),
+    }
+
+def generate_market(n_coins, days, start_day=datetime(2024, 1, 1, 17), seed=0, volatility=0.03, kucoin_listed=0.9, missing_days=0.01):
+    # returns {'coins', 'start_day', 'end_day', 'kucoin_pairs'}, kucoin_pairs is a get_kucoin_pairs() style snapshot with kucoin_listed share of the coins
+    rng = np.random.default_rng(seed)
+    end_day = start_day + timedelta(days=days)
+    coins = ['coin-' + str(idx) for idx in range(n_coins)]
+    day_list = [start_day + timedelta(days=day) for day in range(-lookback_days, days + 1)]
+    # hourly BTC price paths (jittered timestamps) from before the first snapshot to after end_day
+    from_timestamp, to_timestamp = datetime.timestamp(day_list[0] - timedelta(days=2)), datetime.timestamp(end_day + timedelta(days=2))
+    hours = np.arange(from_timestamp, to_timestamp, 3600.0)
+    btc_usd = 40000*np.exp(np.cumsum(rng.normal(scale=0.002, size=len(hours))))
+    for data_path in [crypto.coin_granular_path, 'data/crypto/saved_coins_data/', 'data/crypto/saved_portfolio_backups/']: # module expects the data/crypto folders
+        os.makedirs(data_path, exist_ok=True)
+    day_hour_idxs = np.searchsorted(hours, [datetime.timestamp(day + timedelta(hours=7)) for day in day_list]) # price at the (utc) date get_coin_data(historical=True) is called with
+    coin_prices = {}
+    for coin in coins:
+        timestamps = ((hours + rng.integers(0, 3000, size=len(hours)))*1000).astype(np.int64)
+        prices = 10**rng.uniform(-7, -3)*np.exp(np.cumsum(rng.normal(scale=volatility, size=len(hours))))
+        with open(crypto.coin_granular_path + coin + '_btc.npz', 'wb') as f:
+            np.savez(f, timestamps=timestamps, prices=prices, covered=np.array([[from_timestamp, to_timestamp]], dtype=np.float64))
+        coin_prices[coin] = prices[day_hour_idxs]
+    # daily usd / btc prices in the coin history cache (coin, '%d-%m-%Y')
+    db = crypto._coin_history_cache_db()
+    db.executemany("INSERT OR REPLACE INTO coin_history (coin, date, data) VALUES (?, ?, ?)", ((coin, (day + timedelta(hours=7)).strftime('%d-%m-%Y'), json.dumps({'symbol': coin.replace('-', ''), 'market_data': {'current_price': {'usd': coin_prices[coin][day_idx]*btc_usd[day_hour_idxs[day_idx]], 'btc': coin_prices[coin][day_idx]}, 'market_cap': {'usd': 1e6}}})) for coin in coins for day_idx, day in enumerate(day_list)))
+    db.commit()
+    # daily rank snapshots, a random walk score orders the coins present that day
+    score = rng.normal(size=n_coins)
+    for day_idx, day in enumerate(day_list):
+        score = score + rng.normal(size=n_coins)
+        present = np.flatnonzero(rng.random(n_coins) > 0.02)
+        if (0 < day_idx < len(day_list) - 1) and (rng.random() < missing_days): # days without saved data like the real saved coins data
+            continue
+        present = present[np.argsort(-score[present], kind='stable')]
+        df_coins = pd.DataFrame(np.nan, index=pd.Index([coins[idx] for idx in present]), columns=coins_data_columns)
+        df_coins["Market Cap Rank"] = np.arange(1, len(present) + 1, dtype=np.float64)
+        df_coins["Price"] = [coin_prices[coins[idx]][day_idx]*btc_usd[day_hour_idxs[day_idx]] for idx in present]
+        df_coins["Market Cap"] = 1e11/df_coins["Market Cap Rank"]
+        df_coins["24h Volume"] = df_coins["Market Cap"]*rng.uniform(0.01, 0.2, size=len(present))
+        df_coins["Supply: Circulating"] = df_coins["Market Cap"]/df_coins["Price"]
+        crypto.save_coins_history(day.strftime('%Y-%m-%d'), df_coins)
+    kucoin_pairs = {'BTC-USDT': {'price': float(btc_usd[day_hour_idxs[-1]]), '24h_volume': 1e9}}
+    kucoin_pairs.update({coin.replace('-', '').upper() + '-USDT': {'price': float(coin_prices[coin][-1]*btc_usd[day_hour_idxs[-1]]), '24h_volume': 1e6} for coin in coins if rng.random() < kucoin_listed})
+    return {'coins': coins, 'start_day': start_day, 'end_day': end_day, 'kucoin_pairs': kucoin_pairs}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--coins', type=int, default=300)
+    parser.add_argument('--days', type=int, default=180)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--path', default='synthetic_market')
+    args = parser.parse_args()
+    os.makedirs(args.path, exist_ok=True)
+    os.chdir(args.path)
+    market = generate_market(args.coins, args.days, seed=args.seed)
+    print("Synthetic market: " + str(len(market['coins'])) + " coins from " + str(market['start_day']) + " to " + str(market['end_day']) + " in: " + os.getcwd())
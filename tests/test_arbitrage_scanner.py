@@ -0,0 +1,58 @@
+import time
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from speterlin_crypto import module1 as crypto
+
+@pytest.fixture
+def venues(monkeypatch):
+    monkeypatch.setitem(crypto.arbitrage_scanner, 'reference', {'symbols': None, 'coins': None, 'prices': None, 'time': None})
+    monkeypatch.setitem(crypto.arbitrage_scanner, 'arbitrages', {})
+    monkeypatch.setitem(crypto.arbitrage_scanner, 'stats', Counter())
+    data = {'reference': {'aaa-coin': {'symbol': 'aaa', 'price': 1.0}, 'bbb-coin': {'symbol': 'bbb', 'price': 2.0}, 'aaa-clone': {'symbol': 'aaa', 'price': 5.0}}, 'kucoin': {'AAA-USDT': {'price': 1.1}, 'BBB-USDT': {'price': 2.0}, 'BTC-USDT': {'price': 50000.0}}, 'binance': {'BBB-BTC': {'price': 0.0}, 'BBBBTC': {'price': 2.5/50000}, 'BTCUSDT': {'price': 50000.0}}}
+    monkeypatch.setattr(crypto, 'get_coins_markets_coinmarketcap', lambda pages: data['reference'])
+    monkeypatch.setattr(crypto, 'get_kucoin_pairs_snapshot', lambda refresh=False: data['kucoin'])
+    monkeypatch.setattr(crypto, 'get_binance_pairs', lambda: data['binance'])
+    return data
+
+def _spreads(df_arbitrages):
+    return {(symbol, buy_exchange, sell_exchange): round(roi, 6) for symbol, buy_exchange, sell_exchange, roi in zip(df_arbitrages['symbol'], df_arbitrages['buy_exchange'], df_arbitrages['sell_exchange'], df_arbitrages['roi'])}
+
+def test_spreads(venues):
+    df_arbitrages, df_changes = crypto.scan_arbitrages(arbitrage_roi_min=0.05)
+    assert _spreads(df_arbitrages) == {('BBB', 'reference', 'binance'): 0.25, ('BBB', 'kucoin', 'binance'): 0.25, ('AAA', 'reference', 'kucoin'): 0.1} # aaa priced from aaa-coin (highest market cap), binance BBB from BBBBTC*BTCUSDT
+    assert list(df_arbitrages['roi']) == sorted(df_arbitrages['roi'], reverse=True)
+    for buy_price, sell_price, roi in zip(df_arbitrages['buy_price'], df_arbitrages['sell_price'], df_arbitrages['roi']):
+        assert crypto.exchange_check_arbitrage(price=buy_price, other_price=sell_price) == [True, pytest.approx(roi)]
+    assert list(df_changes['status']) == ['new']*3
+    venues['kucoin']['AAA-USDT']['price'] = 1.104 # changed by less than change_min
+    df_arbitrages, df_changes = crypto.scan_arbitrages(arbitrage_roi_min=0.05)
+    assert len(df_arbitrages) == 3 and df_changes.empty
+
+def test_stale_reference_spreads_dropped(venues, monkeypatch):
+    crypto.scan_arbitrages(arbitrage_roi_min=0.05)
+    venues['reference'] = {} # coinmarketcap refresh fails
+    crypto.arbitrage_scanner['reference']['time'] -= crypto.arbitrage_scanner['reference_max_staleness'] + 1
+    venues['kucoin']['AAA-USDT']['price'] = 2.0 # would be a new reference vs kucoin arbitrage against the old reference
+    df_arbitrages, df_changes = crypto.scan_arbitrages(arbitrage_roi_min=0.05)
+    assert _spreads(df_arbitrages) == {('BBB', 'kucoin', 'binance'): 0.25}
+    assert df_changes.empty # reference arbitrages neither new nor closed while the reference is stale
+    assert crypto.arbitrage_scanner['stats']['stale_reference'] == 1
+    venues['reference'] = {'aaa-coin': {'symbol': 'aaa', 'price': 1.0}}
+    df_arbitrages, df_changes = crypto.scan_arbitrages(arbitrage_roi_min=0.05)
+    assert _spreads(df_arbitrages) == {('AAA', 'reference', 'kucoin'): 1.0}
+    assert sorted(zip(df_changes['symbol'], df_changes['status'])) == [('AAA', 'changed'), ('BBB', 'closed'), ('BBB', 'closed')]  # bbb no longer in the reference listing
+
+def test_scan_time(venues):
+    rng = np.random.default_rng(0)
+    n_coins = 5000
+    venues['reference'] = {'coin-' + str(idx): {'symbol': 'c' + str(idx), 'price': float(price)} for idx, price in enumerate(10**rng.uniform(-3, 3, size=n_coins))}
+    venues['kucoin'] = {'C' + str(idx) + '-USDT': {'price': coin['price']*rng.uniform(0.9, 1.1)} for idx, coin in enumerate(venues['reference'].values())}
+    venues['binance'] = {'C' + str(idx) + 'USDT': {'price': coin['price']*rng.uniform(0.9, 1.1)} for idx, coin in enumerate(venues['reference'].values())}
+    crypto.scan_arbitrages(arbitrage_roi_min=0.05) # warm up
+    start_time = time.perf_counter()
+    df_arbitrages, df_changes = crypto.scan_arbitrages(arbitrage_roi_min=0.05, refresh_reference=True)
+    assert time.perf_counter() - start_time < 1.0 # well under a second for every coin on every venue
+    assert len(df_arbitrages) > 0
@@ -0,0 +1,19 @@
+import contextlib
+import copy
+import io
+
+import pandas as pd
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import generate_market, new_portfolio
+
+def test_run_portfolio_rr_backtest_matches_run_portfolio_rr(data_dir):
+    market = generate_market(40, 30, seed=0)
+    portfolio = new_portfolio(market['start_day'])
+    with contextlib.redirect_stdout(io.StringIO()): # module prints every trade
+        portfolio_rr = crypto.run_portfolio_rr(copy.deepcopy(portfolio), start_day=market['start_day'], end_day=market['end_day'], paper_trading=True, back_testing=True, kucoin_pairs_with_price_and_vol_current=market['kucoin_pairs'])
+        portfolio_backtest = crypto.run_portfolio_rr_backtest(copy.deepcopy(portfolio), start_day=market['start_day'], end_day=market['end_day'], kucoin_pairs_with_price_and_vol_current=market['kucoin_pairs'])
+    assert len(portfolio_rr['sold']) > 0 and len(portfolio_rr['open']) > 0 # market trades both ways
+    pd.testing.assert_frame_equal(portfolio_backtest['sold'], portfolio_rr['sold'])
+    pd.testing.assert_frame_equal(portfolio_backtest['open'], portfolio_rr['open'])
+    assert portfolio_backtest['balance'] == portfolio_rr['balance']
@@ -0,0 +1,28 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from speterlin_crypto import module1 as crypto
+
+def test_failed_chunk_leaves_no_coverage_without_data(data_dir, monkeypatch):
+    from_timestamp = datetime.timestamp(datetime(2024, 1, 1))
+    to_timestamp = from_timestamp + 3*crypto.coin_granular_chunk_days*24*60*60
+    calls = []
+    def get_coin_data_granular_cg(coin, from_timestamp, to_timestamp, currency='btc'):
+        calls.append([from_timestamp, to_timestamp])
+        if len(calls) == 2:
+            raise RuntimeError("rate limited")
+        return {'prices': [[from_timestamp*1000 + 1000*60*60*hour, 1.0 + hour] for hour in range(3)]}
+    monkeypatch.setattr(crypto, 'get_coin_data_granular_cg', get_coin_data_granular_cg)
+    with pytest.raises(RuntimeError):
+        crypto.get_coin_data_granular('coin-0', from_timestamp, to_timestamp)
+    store = crypto._coin_granular_store[('coin-0', 'btc')]
+    assert store['covered'] == [calls[0]] # only the chunk whose prices were merged
+    assert len(store['timestamps']) == 3
+    assert os.path.exists(crypto.coin_granular_path + 'coin-0_btc.npz')
+    monkeypatch.setattr(crypto, 'get_coin_data_granular_cg', lambda coin, from_timestamp, to_timestamp, currency='btc': {'prices': [[from_timestamp*1000, 5.0]]})
+    prices = np.array(crypto.get_coin_data_granular('coin-0', from_timestamp, to_timestamp)['prices'])
+    assert crypto._coin_granular_store[('coin-0', 'btc')]['covered'] == [[from_timestamp, to_timestamp]] # failed chunk refetched
+    assert len(prices) == 3 + 2
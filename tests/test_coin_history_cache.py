@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from speterlin_crypto import module1 as crypto
+
+@pytest.fixture
+def coin_history(data_dir, monkeypatch):
+    calls, responses = [], {}
+    def get_coin_history_by_id(coin, date):
+        calls.append((coin, date))
+        return responses[date]
+    monkeypatch.setattr(crypto.cg, 'get_coin_history_by_id', get_coin_history_by_id)
+    return [calls, responses]
+
+def _market_data(market_cap):
+    return {'symbol': 'abc', 'market_data': {'current_price': {'usd': 2.0, 'btc': 2.0/50000}, 'market_cap': {'usd': market_cap}}}
+
+def test_only_past_days_are_cached(coin_history):
+    calls, responses = coin_history
+    today, tomorrow, yesterday, last_week = [(datetime.utcnow() - timedelta(days=days)).strftime('%d-%m-%Y') for days in [0, -1, 1, 7]]
+    responses.update({today: _market_data(1e9), tomorrow: {'symbol': 'abc'}, yesterday: _market_data(None), last_week: _market_data(1e9)})
+    for _ in range(2):
+        for date in [today, tomorrow, yesterday, last_week]:
+            crypto.get_coin_history_cached('abc-coin', date)
+    assert calls == [('abc-coin', today), ('abc-coin', tomorrow), ('abc-coin', yesterday), ('abc-coin', last_week), ('abc-coin', today), ('abc-coin', tomorrow)] # past days from cache
+    assert sorted(crypto._coin_history_cache_db().execute("SELECT date FROM coin_history").fetchall()) == sorted([(yesterday,), (last_week,)])
+
+def test_past_day_without_market_data_is_cached(coin_history):
+    calls, responses = coin_history
+    last_week = (datetime.utcnow() - timedelta(days=7)).strftime('%d-%m-%Y')
+    responses[last_week] = {'symbol': 'abc'} # delisted / not yet listed
+    assert crypto.get_coin_history_cached('abc-coin', last_week) == {'symbol': 'abc'}
+    disk_hits = crypto.get_coin_history_cache_stats()['disk_hits']
+    crypto.coin_history_cache['memory'].pop(('abc-coin', last_week)) # served from disk
+    assert crypto.get_coin_history_cached('abc-coin', last_week) == {'symbol': 'abc'}
+    assert crypto.get_coin_history_cached('abc-coin', last_week) == {'symbol': 'abc'} # and memory
+    assert len(calls) == 1
+    assert crypto.get_coin_history_cache_stats()['disk_hits'] == disk_hits + 1
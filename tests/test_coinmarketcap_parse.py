@@ -0,0 +1,32 @@
+import json
+import os
+
+from speterlin_crypto import module1 as crypto
+
+fixtures_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures') # coinmarketcap pages, also parsed by benchmarks/parse_benchmark.py
+
+def _fixture_page(file_name): # captured page if there is one else the synthetic one, like parse_benchmark.page_path
+    return os.path.join(fixtures_path, file_name) if os.path.exists(os.path.join(fixtures_path, file_name)) else os.path.join(fixtures_path, 'synthetic_' + file_name)
+
+def _page(page_props):
+    return '<html><script id="__NEXT_DATA__" type="application/json">' + json.dumps({'props': {'pageProps': page_props}}) + '</script></html>'
+
+def _listing(ranks):
+    return [{'keysArr': ['slug', 'symbol', 'cmcRank', 'circulatingSupply', 'quote.USD.price', 'quote.USD.marketCap', 'quote.USD.volume24h']}] + [['coin-' + str(rank), 'C' + str(rank), rank, 1e6, 1.0, 1e6, 1e5] for rank in ranks]
+
+def test_fixture_listing_in_rank_order():
+    with open(_fixture_page('coinmarketcap_listing_page.html')) as f:
+        coins_rows = crypto.parse_coins_markets_coinmarketcap_page(f.read(), backends=['json'])
+    assert len(coins_rows) == 100
+    assert [coin_id for coin_id, market_data in coins_rows[:2]] == ['bitcoin', 'ethereum']
+
+def test_other_coin_lists_not_read_as_listing():
+    trending = [{'slug': 'trending-' + str(idx), 'symbol': 'T' + str(idx), 'cmcRank': 500 + idx} for idx in range(10)]
+    html = _page({'trending': trending, 'initialState': json.dumps({'gainers': {'data': trending}, 'cryptocurrency': {'listingLatest': {'page': 2, 'data': _listing(range(101, 201))}}})})
+    coins_rows = crypto.parse_coins_markets_coinmarketcap_page(html, backends=['json'])
+    assert [coin_id for coin_id, market_data in coins_rows] == ['coin-' + str(rank) for rank in range(101, 201)]
+    assert coins_rows[0][1]['symbol'] == 'c101'
+
+def test_listing_rejected_if_short_or_ranks_not_continuous():
+    assert crypto.parse_coins_markets_coinmarketcap_page(_page({'initialState': json.dumps({'cryptocurrency': {'listingLatest': {'data': _listing(range(1, 21))}}})}), backends=['json']) == []
+    assert crypto.parse_coins_markets_coinmarketcap_page(_page({'initialState': json.dumps({'cryptocurrency': {'listingLatest': {'data': _listing(list(range(1, 60)) + list(range(70, 111)))}}})}), backends=['json']) == []
@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from speterlin_crypto import module1 as crypto
+
+def _df_coins(prices, ranks_dtype='float64'):
+    df_coins = pd.DataFrame({'Market Cap Rank': np.arange(1, len(prices) + 1), 'Price': prices, 'Alexa Rank': float("NaN")}, index=pd.Index(['coin-' + str(idx) for idx in range(len(prices))]))
+    return df_coins.astype({'Market Cap Rank': ranks_dtype})
+
+def test_saving_date_again_replaces_rows(data_dir):
+    crypto.save_coins_history('2024-01-01', _df_coins([1.0, 2.0, 3.0]))
+    crypto.save_coins_history('2024-01-02', _df_coins([4.0, 5.0]))
+    assert list(crypto.get_saved_coins_data('2024-01-01')['Price']) == [1.0, 2.0, 3.0] # read (and cached) before the re-save
+    crypto.save_coins_history('2024-01-01', _df_coins([10.0, 20.0]))
+    pd.testing.assert_frame_equal(crypto.get_saved_coins_data('2024-01-01'), _df_coins([10.0, 20.0]))
+    pd.testing.assert_frame_equal(crypto.get_saved_coins_data('2024-01-02'), _df_coins([4.0, 5.0]))
+    df_range = crypto.get_saved_coins_history('2024-01-01', '2024-01-02')
+    assert list(df_range['Price']) == [10.0, 20.0, 4.0, 5.0]
+
+def test_saved_dtypes_restored(data_dir):
+    df_coins = _df_coins([1.0, 2.0], ranks_dtype='int64')
+    df_coins['Name'] = pd.Series([1.5, float("NaN")], index=df_coins.index, dtype=object)
+    crypto.save_coins_history('2024-01-01', df_coins)
+    crypto.save_coins_history('2024-01-02', _df_coins([3.0])) # float64 ranks, another schema
+    pd.testing.assert_frame_equal(crypto.get_saved_coins_data('2024-01-01'), df_coins)
+    pd.testing.assert_frame_equal(crypto.get_saved_coins_data('2024-01-02'), _df_coins([3.0]))
@@ -0,0 +1,25 @@
+import pytest
+import requests
+
+from speterlin_crypto import module1 as crypto
+
+@pytest.mark.parametrize('error', [requests.exceptions.ReadTimeout, requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError])
+def test_timeouts_retried(error, monkeypatch):
+    monkeypatch.setitem(crypto.offline, 'mode', 'replay') # retry sleeps offline['retry_sleep'] instead of 60s
+    monkeypatch.setitem(crypto.offline, 'retry_sleep', 0)
+    calls = []
+    def fetch():
+        calls.append(1)
+        if len(calls) == 1:
+            raise error("timed out")
+        return {'ok': True}
+    assert crypto._fetch_data(fetch, params={}, error_str=" - test", empty_data={}) == {'ok': True}
+    assert len(calls) == 2
+
+def test_value_errors_not_retried():
+    calls = []
+    def fetch():
+        calls.append(1)
+        raise ValueError("bad data")
+    assert crypto._fetch_data(fetch, params={}, error_str=" - test", empty_data={}) == {}
+    assert len(calls) == 1
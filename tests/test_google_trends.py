@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import new_portfolio
+
+popularity = {term: scale*np.exp(slope*np.arange(16)) for term, scale, slope in [('alpha', 80.0, 0.05), ('beta', 60.0, -0.04), ('gamma', 100.0, 0.01), ('delta', 50.0, -0.02), ('epsilon', 3.0, 0.08)]} # epsilon is too small in a batch, re-queried alone
+
+@pytest.fixture
+def google_trends(data_dir, monkeypatch):
+    monkeypatch.setitem(crypto.google_trends_cache, 'enabled', False)
+    payloads = []
+    def _google_trends_query(kw_list, timeframe, cat, geo, tz, gprop, hl): # like Google, terms of a payload scaled to the payload's max of 100 and rounded
+        payloads.append(list(kw_list))
+        payload_max = max(popularity[kw].max() for kw in kw_list)
+        data = pd.DataFrame({kw: np.round(popularity[kw]*100/payload_max).astype(np.int64) for kw in kw_list}, index=pd.date_range(datetime(2024, 1, 1), periods=16, name='date'))
+        data['isPartial'] = False
+        return data
+    monkeypatch.setattr(crypto, '_google_trends_query', _google_trends_query)
+    monkeypatch.setattr(crypto, 'get_coin_data', lambda coin, **params: {'symbol': coin[:3], 'market_data': {'market_cap': {'usd': 1e9}, 'current_price': {'usd': 10.0, 'btc': 10.0/50000}}})
+    return payloads
+
+def _buy(batch_size, monkeypatch):
+    monkeypatch.setitem(crypto.google_trends_cache, 'batch_size', batch_size)
+    stop_day = datetime(2024, 1, 16, 17)
+    portfolio = new_portfolio(stop_day, buy_date_gtrends_15d=True)
+    kucoin_pairs = {'BTC-USDT': {'price': 50000.0, '24h_volume': 1e9}}
+    kucoin_pairs.update({term[:3].upper() + '-USDT': {'price': 10.0, '24h_volume': 1e6} for term in popularity})
+    return crypto.update_portfolio_buy_and_sell_coins(portfolio, coins_to_buy=[[term, 20.0] for term in popularity], coins_to_sell=[], stop_day=stop_day, end_day=stop_day, paper_trading=True, back_testing=True, kucoin_pairs_with_price_and_vol_current=kucoin_pairs)
+
+def test_batched_trends_give_same_buys_as_single_keyword(google_trends, monkeypatch):
+    portfolio_single = _buy(1, monkeypatch)
+    assert google_trends == [[term] for term in popularity] # one payload per coin
+    google_trends.clear()
+    portfolio_batched = _buy(5, monkeypatch)
+    assert google_trends == [list(popularity), ['epsilon']] # all candidates in one payload (before the buy loop), epsilon re-queried alone
+    assert list(portfolio_batched['open'].index) == list(portfolio_single['open'].index) == list(popularity)
+    gtrends_single, gtrends_batched = portfolio_single['open']['gtrends_15d'].to_numpy(dtype=np.float64), portfolio_batched['open']['gtrends_15d'].to_numpy(dtype=np.float64)
+    assert not np.isnan(gtrends_single).any() and list(np.sign(gtrends_batched)) == list(np.sign(gtrends_single))
+    assert np.allclose(gtrends_batched, gtrends_single, rtol=0.1, atol=0.05)
+
+def test_batched_series_are_integers(google_trends):
+    kw_series = crypto._get_google_trends_series(['alpha', 'beta'], datetime(2024, 1, 1), datetime(2024, 1, 16))
+    assert all(isinstance(value, int) for series in kw_series.values() for value in series['value'])
+    assert max(kw_series['beta']['value']) == 100
+    frame = crypto._google_trends_frame({'beta': kw_series['beta']})
+    assert frame['beta'].dtype == np.int64
@@ -0,0 +1,51 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import new_portfolio
+
+def _coin(coin_id, symbol, market_cap_rank):
+    return {'id': coin_id, 'symbol': symbol, 'market_cap_rank': market_cap_rank, 'symbol_owner': True, 'cg_id': coin_id, 'kucoin_pair': symbol.upper() + '-USDT', 'binance_pair': None}
+
+@pytest.fixture
+def registry(data_dir, monkeypatch):
+    monkeypatch.setitem(crypto.instrument_registry, 'data', crypto._instrument_registry_index([_coin('old-coin', 'old', 1)], time.time() - 2*60*60)) # built before new-coin was listed
+    monkeypatch.setitem(crypto.instrument_registry, 'time', crypto.instrument_registry['data']['time'])
+    builds = []
+    def _build_instrument_registry(pages, cg_pages):
+        builds.append(threading.current_thread())
+        return [_coin('old-coin', 'old', 1), _coin('new-coin', 'new', 2)]
+    monkeypatch.setattr(crypto, '_build_instrument_registry', _build_instrument_registry)
+    return builds
+
+def test_live_buy_refreshes_registry_for_new_coin(registry, monkeypatch):
+    monkeypatch.setattr(crypto, 'get_coin_data', lambda coin, **params: {'symbol': 'new', 'market_data': {'market_cap': {'usd': 1e9}, 'current_price': {'usd': 2.0, 'btc': 2.0/50000}}})
+    orders = []
+    def kucoin_trade_coins_usdt(orders_to_submit, **params):
+        orders.extend(orders_to_submit)
+        return [[50, 2.0, 2.0/50000, {}, [], None] for order in orders_to_submit]
+    monkeypatch.setattr(crypto, 'kucoin_trade_coins_usdt', kucoin_trade_coins_usdt)
+    portfolio = new_portfolio(datetime(2024, 1, 1))
+    kucoin_pairs = {'BTC-USDT': {'price': 50000.0, '24h_volume': 1e9}, 'NEW-USDT': {'price': 2.0, '24h_volume': 1e6}}
+    portfolio = crypto.update_portfolio_buy_and_sell_coins(portfolio, coins_to_buy=[['new-coin', 50]], coins_to_sell=[], stop_day=datetime.now(), end_day=datetime.now(), paper_trading=True, back_testing=False, kucoin_pairs_with_price_and_vol_current=kucoin_pairs)
+    assert registry == [threading.current_thread()] # one blocking refresh
+    assert [order['symbol_pair'] for order in orders] == ['NEW-USDT']
+    assert list(portfolio['open'].index) == ['new-coin']
+
+def test_blocking_refresh_waits_for_background_refresh(registry, monkeypatch):
+    release = threading.Event()
+    build = crypto._build_instrument_registry
+    monkeypatch.setattr(crypto, '_build_instrument_registry', lambda pages, cg_pages: release.wait() and build(pages, cg_pages))
+    crypto.refresh_instrument_registry(background=True)
+    result = {}
+    waiter = threading.Thread(target=lambda: result.update(data=crypto.refresh_instrument_registry()))
+    waiter.start()
+    time.sleep(0.05)
+    assert waiter.is_alive() and crypto.instrument_registry['refreshing']
+    release.set()
+    waiter.join(timeout=5)
+    assert 'new-coin' in result['data']['id'] and len(registry) == 1
+    assert not crypto.instrument_registry['refreshing'] and crypto.instrument_registry['refreshed'].is_set()
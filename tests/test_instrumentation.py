@@ -0,0 +1,58 @@
+import json
+import re
+import time
+from collections import Counter
+
+import pytest
+
+from speterlin_crypto import module1 as crypto
+
+@pytest.fixture
+def instrumentation(monkeypatch):
+    monkeypatch.setitem(crypto.instrumentation, 'enabled', True)
+    monkeypatch.setitem(crypto.instrumentation, 'timers', {})
+    monkeypatch.setitem(crypto.instrumentation, 'counters', Counter())
+    return crypto.instrumentation
+
+def slow_call(seconds):
+    time.sleep(seconds)
+    return {'slept': seconds}
+
+def failing_call():
+    raise ValueError("Mock fetch error")
+
+def test_json_lines_record(instrumentation, tmp_path):
+    assert crypto._fetch_data(slow_call, params={'seconds': 0.03}, error_str="", empty_data={}) == {'slept': 0.03}
+    path = tmp_path / 'metrics.jsonl'
+    text = crypto.get_metrics_json_lines(path=str(path))
+    records = [json.loads(line) for line in text.splitlines()]
+    assert len(records) == 1
+    record = records[0]
+    assert {key: record[key] for key in ['type', 'stage', 'endpoint', 'count']} == {'type': 'timer', 'stage': 'fetch', 'endpoint': 'slow_call', 'count': 1}
+    assert 0.03 <= record['sum'] == record['max'] < 1.0
+    assert list(record['buckets']) == [str(bound) for bound in instrumentation['buckets']] + ["+Inf"]
+    assert sum(record['buckets'].values()) == 1 and record['buckets'][next(str(bound) for bound in instrumentation['buckets'] if record['sum'] <= bound)] == 1 # bucket holding the call's seconds
+    crypto.get_metrics_json_lines(path=str(path))
+    assert path.read_text().startswith(text) and len(path.read_text().splitlines()) == 2 # appended
+
+def test_prometheus_text_format(instrumentation):
+    crypto._fetch_data(slow_call, params={'seconds': 0.03}, error_str="", empty_data={})
+    crypto._fetch_data(failing_call, params={}, error_str="", empty_data={})
+    crypto._instrument_count('http', 'host "a"\\b', 'status_429')
+    lines = crypto.get_metrics_prometheus().splitlines()
+    assert lines[:2] == ["# HELP speterlin_crypto_stage_seconds Time spent per stage and endpoint.", "# TYPE speterlin_crypto_stage_seconds histogram"]
+    assert all(line.startswith('#') or re.fullmatch(r'[a-z_]+\{(\w+="(?:[^"\\]|\\.)*",?)+\} \S+', line) for line in lines) # name{labels} value
+    buckets = [line for line in lines if line.startswith('speterlin_crypto_stage_seconds_bucket{stage="fetch",endpoint="slow_call",')]
+    assert [re.search(r'le="([^"]+)"', line).group(1) for line in buckets] == [repr(float(bound)) for bound in instrumentation['buckets']] + ["+Inf"]
+    counts = [int(line.split()[-1]) for line in buckets]
+    assert counts == sorted(counts) and counts[0] == 0 and counts[-1] == 1 # cumulative
+    assert 'speterlin_crypto_stage_seconds_count{stage="fetch",endpoint="slow_call"} 1' in lines
+    assert 0.03 <= float(next(line for line in lines if line.startswith('speterlin_crypto_stage_seconds_sum{stage="fetch",endpoint="slow_call"}')).split()[-1]) < 1.0
+    assert lines.index("# TYPE speterlin_crypto_events_total counter") > lines.index('speterlin_crypto_stage_seconds_count{stage="fetch",endpoint="slow_call"} 1')
+    assert 'speterlin_crypto_events_total{stage="fetch",endpoint="failing_call",event="errors"} 1' in lines
+    assert 'speterlin_crypto_events_total{stage="http",endpoint="host \\"a\\"\\\\b",event="status_429"} 1' in lines # escaped label value
+
+def test_disabled_records_nothing(instrumentation):
+    instrumentation['enabled'] = False
+    crypto._fetch_data(slow_call, params={'seconds': 0}, error_str="", empty_data={})
+    assert crypto.get_metrics_json_lines() == ""
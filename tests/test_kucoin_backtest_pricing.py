@@ -0,0 +1,47 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import new_portfolio
+
+@pytest.fixture
+def candle_pricing(data_dir, monkeypatch):
+    coins = [{'id': 'abc-coin', 'symbol': 'abc', 'market_cap_rank': 1, 'symbol_owner': True, 'cg_id': 'abc-coin', 'kucoin_pair': 'ABC-USDT', 'binance_pair': None}, {'id': 'abc-clone', 'symbol': 'abc', 'market_cap_rank': 2, 'symbol_owner': False, 'cg_id': None, 'kucoin_pair': None, 'binance_pair': None}] # abc-clone has abc-coin's symbol
+    monkeypatch.setitem(crypto.instrument_registry, 'data', crypto._instrument_registry_index(coins, time.time()))
+    monkeypatch.setitem(crypto.instrument_registry, 'time', time.time())
+    monkeypatch.setitem(crypto.kucoin_candles, 'backtest_pricing', True)
+    symbol_pairs = []
+    def get_kucoin_candle_price(symbol_pair, timestamp, prefetch_to_timestamp=None):
+        symbol_pairs.append(symbol_pair)
+        return [2.0, 2.0/50000]
+    def get_kucoin_candle_prices_in_btc(symbol_pair, from_timestamp, to_timestamp, prefetch_to_timestamp=None):
+        symbol_pairs.append(symbol_pair)
+        return {'prices': [[to_timestamp*1000, 2.0/50000]]}
+    monkeypatch.setattr(crypto, 'get_kucoin_candle_price', get_kucoin_candle_price)
+    monkeypatch.setattr(crypto, 'get_kucoin_candle_prices_in_btc', get_kucoin_candle_prices_in_btc)
+    return symbol_pairs
+
+def test_candle_price_only_for_symbol_owner(candle_pricing):
+    day = datetime(2024, 1, 2)
+    assert crypto._kucoin_candle_backtest_price('abc-coin', 'abc', day, day) == [2.0, 2.0/50000]
+    assert all(price != price for price in crypto._kucoin_candle_backtest_price('abc-clone', 'abc', day, day)) # NaNs, CoinGecko fallback
+    assert all(price != price for price in crypto._kucoin_candle_backtest_price('unknown-coin', 'abc', day, day))
+    assert candle_pricing == ['ABC-USDT']
+
+def test_positions_update_uses_coingecko_for_symbol_collision(candle_pricing, monkeypatch):
+    granular_coins = []
+    def get_coin_data_granular(coin, currency, from_timestamp, to_timestamp, prefetch_to_timestamp=None):
+        granular_coins.append(coin)
+        return {'prices': [[to_timestamp*1000, 1.0/50000]]}
+    monkeypatch.setattr(crypto, 'get_coin_data_granular', get_coin_data_granular)
+    stop_day = datetime(2024, 1, 2, 17)
+    portfolio = new_portfolio(stop_day - timedelta(days=1))
+    for coin in ['abc-coin', 'abc-clone']:
+        portfolio['open'].loc[coin] = ['abc', 'long', stop_day - timedelta(days=1), 1.0, 1.0/50000, 10.0, stop_day - timedelta(days=1), 1.0/50000, 0.0, float("NaN"), float("NaN"), 20.0, False, float("NaN"), None, None]
+    portfolio = crypto.update_portfolio_postions_back_testing(portfolio, stop_day=stop_day, end_day=stop_day, kucoin_pairs_with_price_and_vol_current={})
+    assert candle_pricing == ['ABC-USDT'] # abc-coin priced from Kucoin candles
+    assert granular_coins == ['abc-clone']
+    assert portfolio['open'].loc['abc-coin', 'current_price(btc)'] == pytest.approx(2.0/50000)
+    assert portfolio['open'].loc['abc-clone', 'current_price(btc)'] == pytest.approx(1.0/50000)
@@ -0,0 +1,33 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from speterlin_crypto import module1 as crypto
+
+from kucoin_mock_client import KucoinMockClient
+
+@pytest.fixture
+def tickers(monkeypatch):
+    messages = []
+    monkeypatch.setattr(crypto, 'twilio_client', SimpleNamespace(messages=SimpleNamespace(create=lambda **params: messages.append(params['body']))))
+    monkeypatch.setitem(crypto.kucoin_pairs_snapshot, 'data', {'BTC-USDT': {'price': 50000.0, '24h_volume': 1e9}})
+    monkeypatch.setitem(crypto.kucoin_pairs_snapshot, 'time', time.time()) # fresh, no tickers request
+    return crypto.kucoin_pairs_snapshot['data']
+
+def test_buy_orders_priced_from_fresh_snapshot(tickers):
+    tickers.update({'AAA-USDT': {'price': 2.02, '24h_volume': 1e6}, 'BBB-USDT': {'price': 1.0, '24h_volume': 1e6}})
+    client = KucoinMockClient(latency=0)
+    orders = [{'symbol_pair': 'AAA-USDT', 'coin': 'aaa', 'trade': "buy", 'usdt_invest': 100, 'check_price': 2.0, 'paper_trading': False}, {'symbol_pair': 'BBB-USDT', 'coin': 'bbb', 'trade': "buy", 'usdt_invest': 100, 'paper_trading': False}]
+    results = crypto.kucoin_trade_coins_usdt(orders, open_time=0, client=client)
+    assert results[0][:3] == [49, 2.02, 2.02/50000.0] # sized from the snapshot price, not check_price
+    assert results[1][:2] == [100, 1.0]
+    assert sorted((order['symbol'], order['price'], order['size']) for order in client.orders.values()) == [('AAA-USDT', '2.02', '49'), ('BBB-USDT', '1.0', '100')]
+    assert [result[5] for result in results] == ["Filled", "Filled"]
+
+def test_buy_orders_skipped_when_recheck_fails(tickers):
+    tickers.update({'MOVED-USDT': {'price': 2.2, '24h_volume': 1e6}, 'THIN-USDT': {'price': 2.0, '24h_volume': 1000.0}, 'DEAR-USDT': {'price': 150.0, '24h_volume': 1e6}})
+    client = KucoinMockClient(latency=0)
+    orders = [{'symbol_pair': symbol_pair, 'coin': symbol_pair.lower(), 'trade': "buy", 'usdt_invest': 100, 'check_price': check_price, 'paper_trading': False} for symbol_pair, check_price in [('MOVED-USDT', 2.0), ('THIN-USDT', 2.0), ('DEAR-USDT', 90.0), ('GONE-USDT', 2.0)]]
+    assert crypto.kucoin_trade_coins_usdt(orders, open_time=0, client=client) == [None]*4
+    assert not client.requests # nothing submitted
@@ -0,0 +1,43 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from speterlin_crypto import module1 as crypto
+
+@pytest.fixture
+def slow_tickers(monkeypatch):
+    monkeypatch.setitem(crypto.kucoin_pairs_snapshot, 'data', {})
+    monkeypatch.setitem(crypto.kucoin_pairs_snapshot, 'time', None)
+    calls, release = [], threading.Event()
+    def get_kucoin_pairs():
+        calls.append(time.time())
+        release.wait(5)
+        return {'BTC-USDT': {'price': 50000.0 + len(calls), '24h_volume': 1e9}}
+    monkeypatch.setattr(crypto, 'get_kucoin_pairs', get_kucoin_pairs)
+    return calls, release
+
+def test_one_fetch_for_concurrent_callers(slow_tickers):
+    calls, release = slow_tickers
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        futures = [executor.submit(crypto.get_kucoin_pairs_snapshot, refresh=True) for _ in range(6)]
+        time.sleep(0.1)
+        release.set()
+        results = [future.result(timeout=5) for future in futures]
+    assert len(calls) == 1
+    assert all(result['BTC-USDT']['price'] == 50001.0 for result in results)
+    assert not crypto.kucoin_pairs_snapshot['refreshing']
+
+def test_lock_not_held_while_fetching(slow_tickers):
+    calls, release = slow_tickers
+    fetcher = threading.Thread(target=crypto.get_kucoin_pairs_snapshot)
+    fetcher.start()
+    while not calls:
+        time.sleep(0.01)
+    assert crypto.kucoin_pairs_snapshot['lock'].acquire(timeout=1) # not blocked by the fetch
+    crypto.kucoin_pairs_snapshot['lock'].release()
+    release.set()
+    fetcher.join(timeout=5)
+    assert crypto.get_kucoin_pairs_snapshot()['BTC-USDT']['price'] == 50001.0 # cached
+    assert len(calls) == 1
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from speterlin_crypto import module1 as crypto
+
+package_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+client_modules = ['kucoin', 'binance', 'twilio', 'pycoingecko']
+
+class MockClient:
+    built = []
+
+    def __init__(self, **kwargs):
+        time.sleep(0.01) # widen the race between first accesses
+        self.kwargs = kwargs
+        MockClient.built.append(self)
+
+    def get_orders(self, status=None):
+        return {'items': [], 'status': status}
+
+@pytest.fixture
+def mock_provider(monkeypatch):
+    MockClient.built.clear()
+    monkeypatch.setitem(crypto.clients, 'mock', {'module': __name__, 'class': 'MockClient', 'extra': None, 'env': {'api_key': 'MOCK_API_KEY'}, 'kwargs': None})
+    monkeypatch.setenv('MOCK_API_KEY', 'key')
+    return crypto._LazyClient('mock')
+
+def test_import_does_not_construct_clients():
+    code = "import sys\nfrom speterlin_crypto import module1 as crypto\nprint(','.join(name for name in " + repr(client_modules) + " if name in sys.modules))\nprint(all(client._client is None for client in [crypto.kucoin_client, crypto.binance_client, crypto.twilio_client, crypto.cg._client]))"
+    env = dict(os.environ, PYTHONPATH=package_path)
+    for env_var in ['KUCOIN_API_KEY', 'BINANCE_API_KEY', 'TWILIO_ACCOUNT_SID']:
+        env.pop(env_var, None)
+    proc = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    assert proc.stdout.splitlines() == ["", "True"] # no client module imported, no client built
+
+def test_first_attribute_access_builds_and_caches_client(mock_provider):
+    assert not MockClient.built and repr(mock_provider) == "<lazy mock client>"
+    assert mock_provider.get_orders(status='active') == {'items': [], 'status': 'active'}
+    assert len(MockClient.built) == 1 and MockClient.built[0].kwargs == {'api_key': 'key'} # kwargs from env
+    assert mock_provider.kwargs is MockClient.built[0].kwargs and mock_provider._client is MockClient.built[0]
+    assert len(MockClient.built) == 1 and repr(mock_provider) == "<lazy mock client (built)>"
+
+def test_concurrent_first_access_builds_once(mock_provider):
+    start = threading.Barrier(8)
+    def get_orders(_):
+        start.wait()
+        return mock_provider.get_orders
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        methods = list(executor.map(get_orders, range(8)))
+    assert len(MockClient.built) == 1 and all(method.__self__ is MockClient.built[0] for method in methods)
@@ -0,0 +1,45 @@
+import pytest
+
+from speterlin_crypto import module1 as crypto
+
+@pytest.fixture
+def offline(data_dir):
+    saved = dict(crypto.offline)
+    yield str(data_dir / 'recordings.sqlite')
+    if crypto.offline['db'] is not None:
+        crypto.offline['db'].close()
+    crypto.offline.clear()
+    crypto.offline.update(saved)
+
+def _record(responses):
+    for response in responses:
+        crypto._offline_call('test', 'get', {'page': 1}, lambda: response)
+
+def _replay(count):
+    return [crypto._offline_call('test', 'get', {'page': 1}, lambda: pytest.fail("network call while replaying")) for _ in range(count)]
+
+def test_recording_again_needs_clear(offline):
+    crypto.set_offline_mode('record', path=offline)
+    _record(['a1', 'a2', 'a3'])
+    crypto.set_offline_mode('replay')
+    assert _replay(3) == ['a1', 'a2', 'a3']
+    with pytest.raises(ValueError):
+        crypto.set_offline_mode('record')
+    assert crypto.offline['mode'] == 'replay' # unchanged
+    crypto.set_offline_mode('record', clear=True)
+    _record(['b1'])
+    crypto.set_offline_mode('replay')
+    assert _replay(2) == ['b1', 'b1'] # only the new session, last one repeats
+
+def test_refused_path_keeps_current_recordings(offline, tmp_path):
+    other_path = str(tmp_path / 'other.sqlite')
+    crypto.set_offline_mode('record', path=other_path)
+    _record(['other'])
+    crypto.set_offline_mode('record', path=offline)
+    _record(['a1'])
+    with pytest.raises(ValueError):
+        crypto.set_offline_mode('record', path=other_path)
+    assert crypto.offline['path'] == offline
+    _record(['a2'])
+    crypto.set_offline_mode('replay')
+    assert _replay(2) == ['a1', 'a2']
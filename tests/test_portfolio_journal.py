@@ -0,0 +1,35 @@
+import os
+from datetime import datetime
+
+import pandas as pd
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import new_portfolio
+
+sold_row = ['symbol', 'long', pd.Timestamp('2024-01-01'), 1.0, 0.0001, 10.0, pd.Timestamp('2024-01-05'), float("NaN"), 0.00012, 0.2, float("NaN"), float("NaN"), 3.0, float("NaN"), 'KTrade Error', None]
+
+def _saved(portfolio):
+    file_name = [file_name for file_name in os.listdir('data/crypto/saved_portfolio_backups/') if file_name.endswith('.pckl')][0][:-len('.pckl')]
+    return crypto.get_saved_portfolio_backup(file_name)
+
+def test_edited_sold_row_survives_recovery(data_dir):
+    portfolio = new_portfolio(datetime(2024, 1, 1))
+    portfolio['sold'].loc[0] = ['coin-0'] + sold_row
+    crypto.save_portfolio_backup(portfolio) # snapshot
+    portfolio['sold'].loc[1] = ['coin-1'] + sold_row
+    crypto.save_portfolio_backup(portfolio) # journal (appended row)
+    portfolio['sold'].loc[0, ['sell_price', 'trade_notes']] = [2.0, 'Filled'] # like retry_exchange_trade_error_or_paper_orders_in_portfolio
+    crypto.save_portfolio_backup(portfolio)
+    saved = _saved(portfolio)
+    assert saved['sold'].loc[0, 'sell_price'] == 2.0 and saved['sold'].loc[0, 'trade_notes'] == 'Filled'
+    pd.testing.assert_frame_equal(saved['sold'], portfolio['sold'], check_dtype=False)
+
+def test_appended_sold_rows_are_journaled(data_dir):
+    portfolio = new_portfolio(datetime(2024, 1, 1))
+    crypto.save_portfolio_backup(portfolio)
+    for idx in range(3):
+        portfolio['sold'].loc[idx] = ['coin-' + str(idx)] + sold_row
+        crypto.save_portfolio_backup(portfolio)
+    state = next(iter(crypto.portfolio_journal['state'].values()))
+    assert state['records'] == 3 # no snapshot needed for appends
+    pd.testing.assert_frame_equal(_saved(portfolio)['sold'], portfolio['sold'], check_dtype=False)
@@ -0,0 +1,65 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import new_portfolio
+
+def portfolio_calculate_roi_loop(portfolio, open_positions=True, sold_positions=False, avoid_paper_positions=False): # portfolio_calculate_roi before the running aggregates
+    value_of_current_investments, value_of_sold_investments, cost_of_investments = 0, 0, 0
+    if open_positions:
+        for coin in portfolio['open'].index:
+            if avoid_paper_positions and (portfolio['open'].loc[coin, 'position'] == 'long-p'):
+                continue
+            current_price_in_btc, buy_price_in_btc, balance = portfolio['open'].loc[coin, ['current_price(btc)', 'buy_price(btc)', 'balance']]
+            value_of_current_investments += current_price_in_btc*balance
+            cost_of_investments += buy_price_in_btc*balance
+    if sold_positions:
+        for idx in portfolio['sold'].index:
+            if avoid_paper_positions and (portfolio['sold'].loc[idx, 'position'] == 'long-p'):
+                continue
+            sell_price_in_btc, buy_price_in_btc, balance = portfolio['sold'].loc[idx, ['sell_price(btc)', 'buy_price(btc)', 'balance']]
+            value_of_sold_investments += sell_price_in_btc*balance
+            cost_of_investments += buy_price_in_btc*balance
+    if cost_of_investments:
+        return (value_of_current_investments + value_of_sold_investments - cost_of_investments) / cost_of_investments
+    else:
+        return float("NaN")
+
+def _assert_rois_equal(portfolio):
+    for open_positions, sold_positions in [(True, False), (False, True), (True, True)]:
+        for avoid_paper_positions in [False, True]:
+            roi, roi_loop = crypto.portfolio_calculate_roi(portfolio, open_positions=open_positions, sold_positions=sold_positions, avoid_paper_positions=avoid_paper_positions), portfolio_calculate_roi_loop(portfolio, open_positions=open_positions, sold_positions=sold_positions, avoid_paper_positions=avoid_paper_positions)
+            assert (roi == roi_loop) or (np.isnan(roi) and np.isnan(roi_loop)) # exactly, not approximately
+
+def _sell(portfolio, rng, n):
+    with crypto._portfolio_book(portfolio):
+        for _ in range(n):
+            buy_price_in_btc, balance = 10**rng.uniform(-8, -2), float(rng.integers(1, 10000))
+            portfolio['sold_ledger'].append(['coin', 'sym', 'long-p' if rng.random() < 0.3 else 'long', pd.Timestamp('2024-01-01'), 1.0, buy_price_in_btc, balance, pd.Timestamp('2024-01-05'), 1.0, buy_price_in_btc*rng.uniform(0.5, 2), 0.0, 1e6, 0.0, 20.0, float("NaN"), 'Filled', None])
+
+def test_running_aggregates_match_row_loop():
+    rng = np.random.default_rng(0)
+    portfolio = new_portfolio(datetime(2024, 1, 1))
+    portfolio['open'].loc['coin-0'] = ['aaa', 'long', pd.Timestamp('2024-01-01'), 1.0, 0.0001, 10.0, pd.Timestamp('2024-01-02'), 0.00011, 0.1, 1e6, 0.0, 20.0, False, float("NaN"), 'Filled', None]
+    portfolio['open'].loc['coin-1'] = ['bbb', 'long-p', pd.Timestamp('2024-01-01'), 1.0, 0.003, 7.0, pd.Timestamp('2024-01-02'), 0.0029, -0.03, 1e6, 0.0, 20.0, False, float("NaN"), 'Filled', None]
+    _assert_rois_equal(portfolio)
+    rebuilds = crypto.portfolio_metrics['stats']['rebuilds']
+    for n in [3, 40, 1, 5, 16, 2]: # in place (< sold_ledger_concat_min) and concat appends
+        _sell(portfolio, rng, n)
+        _assert_rois_equal(portfolio)
+    assert crypto.portfolio_metrics['stats']['rebuilds'] == rebuilds # every sale folded in as the ledger was appended
+    crypto._portfolio_sold_aggregates_invalidate(portfolio['sold']) # like the retry functions
+    portfolio['sold'].loc[5, ['sell_price(btc)', 'balance']] = [0.5, 3.0]
+    _assert_rois_equal(portfolio)
+    assert crypto.portfolio_metrics['stats']['rebuilds'] == rebuilds + 1
+
+def test_new_sold_frame_not_confused_with_freed_one():
+    rng = np.random.default_rng(1)
+    for _ in range(20): # freed frames' ids get reused
+        portfolio = new_portfolio(datetime(2024, 1, 1))
+        _sell(portfolio, rng, int(rng.integers(1, 30)))
+        _assert_rois_equal(portfolio)
+        portfolio['sold'] = portfolio['sold'].copy() # new frame, same rows
+        _assert_rois_equal(portfolio)
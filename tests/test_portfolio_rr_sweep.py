@@ -0,0 +1,60 @@
+import contextlib
+import copy
+import io
+from multiprocessing import shared_memory
+
+import pandas as pd
+import pytest
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import generate_market, new_portfolio
+
+param_grid = {'up_down_move': [10, 50], 'sl': [-0.3, -0.15]}
+
+@pytest.fixture
+def market(data_dir, monkeypatch):
+    market = generate_market(40, 30, seed=0)
+    monkeypatch.setattr(crypto, 'get_kucoin_pairs', lambda: market['kucoin_pairs']) # sweep fetches tickers once
+    return market
+
+@pytest.fixture
+def shm_names(monkeypatch):
+    names = []
+    class RecordingSharedMemory(shared_memory.SharedMemory):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            if kwargs.get('create'):
+                names.append(self.name)
+    monkeypatch.setattr(shared_memory, 'SharedMemory', RecordingSharedMemory)
+    return names
+
+def _unlinked(name):
+    try:
+        shared_memory.SharedMemory(name=name).close()
+    except FileNotFoundError:
+        return True
+    return False
+
+def test_sweep_matches_individual_backtests(market, shm_names):
+    portfolio = new_portfolio(market['start_day'])
+    with contextlib.redirect_stdout(io.StringIO()): # module prints every trade
+        results = crypto.run_portfolio_rr_sweep(portfolio, param_grid, start_day=market['start_day'], end_day=market['end_day'], processes=2)
+        expected = []
+        for up_down_move in param_grid['up_down_move']:
+            for sl in param_grid['sl']:
+                portfolio_combination = copy.deepcopy(portfolio)
+                portfolio_combination['constants'].update({'up_down_move': up_down_move, 'sl': sl})
+                portfolio_combination = crypto.run_portfolio_rr_backtest(portfolio_combination, start_day=market['start_day'], end_day=market['end_day'], kucoin_pairs_with_price_and_vol_current=market['kucoin_pairs'])
+                metrics, trade_stats = crypto.get_portfolio_metrics(portfolio_combination), crypto.get_portfolio_trade_stats(portfolio_combination)
+                expected.append({'up_down_move': up_down_move, 'sl': sl, **{key: metrics[key] for key in ['roi(btc)', 'open_roi(btc)', 'sold_roi(btc)', 'open_trades', 'sold_trades']}, **{key: trade_stats[key] for key in ['sold_by_sl', 'sold_by_tsl', 'win_rate', 'max_drawdown']}, 'balance': portfolio_combination['balance']['usdt']})
+    assert results['sold_trades'].sum() > 0
+    pd.testing.assert_frame_equal(results.drop(columns=['execution_time']), pd.DataFrame(expected))
+    assert len(shm_names) == 2 and all(_unlinked(name) for name in shm_names) # ranks and positions
+
+def test_sweep_unlinks_shared_memory_on_error(market, shm_names, monkeypatch):
+    def as_completed(futures):
+        raise RuntimeError("Mock sweep error")
+    monkeypatch.setattr(crypto, 'as_completed', as_completed)
+    with pytest.raises(RuntimeError, match="Mock sweep error"), contextlib.redirect_stdout(io.StringIO()):
+        crypto.run_portfolio_rr_sweep(new_portfolio(market['start_day']), param_grid, start_day=market['start_day'], end_day=market['end_day'], processes=2)
+    assert len(shm_names) == 2 and all(_unlinked(name) for name in shm_names)
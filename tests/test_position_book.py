@@ -0,0 +1,40 @@
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import new_portfolio
+
+open_row = ['aaa', 'long', pd.Timestamp('2024-01-01'), 1.0, 0.0001, 10.0, pd.Timestamp('2024-01-02'), 0.00011, 0.1, 1e6, 0.0, 20.0, False, float("NaN"), 'Filled', None]
+sold_row = ['coin-0', 'aaa', 'long', pd.Timestamp('2024-01-01'), 1.0, 0.0001, 10.0, pd.Timestamp('2024-01-05'), 1.2, 0.00012, 0.2, 1e6, 0.0, 20.0, float("NaN"), 'Filled', None]
+
+def test_book_converted_back_when_block_raises(monkeypatch):
+    portfolio = new_portfolio(datetime(2024, 1, 1))
+    portfolio['open'].loc['coin-0'] = open_row
+    def kucoin_trade_coins_usdt(orders, **params):
+        raise RuntimeError("order failed")
+    monkeypatch.setattr(crypto, 'kucoin_trade_coins_usdt', kucoin_trade_coins_usdt)
+    with pytest.raises(RuntimeError):
+        crypto.portfolio_panic_sell(portfolio, df_matching_open_positions=portfolio['open'])
+    assert isinstance(portfolio['open'], pd.DataFrame) and ('sold_ledger' not in portfolio)
+    assert list(portfolio['open'].index) == ['coin-0']
+
+def test_nested_book_blocks_convert_once():
+    portfolio = new_portfolio(datetime(2024, 1, 1))
+    with crypto._portfolio_book(portfolio):
+        with crypto._portfolio_book(portfolio): # i.e. update_portfolio_buy_and_sell_coins inside run_portfolio_rr
+            portfolio['sold_ledger'].append(sold_row)
+        assert isinstance(portfolio['open'], crypto.PositionBook) and len(portfolio['sold_ledger']) == 1
+    assert len(portfolio['sold']) == 1
+
+@pytest.mark.parametrize('rows', [2, crypto.sold_ledger_concat_min + 1]) # written in place / concatenated
+def test_sold_ledger_appended_after_existing_rows(rows):
+    portfolio = new_portfolio(datetime(2024, 1, 1))
+    portfolio['sold'].loc[0] = sold_row
+    with crypto._portfolio_book(portfolio):
+        for idx in range(rows):
+            portfolio['sold_ledger'].append(['coin-' + str(idx + 1)] + sold_row[1:])
+    assert list(portfolio['sold'].index) == list(range(rows + 1))
+    assert list(portfolio['sold']['coin']) == ['coin-' + str(idx) for idx in range(rows + 1)]
+    assert portfolio['sold']['sell_price'].dtype == 'float64'
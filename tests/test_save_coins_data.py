@@ -0,0 +1,69 @@
+import json
+import re
+
+import pandas as pd
+import pytest
+import requests
+
+from speterlin_crypto import module1 as crypto
+
+pages, coins_per_page = 2, 60
+failed_coins = {'coin-7': ValueError("Mock coin page error"), 'coin-65': requests.exceptions.ConnectionError("Mock connection error")} # coin-100 page has no statistics
+
+@pytest.fixture
+def replay(data_dir, monkeypatch):
+    saved = dict(crypto.offline)
+    crypto.set_offline_mode('record', path=str(data_dir / 'recordings.sqlite'), clear=True)
+    monkeypatch.setattr(crypto, '_http_request_live', _coinmarketcap_live)
+    for url in ['https://www.coinmarketcap.com/?page=' + str(page) for page in range(1, pages + 1)] + ['https://www.coinmarketcap.com/currencies/coin-' + str(rank) for rank in range(1, pages*coins_per_page + 1)]:
+        try:
+            crypto._http_request(url)
+        except Exception: # recorded, replays as an error
+            pass
+    monkeypatch.setattr(crypto, '_http_request_live', lambda url, **kwargs: pytest.fail("network call while replaying: " + url))
+    yield lambda: crypto.set_offline_mode('replay', latency=[0, 0.005], seed=0) # shuffles concurrent completion order, cursors reset for each run
+    if crypto.offline['db'] is not None:
+        crypto.offline['db'].close()
+    crypto.offline.clear()
+    crypto.offline.update(saved)
+
+def _page(page_props):
+    response = requests.models.Response()
+    response.status_code, response.encoding = 200, 'utf-8'
+    response._content = ('<html><script id="__NEXT_DATA__" type="application/json">' + json.dumps({'props': {'pageProps': page_props}}) + '</script></html>').encode()
+    return response
+
+def _coinmarketcap_live(url, method='GET', headers=None, **kwargs):
+    page = re.search(r'\?page=(\d+)$', url)
+    if page:
+        ranks = range((int(page.group(1)) - 1)*coins_per_page + 1, int(page.group(1))*coins_per_page + 1)
+        return _page({'initialState': json.dumps({'cryptocurrency': {'listingLatest': {'data': [{'keysArr': ['slug', 'symbol', 'cmcRank', 'circulatingSupply', 'quote.USD.price', 'quote.USD.marketCap', 'quote.USD.volume24h']}] + [['coin-' + str(rank), 'C' + str(rank), rank, 1e6, 1000.0/rank, 1e9/rank, 1e7/rank] for rank in ranks]}}})})
+    coin = url.split('/currencies/')[-1]
+    if coin in failed_coins:
+        raise failed_coins[coin]
+    if coin == 'coin-100':
+        return _page({'detailRes': {'detail': {}}})
+    rank = int(coin.split('-')[-1])
+    return _page({'detailRes': {'detail': {'statistics': {'price': 1001.0/rank, 'marketCap': 1.01e9/rank, 'volume24h': 2e7/rank, 'fullyDilutedMarketCap': 2e9/rank, 'circulatingSupply': 1e6, 'totalSupply': 2e6, 'maxSupply': None}}}})
+
+def test_concurrent_matches_serial(replay, capsys):
+    replay()
+    df_serial = crypto.save_coins_data('2024-01-01', pages=pages)
+    replay()
+    df_concurrent = crypto.save_coins_data('2024-01-02', pages=pages, concurrent=True, max_workers=8)
+    pd.testing.assert_frame_equal(df_concurrent, df_serial)
+    assert list(df_serial.index) == ['coin-' + str(rank) for rank in range(1, pages*coins_per_page + 1)] # market cap rank order
+    assert list(df_serial["Market Cap Rank"]) == list(range(1, pages*coins_per_page + 1))
+    assert df_serial.loc['coin-2', "Market Cap"] == 1.01e9/2 # coin page
+    assert df_serial.loc['coin-7', "Market Cap"] == 1e9/7 # listing fallback
+    pd.testing.assert_frame_equal(crypto.get_saved_coins_data('2024-01-02'), df_serial, check_names=False)
+
+def test_concurrent_counts_fetch_errors(replay, capsys):
+    replay()
+    crypto.save_coins_data('2024-01-01', pages=pages, concurrent=True)
+    output = capsys.readouterr().out
+    assert "save_coins_data progress: " + str(pages*coins_per_page) + "/" + str(pages*coins_per_page) + " coins, 3 errors" in output
+    assert sorted(re.findall(r'Error retrieving initial coin data for: (\S+)', output)) == sorted(['coin-100', *failed_coins])
+    assert output.count("Mock connection error") == 2 # retried once
+    stats = crypto.get_offline_stats().set_index('provider').loc['www.coinmarketcap.com']
+    assert (stats['replayed'], stats['missing']) == (pages + pages*coins_per_page + 1, 0)
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+import math
+
+import numpy as np
+import pytest
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import generate_market
+
+def baseline_sl_tsl_exit(prices_in_btc, buy_price_in_btc, sl, tsl_a, tsl_p, tsl_armed=False, tsl_max_price_in_btc=float("NaN")): # tick loop update_portfolio_postions_back_testing used before get_sl_tsl_exit
+    for idx, price_in_btc in enumerate(prices_in_btc):
+        price_in_btc_change = (price_in_btc - buy_price_in_btc) / buy_price_in_btc
+        if not tsl_armed and price_in_btc_change >= tsl_a:
+            tsl_armed, tsl_max_price_in_btc = True, price_in_btc
+        if tsl_armed:
+            if price_in_btc > tsl_max_price_in_btc:
+                tsl_max_price_in_btc = price_in_btc
+            if (price_in_btc - tsl_max_price_in_btc) / tsl_max_price_in_btc <= tsl_p:
+                return [idx, 'Sell by TSL', tsl_armed, tsl_max_price_in_btc]
+        elif price_in_btc_change <= sl:
+            return [idx, 'Sell by SL', tsl_armed, tsl_max_price_in_btc]
+    return [None, None, tsl_armed, tsl_max_price_in_btc]
+
+def assert_same_exit(prices_in_btc, buy_price_in_btc, sl, tsl_a, tsl_p, tsl_armed=False, tsl_max_price_in_btc=float("NaN")):
+    expected = baseline_sl_tsl_exit(list(prices_in_btc), buy_price_in_btc, sl, tsl_a, tsl_p, tsl_armed, tsl_max_price_in_btc)
+    exit_idx, reason, armed, max_price_in_btc = crypto.get_sl_tsl_exit(prices_in_btc, buy_price_in_btc, sl, tsl_a, tsl_p, tsl_armed, tsl_max_price_in_btc)
+    assert [exit_idx, reason, armed] == expected[:3]
+    if exit_idx is not None:
+        assert prices_in_btc[exit_idx] == prices_in_btc[expected[0]] or (math.isnan(prices_in_btc[exit_idx]) and math.isnan(prices_in_btc[expected[0]]))
+    assert (max_price_in_btc == expected[3]) or (math.isnan(max_price_in_btc) and math.isnan(expected[3]))
+    return exit_idx, reason
+
+def test_recorded_granular_paths(data_dir):
+    market = generate_market(n_coins=20, days=10, seed=1)
+    exits = set()
+    for coin in market['coins']:
+        prices_in_btc = np.array(crypto.get_coin_data_granular(coin, datetime.timestamp(market['start_day']), datetime.timestamp(market['end_day']))['prices'])[:, 1]
+        for day in range(0, len(prices_in_btc) - 24, 24): # a position bought each day and held to the end of the path
+            for sl, tsl_a, tsl_p in [(-0.1, 0.1, -0.05), (-0.3, 0.5, -0.1), (-0.05, 0.02, -0.01)]:
+                exits.add(assert_same_exit(prices_in_btc[day:], prices_in_btc[day], sl, tsl_a, tsl_p)[1])
+    assert exits == {None, 'Sell by SL', 'Sell by TSL'}
+
+@pytest.mark.parametrize('seed', range(200))
+def test_random_paths_with_nan_ticks(seed):
+    rng = np.random.default_rng(seed)
+    prices_in_btc = np.exp(np.cumsum(rng.normal(scale=0.05, size=rng.integers(1, 60))))
+    prices_in_btc[rng.random(len(prices_in_btc)) < 0.15] = float("NaN")
+    tsl_armed = bool(rng.random() < 0.3)
+    tsl_max_price_in_btc = float("NaN") if not tsl_armed or rng.random() < 0.2 else float(rng.uniform(0.9, 1.3))
+    assert_same_exit(prices_in_btc, 1.0, -0.2, 0.15, -0.1, tsl_armed, tsl_max_price_in_btc)
+
+@pytest.mark.parametrize('prices_in_btc, expected', [
+    ([1.0, 0.75, 0.5], (1, 'Sell by SL')), # change exactly sl
+    ([1.0, 1.5, 1.25], (None, None)), # arms exactly at tsl_a, drawdown above tsl_p
+    ([1.5, 2.0, 1.5], (2, 'Sell by TSL')), # drawdown exactly tsl_p from max
+    ([float("NaN"), 0.75], (1, 'Sell by SL')),
+    ([1.5, float("NaN"), 1.5], (None, None)), # NaN tick doesn't arm, raise max or exit
+    ([0.75, 1.5], (0, 'Sell by SL')), # SL before the arm tick
+])
+def test_exact_boundary_prices(prices_in_btc, expected):
+    assert assert_same_exit(np.array(prices_in_btc), 1.0, -0.25, 0.5, -0.25) == expected
+
+def test_tsl_arms_and_exits_on_same_tick():
+    assert assert_same_exit(np.array([1.0, 1.6, 1.7]), 1.0, -0.25, 0.5, 0.0) == (1, 'Sell by TSL') # tsl_p 0 exits on the arm tick (drawdown 0)
+    assert assert_same_exit(np.array([0.9, 1.5, 1.6]), 1.0, -0.25, 0.5, 0.1) == (1, 'Sell by TSL') # positive tsl_p exits on the arm tick too
+    assert assert_same_exit(np.array([1.6, 1.5]), 1.0, -0.25, 0.5, 0.0, True, 1.6) == (0, 'Sell by TSL') # already armed
@@ -0,0 +1,43 @@
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+from speterlin_crypto import module1 as crypto
+from synthetic_market import new_portfolio
+
+pytest.importorskip('websockets')
+
+open_row = ['aaa', 'long', pd.Timestamp('2024-01-01'), 5.0, 0.0001, 10.0, pd.Timestamp('2024-01-02'), 0.0001, 0.0, 1e6, 0.0, 20.0, False, float("NaN"), 'Filled', None]
+
+def test_sells_run_off_the_event_loop(monkeypatch):
+    monkeypatch.setitem(crypto.kucoin_pairs_snapshot, 'data', {'BTC-USDT': {'price': 50000.0, '24h_volume': 1e9}})
+    monkeypatch.setitem(crypto.kucoin_pairs_snapshot, 'time', time.time())
+    sells = []
+    def kucoin_trade_coin_usdt(symbol_pair, coin, quantity=None, price=None, price_in_btc=None, **params):
+        import asyncio
+        try:
+            asyncio.get_running_loop()
+            on_event_loop = True
+        except RuntimeError:
+            on_event_loop = False
+        sells.append([symbol_pair, price, on_event_loop, threading.current_thread().name])
+        time.sleep(0.2) # blocking order
+        return [quantity, price, price_in_btc, {}, [], "Filled"]
+    monkeypatch.setattr(crypto, 'kucoin_trade_coin_usdt', kucoin_trade_coin_usdt)
+    portfolio = new_portfolio(datetime(2024, 1, 1))
+    portfolio['open'].loc['coin-a'] = open_row
+    portfolio['open'].loc['coin-b'] = ['bbb'] + open_row[1:]
+    tick_time = int(time.time()*1000)
+    ticks = [[tick_time, 'BTC-USDT', 50000.0], [tick_time + 1, 'AAA-USDT', 8.0], [tick_time + 2, 'BBB-USDT', 5.5], [tick_time + 3, 'AAA-USDT', 6.0], [tick_time + 4, 'BBB-USDT', 3.0]] # aaa arms TSL (+60%) then drops 25% (TSL), bbb drops 40% (SL)
+    ws_url, stop = crypto.start_kucoin_ticker_replay_server(ticks, speed=0)
+    try:
+        portfolio, streamed = crypto.portfolio_stream_sl_tsl(portfolio, stop_time=time.time() + 10, ws_url=ws_url)
+    finally:
+        stop()
+    assert streamed
+    assert [[symbol_pair, price, on_event_loop] for symbol_pair, price, on_event_loop, thread_name in sells] == [['AAA-USDT', 6.0, False], ['BBB-USDT', 3.0, False]]
+    assert list(portfolio['sold']['other_notes']) == ['Sell by TSL', 'Sell by SL']
+    assert portfolio['open'].empty and isinstance(portfolio['open'], pd.DataFrame)